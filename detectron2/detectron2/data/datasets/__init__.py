@@ -1,4 +1,5 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
+from .annotation_cache import get_annotation_cache_dir, load_cached_dataset_dicts
 from .coco import load_coco_json, load_sem_seg, register_coco_instances, convert_to_coco_json
 from .coco_panoptic import register_coco_panoptic, register_coco_panoptic_separated
 from .lvis import load_lvis_json, register_lvis_instances, get_lvis_instances_meta
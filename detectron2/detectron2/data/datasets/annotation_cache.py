@@ -0,0 +1,103 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+A persistent cache of the dataset dicts produced by the annotation loaders, so that the annotation files
+are parsed once and not by every process that loads the dataset.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from fvcore.common.timer import Timer
+
+from .. import MetadataCatalog
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["get_annotation_cache_dir", "load_cached_dataset_dicts"]
+
+# bump to invalidate the cached files when the loaders or the format change
+_CACHE_VERSION = 1
+
+
+def get_annotation_cache_dir():
+    """
+    Returns:
+        str: the cache directory, given by the environment variable DETECTRON2_ANNOTATION_CACHE.
+        The cache is disabled if it is unset or empty. The cached files are unpickled, the directory
+        must only be writable by trusted users.
+    """
+    return os.path.expanduser(os.getenv("DETECTRON2_ANNOTATION_CACHE", ""))
+
+
+def _cache_path(directory, loader_name, annotation_file, args):
+    stat = os.stat(annotation_file)
+    key = repr(
+        (
+            _CACHE_VERSION,
+            loader_name,
+            os.path.abspath(annotation_file),
+            stat.st_mtime_ns,
+            stat.st_size,
+            args,
+        )
+    )
+    return os.path.join(directory, hashlib.sha1(key.encode()).hexdigest() + ".pkl")
+
+
+def load_cached_dataset_dicts(
+    loader_name, annotation_file, args, load, dataset_name=None, metadata_keys=()
+):
+    """
+    Returns the dataset dicts of `load()`, cached in :func:`get_annotation_cache_dir` under a key of
+    the loader, the path, modification time and size of the annotation file and the loader arguments.
+    The dicts are stored pickled with the highest protocol.
+
+    Args:
+        loader_name (str): name of the loader, part of the key
+        annotation_file (str): local path of the annotation file parsed by `load`
+        args (tuple): the other arguments of the loader, part of the key. Their repr must identify them.
+        load (callable): the loader, returns list[dict]
+        dataset_name (str or None): a dataset whose metadata is set by `load`
+        metadata_keys (tuple[str]): the metadata of `dataset_name` set by `load`. They are cached with
+            the dicts and set again when the dicts are read from the cache.
+
+    Returns:
+        list[dict]
+    """
+    directory = get_annotation_cache_dir()
+    if not directory or not os.path.isfile(annotation_file):
+        return load()
+    path = _cache_path(directory, loader_name, annotation_file, args)
+    if os.path.isfile(path):
+        timer = Timer()
+        try:
+            with open(path, "rb") as f:
+                dataset_dicts, metadata = pickle.load(f)
+        except Exception as e:
+            logger.warning("Cannot read the cached annotations {}: {}".format(path, e))
+        else:
+            if dataset_name is not None and metadata:
+                MetadataCatalog.get(dataset_name).set(**metadata)
+            logger.info(
+                "Loaded {} cached dataset dicts of {} in {:.2f} seconds.".format(
+                    len(dataset_dicts), annotation_file, timer.seconds()
+                )
+            )
+            return dataset_dicts
+
+    dataset_dicts = load()
+    metadata = {}
+    if dataset_name is not None:
+        meta = MetadataCatalog.get(dataset_name)
+        metadata = {k: getattr(meta, k) for k in metadata_keys if hasattr(meta, k)}
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # written to a temporary file and renamed, so that concurrent processes never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((dataset_dicts, metadata), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Cannot cache the annotations of {}: {}".format(annotation_file, e))
+    return dataset_dicts
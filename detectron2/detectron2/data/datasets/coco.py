@@ -16,6 +16,7 @@ from detectron2.structures import Boxes, BoxMode, PolygonMasks, RotatedBoxes
 from detectron2.utils.file_io import PathManager
 
 from .. import DatasetCatalog, MetadataCatalog
+from .annotation_cache import load_cached_dataset_dicts
 
 """
 This file contains functions to parse COCO-format annotations into dicts in "Detectron2 format".
@@ -65,7 +66,21 @@ def load_coco_json(json_file, image_root, dataset_name=None, extra_annotation_ke
     Notes:
         1. This function does not read the image files.
            The results do not have the "image" field.
+        2. The results are cached on disk if $DETECTRON2_ANNOTATION_CACHE is set,
+           see :func:`load_cached_dataset_dicts`.
     """
+    local_file = PathManager.get_local_path(json_file)
+    return load_cached_dataset_dicts(
+        "load_coco_json",
+        local_file,
+        (image_root, dataset_name, extra_annotation_keys),
+        lambda: _load_coco_json(json_file, image_root, dataset_name, extra_annotation_keys),
+        dataset_name=dataset_name,
+        metadata_keys=("thing_classes", "thing_dataset_id_to_contiguous_id"),
+    )
+
+
+def _load_coco_json(json_file, image_root, dataset_name=None, extra_annotation_keys=None):
     from pycocotools.coco import COCO
 
     timer = Timer()
@@ -5,6 +5,7 @@
 Common data processing utilities that are used in a
 typical object detection data pipeline.
 """
+import contextlib
 import logging
 import numpy as np
 from typing import List, Union
@@ -163,22 +164,53 @@ def _apply_exif_orientation(image):
     return image
 
 
-def read_image(file_name, format=None):
+def _draft_image(image, target_size, format=None):
+    """
+    Configure a JPEG image to be decoded at the largest power-of-two reduction (1/2, 1/4 or 1/8,
+    DCT-domain scaling) at which it is still at least of `target_size`. No-op for other formats.
+
+    Args:
+        image (PIL.Image): an image that is not loaded yet
+        target_size (tuple[int, int]): (h, w), after the exif orientation
+    """
+    h, w = target_size
+    try:
+        orientation = image.getexif().get(_EXIF_ORIENT)
+    except Exception:  # https://github.com/facebookresearch/detectron2/issues/1885
+        orientation = None
+    if orientation in (5, 6, 7, 8):
+        # transposed by the orientation, the file has the other aspect
+        h, w = w, h
+    # the luma of a color JPEG is its "L" conversion (up to rounding), skip decoding the chroma
+    image.draft("L" if format == "L" else None, (max(int(w), 1), max(int(h), 1)))
+
+
+def read_image(file_name, format=None, target_size=None):
     """
     Read an image into the given format.
     Will apply rotation and flipping if the image has such exif information.
 
     Args:
-        file_name (str): image file path
+        file_name (str or file): image file path, or a binary file object
         format (str): one of the supported image modes in PIL, or "BGR" or "YUV-BT.601".
+        target_size (tuple[int, int] or None): (h, w) hint of the size the image will be
+            downscaled to. If given, a JPEG image is decoded at the largest power-of-two reduction
+            of its size that is at least `target_size`, and the returned image is smaller than the
+            file, e.g. ceil(H / 4) x ceil(W / 4).
 
     Returns:
         image (np.ndarray):
             an HWC image in the given format, which is 0-255, uint8 for
             supported image modes in PIL or "BGR"; float (0-1 for Y) for YUV-BT.601.
     """
-    with PathManager.open(file_name, "rb") as f:
+    if hasattr(file_name, "read"):
+        file = contextlib.nullcontext(file_name)
+    else:
+        file = PathManager.open(file_name, "rb")
+    with file as f:
         image = Image.open(f)
+        if target_size is not None:
+            _draft_image(image, target_size, format)
 
         # work around this bug: https://github.com/python-pillow/Pillow/issues/3973
         image = _apply_exif_orientation(image)
@@ -414,16 +414,21 @@ def instances_to_coco_json(instances, img_id):
     if has_mask:
         # use RLE to encode the masks, because they are too large and takes memory
         # since this evaluator stores outputs of the entire dataset
-        rles = [
-            mask_util.encode(np.array(mask[:, :, None], order="F", dtype="uint8"))[0]
-            for mask in instances.pred_masks
-        ]
+        if hasattr(instances.pred_masks, "to_rles"):
+            # compact mask structures (e.g. CroppedBitMasks) encode without densifying
+            rles = instances.pred_masks.to_rles()
+        else:
+            rles = [
+                mask_util.encode(np.array(mask[:, :, None], order="F", dtype="uint8"))[0]
+                for mask in instances.pred_masks
+            ]
         for rle in rles:
             # "counts" is an array encoded by mask_util as a byte-stream. Python3's
             # json writer which always produces strings cannot serialize a bytestream
             # unless you decode it. Thankfully, utf-8 works out (which is also what
             # the pycocotools/_mask.pyx does).
-            rle["counts"] = rle["counts"].decode("utf-8")
+            if isinstance(rle["counts"], bytes):
+                rle["counts"] = rle["counts"].decode("utf-8")
 
     has_keypoints = instances.has("pred_keypoints")
     if has_keypoints:
@@ -4,7 +4,14 @@ from .image_list import ImageList
 
 from .instances import Instances
 from .keypoints import Keypoints, heatmaps_to_keypoints
-from .masks import BitMasks, PolygonMasks, polygons_to_bitmask, ROIMasks
+from .masks import (
+    BitMasks,
+    CroppedBitMasks,
+    PolygonMasks,
+    RLEMasks,
+    polygons_to_bitmask,
+    ROIMasks,
+)
 from .rotated_boxes import RotatedBoxes
 from .rotated_boxes import pairwise_iou as pairwise_iou_rotated
 
@@ -532,3 +532,226 @@ class ROIMasks:
             paste_func = retry_if_cuda_oom(paste_masks_in_image)
         bitmasks = paste_func(self.tensor, boxes.tensor, (height, width), threshold=threshold)
         return BitMasks(bitmasks)
+
+
+class CroppedBitMasks:
+    """
+    Binary masks of N instances in an image of size (H, W). Each mask is stored as
+    a bitmap cropped to its bounding box, together with the (x0, y0) offset of the crop.
+    This is much smaller than a dense (N, H, W) tensor when the instances are small.
+
+    Attributes:
+        crops (list[Tensor]): N bool tensors of shape (h_i, w_i).
+        offsets (Tensor): (N, 2) int64 tensor on CPU of (x0, y0) for each crop.
+        image_size (tuple[int, int]): (H, W) of the full image.
+    """
+
+    def __init__(self, crops: List[torch.Tensor], offsets: torch.Tensor, image_size):
+        assert len(crops) == len(offsets), (len(crops), len(offsets))
+        self.crops = crops
+        self.offsets = torch.as_tensor(offsets, dtype=torch.int64, device="cpu").view(-1, 2)
+        self.image_size = (int(image_size[0]), int(image_size[1]))
+
+    @staticmethod
+    def from_bitmasks(masks: Union[torch.Tensor, BitMasks]) -> "CroppedBitMasks":
+        """
+        Args:
+            masks: (N, H, W) tensor or :class:`BitMasks`; nonzero elements are foreground.
+        """
+        if isinstance(masks, BitMasks):
+            masks = masks.tensor
+        masks = masks.bool()
+        N, H, W = masks.shape
+        rows = masks.any(dim=2)
+        cols = masks.any(dim=1)
+        ys = torch.arange(H, device=masks.device)
+        xs = torch.arange(W, device=masks.device)
+        y0 = torch.where(rows, ys, H).min(dim=1).values
+        y1 = torch.where(rows, ys, -1).max(dim=1).values + 1
+        x0 = torch.where(cols, xs, W).min(dim=1).values
+        x1 = torch.where(cols, xs, -1).max(dim=1).values + 1
+        # a single device-to-host copy for all boxes
+        bounds = torch.stack([x0, y0, x1, y1], dim=1).tolist()
+
+        crops = []
+        offsets = []
+        for i, (bx0, by0, bx1, by1) in enumerate(bounds):
+            if bx1 <= bx0:
+                crops.append(masks.new_zeros((0, 0)))
+                offsets.append((0, 0))
+            else:
+                # clone, so that the crop does not keep the full-size storage alive
+                crops.append(masks[i, by0:by1, bx0:bx1].clone())
+                offsets.append((bx0, by0))
+        return CroppedBitMasks(crops, torch.tensor(offsets, dtype=torch.int64).view(-1, 2), (H, W))
+
+    def to(self, *args: Any, **kwargs: Any) -> "CroppedBitMasks":
+        return CroppedBitMasks(
+            [c.to(*args, **kwargs) for c in self.crops], self.offsets, self.image_size
+        )
+
+    @property
+    def device(self) -> device:
+        return self.crops[0].device if len(self.crops) else torch.device("cpu")
+
+    @property
+    def nbytes(self) -> int:
+        return sum(c.numel() * c.element_size() for c in self.crops) + self.offsets.numel() * 8
+
+    def __len__(self) -> int:
+        return len(self.crops)
+
+    def _indices(self, item) -> List[int]:
+        if isinstance(item, int):
+            return [item]
+        if isinstance(item, slice):
+            return list(range(len(self)))[item]
+        item = torch.as_tensor(item, device="cpu")
+        if item.dtype == torch.bool:
+            item = item.nonzero().squeeze(1)
+        return item.view(-1).tolist()
+
+    def __getitem__(self, item) -> "CroppedBitMasks":
+        """
+        Returns:
+            CroppedBitMasks: Create a new :class:`CroppedBitMasks` by indexing
+            with an int, a slice, a bool vector or a vector of indices.
+        """
+        indices = self._indices(item)
+        return CroppedBitMasks(
+            [self.crops[i] for i in indices], self.offsets[indices], self.image_size
+        )
+
+    @torch.jit.unused
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + "(num_instances={})".format(len(self))
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Returns:
+            Tensor: bool tensor of shape (N, H, W).
+        """
+        H, W = self.image_size
+        dense = torch.zeros((len(self), H, W), dtype=torch.bool, device=self.device)
+        for i, (crop, (x0, y0)) in enumerate(zip(self.crops, self.offsets.tolist())):
+            h, w = crop.shape
+            dense[i, y0 : y0 + h, x0 : x0 + w] = crop
+        return dense
+
+    def to_rles(self) -> List[dict]:
+        """
+        Returns:
+            list[dict]: COCO run-length encoding of each mask at full image size.
+        """
+        H, W = self.image_size
+        # one full-size canvas is reused for all instances
+        canvas = np.zeros((H, W, 1), dtype=np.uint8, order="F")
+        rles = []
+        for crop, (x0, y0) in zip(self.crops, self.offsets.tolist()):
+            h, w = crop.shape
+            canvas[y0 : y0 + h, x0 : x0 + w, 0] = crop.cpu().numpy()
+            rles.append(mask_util.encode(canvas)[0])
+            canvas[y0 : y0 + h, x0 : x0 + w, 0] = 0
+        return rles
+
+    def get_bounding_boxes(self) -> Boxes:
+        """
+        Returns:
+            Boxes: tight bounding boxes around the masks, in XYXY_ABS format.
+        """
+        sizes = torch.tensor([c.shape[::-1] for c in self.crops], dtype=torch.float32).view(-1, 2)
+        x0y0 = self.offsets.to(torch.float32)
+        return Boxes(torch.cat([x0y0, x0y0 + sizes], dim=1))
+
+    @staticmethod
+    def cat(masks_list: List["CroppedBitMasks"]) -> "CroppedBitMasks":
+        assert len(masks_list) > 0
+        return CroppedBitMasks(
+            list(itertools.chain.from_iterable(m.crops for m in masks_list)),
+            torch.cat([m.offsets for m in masks_list]),
+            masks_list[0].image_size,
+        )
+
+
+class RLEMasks:
+    """
+    Binary masks stored as COCO run-length encodings. When built from
+    :class:`CroppedBitMasks`, the encoding is computed lazily the first time it is
+    needed, so that it runs on CPU after the masks have left the model.
+    """
+
+    def __init__(self, masks: Union[List[dict], CroppedBitMasks], image_size=None):
+        """
+        Args:
+            masks: a list of RLE dicts, or :class:`CroppedBitMasks` to encode lazily.
+            image_size (tuple[int, int]): (H, W). Required when `masks` is a list.
+        """
+        if isinstance(masks, CroppedBitMasks):
+            self._source = masks
+            self._rles = None
+            self.image_size = masks.image_size
+        else:
+            assert image_size is not None
+            self._source = None
+            self._rles = list(masks)
+            self.image_size = (int(image_size[0]), int(image_size[1]))
+
+    def to(self, *args: Any, **kwargs: Any) -> "RLEMasks":
+        if self._rles is None:
+            return RLEMasks(self._source.to(*args, **kwargs))
+        return self
+
+    @property
+    def nbytes(self) -> int:
+        if self._rles is None:
+            return self._source.nbytes
+        return sum(len(r["counts"]) for r in self._rles)
+
+    def __len__(self) -> int:
+        return len(self._source) if self._rles is None else len(self._rles)
+
+    def __getitem__(self, item) -> "RLEMasks":
+        if self._rles is None:
+            return RLEMasks(self._source[item])
+        indices = CroppedBitMasks._indices(self, item)
+        return RLEMasks([self._rles[i] for i in indices], self.image_size)
+
+    @torch.jit.unused
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + "(num_instances={})".format(len(self))
+
+    def to_rles(self) -> List[dict]:
+        """
+        Returns:
+            list[dict]: COCO run-length encoding of each mask. The dicts are copies and
+            can be modified by the caller.
+        """
+        if self._rles is None:
+            self._rles = self._source.to_rles()
+            self._source = None
+        return [dict(r) for r in self._rles]
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Returns:
+            Tensor: bool tensor of shape (N, H, W).
+        """
+        if self._rles is None:
+            return self._source.to_dense()
+        H, W = self.image_size
+        if len(self._rles) == 0:
+            return torch.zeros((0, H, W), dtype=torch.bool)
+        return torch.from_numpy(mask_util.decode(self._rles)).permute(2, 0, 1).bool()
+
+    def get_bounding_boxes(self) -> Boxes:
+        if self._rles is None:
+            return self._source.get_bounding_boxes()
+        boxes = torch.as_tensor(mask_util.toBbox(self._rles), dtype=torch.float32).view(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]
+        return Boxes(boxes)
+
+    @staticmethod
+    def cat(masks_list: List["RLEMasks"]) -> "RLEMasks":
+        assert len(masks_list) > 0
+        rles = list(itertools.chain.from_iterable(m.to_rles() for m in masks_list))
+        return RLEMasks(rles, masks_list[0].image_size)
@@ -14,7 +14,16 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg
 from PIL import Image
 
 from detectron2.data import MetadataCatalog
-from detectron2.structures import BitMasks, Boxes, BoxMode, Keypoints, PolygonMasks, RotatedBoxes
+from detectron2.structures import (
+    BitMasks,
+    Boxes,
+    BoxMode,
+    CroppedBitMasks,
+    Keypoints,
+    PolygonMasks,
+    RLEMasks,
+    RotatedBoxes,
+)
 from detectron2.utils.file_io import PathManager
 
 from .colormap import random_color
@@ -405,7 +414,11 @@ class Visualizer:
         keypoints = predictions.pred_keypoints if predictions.has("pred_keypoints") else None
 
         if predictions.has("pred_masks"):
-            masks = np.asarray(predictions.pred_masks)
+            masks = predictions.pred_masks
+            if isinstance(masks, (CroppedBitMasks, RLEMasks)):
+                masks = masks.to_rles()
+            else:
+                masks = np.asarray(masks)
             masks = [GenericMask(x, self.output.height, self.output.width) for x in masks]
         else:
             masks = None
@@ -426,9 +439,12 @@ class Visualizer:
             alpha = 0.5
 
         if self._instance_mode == ColorMode.IMAGE_BW:
+            pred_masks = predictions.pred_masks if predictions.has("pred_masks") else None
+            if isinstance(pred_masks, (CroppedBitMasks, RLEMasks)):
+                pred_masks = pred_masks.to_dense()
             self.output.reset_image(
                 self._create_grayscale_image(
-                    (predictions.pred_masks.any(dim=0) > 0).numpy()
+                    (pred_masks.any(dim=0) > 0).numpy()
                     if predictions.has("pred_masks")
                     else None
                 )
@@ -1238,6 +1254,8 @@ class Visualizer:
             m = m.polygons
         if isinstance(m, BitMasks):
             m = m.tensor.numpy()
+        if isinstance(m, (CroppedBitMasks, RLEMasks)):
+            m = m.to_rles()
         if isinstance(m, torch.Tensor):
             m = m.numpy()
         ret = []
@@ -0,0 +1,131 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from detectron2.data import MetadataCatalog
+from detectron2.data.datasets import annotation_cache
+from detectron2.data.datasets.annotation_cache import load_cached_dataset_dicts
+
+
+class CountingLoader:
+    """
+    Loads the dicts of a json file, and sets the metadata of a dataset like `load_coco_json`.
+    """
+
+    def __init__(self, json_file, dataset_name=None):
+        self.json_file = json_file
+        self.dataset_name = dataset_name
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        with open(self.json_file) as f:
+            dicts = json.load(f)
+        if self.dataset_name is not None:
+            MetadataCatalog.get(self.dataset_name).set(thing_classes=["a", "b"])
+        return dicts
+
+
+class TestAnnotationCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        self.json_file = os.path.join(self.tmpdir.name, "annotations.json")
+        self.write_annotations([{"file_name": "a.jpg", "image_id": 0}, {"file_name": "b.jpg", "image_id": 1}])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_annotations(self, dicts):
+        with open(self.json_file, "w") as f:
+            json.dump(dicts, f)
+
+    def load(self, loader, args=(), dataset_name=None):
+        return load_cached_dataset_dicts(
+            "test_loader",
+            self.json_file,
+            args,
+            loader,
+            dataset_name=dataset_name,
+            metadata_keys=("thing_classes",),
+        )
+
+    def cached_files(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_disabled_by_default(self):
+        loader = CountingLoader(self.json_file)
+        with mock.patch.dict(os.environ):
+            os.environ.pop("DETECTRON2_ANNOTATION_CACHE", None)
+            self.assertEqual(annotation_cache.get_annotation_cache_dir(), "")
+            for _ in range(2):
+                self.assertEqual(len(self.load(loader)), 2)
+            os.environ["DETECTRON2_ANNOTATION_CACHE"] = ""
+            self.load(loader)
+        self.assertEqual(loader.calls, 3)
+        self.assertEqual(self.cached_files(), [])
+
+    def test_miss_and_hit(self):
+        loader = CountingLoader(self.json_file, "test_annotation_cache")
+        with mock.patch.dict(os.environ, {"DETECTRON2_ANNOTATION_CACHE": self.cache_dir}):
+            dicts = self.load(loader, dataset_name="test_annotation_cache")
+            self.assertEqual(loader.calls, 1)
+            files = self.cached_files()
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].endswith(".pkl"))
+
+            # the metadata set by the loader is set again on a hit
+            MetadataCatalog.remove("test_annotation_cache")
+            cached = self.load(loader, dataset_name="test_annotation_cache")
+            self.assertEqual(loader.calls, 1)
+            self.assertEqual(cached, dicts)
+            self.assertEqual(MetadataCatalog.get("test_annotation_cache").thing_classes, ["a", "b"])
+        MetadataCatalog.remove("test_annotation_cache")
+
+    def test_invalidation(self):
+        loader = CountingLoader(self.json_file)
+        with mock.patch.dict(os.environ, {"DETECTRON2_ANNOTATION_CACHE": self.cache_dir}):
+            self.load(loader)
+            self.load(loader)
+            self.assertEqual(loader.calls, 1)
+
+            # other loader arguments
+            self.load(loader, args=("other",))
+            self.assertEqual(loader.calls, 2)
+
+            # a modified annotation file, of another size and modification time
+            self.write_annotations([{"file_name": "c.jpg", "image_id": 2}])
+            stat = os.stat(self.json_file)
+            os.utime(self.json_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            dicts = self.load(loader)
+            self.assertEqual(loader.calls, 3)
+            self.assertEqual(dicts, [{"file_name": "c.jpg", "image_id": 2}])
+
+            # another version of the cache format
+            with mock.patch.object(annotation_cache, "_CACHE_VERSION", annotation_cache._CACHE_VERSION + 1):
+                self.load(loader)
+            self.assertEqual(loader.calls, 4)
+        self.assertEqual(len(self.cached_files()), 4)
+
+    def test_corrupted_file(self):
+        loader = CountingLoader(self.json_file)
+        with mock.patch.dict(os.environ, {"DETECTRON2_ANNOTATION_CACHE": self.cache_dir}):
+            dicts = self.load(loader)
+            (name,) = self.cached_files()
+            with open(os.path.join(self.cache_dir, name), "wb") as f:
+                f.write(b"not a pickle")
+            # read again, and the cached file is replaced
+            self.assertEqual(self.load(loader), dicts)
+            self.assertEqual(loader.calls, 2)
+            self.assertEqual(self.load(loader), dicts)
+            self.assertEqual(loader.calls, 2)
+            self.assertEqual(self.cached_files(), [name])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,16 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
+import numpy as np
 import unittest
+import pycocotools.mask as mask_util
 import torch
 
-from detectron2.structures.masks import BitMasks, PolygonMasks, polygons_to_bitmask
+from detectron2.structures.masks import (
+    BitMasks,
+    CroppedBitMasks,
+    PolygonMasks,
+    RLEMasks,
+    polygons_to_bitmask,
+)
 
 
 class TestBitMask(unittest.TestCase):
@@ -49,5 +57,48 @@ class TestBitMask(unittest.TestCase):
         self.assertEqual(masks[torch.tensor([True, False, False])].tensor.shape, (1, 10, 10))
 
 
+class TestCroppedBitMasks(unittest.TestCase):
+    def _masks(self):
+        masks = torch.zeros(3, 20, 30, dtype=torch.bool)
+        masks[0, 2:5, 3:9] = True
+        masks[1, 10:20, 0:4] = True
+        masks[1, 12, 25] = True
+        return masks
+
+    def test_to_dense(self):
+        masks = self._masks()
+        cropped = CroppedBitMasks.from_bitmasks(masks)
+        self.assertEqual(len(cropped), 3)
+        self.assertTrue(torch.equal(cropped.to_dense(), masks))
+        self.assertLess(cropped.nbytes, masks.numel())
+
+    def test_get_bounding_boxes(self):
+        masks = self._masks()
+        box = CroppedBitMasks.from_bitmasks(masks).get_bounding_boxes().tensor
+        self.assertTrue(torch.equal(box, BitMasks(masks).get_bounding_boxes().tensor))
+
+    def test_getitem(self):
+        masks = self._masks()
+        cropped = CroppedBitMasks.from_bitmasks(masks)
+        self.assertTrue(torch.equal(cropped[1].to_dense(), masks[1:2]))
+        self.assertTrue(torch.equal(cropped[1:3].to_dense(), masks[1:3]))
+        keep = torch.tensor([True, False, True])
+        self.assertTrue(torch.equal(cropped[keep].to_dense(), masks[keep]))
+        self.assertTrue(torch.equal(cropped[torch.tensor([2, 0])].to_dense(), masks[[2, 0]]))
+
+    def test_rle(self):
+        masks = self._masks()
+        expected = mask_util.encode(np.asfortranarray(masks.permute(1, 2, 0).numpy().astype("uint8")))
+        cropped = CroppedBitMasks.from_bitmasks(masks)
+        for rle, rle_expected in zip(cropped.to_rles(), expected):
+            self.assertEqual(rle, rle_expected)
+
+        rle_masks = RLEMasks(cropped)
+        self.assertEqual(len(rle_masks), 3)
+        self.assertEqual([r["counts"] for r in rle_masks.to_rles()], [r["counts"] for r in expected])
+        self.assertTrue(torch.equal(rle_masks.to_dense(), masks))
+        self.assertTrue(torch.equal(rle_masks[1:].to_dense(), masks[1:]))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -70,6 +70,17 @@ def get_parser():
         default=0.5,
         help="Minimum score for instance predictions to be shown",
     )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Run the model in separate processes (one per GPU) from visualization.",
+    )
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="With --parallel, exchange frames and results through shared memory "
+        "instead of pickling them through queues.",
+    )
     parser.add_argument(
         "--opts",
         help="Modify config options using the command-line 'KEY VALUE' pairs",
@@ -105,7 +116,7 @@ if __name__ == "__main__":
 
     cfg = setup_cfg(args)
 
-    demo = VisualizationDemo(cfg)
+    demo = VisualizationDemo(cfg, parallel=args.parallel, shared_memory=args.shared_memory)
 
     if args.input:
         if len(args.input) == 1:
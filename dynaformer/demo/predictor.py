@@ -2,26 +2,39 @@
 # Copied from: https://github.com/facebookresearch/detectron2/blob/master/demo/predictor.py
 import atexit
 import bisect
+import itertools
+import logging
 import multiprocessing as mp
+import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import cv2
+import numpy as np
 import torch
 
+from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.data import MetadataCatalog
+from detectron2.data import transforms as T
+from detectron2.data.detection_utils import read_image
 from detectron2.engine.defaults import DefaultPredictor
+from detectron2.modeling import build_model
 from detectron2.utils.video_visualizer import VideoVisualizer
 from detectron2.utils.visualizer import ColorMode, Visualizer
 
 
 class VisualizationDemo(object):
-    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False):
+    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False, shared_memory=False):
         """
         Args:
             cfg (CfgNode):
             instance_mode (ColorMode):
             parallel (bool): whether to run the model in different processes from visualization.
                 Useful since the visualization logic can be slow.
+            shared_memory (bool): only used when `parallel` is True. Whether the worker
+                processes exchange frames and dense results through shared memory slots
+                instead of pickling them through `mp.Queue`.
         """
         self.metadata = MetadataCatalog.get(
             cfg.DATASETS.TEST[0] if len(cfg.DATASETS.TEST) else "__unused"
@@ -32,7 +45,7 @@ class VisualizationDemo(object):
         self.parallel = parallel
         if parallel:
             num_gpu = torch.cuda.device_count()
-            self.predictor = AsyncPredictor(cfg, num_gpus=num_gpu)
+            self.predictor = AsyncPredictor(cfg, num_gpus=num_gpu, shared_memory=shared_memory)
         else:
             self.predictor = DefaultPredictor(cfg)
 
@@ -128,11 +141,201 @@ class VisualizationDemo(object):
                 yield process_predictions(frame, self.predictor(frame))
 
 
+class _SharedArray:
+    """
+    Descriptor of an array stored in a shared memory slot. It is sent through
+    `mp.Queue` in place of the array itself.
+    """
+
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def __len__(self):
+        # `Instances.set` checks the length of every field
+        return self.shape[0]
+
+
+def _attach_shared_memory(name):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # Only the process that created the block should unlink it. Without this, the
+        # resource tracker of a worker would remove the block when the worker exits.
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+class SharedMemoryRing:
+    """
+    A ring of preallocated shared memory slots used by :class:`AsyncPredictor`.
+
+    Each slot holds one input frame followed by a result region where the worker
+    writes the dense outputs of the model (`pred_masks`, `sem_seg`, `panoptic_seg`).
+    Only slot indices, shapes and the small remaining outputs go through `mp.Queue`.
+    """
+
+    def __init__(self, num_slots, frame_bytes, result_bytes, name=None):
+        """
+        Args:
+            num_slots (int): number of slots, i.e. frames that can be in flight.
+            frame_bytes (int): capacity of the frame region of a slot.
+            result_bytes (int): capacity of the result region of a slot.
+            name (str): if given, attach to an existing ring instead of creating one.
+        """
+        self.num_slots = num_slots
+        self.frame_bytes = frame_bytes
+        self.result_bytes = result_bytes
+        self.slot_bytes = self._align(frame_bytes) + self._align(result_bytes)
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=num_slots * self.slot_bytes)
+            self._owner = True
+        else:
+            self._shm = _attach_shared_memory(name)
+            self._owner = False
+        self._free = deque(range(num_slots))
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def spec(self):
+        """
+        Arguments needed to attach to this ring from another process.
+        """
+        return (self.num_slots, self.frame_bytes, self.result_bytes, self.name)
+
+    @staticmethod
+    def _align(nbytes, alignment=64):
+        return (nbytes + alignment - 1) // alignment * alignment
+
+    def acquire(self):
+        """
+        Returns:
+            int or None: a free slot, or None if all slots are in flight.
+        """
+        return self._free.popleft() if len(self._free) else None
+
+    def release(self, slot):
+        self._free.append(slot)
+
+    def _frame_buffer(self, slot):
+        start = slot * self.slot_bytes
+        return self._shm.buf[start : start + self.frame_bytes]
+
+    def _result_buffer(self, slot):
+        start = slot * self.slot_bytes + self._align(self.frame_bytes)
+        return self._shm.buf[start : start + self.result_bytes]
+
+    def write_frame(self, slot, frame):
+        dst = np.ndarray(frame.shape, dtype=frame.dtype, buffer=self._frame_buffer(slot))
+        dst[...] = frame
+        return frame.shape, frame.dtype.str
+
+    def read_frame(self, slot, shape, dtype):
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self._frame_buffer(slot))
+
+    def write_predictions(self, slot, predictions):
+        """
+        Move the dense outputs in `predictions` into the result region of `slot`.
+        Outputs that do not fit are left in place and will be pickled as usual.
+
+        Returns:
+            dict: predictions where the moved tensors are replaced by :class:`_SharedArray`.
+        """
+        buf = self._result_buffer(slot)
+        offset = 0
+
+        def _write(tensor):
+            nonlocal offset
+            array = tensor.to("cpu").numpy()
+            if offset + array.nbytes > self.result_bytes:
+                return tensor
+            dst = np.ndarray(array.shape, dtype=array.dtype, buffer=buf, offset=offset)
+            dst[...] = array
+            desc = _SharedArray(offset, array.shape, array.dtype.str)
+            offset = self._align(offset + array.nbytes)
+            return desc
+
+        predictions = dict(predictions)
+        if "instances" in predictions:
+            instances = predictions["instances"].to("cpu")
+            if instances.has("pred_masks") and isinstance(instances.pred_masks, torch.Tensor):
+                # binary masks are stored as bool: 4x fewer bytes than float masks.
+                # compact formats (MODEL.DYNAFormer.TEST.MASK_FORMAT) are small and pickled.
+                instances.pred_masks = _write(instances.pred_masks.bool())
+            predictions["instances"] = instances
+        if "sem_seg" in predictions:
+            predictions["sem_seg"] = _write(predictions["sem_seg"])
+        if "panoptic_seg" in predictions:
+            panoptic_seg, segments_info = predictions["panoptic_seg"]
+            predictions["panoptic_seg"] = (_write(panoptic_seg), segments_info)
+        return predictions
+
+    def read_predictions(self, slot, predictions):
+        """
+        Inverse of :meth:`write_predictions`. The returned tensors are views of the
+        slot and stay valid until the slot is released.
+        """
+        buf = self._result_buffer(slot)
+
+        def _read(x):
+            if not isinstance(x, _SharedArray):
+                return x
+            array = np.ndarray(x.shape, dtype=np.dtype(x.dtype), buffer=buf, offset=x.offset)
+            return torch.from_numpy(array)
+
+        if "instances" in predictions and predictions["instances"].has("pred_masks"):
+            instances = predictions["instances"]
+            instances.pred_masks = _read(instances.pred_masks)
+        if "sem_seg" in predictions:
+            predictions["sem_seg"] = _read(predictions["sem_seg"])
+        if "panoptic_seg" in predictions:
+            panoptic_seg, segments_info = predictions["panoptic_seg"]
+            predictions["panoptic_seg"] = (_read(panoptic_seg), segments_info)
+        return predictions
+
+    @staticmethod
+    def copy_predictions(predictions):
+        """
+        Copy the tensors of `predictions` returned by :meth:`read_predictions` out of their slot,
+        in place, so that they stay valid after the slot is released or the ring is closed.
+        Views taken from them before the copy still share the slot.
+        """
+
+        def _copy(x):
+            if isinstance(x, torch.Tensor):
+                x.set_(x.clone())
+
+        if "instances" in predictions and predictions["instances"].has("pred_masks"):
+            _copy(predictions["instances"].pred_masks)
+        if "sem_seg" in predictions:
+            _copy(predictions["sem_seg"])
+        if "panoptic_seg" in predictions:
+            _copy(predictions["panoptic_seg"][0])
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
 class AsyncPredictor:
     """
     A predictor that runs the model asynchronously, possibly on >1 GPUs.
     Because rendering the visualization takes considerably amount of time,
     this helps improve throughput a little bit when rendering videos.
+
+    With `shared_memory=True`, frames and dense results are exchanged through a
+    :class:`SharedMemoryRing` and the queues only carry slot indices and metadata.
+    Results returned by :meth:`get` then share memory with their slot, which is
+    recycled at the next call to :meth:`get`; copy them if they need to live longer.
+    The last result is copied out of its slot by :meth:`shutdown`.
     """
 
     class _StopToken:
@@ -147,20 +350,34 @@ class AsyncPredictor:
 
         def run(self):
             predictor = DefaultPredictor(self.cfg)
+            ring = None
 
             while True:
                 task = self.task_queue.get()
                 if isinstance(task, AsyncPredictor._StopToken):
                     break
-                idx, data = task
-                result = predictor(data)
-                self.result_queue.put((idx, result))
-
-    def __init__(self, cfg, num_gpus: int = 1):
+                if len(task) == 2:
+                    idx, data = task
+                    result = predictor(data)
+                    self.result_queue.put((idx, None, result))
+                    continue
+                idx, ring_spec, slot, shape, dtype = task
+                if ring is None or ring.name != ring_spec[-1]:
+                    ring = SharedMemoryRing(*ring_spec)
+                result = predictor(ring.read_frame(slot, shape, dtype))
+                self.result_queue.put((idx, slot, ring.write_predictions(slot, result)))
+            if ring is not None:
+                ring.close()
+
+    def __init__(self, cfg, num_gpus: int = 1, shared_memory: bool = False, num_slots: int = None):
         """
         Args:
             cfg (CfgNode):
             num_gpus (int): if 0, will run on CPU
+            shared_memory (bool): exchange frames and dense results through shared memory.
+            num_slots (int): number of shared memory slots. Defaults to
+                `default_buffer_size + 2`, which is enough for :meth:`VisualizationDemo.run_on_video`.
+                When all slots are in flight, frames fall back to the queue path.
         """
         num_workers = max(num_gpus, 1)
         self.task_queue = mp.Queue(maxsize=num_workers * 3)
@@ -179,29 +396,64 @@ class AsyncPredictor:
         self.result_rank = []
         self.result_data = []
 
+        self.shared_memory = shared_memory
+        self.num_slots = num_slots if num_slots is not None else self.default_buffer_size + 2
+        # masks are stored as bool (1 byte/pixel), sem_seg as float32 and panoptic_seg as int32
+        self._result_bytes_per_pixel = (
+            cfg.TEST.DETECTIONS_PER_IMAGE + 4 * (cfg.MODEL.SEM_SEG_HEAD.NUM_CLASSES + 1) + 4
+        )
+        self.ring = None
+        self._held_slot = None
+        self._held_result = None
+
         for p in self.procs:
             p.start()
         atexit.register(self.shutdown)
 
+    def _maybe_build_ring(self, image):
+        if self.ring is None:
+            height, width = image.shape[:2]
+            self.ring = SharedMemoryRing(
+                self.num_slots, image.nbytes, height * width * self._result_bytes_per_pixel
+            )
+
     def put(self, image):
         self.put_idx += 1
+        if self.shared_memory:
+            self._maybe_build_ring(image)
+            slot = self.ring.acquire() if image.nbytes <= self.ring.frame_bytes else None
+            if slot is not None:
+                shape, dtype = self.ring.write_frame(slot, np.ascontiguousarray(image))
+                self.task_queue.put((self.put_idx, self.ring.spec, slot, shape, dtype))
+                return
         self.task_queue.put((self.put_idx, image))
 
+    def _finish(self, slot, res):
+        # the result returned by the previous call is no longer guaranteed to be valid
+        if self._held_slot is not None:
+            self.ring.release(self._held_slot)
+            self._held_slot = self._held_result = None
+        if slot is not None:
+            self._held_slot, self._held_result = slot, res
+        return res
+
     def get(self):
         self.get_idx += 1  # the index needed for this request
         if len(self.result_rank) and self.result_rank[0] == self.get_idx:
-            res = self.result_data[0]
+            slot, res = self.result_data[0]
             del self.result_data[0], self.result_rank[0]
-            return res
+            return self._finish(slot, res)
 
         while True:
             # make sure the results are returned in the correct order
-            idx, res = self.result_queue.get()
+            idx, slot, res = self.result_queue.get()
+            if slot is not None:
+                res = self.ring.read_predictions(slot, res)
             if idx == self.get_idx:
-                return res
+                return self._finish(slot, res)
             insert = bisect.bisect(self.result_rank, idx)
             self.result_rank.insert(insert, idx)
-            self.result_data.insert(insert, res)
+            self.result_data.insert(insert, (slot, res))
 
     def __len__(self):
         return self.put_idx - self.get_idx
@@ -213,7 +465,140 @@ class AsyncPredictor:
     def shutdown(self):
         for _ in self.procs:
             self.task_queue.put(AsyncPredictor._StopToken())
+        if self.ring is not None:
+            for p in self.procs:
+                p.join(timeout=10)
+            if self._held_slot is not None:
+                # the caller may still use the last result, it must not view the unmapped ring
+                SharedMemoryRing.copy_predictions(self._held_result)
+                self._held_slot = self._held_result = None
+            self.ring.close()
+            self.ring = None
 
     @property
     def default_buffer_size(self):
         return len(self.procs) * 5
+
+
+class BatchPredictor:
+    """
+    Run the model on many images with batched forwards, e.g. for offline scoring.
+
+    Compared to :class:`DefaultPredictor`, this class:
+
+    1. Takes an iterable of images (np.ndarray in BGR order) or file paths.
+    2. Decodes and resizes them in a thread pool, one chunk ahead of the model.
+    3. Groups the images of a chunk by resized (H, W), so that batches padded by
+       `ImageList.from_tensors` carry as little padding as possible.
+    4. Yields the predictions in input order, one dict per image.
+
+    Examples:
+    ::
+        pred = BatchPredictor(cfg, batch_size=8)
+        for predictions in pred(glob.glob("frames/*.jpg")):
+            ...
+        print(pred.images_per_second)
+    """
+
+    def __init__(self, cfg, batch_size: int = 8, num_workers: int = 4, lookahead: int = 4):
+        """
+        Args:
+            cfg (CfgNode):
+            batch_size (int): number of images per forward.
+            num_workers (int): number of threads used to decode and resize images.
+            lookahead (int): number of batches per chunk. Images are only reordered
+                by size within a chunk, so larger values reduce padding at the cost of
+                latency and memory.
+        """
+        self.cfg = cfg.clone()  # cfg can be modified by model
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        if len(cfg.DATASETS.TEST):
+            self.metadata = MetadataCatalog.get(cfg.DATASETS.TEST[0])
+
+        checkpointer = DetectionCheckpointer(self.model)
+        checkpointer.load(cfg.MODEL.WEIGHTS)
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.chunk_size = batch_size * lookahead
+
+        self.num_images = 0
+        self.total_time = 0.0
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def images_per_second(self):
+        return self.num_images / self.total_time if self.total_time > 0 else 0.0
+
+    def _preprocess(self, original_image):
+        if isinstance(original_image, str):
+            # use PIL, to be consistent with evaluation
+            original_image = read_image(original_image, format="BGR")
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def _run_chunk(self, inputs):
+        # bucket by resized size to minimize padding inside each batch
+        order = sorted(range(len(inputs)), key=lambda i: tuple(inputs[i]["image"].shape[-2:]))
+        outputs = [None] * len(inputs)
+        with torch.no_grad():
+            for start in range(0, len(order), self.batch_size):
+                indices = order[start : start + self.batch_size]
+                predictions = self.model([inputs[i] for i in indices])
+                for i, prediction in zip(indices, predictions):
+                    outputs[i] = prediction
+        return outputs
+
+    def __call__(self, images):
+        """
+        Args:
+            images (iterable[np.ndarray or str]): images of shape (H, W, C) in BGR order,
+                or paths to image files.
+
+        Yields:
+            predictions (dict): the output of the model for each image, in input order.
+        """
+        images = iter(images)
+        num_images = 0
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+
+            def submit_chunk():
+                futures = [
+                    executor.submit(self._preprocess, x)
+                    for x in itertools.islice(images, self.chunk_size)
+                ]
+                if len(futures):
+                    pending.append(futures)
+
+            submit_chunk()
+            while len(pending):
+                futures = pending.popleft()
+                # decode the next chunk while the model runs on this one
+                submit_chunk()
+                for predictions in self._run_chunk([f.result() for f in futures]):
+                    num_images += 1
+                    yield predictions
+
+        total_time = time.perf_counter() - start_time
+        self.num_images += num_images
+        self.total_time += total_time
+        self._logger.info(
+            "BatchPredictor: {} images in {:.2f}s ({:.2f} images/s, batch size {})".format(
+                num_images, total_time, num_images / max(total_time, 1e-9), self.batch_size
+            )
+        )
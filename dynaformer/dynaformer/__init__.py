@@ -33,3 +33,4 @@ from .evaluation.instance_evaluation import InstanceSegEvaluator
 from .evaluation.semantic_evaluation import PolypDBSemSegEvaluator
 # util
 from .utils import box_ops, misc, utils
+from .utils.inference import prepare_for_inference
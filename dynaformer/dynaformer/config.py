@@ -24,6 +24,44 @@ def add_dynaformer_config(cfg):
     cfg.INPUT.CROP.SINGLE_CATEGORY_MAX_AREA = 1.0
     # Pad image and segmentation GT in dataset mapper.
     cfg.INPUT.SIZE_DIVISIBILITY = -1
+    # Build the targets of the polyp semantic mapper in uint8 with vectorized ops ("sem_seg" is uint8),
+    # the mask is thresholded on its luma instead of the mean of its channels
+    cfg.INPUT.SEM_SEG_UINT8_TARGETS = False
+    # Sample the augmentations from the size of the image and decode JPEGs at the power-of-two reduction
+    # (1/2, 1/4, 1/8) allowed by the resize, in the LSJ instance and polyp semantic (uint8) mappers
+    cfg.INPUT.REDUCED_DECODING = False
+    # Batch augmentation stage: the data loader workers of the LSJ instance and polyp semantic (uint8)
+    # mappers only decode, the augmentations and the targets are applied in the main process with tensor
+    # ops on MODEL.DEVICE
+    cfg.INPUT.BATCH_AUGMENTATION = False
+
+    # Size-bucketed batching: images of similar size after augmentation are batched together (instead of
+    # DATALOADER.ASPECT_RATIO_GROUPING) to reduce the padding of the batches. Not compatible with
+    # INPUT.BATCH_AUGMENTATION, whose workers only decode the images
+    cfg.DATALOADER.SIZE_BUCKETING = CN()
+    cfg.DATALOADER.SIZE_BUCKETING.ENABLED = False
+    # size in pixels of the buckets, along both dimensions
+    cfg.DATALOADER.SIZE_BUCKETING.BUCKET_SIZE = 64
+    # maximum number of images held by a rank, and of images an image waits for: the oldest one is then
+    # batched with the nearest sizes
+    cfg.DATALOADER.SIZE_BUCKETING.MAX_BUFFER = 64
+    # Collate the training batches into padded (pinned) image and mask tensors in a background thread of the
+    # main process, and copy the next batch to MODEL.DEVICE on a side stream during the step of the current
+    # one, the model normalizes them batched
+    cfg.DATALOADER.PREFETCH = False
+    # Load the training dataset dicts once per machine, on local rank 0, into a file memory-mapped by all
+    # the local ranks and their data loader workers
+    cfg.DATALOADER.SHARED_DATASET = CN()
+    cfg.DATALOADER.SHARED_DATASET.ENABLED = False
+    # directory of the file, /dev/shm (or the temporary directory) if empty
+    cfg.DATALOADER.SHARED_DATASET.DIR = ""
+    # Time the stages of the mapping (read, decode, transform, targets, to_tensor) in the data loader
+    # workers and publish them to the EventStorage with the queue depth, the utilization of the workers
+    # and the bytes per batch. Nothing is recorded when disabled
+    cfg.DATALOADER.INSTRUMENT = CN()
+    cfg.DATALOADER.INSTRUMENT.ENABLED = False
+    # number of iterations between two reports
+    cfg.DATALOADER.INSTRUMENT.PERIOD = 20
 
     # solver config
     # weight decay on embedding
@@ -63,8 +101,15 @@ def add_dynaformer_config(cfg):
     cfg.MODEL.DYNAFormer.DEC_LAYERS = 6
     cfg.MODEL.DYNAFormer.DEC_N_POINTS = 8
     cfg.MODEL.DYNAFormer.TYPE_SAMPLING_LOCATIONS = 'mask'        #['both','mask','bbox']
+    # run the 'mask'/'both' decoder cross-attention with the fused kernel of the deformable attention ops
+    # (rebuild them with make.sh), check its parity with ops/test.py first
+    cfg.MODEL.DYNAFormer.FUSED_MASK_DEFORM_ATTN = False
     cfg.MODEL.DYNAFormer.TYPE_MASK_EMBED = 'MaskSimpleCNN' #[MaskSimpleCNN]
-    cfg.MODEL.DYNAFormer.MASK_EMBED_SPATINAL_SHAPE_LEVEL= 0 #[None,0,1,2]    None is full-size
+    cfg.MODEL.DYNAFormer.MASK_EMBED_SPATINAL_SHAPE_LEVEL= None #[None,0,1,2]    None is full-size
+    # stride of the mask features on which the decoder iterates the mask anchors (4 or 8), with
+    # MASK_FEATURE_REFINE the output layer masks are still predicted at SEM_SEG_HEAD.COMMON_STRIDE
+    cfg.MODEL.DYNAFormer.MASK_FEATURE_STRIDE = 4
+    cfg.MODEL.DYNAFormer.MASK_FEATURE_REFINE = False
     
     cfg.MODEL.DYNAFormer.INITIAL_PRED = True
     cfg.MODEL.DYNAFormer.PRE_NORM = False
@@ -78,6 +123,8 @@ def add_dynaformer_config(cfg):
     cfg.MODEL.DYNAFormer.DN="seg"
     cfg.MODEL.DYNAFormer.DN_NOISE_SCALE=0.4
     cfg.MODEL.DYNAFormer.DN_NUM=100
+    # run the decoder self-attention of the denoising groups as grouped attention instead of dense masked attention
+    cfg.MODEL.DYNAFormer.DN_GROUPED_SELF_ATTN = False
     cfg.MODEL.DYNAFormer.PRED_CONV=False
 
     cfg.MODEL.DYNAFormer.EVAL_FLAG = 1
@@ -103,16 +150,37 @@ def add_dynaformer_config(cfg):
     cfg.MODEL.DYNAFormer.TEST.PANO_TRANSFORM_EVAL = True
     cfg.MODEL.DYNAFormer.TEST.PANO_TEMPERATURE = 0.06
     cfg.MODEL.DYNAFormer.TEST.VISUALIZE = False
+    # representation of instance pred_masks: "float", "bool", "cropped" or "rle"
+    cfg.MODEL.DYNAFormer.TEST.MASK_FORMAT = "float"
+    # number of two-stage proposals (queries) selected at inference, 0 to use NUM_OBJECT_QUERIES;
+    # at most NUM_OBJECT_QUERIES with LEARN_TGT
+    cfg.MODEL.DYNAFormer.TEST.NUM_QUERIES = 0
+    # "fixed": always select TEST.NUM_QUERIES proposals; "adaptive": only keep the proposals
+    # whose score is above QUERY_SCORE_THRESHOLD, at least MIN_QUERIES and at most TEST.NUM_QUERIES
+    cfg.MODEL.DYNAFormer.TEST.QUERY_SELECTION = "fixed"
+    cfg.MODEL.DYNAFormer.TEST.QUERY_SCORE_THRESHOLD = 0.3
+    cfg.MODEL.DYNAFormer.TEST.MIN_QUERIES = 1
+    # reuse the mask embedding of the previous decoder layer for the queries whose binarized anchor mask
+    # changed by at most this 1 - IoU since it was embedded (0.0: only unchanged masks), negative to disable
+    cfg.MODEL.DYNAFormer.TEST.MASK_EMBED_CACHE_THRESHOLD = -1.0
     # cfg.MODEL.DYNAFormer.TEST.EVAL_FLAG = 1
 
     # Sometimes `backbone.size_divisibility` is set to 0 for some backbone (e.g. ResNet)
     # you can use this config to override
     cfg.MODEL.DYNAFormer.SIZE_DIVISIBILITY = 32
+    # pass the padding of the batch (ImageList and LSJ canvases) to the pixel decoder and the
+    # transformer decoder, padded tokens are skipped by the encoder and never selected as proposals.
+    # Changes the outputs of the models trained without it
+    cfg.MODEL.DYNAFormer.USE_PADDING_MASK = False
 
     # pixel decoder config
     cfg.MODEL.SEM_SEG_HEAD.MASK_DIM = 256
     # adding transformer in pixel decoder
     cfg.MODEL.SEM_SEG_HEAD.TRANSFORMER_ENC_LAYERS = 0
+    # sparse token refinement in the encoder: fraction of the tokens refined by each encoder
+    # layer (one value per layer, or one value for all layers), empty for the dense encoder
+    cfg.MODEL.SEM_SEG_HEAD.TOKEN_KEEP_RATIOS = []
+    cfg.MODEL.SEM_SEG_HEAD.TOKEN_SCORE_LOSS_WEIGHT = 1.0
     # pixel decoder
     cfg.MODEL.SEM_SEG_HEAD.PIXEL_DECODER_NAME = "DYNAFormerEncoder"
 
@@ -123,6 +191,10 @@ def add_dynaformer_config(cfg):
     cfg.INPUT.IMAGE_SIZE = 1024
     cfg.INPUT.MIN_SCALE = 0.1
     cfg.INPUT.MAX_SCALE = 2.0
+    # Size of the cache of the annotation masks rasterized at the original resolution, shared by the
+    # data loader workers of the LSJ instance mapper, the cached masks are nearest-resampled like the image
+    # instead of rasterizing the transformed polygons (0, the default)
+    cfg.INPUT.MASK_CACHE_MB = 0
 
     # point loss configs
     # Number of points sampled during training for a mask point head.
@@ -134,6 +206,37 @@ def add_dynaformer_config(cfg):
     # the original paper.
     cfg.MODEL.DYNAFormer.IMPORTANCE_SAMPLE_RATIO = 0.75
 
+    # PointRend-style mask refinement: masks are upsampled at inference by iterative 2x
+    # subdivision, re-predicting the most uncertain points from fine-grained backbone features
+    cfg.MODEL.DYNAFormer.POINT_REFINE = CN()
+    cfg.MODEL.DYNAFormer.POINT_REFINE.ENABLED = False
+    cfg.MODEL.DYNAFormer.POINT_REFINE.IN_FEATURE = "res2"
+    cfg.MODEL.DYNAFormer.POINT_REFINE.HIDDEN_DIM = 256
+    cfg.MODEL.DYNAFormer.POINT_REFINE.NUM_LAYERS = 2
+    # Number of points re-predicted per mask at each subdivision step.
+    cfg.MODEL.DYNAFormer.POINT_REFINE.SUBDIVISION_NUM_POINTS = 28 * 28
+    cfg.MODEL.DYNAFormer.POINT_REFINE.LOSS_WEIGHT = 5.0
+
+    # knowledge distillation of the model (student) from a frozen teacher, trained with DistillTrainer
+    # of train_net.py: query-matched class, box and mask distillation, optionally encoder memory
+    cfg.MODEL.DYNAFormer.DISTILL = CN()
+    cfg.MODEL.DYNAFormer.DISTILL.ENABLED = False
+    cfg.MODEL.DYNAFormer.DISTILL.TEACHER_CONFIG = ""
+    cfg.MODEL.DYNAFormer.DISTILL.TEACHER_WEIGHTS = ""
+    # Number of teacher queries (of highest score) matched to the student queries per image
+    cfg.MODEL.DYNAFormer.DISTILL.NUM_QUERIES = 30
+    # Temperature of the class logits
+    cfg.MODEL.DYNAFormer.DISTILL.TEMPERATURE = 1.0
+    cfg.MODEL.DYNAFormer.DISTILL.CLASS_WEIGHT = 2.0
+    cfg.MODEL.DYNAFormer.DISTILL.BOX_WEIGHT = 5.0
+    cfg.MODEL.DYNAFormer.DISTILL.GIOU_WEIGHT = 2.0
+    cfg.MODEL.DYNAFormer.DISTILL.MASK_WEIGHT = 5.0
+    cfg.MODEL.DYNAFormer.DISTILL.DICE_WEIGHT = 5.0
+    # Weight of the encoder memory (multi-scale pixel decoder features) distillation, 0 disables it
+    cfg.MODEL.DYNAFormer.DISTILL.MEMORY_WEIGHT = 0.0
+    # Channels of the teacher encoder memory (SEM_SEG_HEAD.CONVS_DIM of the teacher)
+    cfg.MODEL.DYNAFormer.DISTILL.TEACHER_MEMORY_DIM = 256
+
     # swin transformer backbone
     cfg.MODEL.SWIN = CN()
     cfg.MODEL.SWIN.PRETRAIN_IMG_SIZE = 224
@@ -152,6 +255,8 @@ def add_dynaformer_config(cfg):
     cfg.MODEL.SWIN.PATCH_NORM = True
     cfg.MODEL.SWIN.OUT_FEATURES = ["res2", "res3", "res4", "res5"]
     cfg.MODEL.SWIN.USE_CHECKPOINT = False
+    # run the patch embedding in channels-last format and return channels-last features
+    cfg.MODEL.SWIN.CHANNELS_LAST = False
 
     cfg.Default_loading=True  # a bug in my d2. resume use this; if first time ResNet load, set it false
 
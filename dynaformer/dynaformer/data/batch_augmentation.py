@@ -0,0 +1,213 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Batch augmentation stage: the data loader workers only decode the images and their targets at the
+original size, and the augmentations of the dataset mapper are applied to the batch in the main
+process, as tensor ops on the training device.
+
+The transforms are the detectron2 transforms of the mapper augmentations, sampled from the size of each
+image (see :func:`sample_transforms`), applied with the tensor equivalent of their numpy implementation:
+PIL resizes are antialiased interpolations, cv2 rotations are grid samples, crops, pads and flips are
+slicing ops. Transforms without a tensor implementation are applied on the CPU.
+"""
+import random
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from torch.nn import functional as F
+
+from detectron2.data import transforms as T
+from detectron2.projects.point_rend import ColorAugSSDTransform
+
+from .reduced_decoding import sample_transforms, supports_reduced_decoding
+
+_RESIZE_MODES = {
+    Image.NEAREST: "nearest-exact",
+    Image.BILINEAR: "bilinear",
+    Image.BICUBIC: "bicubic",
+}
+
+
+def _resize(x, size, mode):
+    """
+    Resize the last two dimensions of `x` like PIL: antialiased when downscaling, pixel centers aligned.
+    PIL resamples a uint8 image horizontally then vertically and rounds to uint8 after each pass, so do
+    the passes separately and round them, instead of a single float interpolation.
+    """
+    shape = x.shape
+    x = x.reshape(1, -1, *shape[-2:]).float()
+    if mode == "nearest-exact":
+        x = F.interpolate(x, size=size, mode=mode)
+    else:
+        for pass_size in [(shape[-2], size[1]), size]:
+            x = F.interpolate(x, size=pass_size, mode=mode, align_corners=False, antialias=True)
+            x = x.round().clamp(0, 255)
+    return x.reshape(*shape[:-2], *size)
+
+
+def _rotate(x, tfm, mode):
+    """
+    Rotate the last two dimensions of `x` like `cv2.warpAffine` with the matrix of a
+    :class:`RotationTransform`, zeros outside of the image.
+    """
+    shape = x.shape
+    matrix = torch.as_tensor(tfm.rm_image, dtype=torch.float32, device=x.device)
+    # cv2 maps the output pixels back to the input with the inverse of the matrix
+    inverse = torch.linalg.inv(torch.cat([matrix, matrix.new_tensor([[0, 0, 1]])]))[:2]
+    ys, xs = torch.meshgrid(
+        torch.arange(tfm.bound_h, device=x.device, dtype=torch.float32),
+        torch.arange(tfm.bound_w, device=x.device, dtype=torch.float32),
+        indexing="ij",
+    )
+    points = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1) @ inverse.T
+    # pixel centers of grid_sample with align_corners=False
+    grid = (2 * points + 1) / points.new_tensor([tfm.w, tfm.h]) - 1
+    x = x.reshape(1, -1, *shape[-2:]).float()
+    x = F.grid_sample(x, grid[None], mode=mode, padding_mode="zeros", align_corners=False)
+    return x.reshape(*shape[:-2], *x.shape[-2:])
+
+
+def _convert(x, alpha=1.0, beta=0.0):
+    # the uint8 conversion of ColorAugSSDTransform
+    return (x * alpha + beta).clamp(0, 255).floor()
+
+
+def _bgr_to_hsv(x):
+    """
+    3*H*W BGR in [0, 255] to the HSV of cv2: H in [0, 180), S and V in [0, 255].
+    """
+    b, g, r = x.unbind(0)
+    value = x.max(0)[0]
+    delta = value - x.min(0)[0]
+    saturation = torch.where(value > 0, delta / value.clamp(min=1e-6) * 255, torch.zeros_like(value))
+    d = delta.clamp(min=1e-6)
+    hue = torch.where(value == r, (g - b) / d, torch.where(value == g, 2 + (b - r) / d, 4 + (r - g) / d))
+    hue = torch.where(delta > 0, (hue * 60) % 360, torch.zeros_like(hue)) / 2
+    return torch.stack([hue.round() % 180, saturation.round(), value])
+
+
+def _hsv_to_bgr(x):
+    hue, saturation, value = x.unbind(0)
+    chroma = value * saturation / 255
+    channels = []
+    # blue, green, red
+    for n in (1, 3, 5):
+        k = (n + hue / 30) % 6
+        channels.append(value - chroma * torch.minimum(torch.minimum(k, 4 - k), torch.ones_like(k)).clamp(min=0))
+    return torch.stack(channels).round()
+
+
+def _color_aug_ssd(x, tfm):
+    """
+    :class:`ColorAugSSDTransform` on a 3*H*W tensor, the random choices are drawn in the same order.
+    """
+    if tfm.is_rgb:
+        x = x.flip(0)
+    if random.randrange(2):
+        x = _convert(x, beta=random.uniform(-tfm.brightness_delta, tfm.brightness_delta))
+
+    def contrast(x):
+        if random.randrange(2):
+            return _convert(x, alpha=random.uniform(tfm.contrast_low, tfm.contrast_high))
+        return x
+
+    def saturation(x):
+        if random.randrange(2):
+            hsv = _bgr_to_hsv(x)
+            hsv[1] = _convert(hsv[1], alpha=random.uniform(tfm.saturation_low, tfm.saturation_high))
+            return _hsv_to_bgr(hsv)
+        return x
+
+    def hue(x):
+        if random.randrange(2):
+            hsv = _bgr_to_hsv(x)
+            hsv[0] = (hsv[0] + random.randint(-tfm.hue_delta, tfm.hue_delta)) % 180
+            return _hsv_to_bgr(hsv)
+        return x
+
+    if random.randrange(2):
+        x = hue(saturation(contrast(x)))
+    else:
+        x = contrast(hue(saturation(x)))
+    if tfm.is_rgb:
+        x = x.flip(0)
+    return x
+
+
+def _apply_numpy(tfm, x, segmentation):
+    # transforms without a tensor implementation, on the CPU
+    array = x.round().clamp(0, 255).to(torch.uint8).cpu().numpy()
+    if segmentation:
+        array = np.stack([tfm.apply_segmentation(a) for a in array.reshape(-1, *array.shape[-2:])])
+        return torch.from_numpy(array).to(x.device).reshape(*x.shape[:-2], *array.shape[-2:]).to(x.dtype)
+    array = tfm.apply_image(np.ascontiguousarray(array.transpose(1, 2, 0)))
+    return torch.from_numpy(np.ascontiguousarray(array.transpose(2, 0, 1))).to(x.device, x.dtype)
+
+
+def apply_transform(tfm, x, segmentation=False):
+    """
+    Apply a transform to a C*H*W float image, or to (...)*H*W segmentations (nearest interpolation,
+    the padding value of segmentations).
+    """
+    if isinstance(tfm, T.TransformList):
+        for t in tfm.transforms:
+            x = apply_transform(t, x, segmentation)
+        return x
+    if isinstance(tfm, T.NoOpTransform):
+        return x
+    if isinstance(tfm, T.HFlipTransform):
+        return x.flip(-1)
+    if isinstance(tfm, T.VFlipTransform):
+        return x.flip(-2)
+    if isinstance(tfm, T.CropTransform):
+        return x[..., tfm.y0 : tfm.y0 + tfm.h, tfm.x0 : tfm.x0 + tfm.w]
+    if isinstance(tfm, T.PadTransform):
+        value = tfm.seg_pad_value if segmentation else tfm.pad_value
+        return F.pad(x, [tfm.x0, tfm.x1, tfm.y0, tfm.y1], value=value)
+    if isinstance(tfm, T.ResizeTransform) and (segmentation or tfm.interp in _RESIZE_MODES):
+        mode = "nearest-exact" if segmentation else _RESIZE_MODES[tfm.interp]
+        return _resize(x, (tfm.new_h, tfm.new_w), mode).to(x.dtype)
+    if isinstance(tfm, T.RotationTransform) and tfm.interp in (cv2.INTER_LINEAR, cv2.INTER_NEAREST):
+        if tfm.angle % 360 == 0:
+            return x
+        mode = "nearest" if segmentation or tfm.interp == cv2.INTER_NEAREST else "bilinear"
+        return _rotate(x, tfm, mode).to(x.dtype)
+    if isinstance(tfm, ColorAugSSDTransform):
+        return x if segmentation else _color_aug_ssd(x, tfm)
+    return _apply_numpy(tfm, x, segmentation)
+
+
+class BatchAugmentation:
+    """
+    Applies the augmentations of a dataset mapper to a batch of inputs decoded by the mapper in
+    decode-only mode. The mapper provides:
+
+        * `tfm_gens`: its augmentations
+        * "image" (uint8 C*H*W) and "segmentations" (dict of uint8 (...)*H*W tensors) in the decoded inputs
+        * `targets(dataset_dict, image, segmentations, transforms)`: adds the training targets to an
+          input from its augmented image and segmentations
+    """
+
+    def __init__(self, mapper, device):
+        assert supports_reduced_decoding(mapper.tfm_gens), (
+            "Batch augmentation samples the transforms from the size of the images, "
+            "got augmentations that need their content: {}".format(mapper.tfm_gens)
+        )
+        self.mapper = mapper
+        self.device = torch.device(device)
+
+    def __call__(self, batched_inputs):
+        for dataset_dict in batched_inputs:
+            image = dataset_dict.pop("image").to(self.device, non_blocking=True)
+            segmentations = {
+                k: v.to(self.device, non_blocking=True) for k, v in dataset_dict.pop("segmentations").items()
+            }
+            transforms = sample_transforms(self.mapper.tfm_gens, *image.shape[-2:])
+            image = apply_transform(transforms, image.float())
+            segmentations = {k: apply_transform(transforms, v, segmentation=True) for k, v in segmentations.items()}
+            self.mapper.targets(dataset_dict, image, segmentations, transforms)
+        return batched_inputs
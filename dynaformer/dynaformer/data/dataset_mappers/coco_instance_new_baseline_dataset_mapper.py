@@ -5,6 +5,8 @@
 # Modified from Mask2Former https://github.com/facebookresearch/Mask2Former by Feng Li.
 import copy
 import logging
+import pickle
+import zlib
 
 import numpy as np
 import torch
@@ -17,6 +19,11 @@ from detectron2.structures import BitMasks, Instances, PolygonMasks
 
 from pycocotools import mask as coco_mask
 
+from ..batch_augmentation import apply_transform
+from ..loader_stats import read_file, stage
+from ..mask_cache import SharedMaskCache
+from ..reduced_decoding import read_reduced_image, sample_transforms, supports_reduced_decoding
+
 __all__ = ["COCOInstanceNewBaselineDatasetMapper"]
 
 
@@ -37,6 +44,54 @@ def convert_coco_poly_to_mask(segmentations, height, width):
     return masks
 
 
+def segmentation_to_rle(segmentation, height, width):
+    """
+    Returns:
+        dict: compressed RLE of the union of the polygons, or of the RLE, of an annotation
+    """
+    if isinstance(segmentation, list):
+        return coco_mask.merge(coco_mask.frPyObjects(segmentation, height, width))
+    if isinstance(segmentation["counts"], list):
+        return coco_mask.frPyObjects(segmentation, height, width)
+    return segmentation
+
+
+def transform_masks(masks, transforms):
+    """
+    Apply the geometric transforms of the image to H*W*N binary masks. The masks are packed as the bits
+    of uint8 segmentation maps, so that a single `apply_segmentation` (nearest interpolation) transforms
+    8 masks.
+
+    Returns:
+        np.ndarray: N*H'*W' bool masks
+    """
+    num_masks = masks.shape[-1]
+    # the padding value of segmentations (255 for FixedSizeCrop) sets all the bits, the padding is
+    # found by transforming a map of ones
+    inside = transforms.apply_segmentation(np.ones(masks.shape[:2], dtype=np.uint8)) == 1
+    packed = np.packbits(masks, axis=-1, bitorder="little")
+    packed = np.stack(
+        [transforms.apply_segmentation(np.ascontiguousarray(packed[:, :, i])) for i in range(packed.shape[-1])], axis=-1
+    )
+    masks = np.unpackbits(packed, axis=-1, count=num_masks, bitorder="little").astype(bool)
+    masks &= inside[:, :, None]
+    return np.ascontiguousarray(masks.transpose(2, 0, 1))
+
+
+def masks_to_instances(masks, classes, image_shape):
+    """
+    Instances of N*H*W bool masks, the empty ones are removed.
+    """
+    instances = Instances(image_shape)
+    instances.gt_classes = classes
+    instances.gt_masks = BitMasks(masks)
+    instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+    # Need to filter empty instances first (due to augmentation)
+    instances = utils.filter_empty_instances(instances)
+    instances.gt_masks = instances.gt_masks.tensor
+    return instances
+
+
 def build_transform_gen(cfg, is_train):
     """
     Create a list of default :class:`Augmentation` from config.
@@ -91,6 +146,10 @@ class COCOInstanceNewBaselineDatasetMapper:
         *,
         tfm_gens,
         image_format,
+        mask_cache_mb=0,
+        reduced_decoding=False,
+        decode_only=False,
+        loader_stats=None,
     ):
         """
         NOTE: this interface is experimental.
@@ -99,6 +158,15 @@ class COCOInstanceNewBaselineDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             tfm_gens: data augmentation
             image_format: an image format supported by :func:`detection_utils.read_image`.
+            mask_cache_mb: size of the cache of the annotation masks rasterized at the original
+                resolution, shared by the data loader workers. The cached masks are transformed like the
+                image instead of rasterizing the transformed polygons. 0 disables it
+            reduced_decoding: sample the augmentations from the size of the image and decode a JPEG
+                at the power-of-two reduction allowed by the resize (see :mod:`reduced_decoding`). The
+                annotations are transformed with the transforms of the full-size image
+            decode_only: only decode the image and the masks of the annotations, the augmentations and
+                the targets are applied to the batch by :class:`BatchAugmentation`
+            loader_stats: :class:`LoaderStats` recording the time of the stages of the mapping, or None
         """
         self.tfm_gens = tfm_gens
         logging.getLogger(__name__).info(
@@ -107,6 +175,11 @@ class COCOInstanceNewBaselineDatasetMapper:
 
         self.img_format = image_format
         self.is_train = is_train
+        # created here so that the data loader workers inherit the shared memory
+        self.mask_cache = SharedMaskCache(mask_cache_mb) if is_train and mask_cache_mb > 0 else None
+        self.reduced_decoding = reduced_decoding and supports_reduced_decoding(self.tfm_gens)
+        self.decode_only = decode_only
+        self.loader_stats = loader_stats
     
     @classmethod
     def from_config(cls, cfg, is_train=True):
@@ -117,9 +190,80 @@ class COCOInstanceNewBaselineDatasetMapper:
             "is_train": is_train,
             "tfm_gens": tfm_gens,
             "image_format": cfg.INPUT.FORMAT,
+            "mask_cache_mb": cfg.INPUT.MASK_CACHE_MB,
+            "reduced_decoding": cfg.INPUT.REDUCED_DECODING,
+            "decode_only": cfg.INPUT.BATCH_AUGMENTATION,
         }
         return ret
 
+    def rasterized_masks(self, dataset_dict, annos):
+        """
+        Returns:
+            np.ndarray: H*W*N uint8 masks of the annotations at the original resolution, from the cache
+        """
+        height, width = dataset_dict["height"], dataset_dict["width"]
+        if "image_id" in dataset_dict:
+            key = dataset_dict["image_id"]
+        else:
+            key = zlib.crc32(dataset_dict["file_name"].encode())
+        value = self.mask_cache.get(key)
+        if value is not None:
+            counts = pickle.loads(value)
+        else:
+            counts = [segmentation_to_rle(obj["segmentation"], height, width)["counts"] for obj in annos]
+            self.mask_cache.put(key, pickle.dumps(counts))
+        return coco_mask.decode([{"size": [height, width], "counts": c} for c in counts])
+
+    def cached_instances(self, dataset_dict, transforms, image_shape):
+        """
+        Instances of the annotations from the cached masks, transformed like the image.
+        """
+        annos = [obj for obj in dataset_dict.pop("annotations") if obj.get("iscrowd", 0) == 0]
+        if annos:
+            masks = transform_masks(self.rasterized_masks(dataset_dict, annos), transforms)
+        else:
+            masks = np.zeros((0,) + tuple(image_shape), dtype=bool)
+        classes = torch.tensor([obj["category_id"] for obj in annos], dtype=torch.int64)
+        return masks_to_instances(torch.from_numpy(masks), classes, image_shape)
+
+    def decode(self, dataset_dict):
+        """
+        Decode-only mapping of the batch augmentation stage: the image and the masks of the annotations
+        at the original size, see :meth:`targets`.
+        """
+        dataset_dict = copy.copy(dataset_dict)
+        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
+        utils.check_image_size(dataset_dict, image)
+        height, width = image.shape[:2]
+        annos = [obj for obj in dataset_dict.pop("annotations", []) if obj.get("iscrowd", 0) == 0]
+        if annos and self.mask_cache is not None:
+            masks = self.rasterized_masks(dataset_dict, annos)
+        elif annos:
+            masks = coco_mask.decode([segmentation_to_rle(obj["segmentation"], height, width) for obj in annos])
+        else:
+            masks = np.zeros((height, width, 0), dtype=np.uint8)
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        dataset_dict["segmentations"] = {"masks": torch.from_numpy(np.ascontiguousarray(masks.transpose(2, 0, 1)))}
+        dataset_dict["gt_classes"] = torch.tensor([obj["category_id"] for obj in annos], dtype=torch.int64)
+        return dataset_dict
+
+    def targets(self, dataset_dict, image, segmentations, transforms):
+        """
+        Adds the targets of an input of :meth:`decode` augmented by :class:`BatchAugmentation`.
+        """
+        image_shape = tuple(image.shape[-2:])
+        height, width = dataset_dict["height"], dataset_dict["width"]
+        padding_mask = apply_transform(
+            transforms, torch.ones((height, width), dtype=torch.uint8, device=image.device), segmentation=True
+        )
+        dataset_dict["image"] = image
+        # the padding value of segmentations (255 for FixedSizeCrop) is padding, and not a mask
+        dataset_dict["padding_mask"] = padding_mask != 1
+        masks = segmentations["masks"] == 1
+        classes = dataset_dict.pop("gt_classes").to(image.device)
+        dataset_dict["instances"] = masks_to_instances(masks, classes, image_shape)
+        return dataset_dict
+
     def __call__(self, dataset_dict):
         """
         Args:
@@ -128,33 +272,64 @@ class COCOInstanceNewBaselineDatasetMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
-        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
-        utils.check_image_size(dataset_dict, image)
+        if self.decode_only:
+            return self.decode(dataset_dict)
+        if self.mask_cache is not None:
+            # the annotations are only read
+            dataset_dict = copy.copy(dataset_dict)
+        else:
+            dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        if self.reduced_decoding:
+            image_size = (dataset_dict["height"], dataset_dict["width"])
+            transforms = sample_transforms(self.tfm_gens, *image_size)
+            with stage(self.loader_stats, "decode"):
+                image, image_transforms = read_reduced_image(
+                    read_file(self.loader_stats, dataset_dict["file_name"]), self.img_format, transforms, image_size
+                )
+            with stage(self.loader_stats, "transform"):
+                padding_mask = np.ones(image.shape[:2], dtype=np.uint8)
+                image = image_transforms.apply_image(image)
+                padding_mask = image_transforms.apply_segmentation(padding_mask)
+        else:
+            with stage(self.loader_stats, "decode"):
+                image = utils.read_image(read_file(self.loader_stats, dataset_dict["file_name"]), format=self.img_format)
+            utils.check_image_size(dataset_dict, image)
 
-        # TODO: get padding mask
-        # by feeding a "segmentation mask" to the same transforms
-        padding_mask = np.ones(image.shape[:2])
+            with stage(self.loader_stats, "transform"):
+                # TODO: get padding mask
+                # by feeding a "segmentation mask" to the same transforms
+                padding_mask = np.ones(image.shape[:2], dtype=np.uint8)
 
-        image, transforms = T.apply_transform_gens(self.tfm_gens, image)
-        # the crop transformation has default padding value 0 for segmentation
-        padding_mask = transforms.apply_segmentation(padding_mask)
-        padding_mask = ~ padding_mask.astype(bool)
+                image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+                # FixedSizeCrop pads segmentations with 255, other transforms with 0
+                padding_mask = transforms.apply_segmentation(padding_mask)
+        padding_mask = padding_mask != 1
 
         image_shape = image.shape[:2]  # h, w
 
         # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
         # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
         # Therefore it's important to use torch.Tensor.
-        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
-        dataset_dict["padding_mask"] = torch.as_tensor(np.ascontiguousarray(padding_mask))
+        with stage(self.loader_stats, "to_tensor"):
+            dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+            dataset_dict["padding_mask"] = torch.as_tensor(np.ascontiguousarray(padding_mask))
 
         if not self.is_train:
             # USER: Modify this if you want to keep them for some reason.
             dataset_dict.pop("annotations", None)
             return dataset_dict
 
-        if "annotations" in dataset_dict:
+        with stage(self.loader_stats, "targets"):
+            self.add_instances(dataset_dict, transforms, image_shape)
+        return dataset_dict
+
+    def add_instances(self, dataset_dict, transforms, image_shape):
+        """
+        Adds the transformed annotations of a training input as "instances".
+        """
+        if "annotations" in dataset_dict and self.mask_cache is not None:
+            dataset_dict["instances"] = self.cached_instances(dataset_dict, transforms, image_shape)
+        elif "annotations" in dataset_dict:
             # USER: Modify this if you want to keep them for some reason.
             for anno in dataset_dict["annotations"]:
                 # Let's always keep mask
@@ -187,5 +362,3 @@ class COCOInstanceNewBaselineDatasetMapper:
                 instances.gt_masks = gt_masks
 
             dataset_dict["instances"] = instances
-
-        return dataset_dict
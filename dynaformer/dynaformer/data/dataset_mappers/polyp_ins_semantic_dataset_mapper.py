@@ -17,9 +17,42 @@ from detectron2.projects.point_rend import ColorAugSSDTransform
 from detectron2.structures import BitMasks, Boxes, Instances
 from detectron2.data.transforms import Augmentation
 
+from ..datasets.register_polypdb_packed import is_packed_path, read_packed_mask
+from ..loader_stats import read_file, stage
+from ..reduced_decoding import (
+    decode_size,
+    read_image_size,
+    read_reduced_image,
+    sample_transforms,
+    supports_reduced_decoding,
+    transforms_for_size,
+)
+
 __all__ = ["PolypInsSemanticDatasetMapper"]
 
 
+def masks_to_boxes(masks):
+    """
+    Boxes of N*H*W bool masks from their row and column projections, the same as
+    :meth:`BitMasks.get_bounding_boxes` (XYXY, zeros for an empty mask) without a loop over the masks.
+    """
+    height, width = masks.shape[-2:]
+    rows = masks.any(dim=2).to(torch.uint8)
+    cols = masks.any(dim=1).to(torch.uint8)
+    # argmax returns the first maximal index
+    boxes = torch.stack(
+        [
+            cols.argmax(dim=1),
+            rows.argmax(dim=1),
+            width - cols.flip(1).argmax(dim=1),
+            height - rows.flip(1).argmax(dim=1),
+        ],
+        dim=1,
+    ).to(torch.float32)
+    boxes[rows.sum(dim=1) == 0] = 0
+    return boxes
+
+
 def RandomRotationWithProbability(angle, probability):
     if random.random() < probability:
         return T.RandomRotation(angle)
@@ -48,6 +81,10 @@ class PolypInsSemanticDatasetMapper:
         image_format,
         ignore_label,
         size_divisibility,
+        uint8_targets=False,
+        reduced_decoding=False,
+        decode_only=False,
+        loader_stats=None,
     ):
         """
         NOTE: this interface is experimental.
@@ -57,12 +94,26 @@ class PolypInsSemanticDatasetMapper:
             image_format: an image format supported by :func:`detection_utils.read_image`.
             ignore_label: the label that is ignored to evaluation
             size_divisibility: pad image size to be divisible by this value
+            uint8_targets: read the mask as a single channel and build the targets in uint8 with
+                vectorized ops. "sem_seg" is then uint8 instead of long
+            reduced_decoding: with `uint8_targets`, sample the augmentations from the size of the
+                image and decode the JPEG image and mask at the power-of-two reduction allowed by the
+                resize (see :mod:`reduced_decoding`)
+            decode_only: with `uint8_targets`, only decode the image and the mask, the augmentations and
+                the targets are applied to the batch by :class:`BatchAugmentation`
+            loader_stats: :class:`LoaderStats` recording the time of the stages of the uint8 mapping, or
+                None
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
         self.img_format = image_format
         self.ignore_label = ignore_label
         self.size_divisibility = size_divisibility
+        self.uint8_targets = uint8_targets
+        self.reduced_decoding = uint8_targets and reduced_decoding and supports_reduced_decoding(augmentations)
+        assert uint8_targets or not decode_only, "The batch augmentation stage builds the uint8 targets"
+        self.decode_only = decode_only
+        self.loader_stats = loader_stats
 
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -109,6 +160,9 @@ class PolypInsSemanticDatasetMapper:
             "image_format": cfg.INPUT.FORMAT,
             "ignore_label": ignore_label,
             "size_divisibility": cfg.INPUT.SIZE_DIVISIBILITY,
+            "uint8_targets": cfg.INPUT.SEM_SEG_UINT8_TARGETS,
+            "reduced_decoding": cfg.INPUT.REDUCED_DECODING,
+            "decode_only": cfg.INPUT.BATCH_AUGMENTATION,
         }
         return ret
 
@@ -122,6 +176,10 @@ class PolypInsSemanticDatasetMapper:
         """
         assert self.is_train, "MaskFormerSemanticDatasetMapper should only be used for training!"
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        if self.decode_only:
+            return self.decode(dataset_dict)
+        if self.uint8_targets:
+            return self.map_uint8(dataset_dict)
         image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
         utils.check_image_size(dataset_dict, image)
 
@@ -129,7 +187,11 @@ class PolypInsSemanticDatasetMapper:
             # PyTorch transformation not implemented for uint16, so converting it to double first
             #sem_seg_gt = utils.read_image(dataset_dict.pop("sem_seg_file_name")).astype("double")
             sem_seg_file_name = dataset_dict.pop("sem_seg_file_name")
-            sem_seg_gt = utils.read_image(sem_seg_file_name)
+            if is_packed_path(sem_seg_file_name):
+                # binarized mask of a packed dataset, H*W with 255 on the polyp
+                sem_seg_gt = read_packed_mask(sem_seg_file_name)
+            else:
+                sem_seg_gt = utils.read_image(sem_seg_file_name)
             
         else:
             sem_seg_gt = None
@@ -147,7 +209,10 @@ class PolypInsSemanticDatasetMapper:
         sem_seg_gt = aug_input.sem_seg
 
         # Compute the mean across the channels to create a single channel image
-        mean_channel = np.mean(sem_seg_gt, axis=-1)  # This will result in a single channel (height, width)
+        if sem_seg_gt.ndim == 3:
+            mean_channel = np.mean(sem_seg_gt, axis=-1)  # This will result in a single channel (height, width)
+        else:
+            mean_channel = sem_seg_gt
         # Threshold: if mean value > 128, it's considered object (1), otherwise background (0)
         sem_seg_gt = (mean_channel > 128).astype("double")
         # Apply the shift operation and convert background (0) to 255, others are shifted by -1
@@ -167,6 +232,9 @@ class PolypInsSemanticDatasetMapper:
                 self.size_divisibility - image_size[0],
             ]
             image = F.pad(image, padding_size, value=128).contiguous()
+            # True on the padding of the canvas, used by the model to skip the padded area
+            padding_mask = F.pad(torch.zeros(image_size, dtype=torch.bool), padding_size, value=True)
+            dataset_dict["padding_mask"] = padding_mask
             if sem_seg_gt is not None:
                 sem_seg_gt = F.pad(sem_seg_gt, padding_size, value=self.ignore_label).contiguous()
 
@@ -213,3 +281,127 @@ class PolypInsSemanticDatasetMapper:
             dataset_dict["instances"] = instances
 
         return dataset_dict
+
+    def read_foreground(self, sem_seg_file_name, target_size=None):
+        """
+        Args:
+            target_size: (h, w) hint of :func:`detection_utils.read_image`
+        Returns:
+            np.ndarray: H*W uint8 map, 1 on the polyp
+        """
+        if is_packed_path(sem_seg_file_name):
+            gray = read_packed_mask(sem_seg_file_name)
+        else:
+            gray = utils.read_image(
+                read_file(self.loader_stats, sem_seg_file_name), format="L", target_size=target_size
+            )[:, :, 0]
+        return (gray > 128).view(np.uint8)
+
+    def check_inputs(self, dataset_dict):
+        if "sem_seg_file_name" not in dataset_dict:
+            raise ValueError(
+                "Cannot find 'sem_seg_file_name' for semantic segmentation dataset {}.".format(
+                    dataset_dict["file_name"]
+                )
+            )
+        if "annotations" in dataset_dict:
+            raise ValueError("Semantic segmentation dataset should not have 'annotations'.")
+
+    def decode(self, dataset_dict):
+        """
+        Decode-only mapping of the batch augmentation stage: the image and the foreground at the original
+        size, see :meth:`targets`.
+        """
+        self.check_inputs(dataset_dict)
+        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
+        utils.check_image_size(dataset_dict, image)
+        foreground = self.read_foreground(dataset_dict.pop("sem_seg_file_name"))
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        dataset_dict["segmentations"] = {"foreground": torch.from_numpy(foreground)}
+        return dataset_dict
+
+    def targets(self, dataset_dict, image, segmentations, transforms):
+        """
+        Adds the targets of an input of :meth:`decode` augmented by :class:`BatchAugmentation`.
+        """
+        return self.add_uint8_targets(dataset_dict, image, segmentations["foreground"])
+
+    def map_uint8(self, dataset_dict):
+        """
+        Same as :meth:`__call__`, with the targets built in uint8: the mask is binarized before the
+        augmentations (nearest interpolation, so the result is the same as binarizing after them) and
+        the instances are found with a histogram instead of `np.unique` and a loop over the classes.
+        """
+        self.check_inputs(dataset_dict)
+        if self.reduced_decoding:
+            if "height" in dataset_dict and "width" in dataset_dict:
+                image_size = (dataset_dict["height"], dataset_dict["width"])
+            else:
+                image_size = read_image_size(dataset_dict["file_name"])
+            transforms = sample_transforms(self.tfm_gens, *image_size)
+            with stage(self.loader_stats, "decode"):
+                image, image_transforms = read_reduced_image(
+                    read_file(self.loader_stats, dataset_dict["file_name"]), self.img_format, transforms, image_size
+                )
+                # decoded with the same hint, a JPEG mask has the reduced size of the image, the transforms
+                # of a mask of another size are rebuilt for it
+                foreground = self.read_foreground(
+                    dataset_dict.pop("sem_seg_file_name"), decode_size(transforms, *image_size)
+                )
+            with stage(self.loader_stats, "transform"):
+                mask_transforms = transforms_for_size(transforms, image_size, foreground.shape)
+                image = image_transforms.apply_image(image)
+                foreground = mask_transforms.apply_segmentation(foreground)
+        else:
+            with stage(self.loader_stats, "decode"):
+                image = utils.read_image(read_file(self.loader_stats, dataset_dict["file_name"]), format=self.img_format)
+                utils.check_image_size(dataset_dict, image)
+                foreground = self.read_foreground(dataset_dict.pop("sem_seg_file_name"))
+            with stage(self.loader_stats, "transform"):
+                aug_input = T.AugInput(image, sem_seg=foreground)
+                aug_input, transforms = T.apply_transform_gens(self.tfm_gens, aug_input)
+                image, foreground = aug_input.image, aug_input.sem_seg
+        with stage(self.loader_stats, "to_tensor"):
+            image = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+            foreground = torch.from_numpy(np.ascontiguousarray(foreground))
+        with stage(self.loader_stats, "targets"):
+            return self.add_uint8_targets(dataset_dict, image, foreground)
+
+    def add_uint8_targets(self, dataset_dict, image, foreground):
+        """
+        Pads the C*H*W image and adds the uint8 targets of the H*W foreground map, on the device of the
+        image.
+        """
+        # polyp is class 0, the background is ignored
+        sem_seg_gt = torch.full_like(foreground, self.ignore_label, dtype=torch.uint8).masked_fill_(foreground > 0, 0)
+
+        if self.size_divisibility > 0:
+            image_size = (image.shape[-2], image.shape[-1])
+            padding_size = [
+                0,
+                self.size_divisibility - image_size[1],
+                0,
+                self.size_divisibility - image_size[0],
+            ]
+            image = F.pad(image, padding_size, value=128).contiguous()
+            # True on the padding of the canvas, used by the model to skip the padded area
+            padding_mask = F.pad(
+                torch.zeros(image_size, dtype=torch.bool, device=image.device), padding_size, value=True
+            )
+            dataset_dict["padding_mask"] = padding_mask
+            sem_seg_gt = F.pad(sem_seg_gt, padding_size, value=self.ignore_label).contiguous()
+
+        dataset_dict["image"] = image
+        dataset_dict["sem_seg"] = sem_seg_gt
+
+        # Prepare per-category binary masks
+        counts = torch.bincount(sem_seg_gt.flatten(), minlength=256)
+        counts[self.ignore_label] = 0
+        classes = counts.nonzero()[:, 0]
+        masks = sem_seg_gt[None] == classes[:, None, None].to(torch.uint8)
+        instances = Instances((image.shape[-2], image.shape[-1]))
+        instances.gt_classes = classes
+        instances.gt_masks = masks
+        instances.gt_boxes = Boxes(masks_to_boxes(masks))
+        dataset_dict["instances"] = instances
+        return dataset_dict
@@ -8,5 +8,6 @@ from . import (
     register_ade20k_instance,
     register_mapillary_vistas_panoptic,
     register_polypdb_instance,
-    register_polypdb_semantic
+    register_polypdb_semantic,
+    register_polypdb_packed,
 )
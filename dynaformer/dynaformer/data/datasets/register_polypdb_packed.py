@@ -0,0 +1,239 @@
+# Copyright (c) Selab-HCMUS and its affiliates.
+"""
+Packed datasets: the images (encoded bytes, as in their files) and the semantic masks (binarized,
+bit-packed) of a dataset are stored in a few large shard files with an offset index, and read
+through memory maps instead of opening one or two small files per image.
+
+A pack directory contains:
+
+    * "shard-XXXXX.bin": blobs, one after the other
+    * "index.npy": one row per blob, (shard, offset, length, height, width), height and width are
+      those of a mask blob and 0 for an image blob
+    * "dataset.json": the dataset dicts, "file_name" and "sem_seg_file_name" are blob indices
+
+The loaded dicts refer to their blobs with "packed://<pack dir>/<blob>" paths. These paths are opened
+by :class:`PackedPathHandler` of detectron2's PathManager, so that :func:`detection_utils.read_image`,
+and the dataset mappers, read the images of a packed dataset unchanged. Masks are read with
+:func:`read_packed_mask`.
+"""
+import io
+import json
+import logging
+import mmap
+import os
+
+import numpy as np
+
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.structures import BoxMode
+from detectron2.utils.file_io import PathHandler, PathManager
+
+logger = logging.getLogger(__name__)
+
+PACKED_PREFIX = "packed://"
+
+INDEX_DTYPE = np.dtype(
+    [("shard", "<i4"), ("offset", "<i8"), ("length", "<i8"), ("height", "<i4"), ("width", "<i4")]
+)
+
+
+def _shard_path(pack_dir, shard):
+    return os.path.join(pack_dir, "shard-{:05d}.bin".format(shard))
+
+
+class PackWriter:
+    """
+    Writes the blobs of a pack directory, starting a new shard when the current one exceeds
+    `shard_size` bytes.
+    """
+
+    def __init__(self, pack_dir, shard_size=256 * 1024 * 1024):
+        self.pack_dir = pack_dir
+        self.shard_size = shard_size
+        self.index = []
+        self._shard = -1
+        self._file = None
+        os.makedirs(pack_dir, exist_ok=True)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self._shard += 1
+        self._file = open(_shard_path(self.pack_dir, self._shard), "wb")
+
+    def add(self, data, height=0, width=0):
+        """
+        Returns:
+            int: index of the blob
+        """
+        if self._file is None or (self._file.tell() > 0 and self._file.tell() + len(data) > self.shard_size):
+            self._next_shard()
+        self.index.append((self._shard, self._file.tell(), len(data), height, width))
+        self._file.write(data)
+        return len(self.index) - 1
+
+    def add_file(self, file_name):
+        with PathManager.open(file_name, "rb") as f:
+            return self.add(f.read())
+
+    def add_mask(self, mask):
+        """
+        Args:
+            mask: H*W bool array
+        """
+        return self.add(np.packbits(mask, axis=None).tobytes(), *mask.shape)
+
+    def close(self, dataset_dicts):
+        """
+        Args:
+            dataset_dicts: the dicts of the dataset, with blob indices as "file_name" (and "sem_seg_file_name")
+        """
+        if self._file is not None:
+            self._file.close()
+        np.save(os.path.join(self.pack_dir, "index.npy"), np.array(self.index, dtype=INDEX_DTYPE))
+        with open(os.path.join(self.pack_dir, "dataset.json"), "w") as f:
+            json.dump(dataset_dicts, f)
+
+
+class PackedShards:
+    """
+    Random access to the blobs of a pack directory. Shards are memory mapped lazily, and again in each
+    process, so that the data loader workers do not share maps opened before they were forked.
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.index = np.load(os.path.join(pack_dir, "index.npy"))
+        self._maps = {}
+        self._pid = None
+
+    def _map(self, shard):
+        if self._pid != os.getpid():
+            self._maps = {}
+            self._pid = os.getpid()
+        if shard not in self._maps:
+            with open(_shard_path(self.pack_dir, shard), "rb") as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def blob(self, blob):
+        """
+        Returns:
+            memoryview: the bytes of the blob, a view of the memory map
+        """
+        row = self.index[blob]
+        shard, offset, length = int(row["shard"]), int(row["offset"]), int(row["length"])
+        return memoryview(self._map(shard))[offset : offset + length]
+
+    def mask(self, blob):
+        """
+        Returns:
+            np.ndarray: H*W uint8 mask of a mask blob, 255 on the foreground
+        """
+        height, width = int(self.index[blob]["height"]), int(self.index[blob]["width"])
+        bits = np.frombuffer(self.blob(blob), dtype=np.uint8)
+        return np.unpackbits(bits, count=height * width).reshape(height, width) * np.uint8(255)
+
+
+_PACKS = {}
+
+
+def get_packed_shards(pack_dir):
+    if pack_dir not in _PACKS:
+        _PACKS[pack_dir] = PackedShards(pack_dir)
+    return _PACKS[pack_dir]
+
+
+def is_packed_path(path):
+    return isinstance(path, str) and path.startswith(PACKED_PREFIX)
+
+
+def _parse_packed_path(path):
+    pack_dir, blob = os.path.split(path[len(PACKED_PREFIX) :])
+    return get_packed_shards(pack_dir), int(blob)
+
+
+def read_packed_mask(path):
+    """
+    Returns:
+        np.ndarray: H*W uint8 mask of a "packed://" path, 255 on the foreground
+    """
+    shards, blob = _parse_packed_path(path)
+    return shards.mask(blob)
+
+
+class PackedPathHandler(PathHandler):
+    """
+    Opens the blobs of packed datasets, "packed://<pack dir>/<blob>", as read-only binary files.
+    """
+
+    def _get_supported_prefixes(self):
+        return [PACKED_PREFIX]
+
+    def _open(self, path, mode="r", buffering=-1, **kwargs):
+        self._check_kwargs(kwargs)
+        assert mode in ("r", "rb"), "Packed datasets are read-only, got mode {}".format(mode)
+        shards, blob = _parse_packed_path(path)
+        return io.BytesIO(shards.blob(blob))
+
+    def _exists(self, path, **kwargs):
+        self._check_kwargs(kwargs)
+        shards, blob = _parse_packed_path(path)
+        return 0 <= blob < len(shards.index)
+
+    def _isfile(self, path, **kwargs):
+        return self._exists(path, **kwargs)
+
+
+PathManager.register_handler(PackedPathHandler())
+
+
+def load_packed_dataset(pack_dir):
+    """
+    Returns:
+        list[dict]: the dataset dicts of a pack directory, with "packed://" paths
+    """
+    pack_dir = os.path.abspath(pack_dir)
+    with open(os.path.join(pack_dir, "dataset.json")) as f:
+        dataset_dicts = json.load(f)
+    for record in dataset_dicts:
+        for key in ("file_name", "sem_seg_file_name"):
+            if key in record:
+                record[key] = "{}{}/{}".format(PACKED_PREFIX, pack_dir, record[key])
+        for anno in record.get("annotations", []):
+            # saved as int by json
+            anno["bbox_mode"] = BoxMode(anno["bbox_mode"])
+    logger.info("Loaded {} images from the packed dataset {}".format(len(dataset_dicts), pack_dir))
+    return dataset_dicts
+
+
+def register_packed_dataset(name, pack_dir, source):
+    """
+    Register a packed dataset with the metadata of the dataset it was packed from.
+
+    Args:
+        name (str): name of the packed dataset
+        pack_dir (str): pack directory
+        source (str): name of the registered dataset that was packed
+    """
+    DatasetCatalog.register(name, lambda: load_packed_dataset(pack_dir))
+    metadata = {k: v for k, v in MetadataCatalog.get(source).as_dict().items() if k != "name"}
+    MetadataCatalog.get(name).set(**metadata, packed_from=source)
+
+
+# ==== Predefined packed training splits, packed with tools/pack_dataset.py ==========
+# Evaluation reads the ground truth of the original files, keep the original splits in DATASETS.TEST.
+
+_PREDEFINED_PACKED_SPLITS = {
+    "polypdb_ins_train_packed": ("polypdb_ins_train", "packed/polypdb_ins_train"),
+    "polypdb_ins_sem_seg_train_packed": ("polypdb_ins_sem_seg_train", "packed/polypdb_ins_sem_seg_train"),
+}
+
+
+def register_all_polypdb_packed(root):
+    for name, (source, pack_dir) in _PREDEFINED_PACKED_SPLITS.items():
+        register_packed_dataset(name, os.path.join(root, pack_dir), source)
+
+
+_root = os.path.expanduser(os.getenv("DETECTRON2_DATASETS", "./datasets"))
+register_all_polypdb_packed(_root)
@@ -3,6 +3,7 @@
 import os
 import logging
 from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets import load_cached_dataset_dicts
 from detectron2.data.datasets.coco import register_coco_instances
 import json
 logger = logging.getLogger(__name__)
@@ -45,8 +46,17 @@ def polyp_ins_load_sem_seg(gt_root, image_root,json_file, gt_ext="png", image_ex
     Notes:
         1. This function does not read the image and ground truth files.
            The results do not have the "image" and "sem_seg" fields.
+        2. The results are cached on disk, see :func:`load_cached_dataset_dicts`.
     """
+    return load_cached_dataset_dicts(
+        "polyp_ins_load_sem_seg",
+        json_file,
+        (gt_root, image_root, gt_ext, image_ext, json_ext),
+        lambda: _polyp_ins_load_sem_seg(gt_root, image_root, json_file, gt_ext, image_ext),
+    )
+
 
+def _polyp_ins_load_sem_seg(gt_root, image_root, json_file, gt_ext="png", image_ext="jpg"):
     # We match input images with ground truth based on their relative filepaths (without file
     # extensions) starting from 'image_root' and 'gt_root' respectively.
     def file2id(folder_path, file_path):
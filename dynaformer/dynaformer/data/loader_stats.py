@@ -0,0 +1,200 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Instrumentation of the training data loader: the mappers time their stages in the data loader workers,
+the timings and counters of the workers are written to shared memory and published to the
+`EventStorage` by the main process.
+"""
+import contextlib
+import io
+import time
+
+import torch
+from torch.utils.data import get_worker_info
+
+from detectron2.structures import Instances
+from detectron2.utils.events import get_event_storage
+from detectron2.utils.file_io import PathManager
+
+STAGES = ("read", "decode", "transform", "targets", "to_tensor")
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def _nbytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.element_size() * x.nelement()
+    if isinstance(x, dict):
+        return sum(_nbytes(v) for v in x.values())
+    if isinstance(x, Instances):
+        return sum(_nbytes(v) for v in x.get_fields().values())
+    if isinstance(getattr(x, "tensor", None), torch.Tensor):
+        # Boxes, BitMasks
+        return _nbytes(x.tensor)
+    return 0
+
+
+class LoaderStats:
+    """
+    Side channel of the timings of the data loader workers. Per worker, the timings of the stages of the
+    last `capacity` mapped samples in a ring buffer, the number of mapped samples, the seconds spent
+    mapping them and the bytes of their tensors, in shared memory created before the workers start so
+    that they all inherit it. A worker only writes its own row and the main process reads them without
+    locks.
+
+    The stages are exclusive: the time of a stage nested in another one is not counted in the outer one.
+    """
+
+    def __init__(self, num_workers, capacity=1024):
+        """
+        Args:
+            num_workers: number of data loader workers, 0 if the samples are mapped in the main process
+            capacity: number of samples of the ring buffer of a worker
+        """
+        self.num_workers = max(num_workers, 1)
+        self.capacity = capacity
+        self.timings = torch.zeros((self.num_workers, capacity, len(STAGES)), dtype=torch.float32).share_memory_()
+        # per worker: number of mapped samples, busy seconds, bytes of the tensors of the mapped samples
+        self.counters = torch.zeros((self.num_workers, 3), dtype=torch.float64).share_memory_()
+        # state of the sample mapped by the current process
+        self._sample_timings = None
+        self._sample_start = 0.0
+        self._nested = 0.0
+
+    def start_sample(self):
+        self._sample_timings = [0.0] * len(STAGES)
+        self._sample_start = time.perf_counter()
+        self._nested = 0.0
+
+    def end_sample(self, dataset_dict):
+        busy = time.perf_counter() - self._sample_start
+        worker_info = get_worker_info()
+        worker = worker_info.id if worker_info is not None else 0
+        num_samples = int(self.counters[worker, 0])
+        self.timings[worker, num_samples % self.capacity] = torch.tensor(self._sample_timings)
+        self.counters[worker, 1] += busy
+        self.counters[worker, 2] += _nbytes(dataset_dict) if dataset_dict is not None else 0
+        # last, the timings of the sample are complete when it is counted
+        self.counters[worker, 0] += 1
+        self._sample_timings = None
+
+    def cancel_sample(self):
+        """
+        Drop the sample being mapped, e.g. when the mapper raised, so that the stages timed until the
+        next :meth:`start_sample` are not charged to it.
+        """
+        self._sample_timings = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the sample being mapped, no-op outside of a sample (e.g. in the main process with
+        :class:`BatchAugmentation`).
+        """
+        if self._sample_timings is None:
+            yield
+            return
+        outer_nested, self._nested = self._nested, 0.0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._sample_timings[STAGES.index(name)] += elapsed - self._nested
+            self._nested = outer_nested + elapsed
+
+
+def stage(stats, name):
+    """
+    Returns:
+        the context timing the stage `name` with `stats`, a no-op context if `stats` is None
+    """
+    return stats.stage(name) if stats is not None else _NULL_STAGE
+
+
+def read_file(stats, file_name):
+    """
+    Returns:
+        `file_name`, or with `stats`, the content of the file read in the "read" stage as a file object,
+            so that :func:`detection_utils.read_image` only decodes it
+    """
+    if stats is None:
+        return file_name
+    with stats.stage("read"):
+        with PathManager.open(file_name, "rb") as f:
+            return io.BytesIO(f.read())
+
+
+class InstrumentedMapper:
+    """
+    Records the samples mapped by `mapper` in :class:`LoaderStats`, and the timings of the stages of a
+    mapper built with the same `loader_stats`.
+    """
+
+    def __init__(self, mapper, stats):
+        self.mapper = mapper
+        self.stats = stats
+
+    def __call__(self, dataset_dict):
+        self.stats.start_sample()
+        try:
+            dataset_dict = self.mapper(dataset_dict)
+            self.stats.end_sample(dataset_dict)
+        finally:
+            self.stats.cancel_sample()
+        return dataset_dict
+
+
+class InstrumentedDataLoader:
+    """
+    Publishes the :class:`LoaderStats` of a data loader to the `EventStorage` every `period` batches:
+
+        * `loader/{stage}_ms`: histogram of the times of a stage per sample, and `loader/{stage}_time`
+          their mean in seconds
+        * `loader/queue_depth`: samples mapped by the workers and not consumed yet
+        * `loader/worker{i}_utilization`: fraction of the time worker i spent mapping samples
+        * `loader/bytes_per_batch`: bytes of the tensors of a batch, transferred from the workers
+    """
+
+    def __init__(self, data_loader, stats, period=20):
+        self.data_loader = data_loader
+        self.stats = stats
+        self.period = period
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        last_counters = self.stats.counters.clone()
+        last_time = time.perf_counter()
+        num_consumed = num_batches = 0
+        for batch in self.data_loader:
+            num_consumed += len(batch)
+            num_batches += 1
+            if num_batches == self.period:
+                counters = self.stats.counters.clone()
+                now = time.perf_counter()
+                self.publish(get_event_storage(), last_counters, counters, now - last_time, num_consumed, num_batches)
+                last_counters, last_time, num_batches = counters, now, 0
+            yield batch
+
+    def publish(self, storage, last_counters, counters, elapsed, num_consumed, num_batches):
+        delta = counters - last_counters
+        storage.put_scalar("loader/queue_depth", float(counters[:, 0].sum()) - num_consumed)
+        for i, busy in enumerate(delta[:, 1].tolist()):
+            storage.put_scalar("loader/worker{}_utilization".format(i), busy / elapsed)
+        storage.put_scalar("loader/bytes_per_batch", float(delta[:, 2].sum()) / num_batches)
+
+        # timings of the samples mapped since the last report, at most `capacity` per worker
+        timings = []
+        for worker, (start, end) in enumerate(zip(last_counters[:, 0].tolist(), counters[:, 0].tolist())):
+            indices = torch.arange(max(int(start), int(end) - self.stats.capacity), int(end)) % self.stats.capacity
+            timings.append(self.stats.timings[worker, indices])
+        timings = torch.cat(timings)
+        if len(timings) == 0:
+            return
+        for i, name in enumerate(STAGES):
+            storage.put_histogram("loader/{}_ms".format(name), timings[:, i] * 1000)
+            storage.put_scalar("loader/{}_time".format(name), float(timings[:, i].mean()))
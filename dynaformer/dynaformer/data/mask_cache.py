@@ -0,0 +1,76 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+A bounded cache of byte strings shared by the data loader workers.
+"""
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+
+class SharedMaskCache:
+    """
+    Direct-mapped table of fixed-size slots in shared memory, created before the data loader workers
+    start so that they all inherit it. A key is stored in slot `key % num_slots` and replaces the
+    previous one. Writes are serialized by a lock; reads take no lock and are treated as misses when
+    they race with a write of the same slot (the version of a slot is odd while it is written).
+
+    Values larger than a slot are not cached.
+    """
+
+    def __init__(self, size_mb, slot_size=16 * 1024):
+        """
+        Args:
+            size_mb: size of the table in MB
+            slot_size: size of a slot in bytes
+        """
+        self.slot_size = slot_size
+        self.num_slots = max(int(size_mb * 1024 * 1024) // slot_size, 1)
+        self.data = torch.zeros((self.num_slots, slot_size), dtype=torch.uint8).share_memory_()
+        # per slot: key + 1 (0 is empty), length and version
+        self.header = torch.zeros((self.num_slots, 3), dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+        # statistics of the current process
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Args:
+            key (int): non-negative key
+        Returns:
+            bytes or None
+        """
+        header = self.header[key % self.num_slots]
+        version = int(header[2])
+        if version % 2 == 1 or int(header[0]) != key + 1:
+            self.misses += 1
+            return None
+        value = self.data[key % self.num_slots, : int(header[1])].numpy().tobytes()
+        if int(header[2]) != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Returns:
+            bool: whether the value was cached
+        """
+        if len(value) > self.slot_size:
+            return False
+        slot = key % self.num_slots
+        with self.lock:
+            self.header[slot, 2] += 1
+            self.header[slot, 0] = key + 1
+            self.header[slot, 1] = len(value)
+            self.data[slot, : len(value)] = torch.from_numpy(np.frombuffer(value, dtype=np.uint8).copy())
+            self.header[slot, 2] += 1
+        return True
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
@@ -0,0 +1,143 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Collation and prefetching of the training batches: the images of a batch are copied into one padded
+(pinned) tensor, the ground truth masks into one packed tensor, and both are moved to the device ahead
+of the training step, see :meth:`DYNAFormer.preprocess_image`.
+"""
+import queue
+import threading
+
+import torch
+
+
+class CollatedBatch(list):
+    """
+    A batch of mapped dicts with:
+
+        * `images`: N*C*H*W tensor of the images padded with zeros to the largest size of the batch
+        * `image_sizes`: list of (h, w)
+        * `gt_masks`: M*H*W tensor of the padded ground truth masks of all the images, in order, or None.
+          The "instances" of the dicts do not have "gt_masks" then
+        * `num_instances`: list of the number of masks of each image
+    """
+
+    def __init__(self, batch, images, image_sizes, gt_masks=None, num_instances=None):
+        super().__init__(batch)
+        self.images = images
+        self.image_sizes = image_sizes
+        self.gt_masks = gt_masks
+        self.num_instances = num_instances
+
+    def to(self, device, non_blocking=False):
+        self.images = self.images.to(device, non_blocking=non_blocking)
+        if self.gt_masks is not None:
+            self.gt_masks = self.gt_masks.to(device, non_blocking=non_blocking)
+        return self
+
+    def record_stream(self, stream):
+        # the tensors are allocated on the copy stream and used on `stream`
+        self.images.record_stream(stream)
+        if self.gt_masks is not None:
+            self.gt_masks.record_stream(stream)
+
+
+def collate_batch(batch, pin_memory=False):
+    """
+    Returns:
+        CollatedBatch: the batch with its images, and its ground truth masks if they are tensors,
+            copied into padded tensors (in pinned memory if `pin_memory` and on the CPU)
+    """
+    image_sizes = [tuple(d["image"].shape[-2:]) for d in batch]
+    max_h, max_w = (max(s) for s in zip(*image_sizes))
+    first = batch[0]["image"]
+    pin_memory = pin_memory and first.device.type == "cpu"
+    images = torch.zeros(
+        (len(batch), first.shape[0], max_h, max_w), dtype=first.dtype, device=first.device, pin_memory=pin_memory
+    )
+    for i, (d, (h, w)) in enumerate(zip(batch, image_sizes)):
+        images[i, :, :h, :w].copy_(d["image"])
+
+    instances = [d.get("instances") for d in batch]
+    if any(x is None or not (x.has("gt_masks") and isinstance(x.gt_masks, torch.Tensor)) for x in instances):
+        return CollatedBatch(batch, images, image_sizes)
+    num_instances = [len(x) for x in instances]
+    masks = [x.gt_masks for x in instances]
+    gt_masks = torch.zeros(
+        (sum(num_instances), max_h, max_w), dtype=masks[0].dtype, device=masks[0].device, pin_memory=pin_memory
+    )
+    start = 0
+    for m in masks:
+        gt_masks[start : start + len(m), : m.shape[-2], : m.shape[-1]].copy_(m)
+        start += len(m)
+    for x in instances:
+        x.remove("gt_masks")
+    return CollatedBatch(batch, images, image_sizes, gt_masks, num_instances)
+
+
+class PrefetchDataLoader:
+    """
+    Collates the batches of a training data loader (:func:`collate_batch`) in a background thread of the
+    main process, a few batches ahead, and keeps the copy of the next batch to the device in flight on a
+    side CUDA stream while the current batch trains.
+
+    The collation is not done by the data loader workers: the batches are formed in the main process
+    (aspect ratio grouping, size bucketing, batch augmentation), and pinned memory is only allocated there.
+    """
+
+    def __init__(self, data_loader, device, num_prefetch=2):
+        """
+        Args:
+            data_loader: an iterable of lists of mapped dicts
+            device: the training device
+            num_prefetch: number of collated batches held ahead
+        """
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _collate(self, batches):
+        try:
+            for batch in self.data_loader:
+                batches.put(collate_batch(batch, pin_memory=self.device.type == "cuda"))
+        except Exception as e:
+            batches.put(e)
+        batches.put(None)
+
+    def _next(self, batches, stream):
+        """
+        Returns:
+            the next collated batch, with its copy to the device issued on `stream`, or None at the end
+        """
+        batch = batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if batch is None or stream is None:
+            return batch
+        with torch.cuda.stream(stream):
+            return batch.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        thread = threading.Thread(target=self._collate, args=(batches,), daemon=True)
+        thread.start()
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        batch = self._next(batches, stream)
+        while batch is not None:
+            if stream is None:
+                yield batch.to(self.device)
+                batch = self._next(batches, stream)
+                continue
+            # the step of this batch waits for its copy only, not for the copy of the next batch issued
+            # below, which overlaps the step
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch.record_stream(current)
+            next_batch = self._next(batches, stream)
+            yield batch
+            batch = next_batch
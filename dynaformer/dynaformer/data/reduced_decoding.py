@@ -0,0 +1,196 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Reduced-size decoding of the images that the augmentations downscale.
+
+The augmentations of an image are sampled from its size, before it is decoded, so that a JPEG can be
+decoded directly at the power-of-two reduction (DCT-domain scaling, see :func:`read_image`) that the
+first resize allows. The transforms before that resize (flips, rotations) are rebuilt for the decoded
+size, and the resize then outputs the size it was sampled with: the transforms after it are unchanged,
+and the annotations are transformed with the transforms sampled for the full-size image.
+"""
+import math
+
+import numpy as np
+from PIL import Image
+
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+from detectron2.projects.point_rend import ColorAugSSDTransform
+from detectron2.utils.file_io import PathManager
+
+# augmentations whose transforms only depend on the size of the image
+_SIZE_AUGMENTATIONS = (
+    T.RandomFlip,
+    T.Resize,
+    T.ResizeShortestEdge,
+    T.ResizeScale,
+    T.RandomRotation,
+    T.RandomCrop,
+    T.FixedSizeCrop,
+)
+# transforms that keep the size of the image
+_SAME_SIZE_TRANSFORMS = (T.NoOpTransform, T.HFlipTransform, T.VFlipTransform, ColorAugSSDTransform)
+# transforms that can be applied to, or rebuilt for, a downscaled input
+_RESCALABLE_TRANSFORMS = (
+    T.NoOpTransform,
+    T.HFlipTransform,
+    T.VFlipTransform,
+    T.RotationTransform,
+    ColorAugSSDTransform,
+)
+
+
+def supports_reduced_decoding(augmentations):
+    """
+    Whether the transforms of `augmentations` can be sampled from the size of the image only.
+    """
+    for aug in augmentations:
+        if isinstance(aug, T.RandomCrop_CategoryAreaConstraint):
+            # without the area constraint, the crop does not look at the segmentation
+            if aug.single_category_max_area < 1.0:
+                return False
+        elif not isinstance(aug, _SIZE_AUGMENTATIONS + _SAME_SIZE_TRANSFORMS):
+            return False
+    return True
+
+
+def transformed_size(tfm, height, width):
+    """
+    Returns:
+        (int, int): size of an image of (height, width) after `tfm`
+    """
+    if isinstance(tfm, T.TransformList):
+        for t in tfm.transforms:
+            height, width = transformed_size(t, height, width)
+        return height, width
+    if isinstance(tfm, _SAME_SIZE_TRANSFORMS):
+        return height, width
+    if isinstance(tfm, T.ResizeTransform):
+        return tfm.new_h, tfm.new_w
+    if isinstance(tfm, T.RotationTransform):
+        return int(tfm.bound_h), int(tfm.bound_w)
+    if isinstance(tfm, T.CropTransform):
+        return tfm.h, tfm.w
+    if isinstance(tfm, T.PadTransform):
+        return height + tfm.y0 + tfm.y1, width + tfm.x0 + tfm.x1
+    raise NotImplementedError("Output size of {} is unknown".format(type(tfm).__name__))
+
+
+def sample_transforms(augmentations, height, width):
+    """
+    Sample the transforms of `augmentations` for an image of (height, width) without decoding it, see
+    :func:`supports_reduced_decoding`.
+
+    Returns:
+        TransformList
+    """
+    transforms = []
+    for aug in augmentations:
+        # the augmentations only read the shape of this placeholder
+        image = np.broadcast_to(np.zeros((), dtype=np.uint8), (height, width, 3))
+        if isinstance(aug, T.Transform):
+            tfm = aug
+        elif isinstance(aug, T.RandomCrop_CategoryAreaConstraint):
+            tfm = aug.crop_aug.get_transform(image)
+        else:
+            tfm = aug.get_transform(image)
+        height, width = transformed_size(tfm, height, width)
+        transforms.append(tfm)
+    return T.TransformList(transforms)
+
+
+def decode_size(transforms, height, width):
+    """
+    Returns:
+        (int, int) or None: the smallest size (h, w) an image of (height, width) can be decoded at for
+            `transforms`, from the scale of their first resize. None if the image is not downscaled
+            by at least 2, or the transforms before the resize cannot be rebuilt for another size
+    """
+    for tfm in transforms.transforms:
+        if isinstance(tfm, T.ResizeTransform):
+            # rotations keep the scale, the resize scales the image as much as the input
+            scale = max(tfm.new_h / tfm.h, tfm.new_w / tfm.w)
+            if scale > 0.5:
+                return None
+            return math.ceil(height * scale), math.ceil(width * scale)
+        if not isinstance(tfm, _RESCALABLE_TRANSFORMS):
+            return None
+    return None
+
+
+def rescale_transforms(transforms, height, width):
+    """
+    Rebuild the transforms sampled by :func:`sample_transforms` for the image decoded at
+    (height, width): the transforms up to the first resize are rebuilt, the others are kept.
+
+    Returns:
+        TransformList
+    """
+    rescaled = []
+    for i, tfm in enumerate(transforms.transforms):
+        if isinstance(tfm, T.ResizeTransform):
+            rescaled.append(T.ResizeTransform(height, width, tfm.new_h, tfm.new_w, tfm.interp))
+            return T.TransformList(rescaled + transforms.transforms[i + 1 :])
+        if isinstance(tfm, T.HFlipTransform):
+            tfm = T.HFlipTransform(width)
+        elif isinstance(tfm, T.VFlipTransform):
+            tfm = T.VFlipTransform(height)
+        elif isinstance(tfm, T.RotationTransform):
+            center = np.asarray(tfm.center) * (width / tfm.w, height / tfm.h)
+            tfm = T.RotationTransform(height, width, tfm.angle, tfm.expand, center, tfm.interp)
+        rescaled.append(tfm)
+        height, width = transformed_size(tfm, height, width)
+    raise ValueError("The transforms do not resize the image")
+
+
+def read_image_size(file_name):
+    """
+    Returns:
+        (int, int): size (h, w) of an image after its exif orientation, from the header of the file
+    """
+    with PathManager.open(file_name, "rb") as f:
+        image = Image.open(f)
+        width, height = image.size
+        try:
+            orientation = image.getexif().get(utils._EXIF_ORIENT)
+        except Exception:
+            orientation = None
+    if orientation in (5, 6, 7, 8):
+        return width, height
+    return height, width
+
+
+def read_reduced_image(file_name, image_format, transforms, image_size):
+    """
+    Read an image at the smallest size allowed by `transforms`, sampled for its `image_size`.
+
+    Returns:
+        np.ndarray: the image, possibly decoded at a reduced size
+        TransformList: `transforms` rebuilt for the decoded image
+    """
+    target_size = decode_size(transforms, *image_size)
+    image = utils.read_image(file_name, format=image_format, target_size=target_size)
+    return image, transforms_for_size(transforms, image_size, image.shape[:2], file_name)
+
+
+def transforms_for_size(transforms, image_size, decoded_size, file_name=""):
+    """
+    Returns:
+        TransformList: `transforms`, sampled for an image of `image_size`, for the image (or a mask of
+            it) decoded at `decoded_size`
+    """
+    image_size, decoded_size = tuple(image_size), tuple(decoded_size)
+    if decoded_size == image_size:
+        return transforms
+    if not any(
+        decoded_size == tuple(math.ceil(s / factor) for s in image_size) for factor in (2, 4, 8)
+    ):
+        raise utils.SizeMismatchError(
+            "Mismatched image shape for image {}, got {}, expect {} or a power-of-two reduction.".format(
+                file_name, decoded_size, image_size
+            )
+        )
+    return rescale_transforms(transforms, *decoded_size)
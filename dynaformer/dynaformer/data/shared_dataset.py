@@ -0,0 +1,135 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Dataset dicts shared by all the processes of a machine: the dicts are loaded and serialized once, by
+local rank 0, into a file memory-mapped by every local rank and their data loader workers, instead of
+being loaded and serialized by `DatasetFromList` in every rank.
+"""
+import atexit
+import logging
+import mmap
+import os
+import pickle
+import tempfile
+import time
+
+import numpy as np
+
+from detectron2.data import get_detection_dataset_dicts
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+
+def write_serialized_list(lst, path):
+    """
+    Serialize the items of `lst` into the file `path`: the number of items n, the n + 1 offsets of the
+    items in the data and the pickled items.
+    """
+    offsets = np.zeros(len(lst) + 1, dtype=np.int64)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(np.int64(len(lst)).tobytes())
+        f.seek(offsets.nbytes + 8)
+        for i, x in enumerate(lst):
+            buffer = pickle.dumps(x, protocol=-1)
+            f.write(buffer)
+            offsets[i + 1] = offsets[i] + len(buffer)
+        f.seek(8)
+        f.write(offsets.tobytes())
+    os.replace(tmp_path, path)
+
+
+class SharedSerializedList:
+    """
+    A list-like object over a file written by :func:`write_serialized_list`, like `_TorchSerializedList`
+    but memory-mapped read-only: the processes that map the same file share its pages, and the items
+    are unpickled from the mapping without a copy of the buffer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        n = int(np.frombuffer(self._buffer, dtype=np.int64, count=1)[0])
+        self._addr = np.frombuffer(self._buffer, dtype=np.int64, count=n + 1, offset=8)
+        self._data_offset = 8 * (n + 2)
+
+    def __reduce__(self):
+        # spawned data loader workers map the file again
+        return SharedSerializedList, (self.path,)
+
+    def __len__(self):
+        return len(self._addr) - 1
+
+    def __getitem__(self, idx):
+        start = self._data_offset + int(self._addr[idx])
+        end = self._data_offset + int(self._addr[idx + 1])
+        return pickle.loads(memoryview(self._buffer)[start:end])
+
+    @property
+    def nbytes(self):
+        return len(self._buffer)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def build_shared_dataset(load_dicts, directory=""):
+    """
+    Load the dataset dicts on local rank 0 only, write them to a file of `directory` and map it on all
+    the local ranks. All ranks must call this function together. The file is removed when local rank 0
+    exits.
+
+    Args:
+        load_dicts (callable): returns the list of dataset dicts
+        directory (str): directory of the file, /dev/shm (or the temporary directory) by default
+
+    Returns:
+        SharedSerializedList
+    """
+    start = time.perf_counter()
+    path = None
+    if comm.get_local_rank() == 0:
+        if not directory:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        fd, path = tempfile.mkstemp(prefix="dynaformer_dataset_", suffix=".bin", dir=directory)
+        os.close(fd)
+        atexit.register(_remove, path)
+        write_serialized_list(load_dicts(), path)
+    # the ranks of a machine are consecutive, see `comm.create_local_process_group`
+    path = comm.all_gather(path)[comm.get_rank() - comm.get_local_rank()]
+    dataset = SharedSerializedList(path)
+    logger.info(
+        "Mapped {} dataset dicts ({:.2f} MiB) from {} in {:.2f} s, RSS {:.2f} MiB".format(
+            len(dataset), dataset.nbytes / 1024**2, path, time.perf_counter() - start, _rss_mb()
+        )
+    )
+    return dataset
+
+
+def build_shared_train_dataset(cfg):
+    """
+    The training dataset dicts of `cfg`, as loaded by `build_detection_train_loader`, shared by the ranks
+    of the machine.
+    """
+    return build_shared_dataset(
+        lambda: get_detection_dataset_dicts(
+            cfg.DATASETS.TRAIN,
+            filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+            min_keypoints=(
+                cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE if cfg.MODEL.KEYPOINT_ON else 0
+            ),
+            proposal_files=cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None,
+        ),
+        cfg.DATALOADER.SHARED_DATASET.DIR,
+    )
@@ -0,0 +1,111 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Size-bucketed batching: the mapped images are batched with images of similar size after augmentation,
+so that `ImageList.from_tensors` pads them less than with the landscape / portrait grouping of
+:class:`AspectRatioGroupedDataset`.
+"""
+import itertools
+import logging
+import math
+
+import torch.utils.data as torchdata
+
+from detectron2.data import build_detection_train_loader
+from detectron2.utils.comm import get_world_size
+
+
+class SizeBucketedDataset(torchdata.IterableDataset):
+    """
+    Batches the mapped dicts of a data loader by the size of their "image", rounded up to multiples of
+    `bucket_size`. A batch is yielded when a bucket is full. At most `max_buffer` dicts are held: when
+    the buffer is full, or when the oldest dict has waited for `max_buffer` dicts, the oldest dict is
+    batched with the dicts of the nearest sizes. Every dict is thus yielded within `max_buffer +
+    batch_size` dicts of its arrival and the sampled distribution is not changed.
+
+    The sizes are those of the mapped images, they must be the augmented sizes.
+    """
+
+    def __init__(self, dataset, batch_size, bucket_size=64, max_buffer=64):
+        """
+        Args:
+            dataset: an iterable of lists of mapped dicts with an "image" tensor, e.g. a data loader
+                of batch size 1
+            batch_size (int):
+            bucket_size (int): size in pixels of the buckets, along both dimensions
+            max_buffer (int): maximum number of dicts held, at least `batch_size`
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.max_buffer = max(max_buffer, batch_size)
+        # (h, w) in buckets -> list of (arrival index, dict)
+        self._buckets = {}
+
+    def _take(self, key, n):
+        bucket = self._buckets[key]
+        if len(bucket) <= n:
+            del self._buckets[key]
+        else:
+            self._buckets[key] = bucket[n:]
+        return [d for _, d in bucket[:n]]
+
+    def _oldest(self):
+        return min(bucket[0][0] for bucket in self._buckets.values())
+
+    def _evict(self):
+        """
+        Returns:
+            list[dict]: a batch of the oldest dict and of the dicts that add the least padding to it
+        """
+        key = min(self._buckets, key=lambda k: self._buckets[k][0][0])
+        batch = self._take(key, self.batch_size)
+        h, w = key
+        while len(batch) < self.batch_size:
+            key = min(self._buckets, key=lambda k: (max(h, k[0]) * max(w, k[1]), self._buckets[k][0][0]))
+            batch += self._take(key, self.batch_size - len(batch))
+            h, w = max(h, key[0]), max(w, key[1])
+        return batch
+
+    def __iter__(self):
+        num_buffered = 0
+        for idx, d in enumerate(itertools.chain.from_iterable(self.dataset)):
+            h, w = d["image"].shape[-2:]
+            key = (math.ceil(h / self.bucket_size), math.ceil(w / self.bucket_size))
+            bucket = self._buckets.setdefault(key, [])
+            bucket.append((idx, d))
+            num_buffered += 1
+            if len(bucket) == self.batch_size:
+                # Clear bucket first, because code after yield is not
+                # guaranteed to execute
+                data = self._take(key, self.batch_size)
+                num_buffered -= self.batch_size
+                yield data
+            if num_buffered >= self.max_buffer or (
+                num_buffered >= self.batch_size and idx - self._oldest() >= self.max_buffer
+            ):
+                num_buffered -= self.batch_size
+                yield self._evict()
+
+
+def build_size_bucketed_train_loader(cfg, mapper, dataset=None):
+    """
+    The training data loader of `cfg`, with :class:`SizeBucketedDataset` batching instead of the aspect
+    ratio grouping. The underlying detectron2 loader yields single dicts per rank, with the sampler and
+    the distributed semantics of `build_detection_train_loader`. `dataset` replaces the dataset dicts
+    of `cfg` if given.
+    """
+    world_size = get_world_size()
+    batch_size = cfg.SOLVER.IMS_PER_BATCH // world_size
+    data_loader = build_detection_train_loader(
+        cfg, mapper=mapper, dataset=dataset, total_batch_size=world_size, aspect_ratio_grouping=False
+    )
+    bucketing_cfg = cfg.DATALOADER.SIZE_BUCKETING
+    logging.getLogger(__name__).info(
+        "Batching by size with buckets of {} pixels and a buffer of {} images".format(
+            bucketing_cfg.BUCKET_SIZE, bucketing_cfg.MAX_BUFFER
+        )
+    )
+    return SizeBucketedDataset(data_loader, batch_size, bucketing_cfg.BUCKET_SIZE, bucketing_cfg.MAX_BUFFER)
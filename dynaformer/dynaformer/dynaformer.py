@@ -15,11 +15,14 @@ from detectron2.data import MetadataCatalog
 from detectron2.modeling import META_ARCH_REGISTRY, build_backbone, build_sem_seg_head
 from detectron2.modeling.backbone import Backbone
 from detectron2.modeling.postprocessing import sem_seg_postprocess
-from detectron2.structures import Boxes, ImageList, Instances, BitMasks
+from detectron2.structures import Boxes, ImageList, Instances, BitMasks, CroppedBitMasks, RLEMasks
+from detectron2.utils.events import get_event_storage
 from detectron2.utils.memory import retry_if_cuda_oom
 
 from .modeling.criterion import SetCriterion
+from .modeling.distiller import KnowledgeDistiller
 from .modeling.matcher import HungarianMatcher
+from .modeling.point_refine import PointRefineHead
 from .utils import box_ops
 
 
@@ -58,6 +61,10 @@ class DYNAFormer(nn.Module):
         focus_on_box: bool = False,
         transform_eval: bool = False,
         semantic_ce_loss: bool = False,
+        mask_format: str = "float",
+        point_refine: nn.Module = None,
+        use_padding_mask: bool = False,
+        distiller: nn.Module = None,
     ):
         """
         Args:
@@ -84,6 +91,15 @@ class DYNAFormer(nn.Module):
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
             transform_eval: transform sigmoid score into softmax score to make score sharper
             semantic_ce_loss: whether use cross-entroy loss in classification
+            mask_format: representation of instance `pred_masks`, one of "float" (dense float
+                tensor), "bool" (dense bool tensor), "cropped" (:class:`CroppedBitMasks`) or
+                "rle" (:class:`RLEMasks`, encoded lazily on CPU)
+            point_refine: optional :class:`PointRefineHead`. If given, masks are upsampled at
+                inference by iterative subdivision instead of dense bilinear interpolation
+            use_padding_mask: pass the padding of the batch (and the "padding_mask" of the inputs,
+                e.g. LSJ canvases) to the pixel decoder and the transformer decoder
+            distiller: optional :class:`KnowledgeDistiller`. If given, the distillation losses are added
+                in training for the inputs that have "distill_targets"
         """
         super().__init__()
         self.backbone = backbone
@@ -112,6 +128,13 @@ class DYNAFormer(nn.Module):
         self.focus_on_box = focus_on_box
         self.transform_eval = transform_eval
         self.semantic_ce_loss = semantic_ce_loss
+        assert mask_format in ("float", "bool", "cropped", "rle"), mask_format
+        self.mask_format = mask_format
+        self.point_refine = point_refine
+        self.use_padding_mask = use_padding_mask
+        self.distiller = distiller
+        # set by `utils.inference.prepare_for_inference`
+        self.channels_last = False
 
         if not self.semantic_on:
             assert self.sem_seg_postprocess_before_inference
@@ -182,6 +205,43 @@ class DYNAFormer(nn.Module):
             for i in range(dec_layers):
                 aux_weight_dict.update({k + f"_{i}": v for k, v in weight_dict.items()})
             weight_dict.update(aux_weight_dict)
+        # PointRend-style mask refinement head
+        point_refine = None
+        if cfg.MODEL.DYNAFormer.POINT_REFINE.ENABLED:                                              #False
+            in_feature = cfg.MODEL.DYNAFormer.POINT_REFINE.IN_FEATURE                             #"res2"
+            point_refine = PointRefineHead(
+                in_feature,
+                backbone.output_shape()[in_feature],
+                cfg.MODEL.SEM_SEG_HEAD.MASK_DIM,
+                hidden_dim=cfg.MODEL.DYNAFormer.POINT_REFINE.HIDDEN_DIM,
+                num_layers=cfg.MODEL.DYNAFormer.POINT_REFINE.NUM_LAYERS,
+                subdivision_num_points=cfg.MODEL.DYNAFormer.POINT_REFINE.SUBDIVISION_NUM_POINTS,
+                train_num_points=cfg.MODEL.DYNAFormer.TRAIN_NUM_POINTS,
+                oversample_ratio=cfg.MODEL.DYNAFormer.OVERSAMPLE_RATIO,
+                importance_sample_ratio=cfg.MODEL.DYNAFormer.IMPORTANCE_SAMPLE_RATIO,
+            )
+            weight_dict["loss_point_refine"] = cfg.MODEL.DYNAFormer.POINT_REFINE.LOSS_WEIGHT       #5.0
+        if any(r < 1.0 for r in cfg.MODEL.SEM_SEG_HEAD.TOKEN_KEEP_RATIOS):
+            weight_dict["loss_token_score"] = cfg.MODEL.SEM_SEG_HEAD.TOKEN_SCORE_LOSS_WEIGHT        #1.0
+        # knowledge distillation from a frozen teacher
+        distiller = None
+        if cfg.MODEL.DYNAFormer.DISTILL.ENABLED:                                                  #False
+            distill_cfg = cfg.MODEL.DYNAFormer.DISTILL
+            distiller = KnowledgeDistiller(
+                matcher,
+                num_points=cfg.MODEL.DYNAFormer.TRAIN_NUM_POINTS,                                  #112 * 112
+                temperature=distill_cfg.TEMPERATURE,                                               #1.0
+                student_memory_dim=cfg.MODEL.SEM_SEG_HEAD.CONVS_DIM,                               #256
+                memory_dim=distill_cfg.TEACHER_MEMORY_DIM if distill_cfg.MEMORY_WEIGHT > 0 else 0, #256
+            )
+            weight_dict.update({
+                "loss_kd_class": distill_cfg.CLASS_WEIGHT,                                         #2.0
+                "loss_kd_bbox": distill_cfg.BOX_WEIGHT,                                            #5.0
+                "loss_kd_giou": distill_cfg.GIOU_WEIGHT,                                           #2.0
+                "loss_kd_mask": distill_cfg.MASK_WEIGHT,                                           #5.0
+                "loss_kd_dice": distill_cfg.DICE_WEIGHT,                                           #5.0
+                "loss_kd_memory": distill_cfg.MEMORY_WEIGHT,                                       #0.0
+            })
         if cfg.MODEL.DYNAFormer.BOX_LOSS:                                                          #True
             losses = ["labels", "masks","boxes"]
         else:
@@ -229,8 +289,12 @@ class DYNAFormer(nn.Module):
             "focus_on_box": cfg.MODEL.DYNAFormer.TEST.TEST_FOUCUS_ON_BOX,                            #False
             "transform_eval": cfg.MODEL.DYNAFormer.TEST.PANO_TRANSFORM_EVAL,                         #True
             "pano_temp": cfg.MODEL.DYNAFormer.TEST.PANO_TEMPERATURE,                                 #0.06
-            "semantic_ce_loss": cfg.MODEL.DYNAFormer.TEST.SEMANTIC_ON and cfg.MODEL.DYNAFormer.SEMANTIC_CE_LOSS and not cfg.MODEL.DYNAFormer.TEST.PANOPTIC_ON
+            "semantic_ce_loss": cfg.MODEL.DYNAFormer.TEST.SEMANTIC_ON and cfg.MODEL.DYNAFormer.SEMANTIC_CE_LOSS and not cfg.MODEL.DYNAFormer.TEST.PANOPTIC_ON,
             #                                           False                                 False                                               False 
+            "mask_format": cfg.MODEL.DYNAFormer.TEST.MASK_FORMAT,                                    #"float"
+            "point_refine": point_refine,
+            "use_padding_mask": cfg.MODEL.DYNAFormer.USE_PADDING_MASK,                               #False
+            "distiller": distiller,
         }
 
     @property
@@ -264,34 +328,49 @@ class DYNAFormer(nn.Module):
                         Each dict contains keys "id", "category_id", "isthing".
         """
         #torch.cuda.empty_cache()
-        images = [x["image"].to(self.device) for x in batched_inputs]
-
-        #-------------------------
-        #to_pil = transforms.ToPILImage()
-        #image = to_pil(images[0])
-        # Save the image
-        #image.save("/content/output_image.png")
-        #-------------------------
+        images = self.preprocess_image(batched_inputs)
 
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
-
-        features = self.backbone(images.tensor)
+        if self.channels_last:
+            features = self.backbone(images.tensor.contiguous(memory_format=torch.channels_last))
+        else:
+            features = self.backbone(images.tensor)
+        padding_mask = self.padding_mask(batched_inputs, images) if self.use_padding_mask else None
 
         if self.training:
+            # fraction of the batch tensor that is padding, see DATALOADER.SIZE_BUCKETING
+            h_pad, w_pad = images.tensor.shape[-2:]
+            get_event_storage().put_scalar(
+                "padding_ratio", 1 - sum(h * w for h, w in images.image_sizes) / (len(images) * h_pad * w_pad)
+            )
             # dn_args={"scalar":30,"noise_scale":0.4}
             # mask classification target
             if "instances" in batched_inputs[0]:
                 gt_instances = [x["instances"].to(self.device) for x in batched_inputs]
+                gt_masks = self.collated_masks(batched_inputs, images)
                 if 'detr' in self.data_loader:
-                    targets = self.prepare_targets_detr(gt_instances, images)
+                    targets = self.prepare_targets_detr(gt_instances, images, gt_masks)
                 else:
-                    targets = self.prepare_targets(gt_instances, images)
+                    targets = self.prepare_targets(gt_instances, images, gt_masks)
             else:
                 targets = None
-            outputs,mask_dict = self.sem_seg_head(features,targets=targets)
+            return_features = self.point_refine is not None or (
+                self.distiller is not None and self.distiller.memory_proj is not None
+            )
+            outputs,mask_dict = self.sem_seg_head(features,padding_mask,targets=targets,
+                                                  return_features=return_features)
             # bipartite matching-based loss
-            losses = self.criterion(outputs, targets,mask_dict)
+            if self.point_refine is not None:
+                # the point losses reuse the matching of the last layer
+                losses, indices = self.criterion(outputs, targets, mask_dict, return_indices=True)
+                losses.update(
+                    self.point_refine.losses(outputs, targets, indices, features[self.point_refine.in_feature])
+                )
+            else:
+                losses = self.criterion(outputs, targets,mask_dict)
+            if self.distiller is not None and "distill_targets" in batched_inputs[0]:
+                losses.update(self.distiller(outputs, images, [x["distill_targets"] for x in batched_inputs]))
+            if targets is not None and "token_score_maps" in outputs:
+                losses.update(self.sem_seg_head.pixel_decoder.token_score_losses(outputs["token_score_maps"], targets))
 
             for k in list(losses.keys()):
                 if k in self.criterion.weight_dict:
@@ -301,17 +380,26 @@ class DYNAFormer(nn.Module):
                     losses.pop(k)
             return losses
         else:
-            outputs, _ = self.sem_seg_head(features)
+            outputs, _ = self.sem_seg_head(features, padding_mask, return_features=self.point_refine is not None)
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
             mask_box_results = outputs["pred_boxes"]
             # upsample masks
-            mask_pred_results = F.interpolate(
-                mask_pred_results,
-                size=(images.tensor.shape[-2], images.tensor.shape[-1]),
-                mode="bilinear",
-                align_corners=False,
-            )
+            if self.point_refine is not None:
+                mask_pred_results = self.point_refine.subdivision_inference(
+                    mask_pred_results,
+                    outputs["pred_mask_embed"],
+                    outputs["mask_features"],
+                    features[self.point_refine.in_feature],
+                    (images.tensor.shape[-2], images.tensor.shape[-1]),
+                )
+            else:
+                mask_pred_results = F.interpolate(
+                    mask_pred_results,
+                    size=(images.tensor.shape[-2], images.tensor.shape[-1]),
+                    mode="bilinear",
+                    align_corners=False,
+                )
 
             del outputs
 
@@ -358,7 +446,80 @@ class DYNAFormer(nn.Module):
 
             return processed_results
 
-    def prepare_targets(self, targets, images):
+    def raw_outputs(self, batched_inputs, return_features=False):
+        """
+        Runs the model without post-processing, e.g. a teacher for knowledge distillation.
+        `return_features` also returns the decoder features, see :meth:`DYNAFormerDecoder.forward`.
+
+        Returns:
+            dict: outputs of the head ("pred_logits", "pred_boxes", "pred_masks", ...)
+            ImageList: the preprocessed inputs
+        """
+        images = self.preprocess_image(batched_inputs)
+        if self.channels_last:
+            features = self.backbone(images.tensor.contiguous(memory_format=torch.channels_last))
+        else:
+            features = self.backbone(images.tensor)
+        padding_mask = self.padding_mask(batched_inputs, images) if self.use_padding_mask else None
+        outputs, _ = self.sem_seg_head(features, padding_mask, return_features=return_features)
+        return outputs, images
+
+    def padding_mask(self, batched_inputs, images):
+        """
+        Returns:
+            N*H*W bool tensor, True on the padding added by `ImageList.from_tensors` and on the
+            "padding_mask" of the inputs if any, or None if the batch has no padding
+        """
+        h_pad, w_pad = images.tensor.shape[-2:]
+        has_padding = any(h != h_pad or w != w_pad for h, w in images.image_sizes) or any(
+            "padding_mask" in x for x in batched_inputs
+        )
+        if not has_padding:
+            return None
+        mask = torch.ones((len(images), h_pad, w_pad), dtype=torch.bool, device=self.device)
+        for i, (h, w) in enumerate(images.image_sizes):
+            if "padding_mask" in batched_inputs[i]:
+                mask[i, :h, :w] = batched_inputs[i]["padding_mask"].to(self.device)[:h, :w]
+            else:
+                mask[i, :h, :w] = False
+        return mask
+
+    def preprocess_image(self, batched_inputs):
+        """
+        Normalize and pad the images of a batch. The images of a batch collated by
+        :class:`PrefetchDataLoader` are normalized, their padding zeroed and padded to the size
+        divisibility in one batched op.
+        """
+        collated = getattr(batched_inputs, "images", None)
+        if collated is None:
+            images = [(x["image"].to(self.device) - self.pixel_mean) / self.pixel_std for x in batched_inputs]
+            return ImageList.from_tensors(images, self.size_divisibility)
+        n, c, h, w = collated.shape
+        stride = max(self.size_divisibility, 1)
+        h_pad, w_pad = (h + stride - 1) // stride * stride, (w + stride - 1) // stride * stride
+        sizes = torch.as_tensor(batched_inputs.image_sizes, device=self.device)
+        # valid pixels of each image, the padding is zero after normalization as in `ImageList.from_tensors`
+        valid = (torch.arange(h, device=self.device)[None, :] < sizes[:, :1])[:, None, :, None] & (
+            torch.arange(w, device=self.device)[None, :] < sizes[:, 1:]
+        )[:, None, None, :]
+        tensor = collated.new_zeros((n, c, h_pad, w_pad), dtype=torch.float32)
+        tensor[:, :, :h, :w] = (collated.to(self.device) - self.pixel_mean) / self.pixel_std * valid
+        return ImageList(tensor, [tuple(s) for s in batched_inputs.image_sizes])
+
+    def collated_masks(self, batched_inputs, images):
+        """
+        Returns:
+            list[Tensor] or None: the ground truth masks of each image, padded to the batch tensor, of a
+                batch collated by :class:`PrefetchDataLoader`
+        """
+        gt_masks = getattr(batched_inputs, "gt_masks", None)
+        if gt_masks is None:
+            return None
+        h_pad, w_pad = images.tensor.shape[-2:]
+        gt_masks = F.pad(gt_masks.to(self.device), (0, w_pad - gt_masks.shape[-1], 0, h_pad - gt_masks.shape[-2]))
+        return list(gt_masks.split(batched_inputs.num_instances))
+
+    def prepare_targets(self, targets, images, gt_masks=None):
         h_pad, w_pad = images.tensor.shape[-2:]
         new_targets = []
         for targets_per_image in targets:
@@ -366,9 +527,12 @@ class DYNAFormer(nn.Module):
             h, w = targets_per_image.image_size
             image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float, device=self.device)
 
-            gt_masks = targets_per_image.gt_masks
-            padded_masks = torch.zeros((gt_masks.shape[0], h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-            padded_masks[:, : gt_masks.shape[1], : gt_masks.shape[2]] = gt_masks
+            if gt_masks is not None:
+                padded_masks = gt_masks[len(new_targets)]
+            else:
+                masks = targets_per_image.gt_masks
+                padded_masks = torch.zeros((masks.shape[0], h_pad, w_pad), dtype=masks.dtype, device=masks.device)
+                padded_masks[:, : masks.shape[1], : masks.shape[2]] = masks
             new_targets.append(
                 {
                     "labels": targets_per_image.gt_classes,
@@ -378,7 +542,7 @@ class DYNAFormer(nn.Module):
             )
         return new_targets
 
-    def prepare_targets_detr(self, targets, images):
+    def prepare_targets_detr(self, targets, images, gt_masks=None):
         h_pad, w_pad = images.tensor.shape[-2:]
         new_targets = []
         for targets_per_image in targets:
@@ -386,9 +550,12 @@ class DYNAFormer(nn.Module):
             h, w = targets_per_image.image_size
             image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float, device=self.device)
 
-            gt_masks = targets_per_image.gt_masks
-            padded_masks = torch.zeros((gt_masks.shape[0], h_pad, w_pad), dtype=gt_masks.dtype, device=gt_masks.device)
-            padded_masks[:, : gt_masks.shape[1], : gt_masks.shape[2]] = gt_masks
+            if gt_masks is not None:
+                padded_masks = gt_masks[len(new_targets)]
+            else:
+                masks = targets_per_image.gt_masks
+                padded_masks = torch.zeros((masks.shape[0], h_pad, w_pad), dtype=masks.dtype, device=masks.device)
+                padded_masks[:, : masks.shape[1], : masks.shape[2]] = masks
             new_targets.append(
                 {
                     "labels": targets_per_image.gt_classes,
@@ -483,8 +650,10 @@ class DYNAFormer(nn.Module):
         # mask_pred is already processed to have the same shape as original input
         image_size = mask_pred.shape[-2:]
         scores = mask_cls.sigmoid()  # [100, 80]
-        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(self.num_queries, 1).flatten(0, 1)
-        scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.test_topk_per_image, sorted=False)  # select 100
+        # the number of queries may differ from self.num_queries at inference (TEST.NUM_QUERIES)
+        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(mask_cls.shape[0], 1).flatten(0, 1)
+        test_topk_per_image = min(self.test_topk_per_image, labels.shape[0])
+        scores_per_image, topk_indices = scores.flatten(0, 1).topk(test_topk_per_image, sorted=False)  # select 100
         labels_per_image = labels[topk_indices]
         topk_indices = topk_indices // self.sem_seg_head.num_classes
         mask_pred = mask_pred[topk_indices]
@@ -498,7 +667,8 @@ class DYNAFormer(nn.Module):
             mask_pred = mask_pred[keep]
         result = Instances(image_size)
         # mask (before sigmoid)
-        result.pred_masks = (mask_pred > 0).float()
+        pred_masks = mask_pred > 0
+        result.pred_masks = self.format_masks(pred_masks)
         # half mask box half pred box
         mask_box_result = mask_box_result[topk_indices]
         if self.panoptic_on:
@@ -508,13 +678,24 @@ class DYNAFormer(nn.Module):
         # result.pred_boxes = BitMasks(mask_pred > 0).get_bounding_boxes()
 
         # calculate average mask prob
-        mask_scores_per_image = (mask_pred.sigmoid().flatten(1) * result.pred_masks.flatten(1)).sum(1) / (result.pred_masks.flatten(1).sum(1) + 1e-6)
+        mask_scores_per_image = (mask_pred.sigmoid().flatten(1) * pred_masks.flatten(1)).sum(1) / (pred_masks.flatten(1).sum(1) + 1e-6)
         if self.focus_on_box:
             mask_scores_per_image = 1.0
         result.scores = scores_per_image * mask_scores_per_image
         result.pred_classes = labels_per_image
         return result
 
+    def format_masks(self, pred_masks):
+        # pred_masks: bool tensor of shape [N, H, W]
+        if self.mask_format == "float":
+            return pred_masks.float()
+        if self.mask_format == "bool":
+            return pred_masks
+        cropped = CroppedBitMasks.from_bitmasks(pred_masks)
+        if self.mask_format == "cropped":
+            return cropped
+        return RLEMasks(cropped.to("cpu"))
+
     def box_postprocess(self, out_bbox, img_h, img_w):
         # postprocess box height and width
         boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
@@ -191,6 +191,167 @@ class FocalModulationBlock(nn.Module):
 
         return x
 
+def _linear_to_conv1x1(linear, in_scale=None, in_shift=None, out_scale=None):
+    """ Fold a Linear layer (applied on the last dim) into a 1x1 conv for channels-last inputs.
+
+    Computes conv(x) == out_scale * linear(in_scale * x + in_shift), which folds the affine
+    part of a preceding LayerNorm (in_scale, in_shift) and a following layer scale (out_scale).
+    """
+    weight = linear.weight.detach().clone()
+    bias = linear.bias.detach().clone() if linear.bias is not None else weight.new_zeros(weight.shape[0])
+    if in_shift is not None:
+        bias = bias + weight @ in_shift.detach()
+    if in_scale is not None:
+        weight = weight * in_scale.detach()[None, :]
+    if out_scale is not None:
+        weight = weight * out_scale.detach()[:, None]
+        bias = bias * out_scale.detach()
+    conv = nn.Conv2d(weight.shape[1], weight.shape[0], kernel_size=1, bias=True)
+    conv.weight.data.copy_(weight[:, :, None, None])
+    conv.bias.data.copy_(bias)
+    return conv.to(linear.weight.device)
+
+
+def _fold_linear(linear, in_scale=None, in_shift=None, out_scale=None):
+    """ Same as :func:`_linear_to_conv1x1`, but returns a Linear layer. """
+    conv = _linear_to_conv1x1(linear, in_scale, in_shift, out_scale)
+    folded = nn.Linear(conv.in_channels, conv.out_channels, bias=True).to(conv.weight.device)
+    folded.weight.data.copy_(conv.weight.data[:, :, 0, 0])
+    folded.bias.data.copy_(conv.bias.data)
+    return folded
+
+
+def _copy_conv(conv):
+    """ Return a copy of a Conv2d with the same weights. """
+    new_conv = nn.Conv2d(
+        conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride,
+        padding=conv.padding, groups=conv.groups, bias=conv.bias is not None,
+    ).to(conv.weight.device)
+    new_conv.load_state_dict(conv.state_dict())
+    return new_conv
+
+
+class FusedFocalModulationBlock(nn.Module):
+    """ Inference-only version of :class:`FocalModulationBlock`.
+
+    The block works on channels-last tensors without permute copies: the input tokens
+    (B, H*W, C) are viewed as (B, H, W, C) and as a channels-last (B, C, H, W) tensor.
+    Compared to the original block:
+      - the linear layers of the modulation are 1x1 convs,
+      - the affine parts of the LayerNorms and the layer scales are folded into the
+        adjacent linear layers (or into the LayerNorm for post-normalization),
+      - `normalize_modulator` is folded into `h`,
+      - the focal levels accumulate the gated contexts in place.
+    Build it with :meth:`from_block` from a trained block.
+    """
+
+    def __init__(self, dim, focal_level, use_postln, use_postln_in_modulation):
+        super().__init__()
+        self.dim = dim
+        self.focal_level = focal_level
+        self.use_postln = use_postln
+        self.use_postln_in_modulation = use_postln_in_modulation
+        self.H = None
+        self.W = None
+
+    @classmethod
+    @torch.no_grad()
+    def from_block(cls, block):
+        modulation = block.modulation
+        dim = block.dim
+        fused = cls(dim, block.focal_level, block.use_postln, modulation.use_postln_in_modulation)
+        ones = block.norm1.weight.new_ones(dim)
+        gamma_1 = block.gamma_1 if isinstance(block.gamma_1, torch.Tensor) else ones
+        gamma_2 = block.gamma_2 if isinstance(block.gamma_2, torch.Tensor) else ones
+
+        # modulation: f (with the pre-norm affine), focal convs, h, proj
+        if block.use_postln:
+            fused.f = _linear_to_conv1x1(modulation.f)
+        else:
+            fused.f = _linear_to_conv1x1(modulation.f, block.norm1.weight, block.norm1.bias)
+        fused.focal_convs = nn.ModuleList([_copy_conv(layer[0]) for layer in modulation.focal_layers])
+        fused.h = _copy_conv(modulation.h)
+        if modulation.normalize_modulator:
+            fused.h.weight.data /= (modulation.focal_level + 1)
+        in_scale = in_shift = None
+        if modulation.use_postln_in_modulation:
+            in_scale, in_shift = modulation.ln.weight, modulation.ln.bias
+            fused.ln_eps = modulation.ln.eps
+        # with post-normalization, the layer scale is folded into norm1 instead
+        fused.proj = _linear_to_conv1x1(
+            modulation.proj, in_scale, in_shift, None if block.use_postln else gamma_1
+        )
+
+        # normalization layers
+        fused.eps1 = block.norm1.eps
+        fused.eps2 = block.norm2.eps
+        if block.use_postln:
+            fused.norm1_weight = nn.Parameter(block.norm1.weight * gamma_1)
+            fused.norm1_bias = nn.Parameter(block.norm1.bias * gamma_1)
+            fused.norm2_weight = nn.Parameter(block.norm2.weight * gamma_2)
+            fused.norm2_bias = nn.Parameter(block.norm2.bias * gamma_2)
+            fused.fc1 = _fold_linear(block.mlp.fc1)
+            fused.fc2 = _fold_linear(block.mlp.fc2)
+        else:
+            fused.fc1 = _fold_linear(block.mlp.fc1, block.norm2.weight, block.norm2.bias)
+            fused.fc2 = _fold_linear(block.mlp.fc2, out_scale=gamma_2)
+        fused.act = block.mlp.act
+        return fused.eval()
+
+    def modulation(self, x):
+        """
+        Args:
+            x: channels-last tensor of shape (B, C, H, W)
+        """
+        C = self.dim
+        x = self.f(x)
+        q, ctx, gates = torch.split(x, (C, C, self.focal_level + 1), 1)
+
+        ctx_all = None
+        for l in range(self.focal_level):
+            ctx = F.gelu(self.focal_convs[l](ctx))
+            if ctx_all is None:
+                ctx_all = ctx * gates[:, l:l+1]
+            else:
+                ctx_all.addcmul_(ctx, gates[:, l:l+1])
+        ctx_global = F.gelu(ctx.mean((2, 3), keepdim=True))
+        ctx_all.addcmul_(ctx_global, gates[:, self.focal_level:])
+
+        x_out = q * self.h(ctx_all)
+        if self.use_postln_in_modulation:
+            x_out = F.layer_norm(x_out.permute(0, 2, 3, 1), (C,), eps=self.ln_eps).permute(0, 3, 1, 2)
+        return self.proj(x_out)
+
+    def forward(self, x):
+        """ Forward function.
+
+        Args:
+            x: Input feature, tensor size (B, H*W, C).
+        """
+        B, L, C = x.shape
+        H, W = self.H, self.W
+        assert L == H * W, "input feature has wrong size"
+
+        shortcut = x.view(B, H, W, C)
+        y = shortcut
+        if not self.use_postln:
+            y = F.layer_norm(y, (C,), eps=self.eps1)
+        # B H W C -> channels-last B C H W, both views of the same memory
+        y = self.modulation(y.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last))
+        y = y.permute(0, 2, 3, 1)
+        if self.use_postln:
+            y = F.layer_norm(y, (C,), self.norm1_weight, self.norm1_bias, eps=self.eps1)
+        x = shortcut + y
+
+        # FFN
+        if self.use_postln:
+            y = F.layer_norm(self.fc2(self.act(self.fc1(x))), (C,), self.norm2_weight, self.norm2_bias, eps=self.eps2)
+        else:
+            y = self.fc2(self.act(self.fc1(F.layer_norm(x, (C,), eps=self.eps2))))
+        x = x + y
+        return x.reshape(B, L, C)
+
+
 class BasicLayer(nn.Module):
     """ A basic focal modulation layer for one stage.
 
@@ -509,8 +670,23 @@ class FocalNet(nn.Module):
 
     def train(self, mode=True):
         """Convert the model into training mode while keep layers freezed."""
+        assert not (mode and getattr(self, "fused", False)), "a fused FocalNet is inference only"
         super(FocalNet, self).train(mode)
         self._freeze_stages()
+        return self
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """ Replace the focal modulation blocks by :class:`FusedFocalModulationBlock`.
+        Call it after loading the weights. The model can not be trained afterwards.
+        """
+        self.eval()
+        for layer in self.layers:
+            layer.blocks = nn.ModuleList(
+                [FusedFocalModulationBlock.from_block(blk) for blk in layer.blocks]
+            )
+        self.fused = True
+        return self
 
 
 @BACKBONE_REGISTRY.register()
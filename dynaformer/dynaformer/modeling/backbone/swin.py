@@ -8,6 +8,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # Modified by Bowen Cheng from https://github.com/SwinTransformer/Swin-Transformer-Semantic-Segmentation/blob/main/mmseg/models/backbones/swin_transformer.py
 
+import functools
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -17,6 +19,8 @@ from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
 from detectron2.modeling import BACKBONE_REGISTRY, Backbone, ShapeSpec
 
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
 
 class Mlp(nn.Module):
     """Multilayer perceptron."""
@@ -71,6 +75,42 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+@functools.lru_cache(maxsize=64)
+def shifted_window_attn_mask(Hp, Wp, window_size, shift_size, device):
+    """
+    Attention mask of SW-MSA, cached per (Hp, Wp, window_size, shift_size, device).
+    The returned tensor is shared and must not be modified in place.
+    Args:
+        Hp, Wp (int): padded height and width, multiples of window_size
+    Returns:
+        attn_mask: (0/-100) mask with shape of (num_windows, Wh*Ww, Wh*Ww)
+    """
+    if hasattr(torch, "inference_mode"):
+        # a mask built under inference_mode could not be reused for training
+        with torch.inference_mode(False):
+            return _build_shifted_window_attn_mask(Hp, Wp, window_size, shift_size, device)
+    return _build_shifted_window_attn_mask(Hp, Wp, window_size, shift_size, device)
+
+
+def _build_shifted_window_attn_mask(Hp, Wp, window_size, shift_size, device):
+    # region id of every position: 3 regions along each axis after the cyclic shift
+    h_region = torch.zeros(Hp, dtype=torch.int64, device=device)
+    h_region[Hp - window_size : Hp - shift_size] = 1
+    h_region[Hp - shift_size :] = 2
+    w_region = torch.zeros(Wp, dtype=torch.int64, device=device)
+    w_region[Wp - window_size : Wp - shift_size] = 1
+    w_region[Wp - shift_size :] = 2
+    img_mask = (h_region[:, None] * 3 + w_region[None, :]).view(1, Hp, Wp, 1).float()
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
+        attn_mask == 0, float(0.0)
+    )
+    return attn_mask
+
+
 class WindowAttention(nn.Module):
     """Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -127,6 +167,8 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=0.02)
         self.softmax = nn.Softmax(dim=-1)
+        # route attention through F.scaled_dot_product_attention when available
+        self.use_sdpa = _HAS_SDPA
 
     def forward(self, x, mask=None):
         """Forward function.
@@ -142,9 +184,6 @@ class WindowAttention(nn.Module):
         )
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = q @ k.transpose(-2, -1)
-
         relative_position_bias = self.relative_position_bias_table[
             self.relative_position_index.view(-1)
         ].view(
@@ -153,6 +192,12 @@ class WindowAttention(nn.Module):
         relative_position_bias = relative_position_bias.permute(
             2, 0, 1
         ).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+        if self.use_sdpa:
+            return self._forward_sdpa(q, k, v, relative_position_bias, mask)
+
+        q = q * self.scale
+        attn = q @ k.transpose(-2, -1)
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -170,6 +215,42 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def _forward_sdpa(self, q, k, v, relative_position_bias, mask=None):
+        """
+        Same as the explicit attention in :meth:`forward`, with the relative position bias
+        (and the shifted window mask) passed to scaled_dot_product_attention as additive mask.
+        Args:
+            q, k, v: (num_windows*B, nH, N, C/nH)
+            relative_position_bias: (nH, N, N)
+            mask: (0/-inf) mask with shape of (num_windows, N, N) or None
+        """
+        B_, nH, N, head_dim = q.shape
+        # scaled_dot_product_attention scales by head_dim ** -0.5
+        default_scale = head_dim ** -0.5
+        if self.scale != default_scale:
+            q = q * (self.scale / default_scale)
+
+        if mask is not None:
+            nW = mask.shape[0]
+            attn_mask = relative_position_bias.unsqueeze(0) + mask.to(relative_position_bias).unsqueeze(1)
+            q = q.view(B_ // nW, nW, nH, N, head_dim)
+            k = k.view(B_ // nW, nW, nH, N, head_dim)
+            v = v.view(B_ // nW, nW, nH, N, head_dim)
+        else:
+            attn_mask = relative_position_bias.unsqueeze(0)
+
+        x = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask.to(q.dtype),
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+        )
+        x = x.reshape(B_, nH, N, head_dim).transpose(1, 2).reshape(B_, N, nH * head_dim)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
 
 class SwinTransformerBlock(nn.Module):
     """Swin Transformer Block.
@@ -413,31 +494,7 @@ class BasicLayer(nn.Module):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
-        h_slices = (
-            slice(0, -self.window_size),
-            slice(-self.window_size, -self.shift_size),
-            slice(-self.shift_size, None),
-        )
-        w_slices = (
-            slice(0, -self.window_size),
-            slice(-self.window_size, -self.shift_size),
-            slice(-self.shift_size, None),
-        )
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(
-            img_mask, self.window_size
-        )  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
-            attn_mask == 0, float(0.0)
-        )
+        attn_mask = shifted_window_attn_mask(Hp, Wp, self.window_size, self.shift_size, x.device)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -521,6 +578,8 @@ class SwinTransformer(nn.Module):
         frozen_stages (int): Stages to be frozen (stop grad and set eval mode).
             -1 means not freezing any parameters.
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        channels_last (bool): If True, run the patch embedding in channels-last memory format and
+            return channels-last outputs (no copy from the B H W C token layout). Default: False.
     """
 
     def __init__(
@@ -544,10 +603,12 @@ class SwinTransformer(nn.Module):
         out_indices=(0, 1, 2, 3),
         frozen_stages=-1,
         use_checkpoint=False,
+        channels_last=False,
     ):
         super().__init__()
 
         self.pretrain_img_size = pretrain_img_size
+        self.channels_last = channels_last
         self.num_layers = len(depths)
         self.embed_dim = embed_dim
         self.ape = ape
@@ -650,6 +711,8 @@ class SwinTransformer(nn.Module):
 
     def forward(self, x):
         """Forward function."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.patch_embed(x)
 
         Wh, Ww = x.size(2), x.size(3)
@@ -658,9 +721,9 @@ class SwinTransformer(nn.Module):
             absolute_pos_embed = F.interpolate(
                 self.absolute_pos_embed, size=(Wh, Ww), mode="bicubic"
             )
-            x = (x + absolute_pos_embed).flatten(2).transpose(1, 2)  # B Wh*Ww C
-        else:
-            x = x.flatten(2).transpose(1, 2)
+            x = x + absolute_pos_embed
+        # B Wh*Ww C, a view for channels-last inputs
+        x = x.permute(0, 2, 3, 1).reshape(x.shape[0], Wh * Ww, -1)
         x = self.pos_drop(x)
 
         outs = {}
@@ -672,7 +735,10 @@ class SwinTransformer(nn.Module):
                 norm_layer = getattr(self, f"norm{i}")
                 x_out = norm_layer(x_out)
 
-                out = x_out.view(-1, H, W, self.num_features[i]).permute(0, 3, 1, 2).contiguous()
+                out = x_out.view(-1, H, W, self.num_features[i]).permute(0, 3, 1, 2)
+                # the permuted B H W C tokens already are a channels-last tensor
+                if not self.channels_last:
+                    out = out.contiguous()
                 outs["res{}".format(i + 2)] = out
 
         return outs
@@ -704,6 +770,7 @@ class D2SwinTransformer(SwinTransformer, Backbone):
         ape = cfg.MODEL.SWIN.APE
         patch_norm = cfg.MODEL.SWIN.PATCH_NORM
         use_checkpoint = cfg.MODEL.SWIN.USE_CHECKPOINT
+        channels_last = cfg.MODEL.SWIN.CHANNELS_LAST
 
         super().__init__(
             pretrain_img_size,
@@ -723,6 +790,7 @@ class D2SwinTransformer(SwinTransformer, Backbone):
             ape,
             patch_norm,
             use_checkpoint=use_checkpoint,
+            channels_last=channels_last,
         )
 
         self._out_features = cfg.MODEL.SWIN.OUT_FEATURES
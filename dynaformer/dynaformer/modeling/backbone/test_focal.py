@@ -0,0 +1,72 @@
+# ------------------------------------------------------------------------
+# Parity check of the fused inference blocks of FocalNet:
+# python dynaformer/modeling/backbone/test_focal.py
+# ------------------------------------------------------------------------
+import copy
+import itertools
+
+import torch
+
+from focal import FocalModulationBlock, FocalNet, FusedFocalModulationBlock
+
+
+torch.manual_seed(3)
+
+
+def randomize_(module):
+    # layer norms and layer scales are initialized to the identity, perturb them so that
+    # the folding is actually checked
+    for name, p in module.named_parameters():
+        if name.endswith("bias") or "norm" in name or "gamma" in name or ".ln." in name:
+            p.data.uniform_(-0.5, 1.5)
+    return module
+
+
+@torch.no_grad()
+def check_fused_block(use_postln, use_postln_in_modulation, normalize_modulator, use_layerscale, focal_level=3):
+    dim, H, W = 32, 13, 11
+    block = FocalModulationBlock(
+        dim, focal_level=focal_level, focal_window=3,
+        use_postln=use_postln, use_postln_in_modulation=use_postln_in_modulation,
+        normalize_modulator=normalize_modulator, use_layerscale=use_layerscale,
+    )
+    block = randomize_(block).eval()
+    if use_layerscale:
+        block.gamma_1.data.uniform_(0.5, 1.5)
+        block.gamma_2.data.uniform_(0.5, 1.5)
+    fused = FusedFocalModulationBlock.from_block(block)
+    block.H = fused.H = H
+    block.W = fused.W = W
+
+    x = torch.randn(2, H * W, dim)
+    expected = block(x)
+    out = fused(x)
+    max_abs_err = (expected - out).abs().max().item()
+    fwdok = torch.allclose(expected, out, rtol=1e-4, atol=1e-4)
+    print(f'* {fwdok} check_fused_block(use_postln={use_postln}, use_postln_in_modulation={use_postln_in_modulation}, '
+          f'normalize_modulator={normalize_modulator}, use_layerscale={use_layerscale}) max_abs_err {max_abs_err:.2e}')
+    return fwdok
+
+
+@torch.no_grad()
+def check_fused_focalnet():
+    model = FocalNet(
+        embed_dim=32, depths=[1, 1, 2, 1], focal_levels=[3, 3, 3, 3], focal_windows=[3, 3, 3, 3],
+        use_conv_embed=True, use_postln=True, use_layerscale=True,
+    )
+    model = randomize_(model).eval()
+    fused = copy.deepcopy(model).fuse_for_inference()
+
+    x = torch.randn(1, 3, 96, 128)
+    expected = model(x)
+    outputs = fused(x)
+    fwdok = all(torch.allclose(expected[k], outputs[k], rtol=1e-4, atol=1e-4) for k in expected)
+    max_abs_err = max((expected[k] - outputs[k]).abs().max().item() for k in expected)
+    print(f'* {fwdok} check_fused_focalnet max_abs_err {max_abs_err:.2e}')
+    return fwdok
+
+
+if __name__ == '__main__':
+    for args in itertools.product([False, True], repeat=4):
+        check_fused_block(*args)
+    check_fused_focalnet()
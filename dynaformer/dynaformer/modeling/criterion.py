@@ -334,12 +334,13 @@ class SetCriterion(nn.Module):
         assert loss in loss_map, f"do you really want to compute {loss} loss?"
         return loss_map[loss](outputs, targets, indices, num_masks)
 
-    def forward(self, outputs, targets, mask_dict=None):
+    def forward(self, outputs, targets, mask_dict=None, return_indices=False):
         """This performs the loss computation.
         Parameters:
              outputs: dict of tensors, see the output specification of the model for the format
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
+             return_indices: also return the matching of the last layer, so that it is not computed again
         """
         outputs_without_aux = {k: v for k, v in outputs.items() if k != "aux_outputs"}
 
@@ -358,6 +359,7 @@ class SetCriterion(nn.Module):
                     output_idx = tgt_idx = torch.tensor([]).long().cuda()
                 exc_idx.append((output_idx, tgt_idx))
         indices = self.matcher(outputs_without_aux, targets)
+        last_layer_indices = indices
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_masks = sum(len(t["labels"]) for t in targets)
         num_masks = torch.as_tensor(
@@ -427,6 +429,8 @@ class SetCriterion(nn.Module):
                 l_dict = {k + f'_interm': v for k, v in l_dict.items()}
                 losses.update(l_dict)
 
+        if return_indices:
+            return losses, last_layer_indices
         return losses
 
     def __repr__(self):
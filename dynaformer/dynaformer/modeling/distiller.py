@@ -0,0 +1,194 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Knowledge distillation of a (lighter) DYNAFormer student from a frozen teacher. The queries of
+highest score of the teacher are matched to the student queries with the Hungarian matcher, the
+matched student queries learn the class probabilities, boxes and mask logits of the teacher and,
+optionally, the student encoder memory learns the teacher one.
+"""
+import math
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from detectron2.projects.point_rend.point_features import point_sample
+
+from ..utils import box_ops
+
+
+def valid_size(image_size, padded_size, shape):
+    """
+    Returns:
+        (int, int): size of the region of a map of spatial `shape`, predicted on a padded batch of
+            `padded_size`, that covers an image of `image_size`
+    """
+    return tuple(min(math.ceil(s * n / p), n) for s, p, n in zip(image_size, padded_size, shape))
+
+
+@torch.no_grad()
+def teacher_targets(outputs, images, num_queries, memory=False):
+    """
+    Distillation targets from the outputs of a teacher in eval mode. Maps are cropped to the image, so
+    that the targets of an image do not depend on the padding of its batch.
+
+    Args:
+        outputs: outputs of the head of the teacher, see :meth:`DYNAFormer.raw_outputs`
+        images: :class:`ImageList` of the inputs of the teacher
+        num_queries: number of queries of highest score kept per image
+        memory: whether to keep the multi-scale encoder features
+    Returns:
+        list[dict]: per image, "logits" (K*C), "labels" (K), "scores" (K), "boxes" (K*4, normalized cxcywh),
+            "masks" (K*h*w half mask logits) and "memory" (list of C*h*w half features)
+    """
+    logits = outputs["pred_logits"].float()
+    scores = logits.sigmoid().max(-1)[0]
+    topk = scores.topk(min(num_queries, scores.shape[1]), dim=1)[1]
+    padded_size = images.tensor.shape[-2:]
+    targets = []
+    for b, index in enumerate(topk):
+        h, w = valid_size(images.image_sizes[b], padded_size, outputs["pred_masks"].shape[-2:])
+        target = {
+            "logits": logits[b, index],
+            "labels": logits[b, index].argmax(-1),
+            "scores": scores[b, index],
+            "boxes": outputs["pred_boxes"][b, index].float(),
+            "masks": outputs["pred_masks"][b, index, :h, :w].half(),
+        }
+        if memory:
+            target["memory"] = []
+            for feature in outputs["multi_scale_features"]:
+                h, w = valid_size(images.image_sizes[b], padded_size, feature.shape[-2:])
+                target["memory"].append(feature[b, :, :h, :w].half())
+        targets.append(target)
+    return targets
+
+
+class KnowledgeDistiller(nn.Module):
+    """
+    Distillation losses of the student, given the targets of :func:`teacher_targets`:
+
+        * "loss_kd_class": binary cross-entropy between the tempered class probabilities of the matched
+          queries
+        * "loss_kd_bbox", "loss_kd_giou": L1 and GIoU between the matched boxes
+        * "loss_kd_mask", "loss_kd_dice": cross-entropy and dice between the matched mask logits (the mask
+          anchors of the next decoder layer) at random points
+        * "loss_kd_memory": mean squared error between the projected student encoder memory and the
+          teacher one, if `memory_dim` is given
+
+    Box and mask losses are weighted by the score of the teacher query, so that low confidence teacher
+    queries only teach the student that they are background.
+    """
+
+    def __init__(
+        self,
+        matcher: nn.Module,
+        num_points: int = 112 * 112,
+        temperature: float = 1.0,
+        student_memory_dim: int = 256,
+        memory_dim: int = 0,
+    ):
+        """
+        Args:
+            matcher: :class:`HungarianMatcher` used to match the teacher queries to the student queries
+            num_points: number of points at which the mask logits are compared
+            temperature: temperature of the class logits
+            student_memory_dim: channels of the student encoder memory
+            memory_dim: channels of the teacher encoder memory, 0 disables memory distillation
+        """
+        super().__init__()
+        self.matcher = matcher
+        self.num_points = num_points
+        self.temperature = temperature
+        self.memory_proj = nn.Conv2d(student_memory_dim, memory_dim, kernel_size=1) if memory_dim > 0 else None
+
+    def forward(self, outputs, images, targets):
+        """
+        Args:
+            outputs: outputs of the head of the student (without the denoising queries)
+            images: :class:`ImageList` of the inputs of the student
+            targets: list[dict], the distillation targets of each image
+        """
+        device = outputs["pred_logits"].device
+        padded_size = images.tensor.shape[-2:]
+        src_logits, tgt_logits = [], []
+        src_boxes, tgt_boxes = [], []
+        src_masks, tgt_masks = [], []
+        weights = []
+        for b, target in enumerate(targets):
+            target = {k: v.to(device) for k, v in target.items() if k != "memory"}
+            h, w = valid_size(images.image_sizes[b], padded_size, outputs["pred_masks"].shape[-2:])
+            pred_masks = outputs["pred_masks"][b, :, :h, :w]
+            src, tgt = self.matcher(
+                {
+                    "pred_logits": outputs["pred_logits"][b : b + 1],
+                    "pred_boxes": outputs["pred_boxes"][b : b + 1],
+                    "pred_masks": pred_masks[None],
+                },
+                [{"labels": target["labels"], "boxes": target["boxes"], "masks": target["masks"].float().sigmoid()}],
+            )[0]
+            src_logits.append(outputs["pred_logits"][b, src])
+            tgt_logits.append(target["logits"][tgt])
+            src_boxes.append(outputs["pred_boxes"][b, src])
+            tgt_boxes.append(target["boxes"][tgt])
+            weights.append(target["scores"][tgt])
+            # student and teacher masks are cropped to the image, the same points cover the same pixels
+            point_coords = torch.rand(1, self.num_points, 2, device=device)
+            src_masks.append(
+                point_sample(pred_masks[src][:, None], point_coords.expand(len(src), -1, -1), align_corners=False)
+            )
+            tgt_masks.append(
+                point_sample(
+                    target["masks"][tgt][:, None].float(), point_coords.expand(len(tgt), -1, -1), align_corners=False
+                )
+            )
+
+        src_logits, tgt_logits = torch.cat(src_logits).float(), torch.cat(tgt_logits)
+        src_boxes, tgt_boxes = torch.cat(src_boxes).float(), torch.cat(tgt_boxes)
+        src_masks, tgt_masks = torch.cat(src_masks).squeeze(1).float(), torch.cat(tgt_masks).squeeze(1)
+        weights = torch.cat(weights)
+        num_queries = max(len(weights), 1)
+        total_weight = weights.sum().clamp(min=1e-6)
+
+        t = self.temperature
+        loss_class = F.binary_cross_entropy_with_logits(src_logits / t, (tgt_logits / t).sigmoid(), reduction="none")
+        loss_bbox = F.l1_loss(src_boxes, tgt_boxes, reduction="none").sum(-1)
+        loss_giou = 1 - torch.diag(
+            box_ops.generalized_box_iou(box_ops.box_cxcywh_to_xyxy(src_boxes), box_ops.box_cxcywh_to_xyxy(tgt_boxes))
+        )
+        tgt_probs = tgt_masks.sigmoid()
+        loss_mask = F.binary_cross_entropy_with_logits(src_masks, tgt_probs, reduction="none").mean(-1)
+        src_probs = src_masks.sigmoid()
+        loss_dice = 1 - (2 * (src_probs * tgt_probs).sum(-1) + 1) / (src_probs.sum(-1) + tgt_probs.sum(-1) + 1)
+        losses = {
+            "loss_kd_class": loss_class.mean(-1).sum() / num_queries * t ** 2,
+            "loss_kd_bbox": (weights * loss_bbox).sum() / total_weight,
+            "loss_kd_giou": (weights * loss_giou).sum() / total_weight,
+            "loss_kd_mask": (weights * loss_mask).sum() / total_weight,
+            "loss_kd_dice": (weights * loss_dice).sum() / total_weight,
+        }
+        if self.memory_proj is not None and "memory" in targets[0]:
+            losses["loss_kd_memory"] = self.memory_loss(outputs["multi_scale_features"], images, targets)
+        return losses
+
+    def memory_loss(self, features, images, targets):
+        """
+        Mean squared error between the projected student encoder features and the teacher ones, resized
+        to the student resolution. Levels are paired from the coarsest one.
+        """
+        padded_size = images.tensor.shape[-2:]
+        loss, num_terms = 0.0, 0
+        for level, feature in enumerate(features):
+            feature = self.memory_proj(feature)
+            for b, target in enumerate(targets):
+                if level >= len(target["memory"]):
+                    continue
+                h, w = valid_size(images.image_sizes[b], padded_size, feature.shape[-2:])
+                tgt = target["memory"][level].to(feature.device).float()[None]
+                if tgt.shape[-2:] != (h, w):
+                    tgt = F.interpolate(tgt, size=(h, w), mode="bilinear", align_corners=False)
+                loss = loss + F.mse_loss(feature[b : b + 1, :, :h, :w].float(), tgt)
+                num_terms += 1
+        return loss / max(num_terms, 1)
@@ -68,12 +68,17 @@ class DYNAFormerHead(nn.Module):
             ),
         }
 
-    def forward(self, features, mask=None,targets=None):
-        return self.layers(features, mask,targets=targets)
+    def forward(self, features, mask=None,targets=None, return_features=False):
+        return self.layers(features, mask,targets=targets, return_features=return_features)
 
-    def layers(self, features, mask=None,targets=None):
-        mask_features, transformer_encoder_features, multi_scale_features = self.pixel_decoder.forward_features(features, mask)
+    def layers(self, features, mask=None,targets=None, return_features=False):
+        mask_features, transformer_encoder_features, multi_scale_features, token_score_maps = \
+            self.pixel_decoder.forward_features(features, mask)
 
-        predictions = self.predictor(multi_scale_features, mask_features, mask, targets=targets)
+        predictions = self.predictor(
+            multi_scale_features, mask_features, mask, targets=targets, return_features=return_features
+        )
+        if token_score_maps is not None:
+            predictions[0]["token_score_maps"] = token_score_maps
 
         return predictions
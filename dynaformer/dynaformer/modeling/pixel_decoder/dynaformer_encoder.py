@@ -6,6 +6,7 @@
 # Modified from MaskDINO https://github.com/IDEA-Research/MaskDINO by Tan-Cong Nguyen
 # ------------------------------------------------------------------------
 import logging
+import math
 import numpy as np
 from typing import Callable, Dict, List, Optional, Tuple, Union
 import fvcore.nn.weight_init as weight_init
@@ -21,7 +22,8 @@ from detectron2.layers import Conv2d, ShapeSpec, get_norm
 from detectron2.modeling import SEM_SEG_HEADS_REGISTRY
 
 from .position_encoding import PositionEmbeddingSine
-from ...utils.utils import _get_clones, _get_activation_fn
+from ...utils.utils import _get_clones, _get_activation_fn, resize_padding_mask
+from ..criterion import sigmoid_focal_loss
 from .ops.modules import MSDeformAttn
 
 
@@ -45,7 +47,8 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
     def __init__(self, d_model=256, nhead=8,
                  num_encoder_layers=6, dim_feedforward=1024, dropout=0.1,
                  activation="relu",
-                 num_feature_levels=4, enc_n_points=4,):
+                 num_feature_levels=4, enc_n_points=4,
+                 token_keep_ratios=()):
         super().__init__()
 
         self.d_model = d_model
@@ -54,10 +57,14 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
         encoder_layer = MSDeformAttnTransformerEncoderLayer(d_model, dim_feedforward,
                                                             dropout, activation,
                                                             num_feature_levels, nhead, enc_n_points)
-        self.encoder = MSDeformAttnTransformerEncoder(encoder_layer, num_encoder_layers)
+        self.encoder = MSDeformAttnTransformerEncoder(encoder_layer, num_encoder_layers, token_keep_ratios)
 
         self.level_embed = nn.Parameter(torch.Tensor(num_feature_levels, d_model))
 
+        # sparse token refinement: a light (intern_class_embed-like) linear scorer ranks the tokens,
+        # and the encoder layers only refine the top-scoring ones
+        self.token_score_embed = nn.Linear(d_model, 1) if self.encoder.sparse else None
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -68,6 +75,9 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
             if isinstance(m, MSDeformAttn):
                 m._reset_parameters()
         normal_(self.level_embed)
+        if self.token_score_embed is not None:
+            prior_prob = 0.01
+            constant_(self.token_score_embed.bias, -math.log((1 - prior_prob) / prior_prob))
 
     def get_valid_ratio(self, mask):
         _, H, W = mask.shape
@@ -79,13 +89,12 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
         return valid_ratio
 
     def forward(self, srcs, masks, pos_embeds):
-
-        enable_mask=0
-        if masks is not None:
-            for src in srcs:
-                if src.size(2)%32 or src.size(3)%32:
-                    enable_mask = 1
-        if enable_mask==0:
+        """
+        Args:
+            masks: per-level padding masks (N*H_l*W_l, True on padding), or None
+        """
+        has_padding = masks is not None
+        if not has_padding:
             masks = [torch.zeros((x.size(0), x.size(2), x.size(3)), device=x.device, dtype=torch.bool) for x in srcs]
         # prepare input for encoder
         src_flatten = []
@@ -110,10 +119,15 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
         level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
         valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
 
+        token_scores = None
+        if self.token_score_embed is not None:
+            token_scores = self.token_score_embed(src_flatten).squeeze(-1)
+
         # encoder
-        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
+        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten,
+                              mask_flatten if has_padding else None, token_scores=token_scores)
 
-        return memory, spatial_shapes, level_start_index
+        return memory, spatial_shapes, level_start_index, token_scores
 
 
 class MSDeformAttnTransformerEncoderLayer(nn.Module):
@@ -157,12 +171,47 @@ class MSDeformAttnTransformerEncoderLayer(nn.Module):
 
         return src
 
+    def forward_sparse(self, src, pos, reference_points, spatial_shapes, level_start_index, padding_mask, keep_idx):
+        """
+        Refine only the tokens `keep_idx` (N*K), which attend to all tokens of `src`, and
+        scatter them back; the other tokens are passed through.
+        """
+        index = keep_idx.unsqueeze(-1).expand(-1, -1, src.shape[-1])
+        query = torch.gather(src, 1, index)
+        query_pos = torch.gather(pos, 1, index) if pos is not None else None
+        query_reference_points = torch.gather(
+            reference_points, 1, keep_idx[:, :, None, None].expand(-1, -1, *reference_points.shape[2:])
+        )
+        # self attention
+        query2 = self.self_attn(self.with_pos_embed(query, query_pos), query_reference_points, src, spatial_shapes,
+                                level_start_index, padding_mask)
+        query = query + self.dropout1(query2)
+        query = self.norm1(query)
+
+        # ffn
+        query = self.forward_ffn(query)
+
+        return src.scatter(1, index, query)
+
 
 class MSDeformAttnTransformerEncoder(nn.Module):
-    def __init__(self, encoder_layer, num_layers):
+    def __init__(self, encoder_layer, num_layers, token_keep_ratios=()):
+        """
+        Args:
+            token_keep_ratios: fraction of the tokens refined by each layer, one value per layer or a
+                single value for all layers. Empty (or all 1.0) runs the dense encoder.
+        """
         super().__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
+        token_keep_ratios = list(token_keep_ratios)
+        if len(token_keep_ratios) == 1:
+            token_keep_ratios = token_keep_ratios * num_layers
+        assert len(token_keep_ratios) in (0, num_layers), \
+            "TOKEN_KEEP_RATIOS must have 1 or {} values, got {}".format(num_layers, token_keep_ratios)
+        assert all(0.0 < r <= 1.0 for r in token_keep_ratios), token_keep_ratios
+        self.token_keep_ratios = token_keep_ratios
+        self.sparse = any(r < 1.0 for r in token_keep_ratios)
 
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
@@ -179,11 +228,55 @@ class MSDeformAttnTransformerEncoder(nn.Module):
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
-    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
+    def num_kept_tokens(self, num_tokens):
+        """
+        Number of tokens refined by each layer for `num_tokens` input (non-padded) tokens.
+        """
+        if not self.sparse:
+            return [num_tokens] * self.num_layers
+        return [max(int(num_tokens * r), 1) for r in self.token_keep_ratios]
+
+    def flops(self, num_tokens, num_valid=None):
+        """
+        Analytic FLOPs (2 * multiply-adds) of the encoder layers for `num_tokens` tokens per image, of which
+        `num_valid` are not padding. The value projection runs over all tokens, everything else only over
+        the refined tokens.
+        """
+        flops = 0
+        num_valid = num_tokens if num_valid is None else num_valid
+        for layer, num_keep in zip(self.layers, self.num_kept_tokens(num_valid)):
+            attn = layer.self_attn
+            d, num_samples = attn.d_model, attn.n_heads * attn.n_levels * attn.n_points
+            flops += num_tokens * d * d                                     # value_proj
+            flops += num_keep * d * num_samples * 3                         # sampling_offsets, attention_weights
+            flops += num_keep * attn.n_levels * attn.n_points * d * 4       # bilinear sampling and aggregation
+            flops += num_keep * d * d                                       # output_proj
+            flops += num_keep * d * layer.linear1.out_features * 2          # ffn
+        return 2 * flops
+
+    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None,
+                token_scores=None):
         output = src
         reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
-        for _, layer in enumerate(self.layers):
-            output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
+        # queries entirely in the padding are skipped, the same number of tokens is refined
+        # for all images of the batch
+        num_valid = src.shape[1]
+        if padding_mask is not None:
+            num_valid = max(int((~padding_mask).sum(1).max()), 1)
+        num_keep = self.num_kept_tokens(num_valid)
+        sparse = min(num_keep) < src.shape[1]
+        if sparse:
+            # topk is sorted, the tokens kept by each layer are a prefix of `order`
+            scores = token_scores.detach() if token_scores is not None else src.new_zeros(src.shape[:2])
+            if padding_mask is not None:
+                scores = scores.masked_fill(padding_mask, float("-inf"))
+            order = scores.topk(max(k for k in num_keep if k < src.shape[1]), dim=1)[1]
+        for lid, layer in enumerate(self.layers):
+            if not sparse or num_keep[lid] >= src.shape[1]:
+                output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
+            else:
+                output = layer.forward_sparse(output, pos, reference_points, spatial_shapes, level_start_index,
+                                              padding_mask, order[:, :num_keep[lid]])
 
         return output
 
@@ -211,6 +304,8 @@ class DYNAFormerEncoder(nn.Module):
         num_feature_levels: int,
         total_num_feature_levels: int,
         feature_order: str,
+        token_keep_ratios: List[float] = (),
+        mask_feature_stride: int = 4,
     ):
         """
         NOTE: this interface is experimental.
@@ -226,6 +321,10 @@ class DYNAFormerEncoder(nn.Module):
             num_feature_levels: feature scales used
             total_num_feature_levels: total feautre scales used (include the downsampled features)
             feature_order: 'low2high' or 'high2low', i.e., 'low2high' means low-resolution features are put in the first.
+            token_keep_ratios: fraction of the tokens refined by each encoder layer (sparse token
+                refinement), empty for the dense encoder
+            mask_feature_stride: stride of the output mask features, the FPN levels of a higher
+                resolution are not built
         """
         super().__init__()
         transformer_input_shape = {                                                                                           #Shape:'res3', 'res4', 'res5'
@@ -251,6 +350,8 @@ class DYNAFormerEncoder(nn.Module):
         self.num_feature_levels = num_feature_levels  # always use 3 scales                                                   #3
         self.total_num_feature_levels = total_num_feature_levels                                                              #3
         self.common_stride = common_stride                                                                                    #4
+        assert mask_feature_stride >= common_stride, (mask_feature_stride, common_stride)
+        self.mask_feature_stride = mask_feature_stride                                                                        #4
 
         self.transformer_num_feature_levels = len(self.transformer_in_features)                                               #3
         self.low_resolution_index = transformer_in_channels.index(max(transformer_in_channels))                               #2
@@ -290,6 +391,7 @@ class DYNAFormerEncoder(nn.Module):
             dim_feedforward=transformer_dim_feedforward,
             num_encoder_layers=transformer_enc_layers,
             num_feature_levels=self.total_num_feature_levels,
+            token_keep_ratios=token_keep_ratios,
         )
         N_steps = conv_dim // 2
         self.pe_layer = PositionEmbeddingSine(N_steps, normalize=True)
@@ -308,12 +410,16 @@ class DYNAFormerEncoder(nn.Module):
         # extra fpn levels
         stride = min(self.transformer_feature_strides)
         self.num_fpn_levels = max(int(np.log2(stride) - np.log2(self.common_stride)), 1)
+        # FPN levels of a higher resolution than the mask features are not built
+        self.fpn_start_level = sum(s < self.mask_feature_stride for s in self.feature_strides[:self.num_fpn_levels])
 
         lateral_convs = []
         output_convs = []
 
         use_bias = norm == ""
         for idx, in_channels in enumerate(self.feature_channels[:self.num_fpn_levels]):
+            if idx < self.fpn_start_level:
+                continue
             lateral_norm = get_norm(norm, conv_dim)
             output_norm = get_norm(norm, conv_dim)
 
@@ -362,14 +468,21 @@ class DYNAFormerEncoder(nn.Module):
         ret["total_num_feature_levels"] = cfg.MODEL.SEM_SEG_HEAD.TOTAL_NUM_FEATURE_LEVELS                                               #3
         ret["num_feature_levels"] = cfg.MODEL.SEM_SEG_HEAD.NUM_FEATURE_LEVELS                                                           #3
         ret["feature_order"] = cfg.MODEL.SEM_SEG_HEAD.FEATURE_ORDER                                                                     #'high2low'
+        ret["token_keep_ratios"] = cfg.MODEL.SEM_SEG_HEAD.TOKEN_KEEP_RATIOS                                                             #[]
+        # with MASK_FEATURE_REFINE, the decoder pools the mask features for the anchor iterations
+        ret["mask_feature_stride"] = (
+            cfg.MODEL.SEM_SEG_HEAD.COMMON_STRIDE if cfg.MODEL.DYNAFormer.MASK_FEATURE_REFINE
+            else cfg.MODEL.DYNAFormer.MASK_FEATURE_STRIDE                                                                       #4
+        )
         return ret
 
     @autocast(enabled=False)
     def forward_features(self, features, masks):
         """
         :param features: multi-scale features from the backbone
-        :param masks: image mask
-        :return: enhanced multi-scale features and mask feature (1/4 resolution) for the decoder to produce binary mask
+        :param masks: padding mask of the images (N*H*W, True on padding), or None
+        :return: enhanced multi-scale features and mask feature (1/4 resolution) for the decoder to produce binary mask,
+            and the per-level token score logits of the sparse encoder (None if it is not sparse)
         """
         # backbone features
         srcs = []
@@ -398,7 +511,9 @@ class DYNAFormerEncoder(nn.Module):
         if self.feature_order != 'low2high':
             srcs = srcsl
             pos = posl
-        y, spatial_shapes, level_start_index = self.transformer(srcs, masks, pos)
+        if masks is not None:
+            masks = [resize_padding_mask(masks, src.shape[-2:]) for src in srcs]
+        y, spatial_shapes, level_start_index, token_scores = self.transformer(srcs, masks, pos)
         bs = y.shape[0]
 
         split_size_or_sections = [None] * self.total_num_feature_levels
@@ -408,6 +523,13 @@ class DYNAFormerEncoder(nn.Module):
             else:
                 split_size_or_sections[i] = y.shape[1] - level_start_index[i]
         y = torch.split(y, split_size_or_sections, dim=1)
+        # per-level token score logits (N*H_l*W_l) in the sparse mode
+        token_score_maps = None
+        if token_scores is not None:
+            token_score_maps = [
+                z.view(bs, *spatial_shapes[i].tolist())
+                for i, z in enumerate(torch.split(token_scores, split_size_or_sections, dim=1))
+            ]
 
         out = []
         multi_scale_features = []
@@ -417,7 +539,8 @@ class DYNAFormerEncoder(nn.Module):
 
         # append `out` with extra FPN levels
         # Reverse feature maps into top-down order (from low to high resolution)
-        for idx, f in enumerate(self.in_features[:self.num_fpn_levels][::-1]):
+        num_encoder_levels = len(out)
+        for idx, f in enumerate(self.in_features[self.fpn_start_level:self.num_fpn_levels][::-1]):
             x = features[f].float()
             lateral_conv = self.lateral_convs[idx]
             output_conv = self.output_convs[idx]
@@ -431,5 +554,26 @@ class DYNAFormerEncoder(nn.Module):
             if num_cur_levels < self.total_num_feature_levels:
                 multi_scale_features.append(o)
                 num_cur_levels += 1
-        return self.mask_features(out[-1]), out[0], multi_scale_features
+        # highest resolution output: the last FPN level, or the highest resolution encoder level
+        # if no FPN level is computed
+        mask_out = out[-1] if len(out) > num_encoder_levels else out[self.high_resolution_index]
+        return self.mask_features(mask_out), out[0], multi_scale_features, token_score_maps
+
+    def token_score_losses(self, token_score_maps, targets):
+        """
+        Focal loss of the token scorer of the sparse encoder: a token is positive if it covers
+        a pixel of any ground truth mask.
+        Args:
+            token_score_maps: per-level token score logits returned by :meth:`forward_features`
+            targets: targets as passed to :class:`SetCriterion`, with padded "masks"
+        """
+        fg = torch.stack([t["masks"].any(0) if len(t["masks"]) else t["masks"].new_zeros(t["masks"].shape[1:])
+                          for t in targets])[:, None].float()
+        logits = []
+        labels = []
+        for score_map in token_score_maps:
+            logits.append(score_map.flatten(1))
+            labels.append(F.adaptive_max_pool2d(fg, score_map.shape[-2:]).flatten(1))
+        loss = sigmoid_focal_loss(torch.cat(logits, 1), torch.cat(labels, 1), len(targets))
+        return {"loss_token_score": loss}
 
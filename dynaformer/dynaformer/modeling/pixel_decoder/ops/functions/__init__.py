@@ -9,5 +9,5 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # Modified by Bowen Cheng from https://github.com/fundamentalvision/Deformable-DETR
 
-from .ms_deform_attn_func import MSDeformAttnFunction
+from .ms_deform_attn_func import MSDeformAttnFunction, MSDeformAttnMaskFunction
 
@@ -28,6 +28,9 @@ except ModuleNotFoundError as e:
     )
     raise ModuleNotFoundError(info_string)
 
+# the fused mask-aware attention is only available in extensions built with it
+MSDA_MASK_AVAILABLE = hasattr(MSDA, "ms_deform_attn_mask_forward")
+
 
 class MSDeformAttnFunction(Function):
     @staticmethod
@@ -70,3 +73,105 @@ def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations,
     attention_weights = attention_weights.transpose(1, 2).reshape(N_*M_, 1, Lq_, L_*P_)
     output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_*D_, Lq_)
     return output.transpose(1, 2).contiguous()
+
+
+class MSDeformAttnMaskFunction(Function):
+    """
+    Fused mask-aware multi-scale deformable attention: the sampling locations are computed from the
+    reference boxes and the offsets, the logits of the points sampled with the `gated_box` reference
+    box are zeroed outside of the reference mask, softmax is taken over the levels and points and
+    the value is sampled, in one kernel. See ms_deform_attn_mask_core_pytorch for the unfused version.
+    """
+
+    @staticmethod
+    def forward(ctx, value, value_spatial_shapes, value_level_start_index, reference_boxes, sampling_offsets,
+                attention_logits, reference_masks, gated_box):
+        """
+        :param value                       (N, \sum_{l} H_l \cdot W_l, n_heads, C)
+        :param reference_boxes             (N, Length_{query}, n_levels, n_boxes, 4), (cx, cy, w, h) in [0, 1], point p
+                                           is sampled with the reference box p % n_boxes
+        :param sampling_offsets            (N, Length_{query}, n_heads, n_levels, n_points, 2)
+        :param attention_logits            (N, Length_{query}, n_heads, n_levels, n_points), before the softmax
+        :param reference_masks             (N, Length_{query}, H, W), uint8
+        :param gated_box                   index of the reference box whose points are gated by the mask, -1 for none
+        :return output                     (N, Length_{query}, n_heads * C)
+        """
+        ctx.gated_box = gated_box
+        output = MSDA.ms_deform_attn_mask_forward(
+            value, value_spatial_shapes, value_level_start_index, reference_boxes, sampling_offsets,
+            attention_logits, reference_masks, gated_box)
+        ctx.save_for_backward(value, value_spatial_shapes, value_level_start_index, reference_boxes, sampling_offsets,
+                              attention_logits, reference_masks)
+        return output
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        value, value_spatial_shapes, value_level_start_index, reference_boxes, sampling_offsets, \
+            attention_logits, reference_masks = ctx.saved_tensors
+        grad_value, grad_sampling_loc, grad_attention_logits = \
+            MSDA.ms_deform_attn_mask_backward(
+                value, value_spatial_shapes, value_level_start_index, reference_boxes, sampling_offsets,
+                attention_logits, reference_masks, grad_output.contiguous(), ctx.gated_box)
+
+        # sampling locations: box[:2] + offset / n_points * box[2:] * 0.5
+        num_point, num_box = sampling_offsets.shape[4], reference_boxes.shape[3]
+        box_index = torch.arange(num_point, device=value.device) % num_box
+        boxes = reference_boxes[:, :, None, :, box_index]
+        grad_sampling_offsets = grad_sampling_loc * boxes[..., 2:] * (0.5 / num_point)
+        grad_reference_boxes = None
+        if ctx.needs_input_grad[3]:
+            grad_boxes = torch.cat([grad_sampling_loc, grad_sampling_loc * sampling_offsets * (0.5 / num_point)], -1).sum(2)
+            grad_reference_boxes = torch.zeros_like(reference_boxes).index_add_(3, box_index, grad_boxes)
+
+        return grad_value, None, None, grad_reference_boxes, grad_sampling_offsets, grad_attention_logits, None, None
+
+
+def check_points_in_mask(mask, points):
+    # mask shape: (N, Q, H, W)
+    # points shape: (N, Q, P, 2)
+    
+    N, Q, H, W = mask.shape
+    _, _, P, _ = points.shape
+    
+    # Convert normalized points (x, y) to pixel coordinates
+    pixel_coords = points.clone()
+    pixel_coords[..., 0] = (points[..., 0] * W).long()  # x-coordinates
+    pixel_coords[..., 1] = (points[..., 1] * H).long()  # y-coordinates
+    
+    # Ensure that pixel_coords are of dtype long
+    pixel_coords = pixel_coords.long()
+    
+    # Clamp the values to ensure they are within valid pixel ranges
+    pixel_coords[..., 0] = pixel_coords[..., 0].clamp(0, W - 1)
+    pixel_coords[..., 1] = pixel_coords[..., 1].clamp(0, H - 1)
+    
+    # Create grid indices for batch and mask
+    batch_indices = torch.arange(N, dtype=torch.long, device=mask.device).view(N, 1, 1)
+    mask_indices = torch.arange(Q, dtype=torch.long, device=mask.device).view(1, Q, 1)
+    
+    # Gather the corresponding values from the mask at the given pixel coordinates
+    mask_at_points = mask[
+        batch_indices,           # Batch dimension
+        mask_indices,            # Mask dimension
+        pixel_coords[..., 1],    # y-coordinates (height)
+        pixel_coords[..., 0]     # x-coordinates (width)
+    ]
+    
+    # mask_at_points will have shape (N, Q, P), and values will be 1 or 0
+    return mask_at_points
+
+
+def ms_deform_attn_mask_core_pytorch(value, value_spatial_shapes, reference_boxes, sampling_offsets, attention_logits,
+                                     reference_masks, gated_box):
+    # unfused version of MSDeformAttnMaskFunction, for debug and test only
+    N_, Lq_, M_, L_, P_, _ = sampling_offsets.shape
+    box_index = torch.arange(P_, device=value.device) % reference_boxes.shape[3]
+    boxes = reference_boxes[:, :, None, :, box_index]
+    sampling_locations = boxes[..., :2] + sampling_offsets / P_ * boxes[..., 2:] * 0.5
+    if gated_box >= 0:
+        point_inside_mask = check_points_in_mask(reference_masks.bool(), sampling_locations.flatten(2, 4)).view(N_, Lq_, M_, L_, P_)
+        penalty = torch.where(box_index == gated_box, point_inside_mask * 1.0, torch.ones_like(point_inside_mask, dtype=torch.float))
+        attention_logits = attention_logits * penalty
+    attention_weights = F.softmax(attention_logits.view(N_, Lq_, M_, L_ * P_), -1).view(N_, Lq_, M_, L_, P_)
+    return ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations, attention_weights)
@@ -23,48 +23,13 @@ from torch import nn
 import torch.nn.functional as F
 from torch.nn.init import xavier_uniform_, constant_
 
-from ..functions import MSDeformAttnFunction
-from ..functions.ms_deform_attn_func import ms_deform_attn_core_pytorch
+from ..functions import MSDeformAttnFunction, MSDeformAttnMaskFunction
+from ..functions.ms_deform_attn_func import ms_deform_attn_core_pytorch, check_points_in_mask, MSDA_MASK_AVAILABLE
 from detectron2.structures import BitMasks
 from dynaformer.utils import box_ops
 from dynaformer.utils.utils import get_bounding_boxes
 
 
-def check_points_in_mask(mask, points):
-    # mask shape: (N, Q, H, W)
-    # points shape: (N, Q, P, 2)
-    
-    N, Q, H, W = mask.shape
-    _, _, P, _ = points.shape
-    
-    # Convert normalized points (x, y) to pixel coordinates
-    pixel_coords = points.clone()
-    pixel_coords[..., 0] = (points[..., 0] * W).long()  # x-coordinates
-    pixel_coords[..., 1] = (points[..., 1] * H).long()  # y-coordinates
-    
-    # Ensure that pixel_coords are of dtype long
-    pixel_coords = pixel_coords.long()
-    
-    # Clamp the values to ensure they are within valid pixel ranges
-    pixel_coords[..., 0] = pixel_coords[..., 0].clamp(0, W - 1)
-    pixel_coords[..., 1] = pixel_coords[..., 1].clamp(0, H - 1)
-    
-    # Create grid indices for batch and mask
-    batch_indices = torch.arange(N, dtype=torch.long, device=mask.device).view(N, 1, 1)
-    mask_indices = torch.arange(Q, dtype=torch.long, device=mask.device).view(1, Q, 1)
-    
-    # Gather the corresponding values from the mask at the given pixel coordinates
-    mask_at_points = mask[
-        batch_indices,           # Batch dimension
-        mask_indices,            # Mask dimension
-        pixel_coords[..., 1],    # y-coordinates (height)
-        pixel_coords[..., 0]     # x-coordinates (width)
-    ]
-    
-    # mask_at_points will have shape (N, Q, P), and values will be 1 or 0
-    return mask_at_points
-
-
 def _is_power_of_2(n):
     if (not isinstance(n, int)) or (n < 0):
         raise ValueError("invalid input for _is_power_of_2: {} (type: {})".format(n, type(n)))
@@ -72,13 +37,14 @@ def _is_power_of_2(n):
 
 
 class MSDeformAttnMask(nn.Module):
-    def __init__(self, d_model=256, n_levels=4, n_heads=8, n_points=8,type_sampling_location="mask"):
+    def __init__(self, d_model=256, n_levels=4, n_heads=8, n_points=8,type_sampling_location="mask", fused_mask_attn=False):
         """
         Multi-Scale Deformable Attention Module
         :param d_model      hidden dimension
         :param n_levels     number of feature levels
         :param n_heads      number of attention heads
         :param n_points     number of sampling points per attention head per feature level
+        :param fused_mask_attn  run the "mask"/"both" sampling with the fused kernel, if the ops are built with it
         """
         super().__init__()
         if d_model % n_heads != 0:
@@ -96,6 +62,11 @@ class MSDeformAttnMask(nn.Module):
         self.n_heads = n_heads
         self.n_points = n_points
         self.type_sampling_location = type_sampling_location
+        # run the "mask"/"both" sampling with the fused kernel (gating, softmax and sampling in one op)
+        if fused_mask_attn and not MSDA_MASK_AVAILABLE:
+            warnings.warn("The ops are built without the fused mask-aware deformable attention, "
+                          "rebuild them (make.sh) to use it.")
+        self.fused_mask_attn = fused_mask_attn and MSDA_MASK_AVAILABLE
 
         self.sampling_offsets = nn.Linear(d_model, n_heads * n_levels * self.n_points * 2)
         self.attention_weights = nn.Linear(d_model, n_heads * n_levels * self.n_points)
@@ -129,7 +100,9 @@ class MSDeformAttnMask(nn.Module):
         input_flatten,                #N*Sum{WH}*C
         input_spatial_shapes,         #3*2
         input_level_start_index,      #Level
-        input_padding_mask=None):     #N*Sum{WH}
+        input_padding_mask=None,      #N*Sum{WH}
+        input_valid_ratios=None,      #N*Level*2
+        reference_padding_mask=None): #N*H*W
         """
         :param query                       (N, Length_{query}, C)
         :param reference_points            (N, Length_{query}, n_levels, 2), range in [0, 1], top-left (0,0), bottom-right (1, 1), including padding area
@@ -138,6 +111,10 @@ class MSDeformAttnMask(nn.Module):
         :param input_spatial_shapes        (n_levels, 2), [(H_0, W_0), (H_1, W_1), ..., (H_{L-1}, W_{L-1})]
         :param input_level_start_index     (n_levels, ), [0, H_0*W_0, H_0*W_0+H_1*W_1, H_0*W_0+H_1*W_1+H_2*W_2, ..., H_0*W_0+H_1*W_1+...+H_{L-1}*W_{L-1}]
         :param input_padding_mask          (N, \sum_{l=0}^{L-1} H_l \cdot W_l), True for padding elements, False for non-padding elements
+        :param input_valid_ratios          (N, n_levels, 2), valid (non-padded) fraction of each level, the reference boxes are
+                                           relative to the valid area and are scaled to the padded area
+        :param reference_padding_mask      (N, H, W), padding at the resolution of reference_masks, the padding is never
+                                           inside a reference mask
 
         :return output                     (N, Length_{query}, C)
         """
@@ -155,36 +132,53 @@ class MSDeformAttnMask(nn.Module):
         attention_weights = self.attention_weights(query).view(N, Len_q, self.n_heads, self.n_levels, self.n_points)
 
         #reference_masks_sig=reference_masks.sigmoid()
+        if self.type_sampling_location in ("both", "mask"):
+          ref_masks = reference_masks > 0
+          if reference_padding_mask is not None:
+            ref_masks = ref_masks & ~reference_padding_mask[:, None]
+        if self.type_sampling_location in ("both", "bbox"):
+          reference_bboxs = reference_bboxs.sigmoid().unsqueeze(2).expand(-1, -1, input_spatial_shapes.shape[0], -1)
+          if input_valid_ratios is not None:
+            reference_bboxs = reference_bboxs * torch.cat([input_valid_ratios, input_valid_ratios], -1)[:, None]
+        if self.type_sampling_location in ("both", "mask") and self.fused_mask_attn:
+          #N*(D+Q)*Level*Box*4, the points sampled with the mask box are gated by the mask
+          mask_box_sig = get_bounding_boxes(ref_masks).to(value.dtype)[:, :, None, None].expand(-1, -1, input_spatial_shapes.shape[0], 1, -1)
+          if self.type_sampling_location == "both":
+            reference_boxes = torch.cat([reference_bboxs[:, :, :, None], mask_box_sig], 3)
+          else:
+            reference_boxes = mask_box_sig
+          output = MSDeformAttnMaskFunction.apply(
+              value, input_spatial_shapes, input_level_start_index, reference_boxes.contiguous(),
+              sampling_offsets.contiguous(), attention_weights.contiguous(), ref_masks.contiguous().view(torch.uint8),
+              reference_boxes.shape[3] - 1)
+          return self.output_proj(output)
+
         if self.type_sampling_location == "both":
           #init sampling location 
           sampling_locations = sampling_offsets
           #Sampling location for Bbox
-          reference_bboxs=reference_bboxs.sigmoid().unsqueeze(2).repeat(1, 1, input_spatial_shapes.shape[0], 1)
           sampling_locations[...,::2,:] = reference_bboxs[:, :, None, :, None, :2] \
                             + sampling_locations[...,::2,:] / self.n_points * reference_bboxs[:, :, None, :, None, 2:] * 0.5
 
           #Sampling location for Mask
-          ref_masks=reference_masks>0
-          mask_box_sig=get_bounding_boxes(ref_masks).unsqueeze(2).repeat(1, 1, input_spatial_shapes.shape[0], 1)
-          sampling_locations[...,1::2,:] = mask_box_sig[:, :, None, :, None, :2] \
-                            + sampling_locations[...,1::2,:] / self.n_points * mask_box_sig[:, :, None, :, None, 2:] * 0.5
+          mask_box_sig=get_bounding_boxes(ref_masks)
+          sampling_locations[...,1::2,:] = mask_box_sig[:, :, None, None, None, :2] \
+                            + sampling_locations[...,1::2,:] / self.n_points * mask_box_sig[:, :, None, None, None, 2:] * 0.5
           point_inside_mask=check_points_in_mask(ref_masks,sampling_locations[...,1::2,:].view(N, Len_q, self.n_heads*self.n_levels*(self.n_points//2), 2))
           attention_weights_panaty= torch.ones_like(attention_weights, dtype=torch.float32, device=attention_weights.device)
           attention_weights_panaty[...,1::2]=point_inside_mask.view(N, Len_q, self.n_heads,self.n_levels,(self.n_points//2))*1.0
           attention_weights=attention_weights*attention_weights_panaty
         
         elif self.type_sampling_location == "mask":
-          ref_masks=reference_masks>0
-          mask_box_sig=get_bounding_boxes(ref_masks).unsqueeze(2).repeat(1, 1, input_spatial_shapes.shape[0], 1)
-          sampling_locations = mask_box_sig[:, :, None, :, None, :2] \
-                            + sampling_offsets / self.n_points * mask_box_sig[:, :, None, :, None, 2:] * 0.5
+          mask_box_sig=get_bounding_boxes(ref_masks)
+          sampling_locations = mask_box_sig[:, :, None, None, None, :2] \
+                            + sampling_offsets / self.n_points * mask_box_sig[:, :, None, None, None, 2:] * 0.5
           
           point_inside_mask=check_points_in_mask(ref_masks,sampling_locations.view(N, Len_q, self.n_heads*self.n_levels*self.n_points, 2))
           attention_weights_panaty=point_inside_mask.view(N, Len_q, self.n_heads,self.n_levels,self.n_points)*1.0
           attention_weights=attention_weights*attention_weights_panaty
           
         elif self.type_sampling_location == "bbox":
-          reference_bboxs=reference_bboxs.sigmoid().unsqueeze(2).repeat(1, 1, input_spatial_shapes.shape[0], 1)
           sampling_locations = reference_bboxs[:, :, None, :, None, :2] \
                             + sampling_offsets / self.n_points * reference_bboxs[:, :, None, :, None, 2:] * 0.5
         else:
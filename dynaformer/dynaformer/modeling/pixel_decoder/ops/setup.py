@@ -47,6 +47,9 @@ def get_extensions():
             "-D__CUDA_NO_HALF_CONVERSIONS__",
             "-D__CUDA_NO_HALF2_OPERATORS__",
         ]
+    elif os.environ.get('FORCE_CPU'):
+        # CPU-only build: the fused mask-aware attention runs on CPU, MSDeformAttn falls back to PyTorch
+        pass
     else:
         if CUDA_HOME is None:
             raise NotImplementedError('CUDA_HOME is None. Please set environment variable CUDA_HOME.')
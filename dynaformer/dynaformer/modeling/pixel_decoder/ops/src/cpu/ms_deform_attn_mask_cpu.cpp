@@ -0,0 +1,276 @@
+/*!
+* Fused mask-aware multi-scale deformable attention, CPU implementation.
+*
+* For every query and head, the sampling locations are computed from the reference boxes and the
+* offsets, the logits of the points sampled with the gated box are zeroed outside of the reference
+* mask, the softmax is taken over the levels and points and the value is sampled, without
+* materializing the sampling locations, the gating and the attention weights.
+*/
+
+#include <vector>
+#include <cmath>
+#include <algorithm>
+#include <memory>
+
+#include <ATen/ATen.h>
+#include <ATen/Parallel.h>
+
+#include "ms_deform_attn_mask_common.h"
+
+
+namespace {
+
+struct MaskAttnShape
+{
+  int batch, spatial_size, num_heads, channels, num_levels, num_query, num_point, num_box, mask_h, mask_w, gated_box;
+};
+
+
+// Sampling locations, gate and softmax of the points of a query and head
+template <typename scalar_t>
+void ms_deform_attn_mask_softmax(const MaskAttnShape &s, const int64_t *spatial_shapes,
+                                 const scalar_t *boxes, const scalar_t *offsets, const scalar_t *logits, const uint8_t *mask,
+                                 scalar_t *loc_w, scalar_t *loc_h, bool *passed, scalar_t *attn)
+{
+  const int num_lp = s.num_levels * s.num_point;
+  scalar_t max_logit = -INFINITY;
+  for (int l = 0; l < s.num_levels; ++l)
+  {
+    for (int p = 0; p < s.num_point; ++p)
+    {
+      const int j = l * s.num_point + p;
+      const int b = p % s.num_box;
+      ms_deform_attn_mask_location(boxes + (l * s.num_box + b) * 4, offsets + j * 2, s.num_point, loc_w[j], loc_h[j]);
+      passed[j] = b != s.gated_box || ms_deform_attn_mask_inside(mask, s.mask_h, s.mask_w, loc_w[j], loc_h[j]);
+      attn[j] = passed[j] ? logits[j] : scalar_t(0);
+      max_logit = std::max(max_logit, attn[j]);
+    }
+  }
+  scalar_t sum = 0;
+  for (int j = 0; j < num_lp; ++j)
+  {
+    attn[j] = std::exp(attn[j] - max_logit);
+    sum += attn[j];
+  }
+  for (int j = 0; j < num_lp; ++j)
+  {
+    attn[j] /= sum;
+  }
+}
+
+
+template <typename scalar_t>
+void ms_deform_attn_mask_cpu_forward_impl(const MaskAttnShape &s, const scalar_t *value, const int64_t *spatial_shapes,
+                                          const int64_t *level_start_index, const scalar_t *boxes, const scalar_t *offsets,
+                                          const scalar_t *logits, const uint8_t *masks, scalar_t *output)
+{
+  const int num_lp = s.num_levels * s.num_point;
+  const int stride = s.num_heads * s.channels;
+  // every (batch, head) writes its own outputs
+  at::parallel_for(0, s.batch * s.num_heads, 0, [&](int64_t begin, int64_t end) {
+    std::vector<scalar_t> loc_w(num_lp), loc_h(num_lp), attn(num_lp);
+    std::unique_ptr<bool[]> passed(new bool[num_lp]);
+    for (int64_t nm = begin; nm < end; ++nm)
+    {
+      const int n = nm / s.num_heads;
+      const int m = nm % s.num_heads;
+      for (int q = 0; q < s.num_query; ++q)
+      {
+        const int64_t nq = static_cast<int64_t>(n) * s.num_query + q;
+        const int64_t nqm = nq * s.num_heads + m;
+        ms_deform_attn_mask_softmax(s, spatial_shapes, boxes + nq * s.num_levels * s.num_box * 4,
+                                    offsets + nqm * num_lp * 2, logits + nqm * num_lp,
+                                    masks + nq * s.mask_h * s.mask_w,
+                                    loc_w.data(), loc_h.data(), passed.get(), attn.data());
+        scalar_t *out = output + nqm * s.channels;
+        for (int l = 0; l < s.num_levels; ++l)
+        {
+          const int height = spatial_shapes[l * 2];
+          const int width = spatial_shapes[l * 2 + 1];
+          const scalar_t *value_l = value + (static_cast<int64_t>(n) * s.spatial_size + level_start_index[l]) * stride + m * s.channels;
+          for (int p = 0; p < s.num_point; ++p)
+          {
+            const int j = l * s.num_point + p;
+            for (int c = 0; c < s.channels; ++c)
+            {
+              out[c] += attn[j] * ms_deform_attn_mask_bilinear(value_l + c, height, width, stride, loc_w[j], loc_h[j]);
+            }
+          }
+        }
+      }
+    }
+  });
+}
+
+
+template <typename scalar_t>
+void ms_deform_attn_mask_cpu_backward_impl(const MaskAttnShape &s, const scalar_t *value, const int64_t *spatial_shapes,
+                                           const int64_t *level_start_index, const scalar_t *boxes, const scalar_t *offsets,
+                                           const scalar_t *logits, const uint8_t *masks, const scalar_t *grad_output,
+                                           scalar_t *grad_value, scalar_t *grad_sampling_loc, scalar_t *grad_logits)
+{
+  const int num_lp = s.num_levels * s.num_point;
+  const int stride = s.num_heads * s.channels;
+  // the value of a (batch, head) is only sampled by the queries of this (batch, head), so its gradient is race free
+  at::parallel_for(0, s.batch * s.num_heads, 0, [&](int64_t begin, int64_t end) {
+    std::vector<scalar_t> loc_w(num_lp), loc_h(num_lp), attn(num_lp), grad_attn(num_lp);
+    std::unique_ptr<bool[]> passed(new bool[num_lp]);
+    for (int64_t nm = begin; nm < end; ++nm)
+    {
+      const int n = nm / s.num_heads;
+      const int m = nm % s.num_heads;
+      for (int q = 0; q < s.num_query; ++q)
+      {
+        const int64_t nq = static_cast<int64_t>(n) * s.num_query + q;
+        const int64_t nqm = nq * s.num_heads + m;
+        ms_deform_attn_mask_softmax(s, spatial_shapes, boxes + nq * s.num_levels * s.num_box * 4,
+                                    offsets + nqm * num_lp * 2, logits + nqm * num_lp,
+                                    masks + nq * s.mask_h * s.mask_w,
+                                    loc_w.data(), loc_h.data(), passed.get(), attn.data());
+        const scalar_t *top_grad = grad_output + nqm * s.channels;
+        scalar_t *grad_loc = grad_sampling_loc + nqm * num_lp * 2;
+        scalar_t weighted_grad_attn = 0;
+        for (int l = 0; l < s.num_levels; ++l)
+        {
+          const int height = spatial_shapes[l * 2];
+          const int width = spatial_shapes[l * 2 + 1];
+          const int64_t value_offset = (static_cast<int64_t>(n) * s.spatial_size + level_start_index[l]) * stride + m * s.channels;
+          for (int p = 0; p < s.num_point; ++p)
+          {
+            const int j = l * s.num_point + p;
+            int corners[4];
+            scalar_t weights[4], lh, lw;
+            grad_attn[j] = 0;
+            if (!ms_deform_attn_mask_bilinear_corners(height, width, stride, loc_w[j], loc_h[j], corners, weights, lh, lw))
+            {
+              continue;
+            }
+            const scalar_t hh = 1 - lh, hw = 1 - lw;
+            scalar_t grad_w = 0, grad_h = 0;
+            for (int c = 0; c < s.channels; ++c)
+            {
+              const scalar_t *value_c = value + value_offset + c;
+              scalar_t *grad_value_c = grad_value + value_offset + c;
+              const scalar_t top_grad_value = top_grad[c] * attn[j];
+              scalar_t v[4];
+              for (int k = 0; k < 4; ++k)
+              {
+                v[k] = corners[k] >= 0 ? value_c[corners[k]] : scalar_t(0);
+                if (corners[k] >= 0)
+                  grad_value_c[corners[k]] += weights[k] * top_grad_value;
+              }
+              grad_attn[j] += top_grad[c] * (weights[0] * v[0] + weights[1] * v[1] + weights[2] * v[2] + weights[3] * v[3]);
+              grad_h += top_grad_value * (-hw * v[0] - lw * v[1] + hw * v[2] + lw * v[3]);
+              grad_w += top_grad_value * (-hh * v[0] + hh * v[1] - lh * v[2] + lh * v[3]);
+            }
+            grad_loc[j * 2] = width * grad_w;
+            grad_loc[j * 2 + 1] = height * grad_h;
+            weighted_grad_attn += attn[j] * grad_attn[j];
+          }
+        }
+        // softmax backward, the logits gated out of the mask are constants
+        scalar_t *grad_logit = grad_logits + nqm * num_lp;
+        for (int j = 0; j < num_lp; ++j)
+        {
+          grad_logit[j] = passed[j] ? attn[j] * (grad_attn[j] - weighted_grad_attn) : scalar_t(0);
+        }
+      }
+    }
+  });
+}
+
+
+MaskAttnShape get_shape(const at::Tensor &value, const at::Tensor &spatial_shapes, const at::Tensor &reference_boxes,
+                        const at::Tensor &sampling_offsets, const at::Tensor &reference_masks, const int gated_box)
+{
+  MaskAttnShape s;
+  s.batch = value.size(0);
+  s.spatial_size = value.size(1);
+  s.num_heads = value.size(2);
+  s.channels = value.size(3);
+  s.num_levels = spatial_shapes.size(0);
+  s.num_query = sampling_offsets.size(1);
+  s.num_point = sampling_offsets.size(4);
+  s.num_box = reference_boxes.size(3);
+  s.mask_h = reference_masks.size(2);
+  s.mask_w = reference_masks.size(3);
+  s.gated_box = gated_box;
+  return s;
+}
+
+
+void check_inputs(const at::Tensor &value, const at::Tensor &spatial_shapes, const at::Tensor &level_start_index,
+                  const at::Tensor &reference_boxes, const at::Tensor &sampling_offsets, const at::Tensor &attn_logits,
+                  const at::Tensor &reference_masks)
+{
+  AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+  AT_ASSERTM(spatial_shapes.is_contiguous(), "spatial_shapes tensor has to be contiguous");
+  AT_ASSERTM(level_start_index.is_contiguous(), "level_start_index tensor has to be contiguous");
+  AT_ASSERTM(reference_boxes.is_contiguous(), "reference_boxes tensor has to be contiguous");
+  AT_ASSERTM(sampling_offsets.is_contiguous(), "sampling_offsets tensor has to be contiguous");
+  AT_ASSERTM(attn_logits.is_contiguous(), "attn_logits tensor has to be contiguous");
+  AT_ASSERTM(reference_masks.is_contiguous(), "reference_masks tensor has to be contiguous");
+  AT_ASSERTM(reference_masks.scalar_type() == at::kByte, "reference_masks must be a uint8 tensor");
+  AT_ASSERTM(reference_boxes.scalar_type() == value.scalar_type(), "reference_boxes must have the dtype of value");
+  AT_ASSERTM(sampling_offsets.scalar_type() == value.scalar_type(), "sampling_offsets must have the dtype of value");
+  AT_ASSERTM(attn_logits.scalar_type() == value.scalar_type(), "attn_logits must have the dtype of value");
+}
+
+} // namespace
+
+
+at::Tensor
+ms_deform_attn_mask_cpu_forward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const int gated_box)
+{
+  check_inputs(value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks);
+  const MaskAttnShape s = get_shape(value, spatial_shapes, reference_boxes, sampling_offsets, reference_masks, gated_box);
+
+  auto output = at::zeros({s.batch, s.num_query, s.num_heads * s.channels}, value.options());
+  AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_mask_forward_cpu", ([&] {
+    ms_deform_attn_mask_cpu_forward_impl<scalar_t>(
+        s, value.data_ptr<scalar_t>(), spatial_shapes.data_ptr<int64_t>(), level_start_index.data_ptr<int64_t>(),
+        reference_boxes.data_ptr<scalar_t>(), sampling_offsets.data_ptr<scalar_t>(), attn_logits.data_ptr<scalar_t>(),
+        reference_masks.data_ptr<uint8_t>(), output.data_ptr<scalar_t>());
+  }));
+  return output;
+}
+
+
+std::vector<at::Tensor>
+ms_deform_attn_mask_cpu_backward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const at::Tensor &grad_output,
+    const int gated_box)
+{
+  check_inputs(value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks);
+  AT_ASSERTM(grad_output.is_contiguous(), "grad_output tensor has to be contiguous");
+  const MaskAttnShape s = get_shape(value, spatial_shapes, reference_boxes, sampling_offsets, reference_masks, gated_box);
+
+  auto grad_value = at::zeros_like(value);
+  auto grad_sampling_loc = at::zeros_like(sampling_offsets);
+  auto grad_attn_logits = at::zeros_like(attn_logits);
+  AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_mask_backward_cpu", ([&] {
+    ms_deform_attn_mask_cpu_backward_impl<scalar_t>(
+        s, value.data_ptr<scalar_t>(), spatial_shapes.data_ptr<int64_t>(), level_start_index.data_ptr<int64_t>(),
+        reference_boxes.data_ptr<scalar_t>(), sampling_offsets.data_ptr<scalar_t>(), attn_logits.data_ptr<scalar_t>(),
+        reference_masks.data_ptr<uint8_t>(), grad_output.data_ptr<scalar_t>(),
+        grad_value.data_ptr<scalar_t>(), grad_sampling_loc.data_ptr<scalar_t>(), grad_attn_logits.data_ptr<scalar_t>());
+  }));
+  return {
+    grad_value, grad_sampling_loc, grad_attn_logits
+  };
+}
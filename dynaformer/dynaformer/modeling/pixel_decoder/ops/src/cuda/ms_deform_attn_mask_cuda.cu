@@ -0,0 +1,321 @@
+/*!
+* Fused mask-aware multi-scale deformable attention, CUDA implementation.
+*
+* One thread per (batch, query, head, channel): the gated logits of the query and head are recomputed
+* by every channel, which is cheaper than storing them since there are only levels * points of them.
+*/
+
+#include <vector>
+
+#include <ATen/ATen.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <cuda.h>
+#include <cuda_runtime.h>
+
+#include "ms_deform_attn_mask_common.h"
+
+#define CUDA_KERNEL_LOOP(i, n)                          \
+  for (int i = blockIdx.x * blockDim.x + threadIdx.x;   \
+      i < (n);                                          \
+      i += blockDim.x * gridDim.x)
+
+namespace {
+
+const int CUDA_NUM_THREADS = 256;
+inline int GET_BLOCKS(const int N, const int num_threads)
+{
+  return (N + num_threads - 1) / num_threads;
+}
+
+
+// Gated logit of the point (l, p) of a query and head, with its sampling location
+template <typename scalar_t>
+__device__ __forceinline__ scalar_t gated_logit(const scalar_t *boxes, const scalar_t *offsets, const scalar_t *logits,
+                                                const uint8_t *mask, const int l, const int p,
+                                                const int num_point, const int num_box, const int gated_box,
+                                                const int mask_h, const int mask_w,
+                                                scalar_t &loc_w, scalar_t &loc_h, bool &passed)
+{
+  const int j = l * num_point + p;
+  const int b = p % num_box;
+  ms_deform_attn_mask_location(boxes + (l * num_box + b) * 4, offsets + j * 2, num_point, loc_w, loc_h);
+  passed = b != gated_box || ms_deform_attn_mask_inside(mask, mask_h, mask_w, loc_w, loc_h);
+  return passed ? logits[j] : scalar_t(0);
+}
+
+
+// max and sum of exp of the gated logits of a query and head
+template <typename scalar_t>
+__device__ __forceinline__ void gated_softmax_stats(const scalar_t *boxes, const scalar_t *offsets, const scalar_t *logits,
+                                                    const uint8_t *mask, const int num_levels, const int num_point,
+                                                    const int num_box, const int gated_box, const int mask_h, const int mask_w,
+                                                    scalar_t &max_logit, scalar_t &sum)
+{
+  scalar_t loc_w, loc_h;
+  bool passed;
+  max_logit = -INFINITY;
+  for (int l = 0; l < num_levels; ++l)
+    for (int p = 0; p < num_point; ++p)
+      max_logit = max(max_logit, gated_logit(boxes, offsets, logits, mask, l, p, num_point, num_box, gated_box,
+                                             mask_h, mask_w, loc_w, loc_h, passed));
+  sum = 0;
+  for (int l = 0; l < num_levels; ++l)
+    for (int p = 0; p < num_point; ++p)
+      sum += exp(gated_logit(boxes, offsets, logits, mask, l, p, num_point, num_box, gated_box,
+                             mask_h, mask_w, loc_w, loc_h, passed) - max_logit);
+}
+
+
+template <typename scalar_t>
+__global__ void ms_deform_attn_mask_forward_kernel(
+    const int n, const scalar_t *value, const int64_t *spatial_shapes, const int64_t *level_start_index,
+    const scalar_t *boxes, const scalar_t *offsets, const scalar_t *logits, const uint8_t *masks,
+    const int spatial_size, const int num_heads, const int channels, const int num_levels, const int num_query,
+    const int num_point, const int num_box, const int gated_box, const int mask_h, const int mask_w,
+    scalar_t *output)
+{
+  CUDA_KERNEL_LOOP(index, n)
+  {
+    const int c = index % channels;
+    const int nqm = index / channels;
+    const int m = nqm % num_heads;
+    const int nq = nqm / num_heads;
+    const int b_idx = nq / num_query;
+    const int num_lp = num_levels * num_point;
+    const int stride = num_heads * channels;
+
+    const scalar_t *boxes_q = boxes + nq * num_levels * num_box * 4;
+    const scalar_t *offsets_q = offsets + nqm * num_lp * 2;
+    const scalar_t *logits_q = logits + nqm * num_lp;
+    const uint8_t *mask_q = masks + static_cast<int64_t>(nq) * mask_h * mask_w;
+
+    scalar_t max_logit, sum;
+    gated_softmax_stats(boxes_q, offsets_q, logits_q, mask_q, num_levels, num_point, num_box, gated_box,
+                        mask_h, mask_w, max_logit, sum);
+
+    scalar_t out = 0;
+    for (int l = 0; l < num_levels; ++l)
+    {
+      const int height = spatial_shapes[l * 2];
+      const int width = spatial_shapes[l * 2 + 1];
+      const scalar_t *value_l = value + (static_cast<int64_t>(b_idx) * spatial_size + level_start_index[l]) * stride + m * channels + c;
+      for (int p = 0; p < num_point; ++p)
+      {
+        scalar_t loc_w, loc_h;
+        bool passed;
+        const scalar_t z = gated_logit(boxes_q, offsets_q, logits_q, mask_q, l, p, num_point, num_box, gated_box,
+                                       mask_h, mask_w, loc_w, loc_h, passed);
+        out += exp(z - max_logit) / sum * ms_deform_attn_mask_bilinear(value_l, height, width, stride, loc_w, loc_h);
+      }
+    }
+    output[index] = out;
+  }
+}
+
+
+template <typename scalar_t>
+__global__ void ms_deform_attn_mask_backward_kernel(
+    const int n, const scalar_t *grad_output, const scalar_t *value, const int64_t *spatial_shapes,
+    const int64_t *level_start_index, const scalar_t *boxes, const scalar_t *offsets, const scalar_t *logits,
+    const uint8_t *masks, const int spatial_size, const int num_heads, const int channels, const int num_levels,
+    const int num_query, const int num_point, const int num_box, const int gated_box, const int mask_h, const int mask_w,
+    scalar_t *grad_value, scalar_t *grad_sampling_loc, scalar_t *grad_logits)
+{
+  CUDA_KERNEL_LOOP(index, n)
+  {
+    const int c = index % channels;
+    const int nqm = index / channels;
+    const int m = nqm % num_heads;
+    const int nq = nqm / num_heads;
+    const int b_idx = nq / num_query;
+    const int num_lp = num_levels * num_point;
+    const int stride = num_heads * channels;
+    const scalar_t top_grad = grad_output[index];
+
+    const scalar_t *boxes_q = boxes + nq * num_levels * num_box * 4;
+    const scalar_t *offsets_q = offsets + nqm * num_lp * 2;
+    const scalar_t *logits_q = logits + nqm * num_lp;
+    const uint8_t *mask_q = masks + static_cast<int64_t>(nq) * mask_h * mask_w;
+    scalar_t *grad_loc_q = grad_sampling_loc + nqm * num_lp * 2;
+    scalar_t *grad_logits_q = grad_logits + nqm * num_lp;
+
+    scalar_t max_logit, sum;
+    gated_softmax_stats(boxes_q, offsets_q, logits_q, mask_q, num_levels, num_point, num_box, gated_box,
+                        mask_h, mask_w, max_logit, sum);
+
+    // first pass: gradients of the value and the locations, and the softmax-weighted gradient of this channel
+    scalar_t weighted_grad_attn = 0;
+    for (int l = 0; l < num_levels; ++l)
+    {
+      const int height = spatial_shapes[l * 2];
+      const int width = spatial_shapes[l * 2 + 1];
+      const int64_t value_offset = (static_cast<int64_t>(b_idx) * spatial_size + level_start_index[l]) * stride + m * channels + c;
+      for (int p = 0; p < num_point; ++p)
+      {
+        const int j = l * num_point + p;
+        scalar_t loc_w, loc_h;
+        bool passed;
+        const scalar_t attn = exp(gated_logit(boxes_q, offsets_q, logits_q, mask_q, l, p, num_point, num_box, gated_box,
+                                              mask_h, mask_w, loc_w, loc_h, passed) - max_logit) / sum;
+        int corners[4];
+        scalar_t weights[4], lh, lw;
+        if (!ms_deform_attn_mask_bilinear_corners(height, width, stride, loc_w, loc_h, corners, weights, lh, lw))
+          continue;
+        const scalar_t hh = 1 - lh, hw = 1 - lw;
+        const scalar_t top_grad_value = top_grad * attn;
+        scalar_t v[4];
+        for (int k = 0; k < 4; ++k)
+        {
+          v[k] = corners[k] >= 0 ? value[value_offset + corners[k]] : scalar_t(0);
+          if (corners[k] >= 0)
+            atomicAdd(grad_value + value_offset + corners[k], weights[k] * top_grad_value);
+        }
+        const scalar_t grad_attn = top_grad * (weights[0] * v[0] + weights[1] * v[1] + weights[2] * v[2] + weights[3] * v[3]);
+        weighted_grad_attn += attn * grad_attn;
+        atomicAdd(grad_loc_q + j * 2, width * top_grad_value * (-hh * v[0] + hh * v[1] - lh * v[2] + lh * v[3]));
+        atomicAdd(grad_loc_q + j * 2 + 1, height * top_grad_value * (-hw * v[0] - lw * v[1] + hw * v[2] + lw * v[3]));
+      }
+    }
+
+    // second pass: softmax backward, it is linear in the gradient of the channels so they are summed atomically
+    for (int l = 0; l < num_levels; ++l)
+    {
+      const int height = spatial_shapes[l * 2];
+      const int width = spatial_shapes[l * 2 + 1];
+      const scalar_t *value_l = value + (static_cast<int64_t>(b_idx) * spatial_size + level_start_index[l]) * stride + m * channels + c;
+      for (int p = 0; p < num_point; ++p)
+      {
+        const int j = l * num_point + p;
+        scalar_t loc_w, loc_h;
+        bool passed;
+        const scalar_t attn = exp(gated_logit(boxes_q, offsets_q, logits_q, mask_q, l, p, num_point, num_box, gated_box,
+                                              mask_h, mask_w, loc_w, loc_h, passed) - max_logit) / sum;
+        if (!passed)
+          continue;
+        const scalar_t grad_attn = top_grad * ms_deform_attn_mask_bilinear(value_l, height, width, stride, loc_w, loc_h);
+        atomicAdd(grad_logits_q + j, attn * (grad_attn - weighted_grad_attn));
+      }
+    }
+  }
+}
+
+
+void check_inputs(const at::Tensor &value, const at::Tensor &spatial_shapes, const at::Tensor &level_start_index,
+                  const at::Tensor &reference_boxes, const at::Tensor &sampling_offsets, const at::Tensor &attn_logits,
+                  const at::Tensor &reference_masks)
+{
+  AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+  AT_ASSERTM(spatial_shapes.is_contiguous(), "spatial_shapes tensor has to be contiguous");
+  AT_ASSERTM(level_start_index.is_contiguous(), "level_start_index tensor has to be contiguous");
+  AT_ASSERTM(reference_boxes.is_contiguous(), "reference_boxes tensor has to be contiguous");
+  AT_ASSERTM(sampling_offsets.is_contiguous(), "sampling_offsets tensor has to be contiguous");
+  AT_ASSERTM(attn_logits.is_contiguous(), "attn_logits tensor has to be contiguous");
+  AT_ASSERTM(reference_masks.is_contiguous(), "reference_masks tensor has to be contiguous");
+  AT_ASSERTM(reference_masks.scalar_type() == at::kByte, "reference_masks must be a uint8 tensor");
+
+  AT_ASSERTM(value.is_cuda(), "value must be a CUDA tensor");
+  AT_ASSERTM(spatial_shapes.is_cuda(), "spatial_shapes must be a CUDA tensor");
+  AT_ASSERTM(level_start_index.is_cuda(), "level_start_index must be a CUDA tensor");
+  AT_ASSERTM(reference_boxes.is_cuda(), "reference_boxes must be a CUDA tensor");
+  AT_ASSERTM(sampling_offsets.is_cuda(), "sampling_offsets must be a CUDA tensor");
+  AT_ASSERTM(attn_logits.is_cuda(), "attn_logits must be a CUDA tensor");
+  AT_ASSERTM(reference_masks.is_cuda(), "reference_masks must be a CUDA tensor");
+}
+
+} // namespace
+
+
+at::Tensor ms_deform_attn_mask_cuda_forward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const int gated_box)
+{
+    check_inputs(value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks);
+
+    const int batch = value.size(0);
+    const int spatial_size = value.size(1);
+    const int num_heads = value.size(2);
+    const int channels = value.size(3);
+    const int num_levels = spatial_shapes.size(0);
+    const int num_query = sampling_offsets.size(1);
+    const int num_point = sampling_offsets.size(4);
+    const int num_box = reference_boxes.size(3);
+    const int mask_h = reference_masks.size(2);
+    const int mask_w = reference_masks.size(3);
+
+    auto output = at::empty({batch, num_query, num_heads * channels}, value.options());
+    const int num_kernels = batch * num_query * num_heads * channels;
+    if (num_kernels == 0)
+        return output;
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_mask_forward_cuda", ([&] {
+        ms_deform_attn_mask_forward_kernel<scalar_t>
+            <<<GET_BLOCKS(num_kernels, CUDA_NUM_THREADS), CUDA_NUM_THREADS, 0, at::cuda::getCurrentCUDAStream()>>>(
+            num_kernels, value.data_ptr<scalar_t>(), spatial_shapes.data_ptr<int64_t>(), level_start_index.data_ptr<int64_t>(),
+            reference_boxes.data_ptr<scalar_t>(), sampling_offsets.data_ptr<scalar_t>(), attn_logits.data_ptr<scalar_t>(),
+            reference_masks.data_ptr<uint8_t>(), spatial_size, num_heads, channels, num_levels, num_query,
+            num_point, num_box, gated_box, mask_h, mask_w, output.data_ptr<scalar_t>());
+    }));
+    cudaError_t err = cudaGetLastError();
+    if (err != cudaSuccess)
+    {
+        printf("error in ms_deform_attn_mask_forward_cuda: %s\n", cudaGetErrorString(err));
+    }
+    return output;
+}
+
+
+std::vector<at::Tensor> ms_deform_attn_mask_cuda_backward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const at::Tensor &grad_output,
+    const int gated_box)
+{
+    check_inputs(value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks);
+    AT_ASSERTM(grad_output.is_contiguous(), "grad_output tensor has to be contiguous");
+    AT_ASSERTM(grad_output.is_cuda(), "grad_output must be a CUDA tensor");
+
+    const int batch = value.size(0);
+    const int spatial_size = value.size(1);
+    const int num_heads = value.size(2);
+    const int channels = value.size(3);
+    const int num_levels = spatial_shapes.size(0);
+    const int num_query = sampling_offsets.size(1);
+    const int num_point = sampling_offsets.size(4);
+    const int num_box = reference_boxes.size(3);
+    const int mask_h = reference_masks.size(2);
+    const int mask_w = reference_masks.size(3);
+
+    auto grad_value = at::zeros_like(value);
+    auto grad_sampling_loc = at::zeros_like(sampling_offsets);
+    auto grad_attn_logits = at::zeros_like(attn_logits);
+    const int num_kernels = batch * num_query * num_heads * channels;
+    if (num_kernels == 0)
+        return {grad_value, grad_sampling_loc, grad_attn_logits};
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_mask_backward_cuda", ([&] {
+        ms_deform_attn_mask_backward_kernel<scalar_t>
+            <<<GET_BLOCKS(num_kernels, CUDA_NUM_THREADS), CUDA_NUM_THREADS, 0, at::cuda::getCurrentCUDAStream()>>>(
+            num_kernels, grad_output.data_ptr<scalar_t>(), value.data_ptr<scalar_t>(), spatial_shapes.data_ptr<int64_t>(),
+            level_start_index.data_ptr<int64_t>(), reference_boxes.data_ptr<scalar_t>(), sampling_offsets.data_ptr<scalar_t>(),
+            attn_logits.data_ptr<scalar_t>(), reference_masks.data_ptr<uint8_t>(), spatial_size, num_heads, channels,
+            num_levels, num_query, num_point, num_box, gated_box, mask_h, mask_w,
+            grad_value.data_ptr<scalar_t>(), grad_sampling_loc.data_ptr<scalar_t>(), grad_attn_logits.data_ptr<scalar_t>());
+    }));
+    cudaError_t err = cudaGetLastError();
+    if (err != cudaSuccess)
+    {
+        printf("error in ms_deform_attn_mask_backward_cuda: %s\n", cudaGetErrorString(err));
+    }
+    return {
+        grad_value, grad_sampling_loc, grad_attn_logits
+    };
+}
@@ -0,0 +1,29 @@
+/*!
+* Fused mask-aware multi-scale deformable attention, CUDA implementation.
+*/
+
+#pragma once
+#include <torch/extension.h>
+
+at::Tensor
+ms_deform_attn_mask_cuda_forward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const int gated_box);
+
+std::vector<at::Tensor>
+ms_deform_attn_mask_cuda_backward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const at::Tensor &grad_output,
+    const int gated_box);
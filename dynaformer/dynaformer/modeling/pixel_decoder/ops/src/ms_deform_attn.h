@@ -16,9 +16,11 @@
 #pragma once
 
 #include "cpu/ms_deform_attn_cpu.h"
+#include "cpu/ms_deform_attn_mask_cpu.h"
 
 #ifdef WITH_CUDA
 #include "cuda/ms_deform_attn_cuda.h"
+#include "cuda/ms_deform_attn_mask_cuda.h"
 #endif
 
 
@@ -65,3 +67,54 @@ ms_deform_attn_backward(
     AT_ERROR("Not implemented on the CPU");
 }
 
+
+at::Tensor
+ms_deform_attn_mask_forward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const int gated_box)
+{
+    if (value.is_cuda())
+    {
+#ifdef WITH_CUDA
+        return ms_deform_attn_mask_cuda_forward(
+            value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks, gated_box);
+#else
+        AT_ERROR("Not compiled with GPU support");
+#endif
+    }
+    return ms_deform_attn_mask_cpu_forward(
+        value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks, gated_box);
+}
+
+std::vector<at::Tensor>
+ms_deform_attn_mask_backward(
+    const at::Tensor &value,
+    const at::Tensor &spatial_shapes,
+    const at::Tensor &level_start_index,
+    const at::Tensor &reference_boxes,
+    const at::Tensor &sampling_offsets,
+    const at::Tensor &attn_logits,
+    const at::Tensor &reference_masks,
+    const at::Tensor &grad_output,
+    const int gated_box)
+{
+    if (value.is_cuda())
+    {
+#ifdef WITH_CUDA
+        return ms_deform_attn_mask_cuda_backward(
+            value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks,
+            grad_output, gated_box);
+#else
+        AT_ERROR("Not compiled with GPU support");
+#endif
+    }
+    return ms_deform_attn_mask_cpu_backward(
+        value, spatial_shapes, level_start_index, reference_boxes, sampling_offsets, attn_logits, reference_masks,
+        grad_output, gated_box);
+}
@@ -0,0 +1,111 @@
+/*!
+* Helpers of the fused mask-aware multi-scale deformable attention, shared by the CPU and CUDA kernels.
+* They follow the operations of MSDeformAttnMask in modules/ms_deform_attn_mask.py, in the same order,
+* so that the fused op matches the unfused composition.
+*/
+
+#pragma once
+
+#include <cstdint>
+#include <cmath>
+
+#ifdef __CUDACC__
+#define MSDA_MASK_HOST_DEVICE __host__ __device__ __forceinline__
+#else
+#define MSDA_MASK_HOST_DEVICE inline
+#endif
+
+
+// Sampling location of a point: reference box (cx, cy, w, h) plus its offset,
+// `box[:2] + offset / num_point * box[2:] * 0.5`
+template <typename scalar_t>
+MSDA_MASK_HOST_DEVICE void ms_deform_attn_mask_location(const scalar_t *box, const scalar_t *offset, const int num_point,
+                                                        scalar_t &loc_w, scalar_t &loc_h)
+{
+  loc_w = box[0] + offset[0] / num_point * box[2] * scalar_t(0.5);
+  loc_h = box[1] + offset[1] / num_point * box[3] * scalar_t(0.5);
+}
+
+
+// Whether the pixel of the reference mask under a sampling location is set, the pixel is
+// found like in check_points_in_mask: truncation of the scaled location, then clamping
+template <typename scalar_t>
+MSDA_MASK_HOST_DEVICE bool ms_deform_attn_mask_inside(const uint8_t *mask, const int height, const int width,
+                                                      const scalar_t loc_w, const scalar_t loc_h)
+{
+  int64_t x = static_cast<int64_t>(loc_w * width);
+  int64_t y = static_cast<int64_t>(loc_h * height);
+  x = x < 0 ? 0 : (x > width - 1 ? width - 1 : x);
+  y = y < 0 ? 0 : (y > height - 1 ? height - 1 : y);
+  return mask[y * width + x] != 0;
+}
+
+
+// Bilinear sampling of one channel with zero padding (grid_sample with align_corners=False),
+// `value` points at the first pixel of the level for the head and channel, `stride` is the
+// distance between two pixels
+template <typename scalar_t>
+MSDA_MASK_HOST_DEVICE scalar_t ms_deform_attn_mask_bilinear(const scalar_t *value, const int height, const int width,
+                                                            const int stride, const scalar_t loc_w, const scalar_t loc_h)
+{
+  const scalar_t h_im = loc_h * height - scalar_t(0.5);
+  const scalar_t w_im = loc_w * width - scalar_t(0.5);
+  if (!(h_im > -1 && w_im > -1 && h_im < height && w_im < width))
+  {
+    return 0;
+  }
+  const int h_low = static_cast<int>(floor(h_im));
+  const int w_low = static_cast<int>(floor(w_im));
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  const scalar_t lh = h_im - h_low;
+  const scalar_t lw = w_im - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+
+  scalar_t v1 = 0, v2 = 0, v3 = 0, v4 = 0;
+  if (h_low >= 0 && w_low >= 0)
+    v1 = value[(h_low * width + w_low) * stride];
+  if (h_low >= 0 && w_high <= width - 1)
+    v2 = value[(h_low * width + w_high) * stride];
+  if (h_high <= height - 1 && w_low >= 0)
+    v3 = value[(h_high * width + w_low) * stride];
+  if (h_high <= height - 1 && w_high <= width - 1)
+    v4 = value[(h_high * width + w_high) * stride];
+
+  return hh * hw * v1 + hh * lw * v2 + lh * hw * v3 + lh * lw * v4;
+}
+
+
+// Corners and weights of a bilinear sample for the backward pass, returns false if the location is
+// outside of the level. Corners outside of the level have an offset of -1.
+template <typename scalar_t>
+MSDA_MASK_HOST_DEVICE bool ms_deform_attn_mask_bilinear_corners(const int height, const int width, const int stride,
+                                                                const scalar_t loc_w, const scalar_t loc_h,
+                                                                int *offsets, scalar_t *weights, scalar_t &lh, scalar_t &lw)
+{
+  const scalar_t h_im = loc_h * height - scalar_t(0.5);
+  const scalar_t w_im = loc_w * width - scalar_t(0.5);
+  if (!(h_im > -1 && w_im > -1 && h_im < height && w_im < width))
+  {
+    return false;
+  }
+  const int h_low = static_cast<int>(floor(h_im));
+  const int w_low = static_cast<int>(floor(w_im));
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  lh = h_im - h_low;
+  lw = w_im - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+
+  offsets[0] = (h_low >= 0 && w_low >= 0) ? (h_low * width + w_low) * stride : -1;
+  offsets[1] = (h_low >= 0 && w_high <= width - 1) ? (h_low * width + w_high) * stride : -1;
+  offsets[2] = (h_high <= height - 1 && w_low >= 0) ? (h_high * width + w_low) * stride : -1;
+  offsets[3] = (h_high <= height - 1 && w_high <= width - 1) ? (h_high * width + w_high) * stride : -1;
+  weights[0] = hh * hw;
+  weights[1] = hh * lw;
+  weights[2] = lh * hw;
+  weights[3] = lh * lw;
+  return true;
+}
@@ -18,4 +18,6 @@
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("ms_deform_attn_forward", &ms_deform_attn_forward, "ms_deform_attn_forward");
   m.def("ms_deform_attn_backward", &ms_deform_attn_backward, "ms_deform_attn_backward");
+  m.def("ms_deform_attn_mask_forward", &ms_deform_attn_mask_forward, "ms_deform_attn_mask_forward");
+  m.def("ms_deform_attn_mask_backward", &ms_deform_attn_mask_backward, "ms_deform_attn_mask_backward");
 }
@@ -19,11 +19,12 @@ import torch.nn as nn
 from torch.autograd import gradcheck
 
 from functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch
+from functions.ms_deform_attn_func import MSDeformAttnMaskFunction, ms_deform_attn_mask_core_pytorch
 
 
 N, M, D = 1, 2, 2
 Lq, L, P = 2, 2, 2
-shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long).cuda()
+shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long, device="cuda" if torch.cuda.is_available() else "cpu")
 level_start_index = torch.cat((shapes.new_zeros((1, )), shapes.prod(1).cumsum(0)[:-1]))
 S = sum([(H*W).item() for H, W in shapes])
 
@@ -81,12 +82,87 @@ def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True
     print(f'* {gradok} check_gradient_numerical(D={channels})')
 
 
-if __name__ == '__main__':
-    check_forward_equal_with_pytorch_double()
-    check_forward_equal_with_pytorch_float()
+def mask_attn_inputs(device, gated_box, dtype=torch.float64, channels=D, requires_grad=False):
+    # gated_box 0: "mask" sampling (one mask box), 1: "both" sampling (bbox for even points, mask box for odd points)
+    num_box = max(gated_box + 1, 1)
+    value = torch.rand(N, S, M, channels, device=device, dtype=dtype) * 0.01
+    reference_boxes = torch.rand(N, Lq, L, num_box, 4, device=device, dtype=dtype)
+    sampling_offsets = (torch.rand(N, Lq, M, L, P, 2, device=device, dtype=dtype) * 2 - 1) * P
+    attention_logits = torch.randn(N, Lq, M, L, P, device=device, dtype=dtype)
+    reference_masks = (torch.rand(N, Lq, 8, 6, device=device) > 0.5).to(torch.uint8)
+    for t in (value, reference_boxes, sampling_offsets, attention_logits):
+        t.requires_grad = requires_grad
+    return value, reference_boxes, sampling_offsets, attention_logits, reference_masks
+
+
+def check_mask_forward_equal_with_pytorch(device, gated_box, dtype=torch.float64):
+    value, reference_boxes, sampling_offsets, attention_logits, reference_masks = mask_attn_inputs(device, gated_box, dtype)
+    shapes_ = shapes.to(device)
+    level_start_index_ = level_start_index.to(device)
+    with torch.no_grad():
+        output_pytorch = ms_deform_attn_mask_core_pytorch(
+            value, shapes_, reference_boxes, sampling_offsets, attention_logits, reference_masks, gated_box).cpu()
+        output_fused = MSDeformAttnMaskFunction.apply(
+            value, shapes_, level_start_index_, reference_boxes, sampling_offsets, attention_logits, reference_masks, gated_box).cpu()
+    if dtype == torch.float64:
+        fwdok = torch.allclose(output_fused, output_pytorch)
+    else:
+        fwdok = torch.allclose(output_fused, output_pytorch, rtol=1e-2, atol=1e-3)
+    max_abs_err = (output_fused - output_pytorch).abs().max()
+
+    print(f'* {fwdok} check_mask_forward_equal_with_pytorch({device}, gated_box={gated_box}, {dtype}): max_abs_err {max_abs_err:.2e}')
+
+
+def check_mask_gradient_equal_with_pytorch(device, gated_box, channels=4):
+    inputs_pytorch = mask_attn_inputs(device, gated_box, channels=channels, requires_grad=True)
+    inputs_fused = [t.detach().clone().requires_grad_(t.requires_grad) for t in inputs_pytorch]
+    shapes_ = shapes.to(device)
+    level_start_index_ = level_start_index.to(device)
+    value, reference_boxes, sampling_offsets, attention_logits, reference_masks = inputs_pytorch
+    grad_output = torch.rand(N, Lq, M * channels, device=device, dtype=torch.float64)
+    ms_deform_attn_mask_core_pytorch(
+        value, shapes_, reference_boxes, sampling_offsets, attention_logits, reference_masks, gated_box).backward(grad_output)
+    value, reference_boxes, sampling_offsets, attention_logits, reference_masks = inputs_fused
+    MSDeformAttnMaskFunction.apply(
+        value, shapes_, level_start_index_, reference_boxes, sampling_offsets, attention_logits, reference_masks, gated_box
+    ).backward(grad_output)
+
+    names = ["value", "reference_boxes", "sampling_offsets", "attention_logits"]
+    for name, t_pytorch, t_fused in zip(names, inputs_pytorch, inputs_fused):
+        gradok = torch.allclose(t_fused.grad, t_pytorch.grad)
+        max_abs_err = (t_fused.grad - t_pytorch.grad).abs().max()
+        print(f'* {gradok} check_mask_gradient_equal_with_pytorch({device}, gated_box={gated_box}, D={channels}) '
+              f'{name}: max_abs_err {max_abs_err:.2e}')
+
+
+def check_mask_gradient_numerical(device, gated_box, channels=4):
+    value, reference_boxes, sampling_offsets, attention_logits, reference_masks = \
+        mask_attn_inputs(device, gated_box, channels=channels, requires_grad=True)
+    func = MSDeformAttnMaskFunction.apply
+
+    # the gating by the mask is piecewise constant, a point on the border of a mask pixel can fail the check
+    gradok = gradcheck(func, (value, shapes.to(device), level_start_index.to(device), reference_boxes,
+                              sampling_offsets, attention_logits, reference_masks, gated_box))
+
+    print(f'* {gradok} check_mask_gradient_numerical({device}, gated_box={gated_box}, D={channels})')
+
 
-    for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
-        check_gradient_numerical(channels, True, True, True)
+if __name__ == '__main__':
+    if torch.cuda.is_available():
+        check_forward_equal_with_pytorch_double()
+        check_forward_equal_with_pytorch_float()
+
+        for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
+            check_gradient_numerical(channels, True, True, True)
+
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    for device in devices:
+        for gated_box in [0, 1]:
+            check_mask_forward_equal_with_pytorch(device, gated_box, torch.float64)
+            check_mask_forward_equal_with_pytorch(device, gated_box, torch.float32)
+            for channels in [4, 32, 71]:
+                check_mask_gradient_equal_with_pytorch(device, gated_box, channels)
+            check_mask_gradient_numerical(device, gated_box)
 
 
 
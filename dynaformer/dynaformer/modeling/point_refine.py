@@ -0,0 +1,175 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+PointRend-style refinement of the query masks. Instead of upsampling all masks to the input
+resolution with dense bilinear interpolation, the masks are upsampled 2x at a time and only
+the most uncertain points are re-predicted from `mask_features`, high resolution backbone
+features and the query mask embeddings.
+"""
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from detectron2.layers import ShapeSpec
+from detectron2.projects.point_rend.point_features import (
+    get_uncertain_point_coords_on_grid,
+    get_uncertain_point_coords_with_randomness,
+    point_sample,
+)
+
+from .criterion import calculate_uncertainty, dice_loss_jit, sigmoid_ce_loss_jit
+
+
+class PointRefineHead(nn.Module):
+    """
+    Predicts a correction of the coarse mask logits at a set of points:
+
+        logit(p) = coarse(p) + <e_q, MLP([mask_features(p), fine_features(p)])>
+
+    where e_q is the mask embedding of the query. The last layer of the MLP is zero
+    initialized, so an untrained head reproduces the (subdivided) bilinear upsampling.
+    """
+
+    def __init__(
+        self,
+        in_feature: str,
+        input_shape: ShapeSpec,
+        mask_dim: int,
+        hidden_dim: int = 256,
+        num_layers: int = 2,
+        subdivision_num_points: int = 28 * 28,
+        train_num_points: int = 112 * 112,
+        oversample_ratio: float = 3.0,
+        importance_sample_ratio: float = 0.75,
+    ):
+        """
+        Args:
+            in_feature: name of the backbone feature used as fine-grained features, e.g. "res2"
+            input_shape: shape of the fine-grained backbone feature
+            mask_dim: channels of `mask_features` and of the query mask embeddings
+            hidden_dim: hidden channels of the point MLP
+            num_layers: number of layers of the point MLP
+            subdivision_num_points: number of points re-predicted per mask at each subdivision step
+            train_num_points, oversample_ratio, importance_sample_ratio: point sampling
+                parameters of the training loss, see :class:`SetCriterion`
+        """
+        super().__init__()
+        self.in_feature = in_feature
+        self.subdivision_num_points = subdivision_num_points
+        self.train_num_points = train_num_points
+        self.oversample_ratio = oversample_ratio
+        self.importance_sample_ratio = importance_sample_ratio
+
+        layers = []
+        in_channels = mask_dim + input_shape.channels
+        for _ in range(num_layers - 1):
+            layers.append(nn.Conv1d(in_channels, hidden_dim, kernel_size=1))
+            layers.append(nn.ReLU(inplace=True))
+            in_channels = hidden_dim
+        self.mlp = nn.Sequential(*layers)
+        self.predictor = nn.Conv1d(in_channels, mask_dim, kernel_size=1)
+        nn.init.zeros_(self.predictor.weight)
+        nn.init.zeros_(self.predictor.bias)
+
+    def forward(self, coarse_logits, mask_embed, mask_features, fine_features, point_coords):
+        """
+        Args:
+            coarse_logits: N*Q*P coarse mask logits at the points
+            mask_embed: N*Q*C query mask embeddings
+            mask_features: N*C*H*W mask features
+            fine_features: N*C'*H'*W' fine-grained backbone features
+            point_coords: N*Q*P*2 point coordinates in [0, 1] x [0, 1] of the padded image
+        Returns:
+            N*Q*P refined mask logits
+        """
+        n, q, p = coarse_logits.shape
+        coords = point_coords.reshape(n, q * p, 2)
+        point_features = torch.cat(
+            [
+                point_sample(mask_features, coords, align_corners=False),
+                point_sample(fine_features.to(mask_features), coords, align_corners=False),
+            ],
+            dim=1,
+        )                                                                              # N*(C+C')*(Q*P)
+        point_features = self.predictor(self.mlp(point_features)).view(n, -1, q, p)    # N*C*Q*P
+        delta = torch.einsum("nqc,ncqp->nqp", mask_embed.to(point_features), point_features)
+        return coarse_logits + delta.to(coarse_logits)
+
+    @torch.no_grad()
+    def subdivision_inference(self, mask_logits, mask_embed, mask_features, fine_features, output_size):
+        """
+        Upsample `mask_logits` (N*Q*h*w, unsigmoid) to `output_size` by iterative subdivision.
+        """
+        n, q = mask_logits.shape[:2]
+        out_h, out_w = output_size
+        while mask_logits.shape[-2] < out_h or mask_logits.shape[-1] < out_w:
+            size = (min(2 * mask_logits.shape[-2], out_h), min(2 * mask_logits.shape[-1], out_w))
+            mask_logits = F.interpolate(mask_logits, size=size, mode="bilinear", align_corners=False)
+            h, w = size
+            num_points = min(self.subdivision_num_points, h * w)
+            uncertainty_map = calculate_uncertainty(mask_logits.reshape(n * q, 1, h, w))
+            point_indices, point_coords = get_uncertain_point_coords_on_grid(uncertainty_map, num_points)
+            flat_logits = mask_logits.reshape(n * q, h * w)
+            coarse = flat_logits.gather(1, point_indices).view(n, q, num_points)
+            refined = self(
+                coarse, mask_embed, mask_features, fine_features, point_coords.view(n, q, num_points, 2)
+            )
+            flat_logits.scatter_(1, point_indices, refined.view(n * q, num_points))
+            mask_logits = flat_logits.view(n, q, h, w)
+        return mask_logits
+
+    def losses(self, outputs, targets, indices, fine_features):
+        """
+        Point loss of the refined logits of the matched queries.
+        Args:
+            outputs: decoder outputs with "pred_masks", "pred_mask_embed" and "mask_features"
+            targets: targets as passed to :class:`SetCriterion`
+            indices: matching between the queries and the targets
+            fine_features: N*C'*H'*W' fine-grained backbone features
+        """
+        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
+        src_idx = torch.cat([src for (src, _) in indices])
+        if src_idx.numel() == 0:
+            return {"loss_point_refine": outputs["pred_masks"].sum() * 0.0 + self.predictor.weight.sum() * 0.0}
+
+        src_masks = outputs["pred_masks"][batch_idx, src_idx][:, None]
+        target_masks = torch.cat(
+            [t["masks"][tgt][:, None] for t, (_, tgt) in zip(targets, indices)]
+        ).to(src_masks)
+
+        with torch.no_grad():
+            point_coords = get_uncertain_point_coords_with_randomness(
+                src_masks.detach(),
+                lambda logits: calculate_uncertainty(logits),
+                self.train_num_points,
+                self.oversample_ratio,
+                self.importance_sample_ratio,
+            )
+            point_labels = point_sample(target_masks, point_coords, align_corners=False).squeeze(1)
+        coarse = point_sample(src_masks.detach(), point_coords, align_corners=False).squeeze(1)
+
+        # evaluate the matched queries of each image on the features of that image
+        point_logits = []
+        start = 0
+        for i, (src, _) in enumerate(indices):
+            end = start + src.numel()
+            if end > start:
+                point_logits.append(
+                    self(
+                        coarse[None, start:end],                              # 1*M*P
+                        outputs["pred_mask_embed"][i : i + 1, src],           # 1*M*C
+                        outputs["mask_features"][i : i + 1],                  # 1*C*H*W
+                        fine_features[i : i + 1],                             # 1*C'*H'*W'
+                        point_coords[None, start:end],                        # 1*M*P*2
+                    )[0]
+                )
+            start = end
+        point_logits = torch.cat(point_logits)
+
+        num_masks = float(src_idx.numel())
+        loss = sigmoid_ce_loss_jit(point_logits, point_labels, num_masks) + dice_loss_jit(
+            point_logits, point_labels, num_masks
+        )
+        return {"loss_point_refine": loss}
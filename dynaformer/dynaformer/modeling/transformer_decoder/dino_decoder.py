@@ -37,7 +37,8 @@ class TransformerDecoder(nn.Module):
                 dec_layer_dropout_prob=None,
                 type_mask_embed="MaskSimpleCNN",
                 binary_semantic_segmenation=False,
-                mask_embed_spatial_shape_level=None
+                mask_embed_spatial_shape_level=None,
+                mask_embed_cache_threshold=-1.0,
                 ):
         super().__init__()
         self.binary_semantic_segmenation=binary_semantic_segmenation
@@ -103,6 +104,10 @@ class TransformerDecoder(nn.Module):
                 assert 0.0 <= i <= 1.0
 
         #self.threshold_mask_layer=[0.5 * (layer_id / (self.num_layers-1)) for layer_id in torch.arange(self.num_layers)]     
+        # inference only: 1 - IoU below which the mask embedding of a query is reused, negative to disable
+        self.mask_embed_cache_threshold = mask_embed_cache_threshold
+        self.reset_mask_embed_cache_stats()
+
         self.threshold_mask_layer=torch.cat((torch.linspace(0.3, 0.5, int(2 * self.num_layers / 3)), torch.full((self.num_layers - int(2 * self.num_layers / 3),), 0.5)))   
         self._reset_parameters()
 
@@ -115,6 +120,65 @@ class TransformerDecoder(nn.Module):
                 m._reset_parameters()
 
 
+    def reset_mask_embed_cache_stats(self):
+        # [hits, queries] of the mask embedding cache in each layer
+        self.mask_embed_cache_stats = [[0, 0] for _ in range(self.num_layers)]
+
+    def mask_embed_cache_hit_rates(self):
+        """
+        Returns:
+            list[float]: fraction of the queries of each layer whose mask embedding was reused
+        """
+        return [hits / max(total, 1) for hits, total in self.mask_embed_cache_stats]
+
+    def embed_reference_masks(self, thres_mask, scale_shape=None, postion_matrix_embed=None):
+        """
+        thres_mask: Q*N*H*W sigmoid of the reference masks, returns Q*N*C
+        """
+        if self.type_mask_embed == "MaskSimpleCNN":
+          return self.maskencoder(thres_mask,scale_shape)
+        elif self.type_mask_embed == "SumSinusoidalMask":
+          return gen_sineembed_for_mask((thres_mask>0.5)*1.0,postion_matrix_embed,scale_shape)
+        else:
+          raise NotImplementedError(f'This method is not implemented yet:{self.type_mask_embed}')
+
+    def cached_embed_reference_masks(self, thres_mask, cache, layer_id, scale_shape=None, postion_matrix_embed=None):
+        """
+        Only embeds the reference masks whose binarized mask changed by more than
+        `mask_embed_cache_threshold` (1 - IoU) since their embedding was computed, as one sub-batch,
+        and reuses the cached embedding of the others.
+        Returns:
+            the (D+Q)*N*C embeddings and the updated cache, (binarized masks, embeddings) or None
+        """
+        binary_mask = thres_mask > 0.5
+        if cache is None:
+            query_mask_embed = self.embed_reference_masks(thres_mask, scale_shape, postion_matrix_embed)
+            self.mask_embed_cache_stats[layer_id][1] += binary_mask.shape[0] * binary_mask.shape[1]
+            return query_mask_embed, (binary_mask, query_mask_embed)
+
+        cached_mask, cached_embed = cache
+        num_queries, bs = binary_mask.shape[:2]
+        binary_mask = binary_mask.flatten(0, 1)                                 #((D+Q)*N)*H*W
+        cached_mask = cached_mask.flatten(0, 1)
+        intersection = (binary_mask & cached_mask).flatten(1).sum(-1)
+        union = (binary_mask | cached_mask).flatten(1).sum(-1)
+        # two empty masks are unchanged
+        iou = torch.where(union > 0, intersection / union.clamp(min=1), torch.ones_like(intersection, dtype=torch.float))
+        changed = ((1 - iou) > self.mask_embed_cache_threshold).nonzero().squeeze(1)
+
+        query_mask_embed = cached_embed.flatten(0, 1)
+        if changed.numel() > 0:
+            changed_embed = self.embed_reference_masks(
+                thres_mask.flatten(0, 1)[changed].unsqueeze(1), scale_shape, postion_matrix_embed
+            ).squeeze(1)
+            query_mask_embed = query_mask_embed.index_copy(0, changed, changed_embed)
+            # the cached masks are the ones the embeddings were computed from, so small changes don't accumulate
+            cached_mask = cached_mask.index_copy(0, changed, binary_mask[changed])
+        self.mask_embed_cache_stats[layer_id][0] += num_queries * bs - changed.numel()
+        self.mask_embed_cache_stats[layer_id][1] += num_queries * bs
+        query_mask_embed = query_mask_embed.view(num_queries, bs, -1)
+        return query_mask_embed, (cached_mask.view_as(thres_mask), query_mask_embed)
+
     def forward(self, tgt,                                                                # (D+Q)*N*C                             
                 memory,                                                                   # Sum{WH}*N*C
                 mask_features,                                                            # N*C*W*H   
@@ -129,6 +193,8 @@ class TransformerDecoder(nn.Module):
                 level_start_index: Optional[Tensor] = None,  # num_levels                 # Level
                 spatial_shapes: Optional[Tensor] = None,  # bs, num_levels, 2             # Level*2
                 valid_ratios: Optional[Tensor] = None,                                    # N*Level*2
+                reference_padding_mask: Optional[Tensor] = None,                          # N*H*W
+                dn_groups: Optional[tuple] = None,                                        # (groups, queries per group)
                 ):
         """
         Input:
@@ -137,6 +203,9 @@ class TransformerDecoder(nn.Module):
             - pos: hw, bs, d_model
             - refmasks_unsigmoid: nq, bs, 2/4/H,W
             - valid_ratios/spatial_shapes: bs, nlevel, 2
+            - reference_padding_mask: bs, H, W, padding at the resolution of refmasks_unsigmoid
+            - dn_groups: (number of denoising groups, queries per group) of the first queries of tgt, the
+              self-attention then runs grouped instead of with tgt_mask
         """
         output = tgt
         device = tgt.device
@@ -148,7 +217,15 @@ class TransformerDecoder(nn.Module):
         ref_masks = [reference_masks]
         
         if self.type_mask_embed == "SumSinusoidalMask":
-          postion_matrix_embed=get_sinusoidal_embedding(reference_masks.shape[2:],reference_masks.device)
+          # the reference masks are pooled at the spatial shape of `mask_embed_spatial_shape_level` if set
+          embed_shape = reference_masks.shape[2:] if self.mask_embed_spatial_shape_level is None \
+              else spatial_shapes[self.mask_embed_spatial_shape_level].tolist()
+          postion_matrix_embed=get_sinusoidal_embedding(embed_shape,reference_masks.device)
+        else:
+          postion_matrix_embed=None
+        # the mask embedding cache is only used at inference, BatchNorm of the mask encoder uses batch statistics in training
+        use_mask_embed_cache = not self.training and self.mask_embed_cache_threshold >= 0
+        mask_embed_cache = None
 
         for layer_id, layer in enumerate(self.layers):
             # preprocess ref points
@@ -160,12 +237,11 @@ class TransformerDecoder(nn.Module):
             
             thres_mask= reference_masks.sigmoid()
             scale_shape= None if self.mask_embed_spatial_shape_level is None else spatial_shapes[self.mask_embed_spatial_shape_level]
-            if self.type_mask_embed == "MaskSimpleCNN":
-              query_mask_embed = self.maskencoder(thres_mask,scale_shape) 
-            elif self.type_mask_embed == "SumSinusoidalMask":
-              query_mask_embed = gen_sineembed_for_mask((thres_mask>0.5)*1.0,postion_matrix_embed,scale_shape) 
+            if use_mask_embed_cache:
+              query_mask_embed, mask_embed_cache = self.cached_embed_reference_masks(
+                  thres_mask, mask_embed_cache, layer_id, scale_shape, postion_matrix_embed)
             else:
-              raise NotImplementedError(f'This method is not implemented yet:{self.type_mask_embed}')
+              query_mask_embed = self.embed_reference_masks(thres_mask, scale_shape, postion_matrix_embed)
             
             if self.binary_semantic_segmenation == True:
               query_centermask_embed = sineembed_for_position_xy(get_bounding_boxes(reference_masks>0)[:,:,:2])
@@ -190,9 +266,12 @@ class TransformerDecoder(nn.Module):
                 memory_key_padding_mask=memory_key_padding_mask,          #N*Sum{WH}
                 memory_level_start_index=level_start_index,               #Level
                 memory_spatial_shapes=spatial_shapes,                     #3*2
+                memory_valid_ratios=valid_ratios,                         #N*Level*2
                 memory_pos=pos,                                           #None
+                reference_padding_mask=reference_padding_mask,            #N*H*W
 
                 self_attn_mask=tgt_mask,                                  #(D+Q)*(D+Q)
+                self_attn_groups=dn_groups,                               #(scalar, single_pad)
                 cross_attn_mask=memory_mask                               #None
             )
             output_norm=self.norm(output)
@@ -237,6 +316,7 @@ class DeformableTransformerDecoderLayer(nn.Module):
                  type_sampling_location="mask",
                  use_deformable_box_attn=False,
                  key_aware_type=None,
+                 fused_mask_attn=False,
                  ):
         super().__init__()
 
@@ -244,7 +324,8 @@ class DeformableTransformerDecoderLayer(nn.Module):
         if use_deformable_box_attn:
             raise NotImplementedError
         else:
-            self.cross_attn = MSDeformAttnMask(d_model, n_levels, n_heads, n_points,type_sampling_location)
+            self.cross_attn = MSDeformAttnMask(d_model, n_levels, n_heads, n_points,type_sampling_location,
+                                               fused_mask_attn=fused_mask_attn)
         self.dropout1 = nn.Dropout(dropout)
         self.norm1 = nn.LayerNorm(d_model)
 
@@ -273,6 +354,43 @@ class DeformableTransformerDecoderLayer(nn.Module):
     def with_pos_embed(tensor, pos):
         return tensor if pos is None else tensor + pos
 
+    def grouped_self_attn(self, q, k, v, groups):
+        """
+        Self-attention of denoising training with the attention pattern of the mask of prepare_for_dn, without
+        computing the masked blocks: each of the `groups[0]` groups of `groups[1]` denoising queries attends to
+        itself and to the matching queries, the matching queries only attend to themselves.
+        q, k, v: (D+Q)*N*C, returns (D+Q)*N*C
+        """
+        num_groups, group_size = groups
+        pad_size = num_groups * group_size
+        L, N, C = q.shape
+        num_heads = self.self_attn.num_heads
+        w_q, w_k, w_v = self.self_attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.self_attn.in_proj_bias.chunk(3)
+        # (D+Q)*N*C -> N*heads*(D+Q)*d
+        q, k, v = [
+            F.linear(x, w, b).view(L, N, num_heads, C // num_heads).permute(1, 2, 0, 3)
+            for x, w, b in ((q, w_q, b_q), (k, w_k, b_k), (v, w_v, b_v))
+        ]
+        dropout_p = self.self_attn.dropout if self.training else 0.0
+
+        def attention(q, k, v):
+            if hasattr(F, "scaled_dot_product_attention"):
+                return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+            attn = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(q.shape[-1]), -1)
+            return F.dropout(attn, dropout_p, self.training) @ v
+
+        matching_out = attention(q[:, :, pad_size:], k[:, :, pad_size:], v[:, :, pad_size:])
+        # N*heads*groups*(group_size+Q)*d, keys and values of each group followed by the matching ones
+        group_k, group_v = [
+            torch.cat([x[:, :, :pad_size].reshape(N, num_heads, num_groups, group_size, -1),
+                       x[:, :, None, pad_size:].expand(-1, -1, num_groups, -1, -1)], 3)
+            for x in (k, v)
+        ]
+        group_out = attention(q[:, :, :pad_size].reshape(N, num_heads, num_groups, group_size, -1), group_k, group_v).flatten(2, 3)
+        out = torch.cat([group_out, matching_out], 2).permute(2, 0, 1, 3).reshape(L, N, C)
+        return self.self_attn.out_proj(out)
+
     def forward_ffn(self, tgt):
         tgt2 = self.linear2(self.dropout3(self.activation(self.linear1(tgt))))
         tgt = tgt + self.dropout4(tgt2)
@@ -297,10 +415,13 @@ class DeformableTransformerDecoderLayer(nn.Module):
                 memory_key_padding_mask: Optional[Tensor] = None,                                 #N*Sum{WH}
                 memory_level_start_index: Optional[Tensor] = None,  # num_levels                  #Level
                 memory_spatial_shapes: Optional[Tensor] = None,  # bs, num_levels, 2              #3*2
+                memory_valid_ratios: Optional[Tensor] = None,                                     #N*Level*2
                 memory_pos: Optional[Tensor] = None,  # pos for memory                            #None
+                reference_padding_mask: Optional[Tensor] = None,                                  #N*H*W
 
                 # sa
                 self_attn_mask: Optional[Tensor] = None,  # mask used for self-attention          #(D+Q)*(D+Q)
+                self_attn_groups: Optional[tuple] = None,  # denoising groups, replaces self_attn_mask  #(scalar, single_pad)
                 cross_attn_mask: Optional[Tensor] = None,  # mask used for cross-attention        #None
                 ):
         """
@@ -311,7 +432,10 @@ class DeformableTransformerDecoderLayer(nn.Module):
         # self attention
         if self.self_attn is not None:
             q = k = self.with_pos_embed(tgt, tgt_query_mask)
-            tgt2 = self.self_attn(q, k, tgt, attn_mask=self_attn_mask)[0]
+            if self_attn_groups is not None:
+                tgt2 = self.grouped_self_attn(q, k, tgt, self_attn_groups)
+            else:
+                tgt2 = self.self_attn(q, k, tgt, attn_mask=self_attn_mask)[0]
             tgt = tgt + self.dropout2(tgt2)
             tgt = self.norm2(tgt)
 
@@ -332,7 +456,9 @@ class DeformableTransformerDecoderLayer(nn.Module):
                               memory_spatial_shapes,                                                       #3*2
                               memory_level_start_index,                                                    #Level
                               #N*Sum{WH}
-                              memory_key_padding_mask).transpose(0, 1)                                     
+                              memory_key_padding_mask,
+                              input_valid_ratios=memory_valid_ratios,                                      #N*Level*2
+                              reference_padding_mask=reference_padding_mask).transpose(0, 1)               #N*H*W                                     
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
 
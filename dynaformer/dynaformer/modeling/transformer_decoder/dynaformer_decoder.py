@@ -17,7 +17,7 @@ from detectron2.utils.registry import Registry
 from detectron2.structures import BitMasks
 
 from .dino_decoder import TransformerDecoder, DeformableTransformerDecoderLayer
-from ...utils.utils import MLP, gen_encoder_output_proposals, inverse_sigmoid,inverse_sigmoid_mask, apply_random_mask_noise_transforms,get_bounding_boxes_ohw
+from ...utils.utils import MLP, gen_encoder_output_proposals, inverse_sigmoid,inverse_sigmoid_mask, apply_random_mask_noise_transforms,get_bounding_boxes_ohw, resize_padding_mask
 from ...utils import box_ops
 from ...utils import test
 
@@ -67,7 +67,16 @@ class DYNAFormerDecoder(nn.Module):
             query_dim: int = 4,
             dec_layer_share: bool = False,
             semantic_ce_loss: bool = False,
-            type_mask_embed: str = 'MaskSimpleCNN'
+            type_mask_embed: str = 'MaskSimpleCNN',
+            test_num_queries: int = 0,
+            test_query_selection: str = 'fixed',
+            test_query_score_threshold: float = 0.3,
+            test_min_queries: int = 1,
+            mask_embed_spatial_shape_level = None,
+            mask_refine_factor: int = 1,
+            mask_embed_cache_threshold: float = -1.0,
+            dn_grouped_self_attn: bool = False,
+            fused_mask_deform_attn: bool = False,
     ):
         """
         NOTE: this interface is experimental.
@@ -94,6 +103,24 @@ class DYNAFormerDecoder(nn.Module):
             query_dim: 4 -> (x, y, w, h)
             dec_layer_share: whether to share each decoder layer
             semantic_ce_loss: use ce loss for semantic segmentation
+            test_num_queries: number of two-stage proposals selected at inference, 0 to use num_queries
+            test_query_selection: 'fixed' selects test_num_queries proposals at inference, 'adaptive'
+                only keeps the proposals whose score is above test_query_score_threshold, at least
+                test_min_queries and at most test_num_queries
+            test_query_score_threshold: score threshold of the adaptive selection
+            test_min_queries: minimum number of proposals kept by the adaptive selection
+            mask_embed_spatial_shape_level: level of the memory whose spatial shape the reference
+                masks are resized to before they are embedded, None to embed them at full size
+            mask_refine_factor: if > 1, the decoder iterates the mask anchors on `mask_features`
+                average pooled by this factor, and only the masks of the output layer are predicted
+                at the resolution of `mask_features`
+            mask_embed_cache_threshold: at inference, the decoder only re-embeds the reference masks
+                whose binarized mask changed by more than this 1 - IoU since they were last embedded,
+                negative to embed all of them in every layer
+            dn_grouped_self_attn: in training, the self-attention of each denoising group only attends to
+                the group and the matching queries, and the matching queries to themselves, instead of
+                running dense attention with the mask of prepare_for_dn
+            fused_mask_deform_attn: run the "mask"/"both" cross-attention with the fused kernel of the ops
         """
         super().__init__()
 
@@ -107,6 +134,7 @@ class DYNAFormerDecoder(nn.Module):
         self.learn_tgt = learn_tgt
         self.noise_scale=noise_scale
         self.dn_num=dn_num
+        self.dn_grouped_self_attn = dn_grouped_self_attn
         self.num_heads = nheads
         self.type_sampling_location=type_sampling_location
         self.num_layers = dec_layers
@@ -115,6 +143,15 @@ class DYNAFormerDecoder(nn.Module):
         self.total_num_feature_levels = total_num_feature_levels
 
         self.num_queries = num_queries
+        self.test_num_queries = test_num_queries if test_num_queries > 0 else num_queries
+        # the content queries of the selected proposals are the first rows of query_feat
+        assert not learn_tgt or self.test_num_queries <= num_queries, \
+            "TEST.NUM_QUERIES ({}) must not exceed NUM_QUERIES ({}) with LEARN_TGT".format(self.test_num_queries, num_queries)
+        self.mask_refine_factor = mask_refine_factor
+        assert test_query_selection in ('fixed', 'adaptive'), test_query_selection
+        self.test_query_selection = test_query_selection
+        self.test_query_score_threshold = test_query_score_threshold
+        self.test_min_queries = min(test_min_queries, self.test_num_queries)
         self.semantic_ce_loss = semantic_ce_loss
         # learnable query features
         if not two_stage or self.learn_tgt:
@@ -138,6 +175,8 @@ class DYNAFormerDecoder(nn.Module):
         assert self.mask_classification, "why not class embedding?"
         
         #CLASS EMBED
+        # only set with the semantic CE loss of a single class
+        self.binary_semantic_segmenation = False
         if self.mask_classification:
             if self.semantic_ce_loss:
                 self.class_embed = nn.Linear(hidden_dim, num_classes+1)
@@ -151,13 +190,16 @@ class DYNAFormerDecoder(nn.Module):
         self.decoder_norm = decoder_norm = nn.LayerNorm(hidden_dim)
         decoder_layer = DeformableTransformerDecoderLayer(hidden_dim, dim_feedforward,
                                                           dropout, activation,
-                                                          self.num_feature_levels, nhead, dec_n_points, self.type_sampling_location)
+                                                          self.num_feature_levels, nhead, dec_n_points, self.type_sampling_location,
+                                                          fused_mask_attn=fused_mask_deform_attn)
         self.decoder = TransformerDecoder(decoder_layer, self.num_layers, decoder_norm,
                                           return_intermediate=return_intermediate_dec,
                                           d_model=hidden_dim, query_dim=query_dim,
                                           num_feature_levels=self.num_feature_levels,
                                           dec_layer_share=dec_layer_share,
                                           type_mask_embed=type_mask_embed,
+                                          mask_embed_spatial_shape_level=mask_embed_spatial_shape_level,
+                                          mask_embed_cache_threshold=mask_embed_cache_threshold,
                                           binary_semantic_segmenation=self.binary_semantic_segmenation if self.binary_semantic_segmenation is not None else False
                                           )
 
@@ -220,8 +262,41 @@ class DYNAFormerDecoder(nn.Module):
         ret["semantic_ce_loss"] = cfg.MODEL.DYNAFormer.TEST.SEMANTIC_ON and cfg.MODEL.DYNAFormer.SEMANTIC_CE_LOSS and ~cfg.MODEL.DYNAFormer.TEST.PANOPTIC_ON
         #                                                   False                                False                                           False
         ret["type_mask_embed"] = cfg.MODEL.DYNAFormer.TYPE_MASK_EMBED
+        ret["test_num_queries"] = cfg.MODEL.DYNAFormer.TEST.NUM_QUERIES                                             #0
+        ret["test_query_selection"] = cfg.MODEL.DYNAFormer.TEST.QUERY_SELECTION                                     #"fixed"
+        ret["test_query_score_threshold"] = cfg.MODEL.DYNAFormer.TEST.QUERY_SCORE_THRESHOLD                         #0.3
+        ret["test_min_queries"] = cfg.MODEL.DYNAFormer.TEST.MIN_QUERIES                                             #1
+        ret["mask_embed_spatial_shape_level"] = cfg.MODEL.DYNAFormer.MASK_EMBED_SPATINAL_SHAPE_LEVEL                #None
+        ret["mask_embed_cache_threshold"] = cfg.MODEL.DYNAFormer.TEST.MASK_EMBED_CACHE_THRESHOLD               #-1.0
+        ret["dn_grouped_self_attn"] = cfg.MODEL.DYNAFormer.DN_GROUPED_SELF_ATTN                                     #False
+        ret["fused_mask_deform_attn"] = cfg.MODEL.DYNAFormer.FUSED_MASK_DEFORM_ATTN                                 #False
+        if cfg.MODEL.DYNAFormer.MASK_FEATURE_REFINE:
+            # the pixel decoder outputs mask features at COMMON_STRIDE, the anchors are iterated at MASK_FEATURE_STRIDE
+            ret["mask_refine_factor"] = cfg.MODEL.DYNAFormer.MASK_FEATURE_STRIDE // cfg.MODEL.SEM_SEG_HEAD.COMMON_STRIDE
         return ret
 
+    @staticmethod
+    def dn_attn_mask(scalar, single_pad, num_queries, device):
+        """
+        Self-attention mask of denoising training, True where attention is not allowed: `scalar` groups of
+        `single_pad` denoising queries followed by `num_queries` matching queries.
+        """
+        pad_size = single_pad * scalar
+        tgt_size = pad_size + num_queries
+        attn_mask = torch.ones(tgt_size, tgt_size).to(device) < 0
+        # match query cannot see the reconstruct
+        attn_mask[pad_size:, :pad_size] = True
+        # reconstruct cannot see each other
+        for i in range(scalar):
+            if i == 0:
+                attn_mask[single_pad * i:single_pad * (i + 1), single_pad * (i + 1):pad_size] = True
+            if i == scalar - 1:
+                attn_mask[single_pad * i:single_pad * (i + 1), :single_pad * i] = True
+            else:
+                attn_mask[single_pad * i:single_pad * (i + 1), single_pad * (i + 1):pad_size] = True
+                attn_mask[single_pad * i:single_pad * (i + 1), :single_pad * i] = True
+        return attn_mask
+
     def prepare_for_dn(self, targets, tgt, refbox_emb, refmask_emb, batch_size,new_size):
         """
         modified from dn-detr. You can refer to dn-detr
@@ -315,19 +390,7 @@ class DYNAFormerDecoder(nn.Module):
                 input_query_bbox[(known_bid.long(), map_known_indice)] = input_box_embed
                 input_query_mask[(known_bid.long(), map_known_indice)] = input_mask_embed
 
-            tgt_size = pad_size + self.num_queries
-            attn_mask = torch.ones(tgt_size, tgt_size).to('cuda') < 0
-            # match query cannot see the reconstruct
-            attn_mask[pad_size:, :pad_size] = True
-            # reconstruct cannot see each other
-            for i in range(scalar):
-                if i == 0:
-                    attn_mask[single_pad * i:single_pad * (i + 1), single_pad * (i + 1):pad_size] = True
-                if i == scalar - 1:
-                    attn_mask[single_pad * i:single_pad * (i + 1), :single_pad * i] = True
-                else:
-                    attn_mask[single_pad * i:single_pad * (i + 1), single_pad * (i + 1):pad_size] = True
-                    attn_mask[single_pad * i:single_pad * (i + 1), :single_pad * i] = True
+            attn_mask = self.dn_attn_mask(scalar, single_pad, self.num_queries, 'cuda')
             mask_dict = {
                 'known_indice': torch.as_tensor(known_indice).long(),
                 'batch_idx': torch.as_tensor(batch_idx).long(),
@@ -389,40 +452,47 @@ class DYNAFormerDecoder(nn.Module):
         return valid_ratio
     
 
-    def forward(self, x, mask_features, masks, targets=None):
+    def forward(self, x, mask_features, masks, targets=None, return_features=False):
         """
         :param x: input, a list of multi-scale feature
         :param mask_features: is the per-pixel embeddings with resolution 1/4 of the original image,
         obtained by fusing backbone encoder encoded features. This is used to produce binary masks.
-        :param masks: mask in the original image
+        :param masks: padding mask of the images (N*H*W, True on padding), or None
         :param targets: used for denoising training
+        :param return_features: also return the last-layer mask embeddings, the mask features and the
+        encoder memory ("pred_mask_embed", "mask_features", "multi_scale_features"), used by the point
+        refinement and the knowledge distillation
         """
         assert len(x) == self.num_feature_levels
         device = x[0].device
         size_list = []
-        # disable mask, it does not affect performance
-        enable_mask = 0
-        if masks is not None:
-            for src in x:
-                if src.size(2) % 32 or src.size(3) % 32:
-                    enable_mask = 1
-        if enable_mask == 0:
-            masks = [torch.zeros((src.size(0), src.size(2), src.size(3)), device=src.device, dtype=torch.bool) for src in x]
+        fine_mask_features = mask_features
+        if self.mask_refine_factor > 1:
+            mask_features = F.avg_pool2d(mask_features, self.mask_refine_factor, ceil_mode=True)
+        has_padding = masks is not None
         src_flatten = []
         mask_flatten = []
         spatial_shapes = []
+        level_masks = []
         for i in range(self.num_feature_levels):
             idx=self.num_feature_levels-1-i
             bs, c , h, w=x[idx].shape
             size_list.append(x[i].shape[-2:])
             spatial_shapes.append(x[idx].shape[-2:])
             src_flatten.append(self.input_proj[idx](x[idx]).flatten(2).transpose(1, 2))
-            mask_flatten.append(masks[i].flatten(1))
+            if has_padding:
+                level_mask = resize_padding_mask(masks, (h, w))
+            else:
+                level_mask = torch.zeros((bs, h, w), device=device, dtype=torch.bool)
+            level_masks.append(level_mask)
+            mask_flatten.append(level_mask.flatten(1))
         src_flatten = torch.cat(src_flatten, 1)  # bs, \sum{hxw}, c
         mask_flatten = torch.cat(mask_flatten, 1)  # bs, \sum{hxw}
         spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
         level_start_index = torch.cat((spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in level_masks], 1)
+        # padding at the resolution of the reference masks, used by the inside-mask checks of the decoder
+        reference_padding_mask = resize_padding_mask(masks, mask_features.shape[-2:]) if has_padding else None
 
         predictions_class = []
         if self.two_stage:
@@ -435,13 +505,23 @@ class DYNAFormerDecoder(nn.Module):
             enc_outputs_class_unselected = self.intern_class_embed(output_memory)
             enc_outputs_coord_unselected = self.intern_box_embed(output_memory) + output_proposals  # (bs, \sum{hw}, 4) unsigmoid
 
-            topk = self.num_queries
+            topk = self.num_queries if self.training else self.test_num_queries
 
             if self.binary_semantic_segmenation is not None and self.binary_semantic_segmenation== True:
-              topk_proposals = torch.topk(enc_outputs_class_unselected[...,0], topk, dim=1)[1]
+              proposal_scores = enc_outputs_class_unselected[...,0]
             else:  
               #instance segm
-              topk_proposals = torch.topk(enc_outputs_class_unselected.max(-1)[0], topk, dim=1)[1]
+              proposal_scores = enc_outputs_class_unselected.max(-1)[0]
+            if has_padding:
+              # never select a proposal in the padding
+              proposal_scores = proposal_scores.masked_fill(mask_flatten, float("-inf"))
+            topk_scores, topk_proposals = torch.topk(proposal_scores, topk, dim=1)
+            if not self.training and self.test_query_selection == 'adaptive':
+              # keep the proposals above the score threshold (sorted by topk), the same number
+              # for all images of the batch
+              num_keep = (topk_scores.sigmoid() > self.test_query_score_threshold).sum(1).max()
+              num_keep = int(num_keep.clamp(min=self.test_min_queries, max=topk))
+              topk_proposals = topk_proposals[:, :num_keep]
 
             #Memory
             #N*HW*256
@@ -470,22 +550,31 @@ class DYNAFormerDecoder(nn.Module):
             refmask_embed = interm_outputs_mask.detach()      #unsig
 
             if self.learn_tgt:
-                tgt = self.query_feat.weight[None].repeat(bs, 1, 1)
+                tgt = self.query_feat.weight[None, :tgt.shape[1]].repeat(bs, 1, 1)
 
             #We use refmask_embed insteal of refbox_embed, but initialize box is better  
             if self.initialize_box_type != 'no':
                 # convert masks into boxes to better initialize box in the decoder
                 assert self.initial_pred
-                flaten_mask = refmask_embed.flatten(0, 1)
+                flaten_mask = refmask_embed > 0
                 h, w = refmask_embed.shape[-2:]
+                box_size = torch.as_tensor([w, h, w, h], dtype=torch.float).to(device)
+                if has_padding:
+                    # like the proposals, the boxes are relative to the valid area, the decoder scales
+                    # them to the padded area with valid_ratios
+                    flaten_mask = flaten_mask & ~reference_padding_mask[:, None]
+                    valid_w = (~reference_padding_mask[:, 0, :]).sum(1)
+                    valid_h = (~reference_padding_mask[:, :, 0]).sum(1)
+                    box_size = torch.stack([valid_w, valid_h, valid_w, valid_h], -1).float()
+                    box_size = box_size.repeat_interleave(refmask_embed.shape[1], 0)
+                flaten_mask = flaten_mask.flatten(0, 1)
                 if self.initialize_box_type == 'bitmask':  # slower, but more accurate
-                    refbbox_embed = BitMasks(flaten_mask > 0).get_bounding_boxes().tensor.to(device)
+                    refbbox_embed = BitMasks(flaten_mask).get_bounding_boxes().tensor.to(device)
                 elif self.initialize_box_type == 'mask2box':  # faster conversion
-                    refbbox_embed = box_ops.masks_to_boxes(flaten_mask > 0).to(device)
+                    refbbox_embed = box_ops.masks_to_boxes(flaten_mask).to(device)
                 else:
                     assert NotImplementedError
-                refbbox_embed = box_ops.box_xyxy_to_cxcywh(refbbox_embed) / torch.as_tensor([w, h, w, h],
-                                                                                              dtype=torch.float).to(device)
+                refbbox_embed = box_ops.box_xyxy_to_cxcywh(refbbox_embed) / box_size
                 refbbox_embed = refbbox_embed.reshape(refmask_embed.shape[0], refmask_embed.shape[1], 4)
                 refbbox_embed = inverse_sigmoid(refbbox_embed)
 
@@ -497,6 +586,7 @@ class DYNAFormerDecoder(nn.Module):
             #refmask_embed = self.query_mask_embed.weight[None].repeat(bs, 1, 1).view(bs,-1, 224, 224)
         
         tgt_mask = None
+        dn_groups = None
         mask_dict = None
         if self.dn != "no" and self.training:
             assert targets is not None
@@ -505,6 +595,9 @@ class DYNAFormerDecoder(nn.Module):
                 self.prepare_for_dn(targets, None, None,None, x[0].shape[0],refmask_embed.shape[-2:])
             if mask_dict is not None:
                 tgt=torch.cat([input_query_label, tgt],dim=1)
+                if self.dn_grouped_self_attn:
+                    # (number of groups, queries per group), replaces the dense tgt_mask
+                    dn_groups = (mask_dict['scalar'], mask_dict['pad_size'] // mask_dict['scalar'])
 
         if self.dn != "no" and self.training and mask_dict is not None:
             #unsig                   #unsig           #unsig
@@ -522,14 +615,16 @@ class DYNAFormerDecoder(nn.Module):
             tgt=tgt.transpose(0, 1),                              # (D+Q)*N*C
             memory=src_flatten.transpose(0, 1),                   # Sum{WH}*N*C
             mask_features=mask_features,                          # N*C*W*H                          
-            memory_key_padding_mask=mask_flatten,                 # N*Sum{WH}
+            memory_key_padding_mask=mask_flatten if has_padding else None,   # N*Sum{WH}
+            reference_padding_mask=reference_padding_mask,        # N*H*W
             pos=None,
             refbboxs_unsigmoid=refbbox_embed.transpose(0, 1),     # (D+Q)*N*H*W           unsig
             refmasks_unsigmoid=refmask_embed.transpose(0, 1),     # (D+Q)*N*H*W           unsig
             level_start_index=level_start_index,                  # Level
             spatial_shapes=spatial_shapes,                        # Level*2
             valid_ratios=valid_ratios,                            # N*Level*2
-            tgt_mask=tgt_mask                                     # (D+Q)*(D+Q)
+            tgt_mask=tgt_mask,                                    # (D+Q)*(D+Q)
+            dn_groups=dn_groups,
         )
         
         # iteratively class and box  prediction
@@ -576,6 +671,25 @@ class DYNAFormerDecoder(nn.Module):
         }
         if self.two_stage:
             out['interm_outputs'] = interm_outputs
+        if return_features or self.mask_refine_factor > 1:
+            mask_embed = self.mask_embed[-1](hs[-1])
+            if mask_dict is not None:
+                mask_embed = mask_embed[:, mask_dict['pad_size']:]
+        if return_features:
+            # mask embeddings of the last layer and the mask features, used to re-predict masks at points
+            out['pred_mask_embed'] = mask_embed                   #N*Q*C
+            out['mask_features'] = fine_mask_features             #N*C*H*W
+            # encoder memory, used by knowledge distillation
+            out['multi_scale_features'] = x                       #list[N*C*H*W]
+        if self.mask_refine_factor > 1:
+            # output layer at the resolution of the mask features: the delta is predicted on the fine
+            # features and added to the upsampled reference mask of the last layer
+            reference_mask = references_mask[-1]
+            if mask_dict is not None:
+                reference_mask = reference_mask[:, mask_dict['pad_size']:]
+            reference_mask = F.interpolate(reference_mask, size=fine_mask_features.shape[-2:], mode="bilinear",
+                                           align_corners=False)
+            out['pred_masks'] = (torch.einsum("bqc,bchw->bqhw", mask_embed, fine_mask_features) + reference_mask) / 2
         return out, mask_dict
 
 
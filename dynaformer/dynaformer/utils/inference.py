@@ -0,0 +1,137 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+"""
+Utilities to optimize a trained DYNAFormer model for (CPU) inference.
+"""
+import logging
+
+import torch
+from torch import nn
+
+from detectron2.layers import Conv2d, FrozenBatchNorm2d
+
+logger = logging.getLogger(__name__)
+
+
+class Conv1x1ChannelsLast(nn.Module):
+    """
+    A 1x1 convolution (optionally followed by the norm and activation of a detectron2
+    :class:`Conv2d`) computed as a matmul over the channels of a channels-last input,
+    with the weight stored pre-transposed as (C_in, C_out).
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        assert conv.kernel_size == (1, 1) and conv.stride == (1, 1) and conv.groups == 1, conv
+        weight = conv.weight.detach()[:, :, 0, 0]
+        self.weight_t = nn.Parameter(weight.t().contiguous(), requires_grad=False)  # C_in*C_out
+        bias = conv.bias.detach() if conv.bias is not None else weight.new_zeros(weight.shape[0])
+        self.bias = nn.Parameter(bias.clone(), requires_grad=False)
+        self.norm = getattr(conv, "norm", None)
+        self.activation = getattr(conv, "activation", None)
+
+    def forward(self, x):
+        n, _, h, w = x.shape
+        # N*C*H*W -> N*H*W*C is a view for channels-last inputs
+        x = torch.addmm(self.bias, x.permute(0, 2, 3, 1).reshape(n * h * w, -1), self.weight_t)
+        # N*H*W*C_out -> channels-last N*C_out*H*W
+        x = x.view(n, h, w, -1).permute(0, 3, 1, 2)
+        if self.norm is not None:
+            x = self.norm(x)
+        if self.activation is not None:
+            x = self.activation(x)
+        return x
+
+    def extra_repr(self):
+        return "in_channels={}, out_channels={}".format(*self.weight_t.shape)
+
+
+@torch.no_grad()
+def fold_frozen_batchnorm(module):
+    """
+    Fold the (frozen) batch norms of detectron2 :class:`Conv2d` layers into the conv weights.
+
+    Returns:
+        int: number of folded batch norms
+    """
+    num_folded = 0
+    for m in module.modules():
+        if not isinstance(m, Conv2d) or m.norm is None:
+            continue
+        norm = m.norm
+        if isinstance(norm, FrozenBatchNorm2d):
+            pass
+        elif isinstance(norm, nn.BatchNorm2d) and not norm.training and norm.track_running_stats:
+            pass
+        else:
+            continue
+        scale = norm.weight * (norm.running_var + norm.eps).rsqrt()
+        shift = norm.bias - norm.running_mean * scale
+        m.weight.copy_(m.weight * scale.view(-1, 1, 1, 1))
+        bias = shift if m.bias is None else m.bias * scale + shift
+        m.bias = nn.Parameter(bias, requires_grad=False)
+        m.norm = None
+        num_folded += 1
+    return num_folded
+
+
+def _pretranspose_conv1x1(module, replaced=None):
+    """
+    Replace the 1x1 convs (stride 1, no groups) among the children of `module` with
+    :class:`Conv1x1ChannelsLast`. Returns a dict from the id of each replaced conv to its replacement.
+    """
+    replaced = {} if replaced is None else replaced
+    for name, child in module.named_children():
+        if (
+            isinstance(child, nn.Conv2d)
+            and child.kernel_size == (1, 1)
+            and child.stride == (1, 1)
+            and child.groups == 1
+            and child.padding == (0, 0)
+        ):
+            replaced[id(child)] = Conv1x1ChannelsLast(child)
+            setattr(module, name, replaced[id(child)])
+        else:
+            _pretranspose_conv1x1(child, replaced)
+    return replaced
+
+
+@torch.no_grad()
+def prepare_for_inference(model):
+    """
+    Optimize a trained :class:`DYNAFormer` for inference, in place:
+      - fold frozen batch norms of the backbone into the conv weights,
+      - use the fused inference blocks of the backbone if it has them (FocalNet),
+      - convert the backbone and the pixel decoder to channels-last,
+      - replace the 1x1 projections of the pixel decoder (`input_proj`, lateral convs,
+        `mask_features`) by matmuls with pre-transposed weights.
+    GroupNorm layers can not be folded, as their statistics depend on the input.
+    The model can not be trained afterwards.
+
+    Returns:
+        the model
+    """
+    model.eval()
+    backbone = model.backbone
+    pixel_decoder = model.sem_seg_head.pixel_decoder
+
+    num_folded = fold_frozen_batchnorm(backbone) + fold_frozen_batchnorm(pixel_decoder)
+    if hasattr(backbone, "fuse_for_inference"):
+        backbone.fuse_for_inference()
+    if hasattr(backbone, "channels_last"):
+        backbone.channels_last = True
+
+    replaced = _pretranspose_conv1x1(pixel_decoder)
+    # lateral convs are referenced from a plain list as well as registered as "adapter_{}"
+    if hasattr(pixel_decoder, "lateral_convs"):
+        pixel_decoder.lateral_convs = [replaced.get(id(m), m) for m in pixel_decoder.lateral_convs]
+
+    backbone.to(memory_format=torch.channels_last)
+    pixel_decoder.to(memory_format=torch.channels_last)
+    model.channels_last = True
+    logger.info(
+        "prepare_for_inference: folded {} batch norms, pre-transposed {} 1x1 convs".format(num_folded, len(replaced))
+    )
+    return model
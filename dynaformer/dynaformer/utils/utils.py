@@ -180,6 +180,16 @@ def inverse_sigmoid_mask(x, eps=1e-11):
     x2 = (1 - x).clamp(min=eps)
     return torch.log(x1/x2).to(torch.float16)
 
+def resize_padding_mask(mask: Tensor, size):
+    """
+    Resize a padding mask (N*H*W, True on padding) to the spatial `size` of a feature map.
+    A feature location is padding only if it is entirely in the padded area.
+    """
+    if mask.shape[-2:] == tuple(size):
+        return mask
+    return ~(F.adaptive_max_pool2d((~mask)[:, None].float(), tuple(size))[:, 0] > 0)
+
+
 def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spatial_shapes:Tensor):
     """
     Input:
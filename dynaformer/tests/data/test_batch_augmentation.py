@@ -0,0 +1,142 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import random
+import unittest
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from detectron2.data import transforms as T
+from detectron2.projects.point_rend import ColorAugSSDTransform
+
+from dynaformer.data.batch_augmentation import _bgr_to_hsv, _convert, _hsv_to_bgr, apply_transform
+
+
+def make_image(height=37, width=53):
+    # smooth content with noise and sharp edges
+    rng = np.random.RandomState(0)
+    ys, xs = np.mgrid[:height, :width]
+    image = np.stack([xs * 255 / width, ys * 255 / height, (xs + ys) * 127 / (width + height)], -1)
+    image += rng.randint(-20, 20, size=image.shape)
+    image[height // 3 : height // 2, width // 4 : width // 2] = [250, 10, 120]
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def make_segmentation(height=37, width=53):
+    rng = np.random.RandomState(1)
+    segmentation = np.zeros((height, width), dtype=np.uint8)
+    segmentation[5:30, 10:40] = 1
+    segmentation[rng.rand(height, width) > 0.9] = 2
+    return segmentation
+
+
+def apply_tensor(tfm, image=None, segmentation=None):
+    """
+    The batch stage on a uint8 H*W*C image or an H*W segmentation, as uint8 numpy arrays.
+    """
+    if image is not None:
+        x = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1))).float()
+        x = apply_transform(tfm, x)
+        return x.round().clamp(0, 255).to(torch.uint8).numpy().transpose(1, 2, 0)
+    x = apply_transform(tfm, torch.from_numpy(segmentation), segmentation=True)
+    return x.numpy()
+
+
+class TestBatchAugmentation(unittest.TestCase):
+    def assertImageClose(self, out, expected, max_diff, mean_diff, outlier_ratio=0.0):
+        """
+        At most `outlier_ratio` of the values differ by more than `max_diff`, and the mean absolute
+        difference is at most `mean_diff`.
+        """
+        self.assertEqual(out.shape, expected.shape)
+        diff = np.abs(out.astype(np.int32) - expected.astype(np.int32))
+        self.assertLessEqual((diff > max_diff).mean(), outlier_ratio, "max diff {}".format(diff.max()))
+        self.assertLessEqual(diff.mean(), mean_diff)
+
+    def assertSegmentationClose(self, out, expected, mismatch_ratio=0.0):
+        self.assertEqual(out.shape, expected.shape)
+        self.assertEqual(out.dtype, expected.dtype)
+        self.assertLessEqual((out != expected).mean(), mismatch_ratio)
+
+    def check_exact(self, tfm):
+        image, segmentation = make_image(), make_segmentation()
+        self.assertTrue(np.array_equal(apply_tensor(tfm, image=image), tfm.apply_image(image)))
+        self.assertTrue(
+            np.array_equal(apply_tensor(tfm, segmentation=segmentation), tfm.apply_segmentation(segmentation))
+        )
+
+    def test_flip(self):
+        self.check_exact(T.HFlipTransform(53))
+        self.check_exact(T.VFlipTransform(37))
+
+    def test_crop(self):
+        self.check_exact(T.CropTransform(7, 3, 30, 25))
+
+    def test_pad(self):
+        # the padding value of FixedSizeCrop, and the one of segmentations
+        _, transforms = T.apply_transform_gens([T.FixedSizeCrop(crop_size=(64, 64))], make_image())
+        self.check_exact(transforms)
+
+    def test_resize(self):
+        image, segmentation = make_image(), make_segmentation()
+        # down and up in both directions, and in one direction only (PIL skips the other pass)
+        for new_h, new_w in [(18, 26), (11, 40), (80, 120), (37, 90), (20, 53)]:
+            for interp in [Image.BILINEAR, Image.BICUBIC]:
+                tfm = T.ResizeTransform(37, 53, new_h, new_w, interp)
+                # up to the fixed point coefficients and the rounding of the ties of PIL
+                self.assertImageClose(apply_tensor(tfm, image=image), tfm.apply_image(image), 1, 0.05)
+            # nearest, up to the rounding of the source pixel at the exact midpoints
+            self.assertSegmentationClose(
+                apply_tensor(tfm, segmentation=segmentation), tfm.apply_segmentation(segmentation), 0.001
+            )
+
+    def test_rotation(self):
+        image, segmentation = make_image(), make_segmentation()
+        for angle in [-45, -10, 30, 90]:
+            tfm = T.RotationTransform(37, 53, angle, expand=True)
+            # cv2 interpolates in fixed point, the pixels on the border of the rotated image differ more
+            self.assertImageClose(apply_tensor(tfm, image=image), tfm.apply_image(image), 2, 1.0, 0.05)
+            self.assertSegmentationClose(
+                apply_tensor(tfm, segmentation=segmentation), tfm.apply_segmentation(segmentation), 0.02
+            )
+        self.check_exact(T.RotationTransform(37, 53, 0, expand=True))
+
+    def test_color_conversions(self):
+        image = make_image()
+        for alpha, beta in [(1.0, 20.3), (1.0, -31.7), (0.63, 0.0), (1.41, 0.0)]:
+            tfm = ColorAugSSDTransform(img_format="BGR")
+            x = torch.from_numpy(image.transpose(2, 0, 1)).float()
+            out = _convert(x, alpha, beta).to(torch.uint8).numpy().transpose(1, 2, 0)
+            self.assertTrue(np.array_equal(out, tfm.convert(image, alpha, beta)))
+
+        x = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1))).float()
+        hsv = _bgr_to_hsv(x).to(torch.uint8).numpy().transpose(1, 2, 0)
+        expected = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        # the hue is circular
+        hue_diff = np.abs(hsv[:, :, 0].astype(np.int32) - expected[:, :, 0])
+        self.assertLessEqual(np.minimum(hue_diff, 180 - hue_diff).max(), 1)
+        self.assertImageClose(hsv[:, :, 1:], expected[:, :, 1:], 1, 0.1)
+        bgr = _hsv_to_bgr(torch.from_numpy(np.ascontiguousarray(expected.transpose(2, 0, 1))).float())
+        bgr = bgr.clamp(0, 255).to(torch.uint8).numpy().transpose(1, 2, 0)
+        self.assertImageClose(bgr, cv2.cvtColor(expected, cv2.COLOR_HSV2BGR), 2, 0.5)
+
+    def test_color_aug_ssd(self):
+        image = make_image()
+        for img_format in ["RGB", "BGR"]:
+            tfm = ColorAugSSDTransform(img_format=img_format)
+            for seed in range(8):
+                # the same random choices in the same order
+                random.seed(seed)
+                expected = tfm.apply_image(image)
+                random.seed(seed)
+                out = apply_tensor(tfm, image=image)
+                self.assertImageClose(out, expected, 4, 1.0, 0.02)
+            segmentation = make_segmentation()
+            self.assertTrue(np.array_equal(apply_tensor(tfm, segmentation=segmentation), segmentation))
+
+
+if __name__ == "__main__":
+    unittest.main()
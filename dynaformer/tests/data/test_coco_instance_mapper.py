@@ -0,0 +1,147 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import copy
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from PIL import Image
+
+from detectron2.data import transforms as T
+from detectron2.structures import BoxMode
+
+from dynaformer.data.batch_augmentation import BatchAugmentation
+from dynaformer.data.dataset_mappers.coco_instance_new_baseline_dataset_mapper import (
+    COCOInstanceNewBaselineDatasetMapper,
+    transform_masks,
+)
+
+
+def make_dataset_dict():
+    # polygons as (x, y) lists, in an image of 30*40
+    polygons = [
+        [[5.0, 5.0, 25.0, 5.0, 25.0, 20.0, 5.0, 20.0]],
+        [[28.0, 2.0, 38.0, 2.0, 38.0, 26.0]],
+        # two parts
+        [[2.0, 22.0, 12.0, 22.0, 12.0, 28.0, 2.0, 28.0], [16.0, 23.0, 24.0, 23.0, 20.0, 29.0]],
+    ]
+    annotations = []
+    for i, segmentation in enumerate(polygons):
+        points = np.concatenate(segmentation).reshape(-1, 2)
+        x0, y0 = points.min(0)
+        x1, y1 = points.max(0)
+        annotations.append(
+            {
+                "segmentation": segmentation,
+                "bbox": [x0, y0, x1 - x0, y1 - y0],
+                "bbox_mode": BoxMode.XYWH_ABS,
+                "category_id": i,
+                "iscrowd": 0,
+            }
+        )
+    return {"file_name": "image.jpg", "image_id": 1, "height": 30, "width": 40, "annotations": annotations}
+
+
+def mask_iou(a, b):
+    return (a & b).sum().item() / max((a | b).sum().item(), 1)
+
+
+class TestTransformMasks(unittest.TestCase):
+    def test_exact_transforms(self):
+        # flips and pads are exact for the nearest interpolation, masks past 8 use a second packed map
+        rng = np.random.RandomState(0)
+        masks = rng.rand(30, 40, 11) > 0.5
+        transforms = T.TransformList([T.HFlipTransform(40), T.VFlipTransform(30)])
+        out = transform_masks(masks, transforms)
+        self.assertEqual(out.dtype, bool)
+        self.assertEqual(out.shape, (11, 30, 40))
+        self.assertTrue(np.array_equal(out, masks.transpose(2, 0, 1)[:, ::-1, ::-1]))
+
+    def test_padding(self):
+        # the padding of FixedSizeCrop (255 for segmentations) is never inside a mask
+        masks = np.ones((30, 40, 9), dtype=bool)
+        image = np.zeros((30, 40, 3), dtype=np.uint8)
+        _, transforms = T.apply_transform_gens([T.FixedSizeCrop(crop_size=(64, 64))], image)
+        out = transform_masks(masks, transforms)
+        self.assertEqual(out.shape, (9, 64, 64))
+        self.assertTrue(out[:, :30, :40].all())
+        self.assertFalse(out[:, 30:].any())
+        self.assertFalse(out[:, :, 40:].any())
+
+    def test_same_as_polygons(self):
+        # the cached masks, rasterized at the original size and nearest-resampled, match the polygons
+        # rasterized at the augmented size up to the pixels of their boundaries
+        dataset_dict = make_dataset_dict()
+        image = np.zeros((30, 40, 3), dtype=np.uint8)
+        augmentations = [T.RandomFlip(prob=1.0), T.Resize((45, 60)), T.FixedSizeCrop(crop_size=(64, 64))]
+        image, transforms = T.apply_transform_gens(augmentations, image)
+        image_shape = image.shape[:2]
+
+        polygon_mapper = COCOInstanceNewBaselineDatasetMapper(is_train=True, tfm_gens=[], image_format="RGB")
+        cached_mapper = COCOInstanceNewBaselineDatasetMapper(
+            is_train=True, tfm_gens=[], image_format="RGB", mask_cache_mb=1
+        )
+        expected = copy.deepcopy(dataset_dict)
+        polygon_mapper.add_instances(expected, transforms, image_shape)
+        expected = expected["instances"]
+        for _ in range(2):
+            # a miss that fills the cache, then a hit
+            out = copy.deepcopy(dataset_dict)
+            cached_mapper.add_instances(out, transforms, image_shape)
+            out = out["instances"]
+
+            self.assertEqual(out.image_size, expected.image_size)
+            self.assertTrue(torch.equal(out.gt_classes, expected.gt_classes))
+            out_masks, expected_masks = out.gt_masks.bool(), expected.gt_masks.bool()
+            self.assertEqual(out_masks.shape, expected_masks.shape)
+            self.assertFalse(out_masks[:, 45:].any())
+            self.assertFalse(out_masks[:, :, 60:].any())
+            for a, b in zip(out_masks, expected_masks):
+                self.assertGreater(mask_iou(a, b), 0.8)
+            self.assertTrue(torch.allclose(out.gt_boxes.tensor, expected.gt_boxes.tensor, atol=2.0))
+        self.assertEqual((cached_mapper.mask_cache.hits, cached_mapper.mask_cache.misses), (1, 1))
+
+
+class TestPaddingMask(unittest.TestCase):
+    # the canvas padding of FixedSizeCrop is padding, the image scaled to 24*32 is not
+    augmentations = [
+        T.ResizeScale(min_scale=0.5, max_scale=0.5, target_height=64, target_width=64),
+        T.FixedSizeCrop(crop_size=(64, 64)),
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dataset_dict = make_dataset_dict()
+        self.dataset_dict["file_name"] = os.path.join(self.tmpdir.name, "image.jpg")
+        Image.fromarray(np.full((30, 40, 3), 128, dtype=np.uint8)).save(self.dataset_dict["file_name"])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_canvas(self, padding_mask):
+        self.assertEqual(padding_mask.dtype, torch.bool)
+        self.assertEqual(tuple(padding_mask.shape), (64, 64))
+        self.assertFalse(padding_mask[:24, :32].any())
+        self.assertTrue(padding_mask[24:].all())
+        self.assertTrue(padding_mask[:, 32:].all())
+
+    def test_lsj_canvas(self):
+        for reduced_decoding in [False, True]:
+            mapper = COCOInstanceNewBaselineDatasetMapper(
+                is_train=True, tfm_gens=self.augmentations, image_format="RGB", reduced_decoding=reduced_decoding
+            )
+            self.check_canvas(mapper(self.dataset_dict)["padding_mask"])
+
+    def test_lsj_canvas_batch_augmentation(self):
+        mapper = COCOInstanceNewBaselineDatasetMapper(
+            is_train=True, tfm_gens=self.augmentations, image_format="RGB", decode_only=True
+        )
+        (dataset_dict,) = BatchAugmentation(mapper, "cpu")([mapper(self.dataset_dict)])
+        self.check_canvas(dataset_dict["padding_mask"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import unittest
+from collections import defaultdict
+from unittest import mock
+import torch
+
+from dynaformer.data import loader_stats
+from dynaformer.data.loader_stats import STAGES, InstrumentedDataLoader, InstrumentedMapper, LoaderStats
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeStorage:
+    def __init__(self):
+        self.scalars = {}
+        self.histograms = defaultdict(list)
+
+    def put_scalar(self, name, value):
+        self.scalars[name] = value
+
+    def put_histogram(self, name, values):
+        self.histograms[name].append(values)
+
+
+class TestLoaderStats(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(loader_stats.time, "perf_counter", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sample_timings(self, stats, worker=0, index=0):
+        return dict(zip(STAGES, stats.timings[worker, index].tolist()))
+
+    def test_exclusive_stages(self):
+        stats = LoaderStats(num_workers=0)
+        stats.start_sample()
+        self.clock.advance(0.5)
+        with stats.stage("read"):
+            self.clock.advance(1)
+            with stats.stage("decode"):
+                self.clock.advance(2)
+                with stats.stage("transform"):
+                    self.clock.advance(4)
+                self.clock.advance(8)
+            with stats.stage("decode"):
+                self.clock.advance(16)
+            self.clock.advance(32)
+        with stats.stage("targets"):
+            self.clock.advance(64)
+        stats.end_sample(None)
+
+        timings = self.sample_timings(stats)
+        self.assertEqual(timings, {"read": 33, "decode": 26, "transform": 4, "targets": 64, "to_tensor": 0})
+        # the time outside of the stages is busy but in no stage
+        self.assertEqual(stats.counters[0].tolist(), [1, 127.5, 0])
+
+    def test_stage_outside_sample(self):
+        stats = LoaderStats(num_workers=0)
+        with stats.stage("read"):
+            self.clock.advance(1)
+        self.assertEqual(stats.timings.abs().sum().item(), 0)
+
+    def test_mapper_raises(self):
+        stats = LoaderStats(num_workers=0)
+
+        def mapper(dataset_dict):
+            with stats.stage("read"):
+                self.clock.advance(1)
+            if dataset_dict["fail"]:
+                raise ValueError("corrupted image")
+            with stats.stage("decode"):
+                self.clock.advance(2)
+            return {"image": torch.zeros(3, 4, 5, dtype=torch.uint8)}
+
+        mapper = InstrumentedMapper(mapper, stats)
+        with self.assertRaises(ValueError):
+            mapper({"fail": True})
+        # the failed sample is not counted, and its timings are dropped
+        self.assertEqual(stats.counters[0, 0].item(), 0)
+        self.assertIsNone(stats._sample_timings)
+        with stats.stage("read"):
+            self.clock.advance(100)
+
+        mapper({"fail": False})
+        self.assertEqual(stats.counters[0].tolist(), [1, 3, 60])
+        timings = self.sample_timings(stats)
+        self.assertEqual((timings["read"], timings["decode"]), (1, 2))
+
+    def test_publish_ring_buffer(self):
+        capacity = 4
+        stats = LoaderStats(num_workers=2, capacity=capacity)
+        # the read time of sample n of worker w is n + 100 * w, at index n % capacity of the ring buffer
+        num_samples = [5, 9]
+        for worker, n in enumerate(num_samples):
+            for i in range(n):
+                stats.timings[worker, i % capacity, 0] = i + 100 * worker
+        last_counters = torch.tensor([[2, 1.0, 100], [0, 0.0, 0]], dtype=torch.float64)
+        counters = torch.tensor([[5, 3.0, 400], [9, 2.0, 500]], dtype=torch.float64)
+        stats.counters.copy_(counters)
+
+        storage = FakeStorage()
+        loader = InstrumentedDataLoader([], stats)
+        loader.publish(storage, last_counters, counters, elapsed=4.0, num_consumed=10, num_batches=2)
+
+        # samples 2 to 4 of worker 0 wrap around the end of the ring buffer, only the last `capacity`
+        # samples 5 to 8 of worker 1 are still in it
+        (read_ms,) = storage.histograms["loader/read_ms"]
+        self.assertEqual(read_ms.tolist(), [x * 1000 for x in [2, 3, 4, 105, 106, 107, 108]])
+        self.assertAlmostEqual(storage.scalars["loader/read_time"], 435 / 7, places=4)
+        self.assertEqual(storage.scalars["loader/queue_depth"], 4)
+        self.assertEqual(storage.scalars["loader/worker0_utilization"], 0.5)
+        self.assertEqual(storage.scalars["loader/worker1_utilization"], 0.5)
+        self.assertEqual(storage.scalars["loader/bytes_per_batch"], 400)
+
+        # nothing mapped since the last report
+        storage = FakeStorage()
+        loader.publish(storage, counters, counters, elapsed=1.0, num_consumed=14, num_batches=1)
+        self.assertEqual(len(storage.histograms), 0)
+        self.assertEqual(storage.scalars["loader/queue_depth"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import multiprocessing as mp
+import unittest
+
+from dynaformer.data.mask_cache import SharedMaskCache
+
+
+def _put(cache, key, value):
+    cache.put(key, value)
+
+
+class TestSharedMaskCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = SharedMaskCache(1, slot_size=64)
+        self.assertEqual(cache.num_slots, 1024 * 1024 // 64)
+        self.assertIsNone(cache.get(3))
+        self.assertTrue(cache.put(3, b"abc"))
+        self.assertEqual(cache.get(3), b"abc")
+        # replaced in place
+        self.assertTrue(cache.put(3, b"de"))
+        self.assertEqual(cache.get(3), b"de")
+        self.assertTrue(cache.put(4, b""))
+        self.assertEqual(cache.get(4), b"")
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        self.assertAlmostEqual(cache.hit_rate(), 0.75)
+
+    def test_eviction(self):
+        cache = SharedMaskCache(1 / 1024, slot_size=256)
+        self.assertEqual(cache.num_slots, 4)
+        self.assertTrue(cache.put(1, b"one"))
+        self.assertTrue(cache.put(2, b"two"))
+        # same slot as 1
+        self.assertTrue(cache.put(5, b"five"))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(5), b"five")
+        self.assertEqual(cache.get(2), b"two")
+        # values larger than a slot are not cached and do not evict
+        self.assertFalse(cache.put(9, bytes(257)))
+        self.assertEqual(cache.get(5), b"five")
+        self.assertIsNone(cache.get(9))
+
+    def test_write_in_progress(self):
+        cache = SharedMaskCache(1 / 1024, slot_size=256)
+        cache.put(2, b"two")
+        # a read racing with a write of the slot is a miss
+        cache.header[2, 2] += 1
+        self.assertIsNone(cache.get(2))
+        cache.header[2, 2] += 1
+        self.assertEqual(cache.get(2), b"two")
+
+    def test_shared_with_workers(self):
+        cache = SharedMaskCache(1 / 1024, slot_size=256)
+        worker = mp.get_context("fork").Process(target=_put, args=(cache, 7, b"from worker"))
+        worker.start()
+        worker.join()
+        self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(cache.get(7), b"from worker")
+
+
+if __name__ == "__main__":
+    unittest.main()
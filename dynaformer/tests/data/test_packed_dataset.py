@@ -0,0 +1,101 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from PIL import Image
+
+from detectron2.utils.file_io import PathManager
+
+from dynaformer.data.dataset_mappers.polyp_ins_semantic_dataset_mapper import PolypInsSemanticDatasetMapper
+from dynaformer.data.datasets.register_polypdb_packed import (
+    PACKED_PREFIX,
+    PackWriter,
+    is_packed_path,
+    load_packed_dataset,
+    read_packed_mask,
+)
+
+
+def make_polyp(height=13, width=21):
+    """
+    An image and its mask, with a size that is not a multiple of 8 so that the bits of the mask do not
+    fill its last byte.
+    """
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=bool)
+    mask[3:9, 5:17] = True
+    mask[10, 0] = True
+    return image, mask
+
+
+class TestPackedDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pack_dir = os.path.join(self.tmpdir.name, "pack")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        blobs = [rng.bytes(n) for n in [10, 30, 1, 25]]
+        masks = [rng.rand(h, w) > 0.5 for h, w in [(5, 7), (8, 8), (1, 1), (13, 21)]]
+
+        # shards of 32 bytes: the blobs are spread over several shards
+        writer = PackWriter(self.pack_dir, shard_size=32)
+        dataset_dicts = []
+        for i, (blob, mask) in enumerate(zip(blobs, masks)):
+            dataset_dicts.append(
+                {"file_name": writer.add(blob), "sem_seg_file_name": writer.add_mask(mask), "image_id": i}
+            )
+        writer.close(dataset_dicts)
+        self.assertGreater(len(set(row[0] for row in writer.index)), 1)
+
+        loaded = load_packed_dataset(self.pack_dir)
+        self.assertEqual(len(loaded), len(blobs))
+        for d, blob, mask in zip(loaded, blobs, masks):
+            for key in ("file_name", "sem_seg_file_name"):
+                self.assertTrue(is_packed_path(d[key]))
+                self.assertTrue(d[key].startswith(PACKED_PREFIX + os.path.abspath(self.pack_dir) + "/"))
+                self.assertTrue(PathManager.exists(d[key]))
+                self.assertTrue(PathManager.isfile(d[key]))
+            with PathManager.open(d["file_name"], "rb") as f:
+                self.assertEqual(f.read(), blob)
+            packed_mask = read_packed_mask(d["sem_seg_file_name"])
+            self.assertEqual(packed_mask.dtype, np.uint8)
+            self.assertTrue(np.array_equal(packed_mask, mask.astype(np.uint8) * 255))
+        out_of_range = "{}{}/{}".format(PACKED_PREFIX, os.path.abspath(self.pack_dir), len(writer.index))
+        self.assertFalse(PathManager.exists(out_of_range))
+
+    def test_semantic_mapper_packed_mask(self):
+        # the binarized mask of a packed dataset (H*W) gives the labels of the RGB mask file
+        image, mask = make_polyp()
+        image_file = os.path.join(self.tmpdir.name, "image.png")
+        mask_file = os.path.join(self.tmpdir.name, "mask.png")
+        Image.fromarray(image).save(image_file)
+        Image.fromarray(np.repeat(mask[:, :, None].astype(np.uint8) * 255, 3, axis=2)).save(mask_file)
+
+        writer = PackWriter(self.pack_dir)
+        writer.close([{"file_name": writer.add_file(image_file), "sem_seg_file_name": writer.add_mask(mask)}])
+        packed = load_packed_dataset(self.pack_dir)[0]
+
+        mapper = PolypInsSemanticDatasetMapper(
+            is_train=True, augmentations=[], image_format="RGB", ignore_label=255, size_divisibility=0
+        )
+        expected = mapper({"file_name": image_file, "sem_seg_file_name": mask_file})
+        out = mapper(packed)
+        self.assertTrue(torch.equal(out["image"], expected["image"]))
+        self.assertTrue(torch.equal(out["sem_seg"], expected["sem_seg"]))
+        self.assertTrue(torch.equal(out["instances"].gt_classes, expected["instances"].gt_classes))
+        self.assertTrue(torch.equal(out["instances"].gt_masks, expected["instances"].gt_masks))
+        self.assertTrue(torch.equal(out["instances"].gt_boxes.tensor, expected["instances"].gt_boxes.tensor))
+
+
+if __name__ == "__main__":
+    unittest.main()
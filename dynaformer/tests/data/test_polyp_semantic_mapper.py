@@ -0,0 +1,97 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from PIL import Image
+
+from detectron2.data import transforms as T
+from detectron2.structures import BitMasks
+
+from dynaformer.data.dataset_mappers.polyp_ins_semantic_dataset_mapper import (
+    PolypInsSemanticDatasetMapper,
+    masks_to_boxes,
+)
+
+
+class TestMasksToBoxes(unittest.TestCase):
+    def test_same_as_bitmasks(self):
+        rng = np.random.RandomState(0)
+        masks = torch.from_numpy(rng.rand(6, 17, 23) > 0.97)
+        # empty, full, single pixel at a corner, one row
+        masks[0] = False
+        masks[1] = True
+        masks[2] = False
+        masks[2, 16, 22] = True
+        masks[3] = False
+        masks[3, 5, 3:9] = True
+        expected = BitMasks(masks).get_bounding_boxes().tensor
+        self.assertTrue(torch.equal(masks_to_boxes(masks), expected))
+        self.assertEqual(masks_to_boxes(masks[:0]).shape, (0, 4))
+
+
+class TestPolypSemanticMapper(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        height, width = 24, 30
+        self.image_file = os.path.join(self.tmpdir.name, "image.png")
+        Image.fromarray(rng.randint(0, 256, size=(height, width, 3), dtype=np.uint8)).save(self.image_file)
+        # gray levels around the threshold, R = G = B so that the mean of the channels is the luma
+        gray = rng.choice(np.array([0, 100, 128, 129, 200, 255], dtype=np.uint8), size=(height, width))
+        gray[5:15, 8:20] = 255
+        self.mask_files = {
+            "RGB": os.path.join(self.tmpdir.name, "mask_rgb.png"),
+            "L": os.path.join(self.tmpdir.name, "mask_l.png"),
+        }
+        Image.fromarray(np.repeat(gray[:, :, None], 3, axis=2)).save(self.mask_files["RGB"])
+        Image.fromarray(gray).save(self.mask_files["L"])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_same_targets(self, size_divisibility):
+        augmentations = [T.ResizeShortestEdge((16, 20), max_size=100, sample_style="choice"), T.RandomFlip()]
+        mappers = [
+            PolypInsSemanticDatasetMapper(
+                is_train=True,
+                augmentations=augmentations,
+                image_format="RGB",
+                ignore_label=255,
+                size_divisibility=size_divisibility,
+                uint8_targets=uint8_targets,
+            )
+            for uint8_targets in [False, True]
+        ]
+        for mask_format, mask_file in self.mask_files.items():
+            for seed in range(4):
+                outputs = []
+                for mapper in mappers:
+                    np.random.seed(seed)
+                    outputs.append(mapper({"file_name": self.image_file, "sem_seg_file_name": mask_file}))
+                legacy, out = outputs
+                msg = "{} mask, seed {}".format(mask_format, seed)
+                self.assertEqual(out["sem_seg"].dtype, torch.uint8)
+                self.assertTrue(torch.equal(out["image"], legacy["image"]), msg)
+                self.assertTrue(torch.equal(out["sem_seg"].long(), legacy["sem_seg"]), msg)
+                if size_divisibility > 0:
+                    self.assertTrue(torch.equal(out["padding_mask"], legacy["padding_mask"]), msg)
+                out, legacy = out["instances"], legacy["instances"]
+                self.assertEqual(out.image_size, legacy.image_size)
+                self.assertTrue(torch.equal(out.gt_classes, legacy.gt_classes), msg)
+                self.assertTrue(torch.equal(out.gt_masks, legacy.gt_masks), msg)
+                self.assertTrue(torch.equal(out.gt_boxes.tensor, legacy.gt_boxes.tensor), msg)
+
+    def test_uint8_targets(self):
+        self.check_same_targets(0)
+
+    def test_uint8_targets_padded(self):
+        self.check_same_targets(32)
+
+
+if __name__ == "__main__":
+    unittest.main()
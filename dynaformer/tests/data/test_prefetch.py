@@ -0,0 +1,84 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import unittest
+from unittest import mock
+import torch
+
+from detectron2.structures import Instances
+
+from dynaformer.data.prefetch import PrefetchDataLoader, collate_batch
+
+
+def make_batch(sizes, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batch = []
+    for i, (h, w) in enumerate(sizes):
+        instances = Instances((h, w))
+        instances.gt_masks = torch.rand((i + 1, h, w), generator=generator) > 0.5
+        instances.gt_classes = torch.zeros(i + 1, dtype=torch.int64)
+        image = torch.randint(0, 256, (3, h, w), dtype=torch.uint8, generator=generator)
+        batch.append({"image": image, "instances": instances})
+    return batch
+
+
+class FailingLoader:
+    def __iter__(self):
+        yield make_batch([(8, 8)])
+        raise RuntimeError("worker died")
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_collate_batch(self):
+        batch = make_batch([(10, 12), (7, 15)])
+        images = [d["image"] for d in batch]
+        masks = [d["instances"].gt_masks for d in batch]
+        collated = collate_batch(batch)
+        self.assertEqual(collated.image_sizes, [(10, 12), (7, 15)])
+        self.assertEqual(tuple(collated.images.shape), (2, 3, 10, 15))
+        self.assertEqual(collated.num_instances, [1, 2])
+        self.assertEqual(tuple(collated.gt_masks.shape), (3, 10, 15))
+        start = 0
+        for i, (image, m) in enumerate(zip(images, masks)):
+            h, w = image.shape[-2:]
+            self.assertTrue(torch.equal(collated.images[i, :, :h, :w], image))
+            self.assertFalse(collated.images[i, :, h:].any())
+            self.assertFalse(collated.images[i, :, :, w:].any())
+            self.assertTrue(torch.equal(collated.gt_masks[start : start + len(m), :h, :w], m))
+            self.assertFalse(collated.gt_masks[start : start + len(m), h:].any())
+            start += len(m)
+            self.assertFalse(collated[i]["instances"].has("gt_masks"))
+
+    def test_order(self):
+        batches = [make_batch([(8, 6 + i)], seed=i) for i in range(5)]
+        images = [b[0]["image"].clone() for b in batches]
+        out = list(PrefetchDataLoader(batches, "cpu"))
+        self.assertEqual(len(out), len(batches))
+        for collated, image in zip(out, images):
+            self.assertTrue(torch.equal(collated.images[0], image))
+
+    def test_error(self):
+        data_loader = iter(PrefetchDataLoader(FailingLoader(), "cpu"))
+        next(data_loader)
+        with self.assertRaisesRegex(RuntimeError, "worker died"):
+            next(data_loader)
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_copy_in_flight(self):
+        # the copy of the next batch is issued before the current batch is yielded
+        batches = [make_batch([(8, 6 + i)], seed=i) for i in range(3)]
+        images = [b[0]["image"].clone() for b in batches]
+        prefetch = PrefetchDataLoader(batches, "cuda")
+        with mock.patch.object(PrefetchDataLoader, "_next", autospec=True, side_effect=PrefetchDataLoader._next) as m:
+            data_loader = iter(prefetch)
+            first = next(data_loader)
+            self.assertEqual(m.call_count, 2)
+            out = [first] + list(data_loader)
+        for collated, image in zip(out, images):
+            self.assertEqual(collated.images.device.type, "cuda")
+            self.assertTrue(torch.equal(collated.images[0].cpu(), image))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+
+from dynaformer.data.shared_dataset import SharedSerializedList, build_shared_dataset, write_serialized_list
+
+
+def make_dicts():
+    return [
+        {"file_name": "a.jpg", "height": 10, "width": 20, "annotations": [{"bbox": [1, 2, 3, 4], "category_id": 0}]},
+        {"file_name": "b.jpg", "height": 30, "width": 40, "annotations": []},
+        # empty items and large items
+        {},
+        {"file_name": "c.jpg", "segmentation": list(range(10000))},
+        {"file_name": "d.jpg", "mask": np.arange(12, dtype=np.uint8).reshape(3, 4)},
+    ]
+
+
+class TestSharedDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "dataset.bin")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def assertSameDicts(self, lst, expected):
+        self.assertEqual(len(lst), len(expected))
+        for i, d in enumerate(expected):
+            item = lst[i]
+            self.assertEqual(set(item), set(d))
+            for k, v in d.items():
+                if isinstance(v, np.ndarray):
+                    self.assertTrue(np.array_equal(item[k], v))
+                else:
+                    self.assertEqual(item[k], v)
+
+    def test_round_trip(self):
+        dicts = make_dicts()
+        write_serialized_list(dicts, self.path)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        lst = SharedSerializedList(self.path)
+        self.assertSameDicts(lst, dicts)
+        self.assertEqual(lst.nbytes, os.path.getsize(self.path))
+        # header: number of items, n + 1 offsets, then the pickled items
+        n = len(dicts)
+        header = np.fromfile(self.path, dtype=np.int64, count=n + 2)
+        self.assertEqual(header[0], n)
+        self.assertEqual(header[1], 0)
+        self.assertEqual(lst.nbytes, 8 * (n + 2) + header[-1])
+        # iterated like a list
+        self.assertEqual(len(list(lst)), n)
+
+    def test_empty(self):
+        write_serialized_list([], self.path)
+        lst = SharedSerializedList(self.path)
+        self.assertEqual(len(lst), 0)
+        with self.assertRaises(IndexError):
+            lst[0]
+
+    def test_pickle(self):
+        # the data loader workers receive the list pickled, and map the file again
+        dicts = make_dicts()
+        write_serialized_list(dicts, self.path)
+        lst = SharedSerializedList(self.path)
+        data = pickle.dumps(lst)
+        self.assertLess(len(data), 1024)
+        copy = pickle.loads(data)
+        self.assertEqual(copy.path, self.path)
+        self.assertSameDicts(copy, dicts)
+
+    def test_build_shared_dataset(self):
+        dicts = make_dicts()
+        lst = build_shared_dataset(lambda: dicts, self.tmpdir.name)
+        self.assertEqual(os.path.dirname(lst.path), self.tmpdir.name)
+        self.assertSameDicts(lst, dicts)
+
+
+if __name__ == "__main__":
+    unittest.main()
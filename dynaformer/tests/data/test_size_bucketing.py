@@ -0,0 +1,76 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import random
+import unittest
+from types import SimpleNamespace
+
+from dynaformer.data.size_bucketing import SizeBucketedDataset
+
+
+def make_dict(idx, height, width):
+    return {"id": idx, "image": SimpleNamespace(shape=(3, height, width))}
+
+
+def stream(dicts, arrivals):
+    """
+    The dicts as the batches of size 1 of a data loader, `arrivals` records the ids of the dicts read.
+    """
+    for d in dicts:
+        arrivals.append(d["id"])
+        yield [d]
+
+
+class TestSizeBucketedDataset(unittest.TestCase):
+    def test_full_buckets(self):
+        dicts = [make_dict(i, h, w) for i, (h, w) in enumerate([(60, 60), (100, 120), (64, 50), (128, 128)])]
+        dataset = SizeBucketedDataset([[d] for d in dicts], batch_size=2, bucket_size=64, max_buffer=8)
+        batches = [[d["id"] for d in batch] for batch in dataset]
+        self.assertEqual(batches, [[0, 2], [1, 3]])
+
+    def test_eviction_order(self):
+        # a full buffer yields the oldest dict with the dicts of the nearest sizes
+        sizes = [(64, 64), (320, 320), (64, 100), (300, 64), (50, 50)]
+        dicts = [make_dict(i, h, w) for i, (h, w) in enumerate(sizes)]
+        dataset = SizeBucketedDataset([[d] for d in dicts], batch_size=2, bucket_size=64, max_buffer=3)
+        batches = [[d["id"] for d in batch] for batch in dataset]
+        # at the arrival of 2, 0 is batched with 2 (padded to 64*128) rather than 1 (320*320). At the
+        # arrival of 4, 1 is batched with 3 or 4 (both padded to 320*320), the oldest one
+        self.assertEqual(batches, [[0, 2], [1, 3]])
+        self.assertEqual([d["id"] for bucket in dataset._buckets.values() for _, d in bucket], [4])
+
+    def test_bounded_delay(self):
+        # an image of a rare size is not held forever by the full buckets of a frequent size
+        batch_size, max_buffer = 4, 8
+        dicts = [make_dict(0, 500, 300)] + [make_dict(i, 64, 64) for i in range(1, 100)]
+        arrivals = []
+        dataset = SizeBucketedDataset(stream(dicts, arrivals), batch_size, 64, max_buffer)
+        for batch in dataset:
+            if any(d["id"] == 0 for d in batch):
+                break
+        else:
+            self.fail("the dict of the rare size is never yielded")
+        self.assertLessEqual(len(arrivals) - 1, max_buffer + batch_size)
+
+    def test_yielded_once(self):
+        rng = random.Random(0)
+        batch_size, max_buffer = 4, 16
+        dicts = [make_dict(i, rng.randint(100, 1024), rng.randint(100, 1024)) for i in range(2000)]
+        arrivals = []
+        dataset = SizeBucketedDataset(stream(dicts, arrivals), batch_size, 128, max_buffer)
+        yielded = []
+        for batch in dataset:
+            self.assertEqual(len(batch), batch_size)
+            for d in batch:
+                self.assertLessEqual(len(arrivals) - 1 - d["id"], max_buffer + batch_size)
+                yielded.append(d["id"])
+        self.assertEqual(len(yielded), len(set(yielded)))
+        # the dicts not yielded are the ones still held at the end of the stream
+        held = [d["id"] for bucket in dataset._buckets.values() for _, d in bucket]
+        self.assertLess(len(held), max_buffer)
+        self.assertEqual(sorted(yielded + held), list(range(len(dicts))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import unittest
+import torch
+from torch import nn
+
+from detectron2.structures import ImageList
+
+from dynaformer.modeling.distiller import KnowledgeDistiller, teacher_targets, valid_size
+from dynaformer.modeling.matcher import HungarianMatcher
+
+
+class IdentityMatcher(nn.Module):
+    def forward(self, outputs, targets):
+        n = len(targets[0]["labels"])
+        return [(torch.arange(n), torch.arange(n))]
+
+
+def random_outputs(num_queries, num_classes, mask_size, feature_dim=4, feature_size=(2, 3)):
+    # normalized cxcywh boxes inside the image
+    centers = torch.rand(1, num_queries, 2) * 0.5 + 0.25
+    sizes = torch.rand(1, num_queries, 2) * 0.3 + 0.1
+    return {
+        "pred_logits": torch.randn(1, num_queries, num_classes) * 3,
+        "pred_boxes": torch.cat([centers, sizes], -1),
+        "pred_masks": torch.randn(1, num_queries, *mask_size) * 5,
+        "multi_scale_features": [torch.randn(1, feature_dim, *feature_size)],
+    }
+
+
+def pad_outputs(outputs, mask_size, feature_size):
+    """
+    The outputs of the same image predicted in a padded batch: the maps are padded with garbage.
+    """
+    padded = dict(outputs)
+    masks = torch.full(outputs["pred_masks"].shape[:2] + mask_size, 50.0)
+    h, w = outputs["pred_masks"].shape[-2:]
+    masks[..., :h, :w] = outputs["pred_masks"]
+    padded["pred_masks"] = masks
+    features = []
+    for feature in outputs["multi_scale_features"]:
+        f = torch.full(feature.shape[:2] + feature_size, -50.0)
+        f[..., : feature.shape[-2], : feature.shape[-1]] = feature
+        features.append(f)
+    padded["multi_scale_features"] = features
+    return padded
+
+
+class TestDistiller(unittest.TestCase):
+    def test_valid_size(self):
+        self.assertEqual(valid_size((32, 32), (32, 32), (8, 8)), (8, 8))
+        self.assertEqual(valid_size((16, 24), (32, 32), (8, 8)), (4, 6))
+        # partially covered cells are kept
+        self.assertEqual(valid_size((17, 24), (32, 32), (8, 8)), (5, 6))
+
+    def test_teacher_targets(self):
+        torch.manual_seed(0)
+        outputs = {
+            "pred_logits": torch.randn(2, 5, 3),
+            "pred_boxes": torch.rand(2, 5, 4),
+            "pred_masks": torch.randn(2, 5, 8, 8),
+            "multi_scale_features": [torch.randn(2, 4, 4, 4)],
+        }
+        images = ImageList(torch.zeros(2, 3, 32, 32), [(32, 32), (17, 24)])
+        targets = teacher_targets(outputs, images, num_queries=2, memory=True)
+
+        self.assertEqual(len(targets), 2)
+        for b, (target, mask_size, memory_size) in enumerate(
+            zip(targets, [(8, 8), (5, 6)], [(4, 4), (3, 3)])
+        ):
+            scores = outputs["pred_logits"][b].sigmoid().max(-1)[0]
+            top_scores, top = scores.topk(2)
+            self.assertTrue(torch.allclose(target["scores"], top_scores))
+            self.assertTrue(torch.equal(target["logits"], outputs["pred_logits"][b, top]))
+            self.assertTrue(torch.equal(target["labels"], outputs["pred_logits"][b, top].argmax(-1)))
+            self.assertTrue(torch.equal(target["boxes"], outputs["pred_boxes"][b, top]))
+            self.assertEqual(target["masks"].dtype, torch.float16)
+            self.assertEqual(tuple(target["masks"].shape), (2,) + mask_size)
+            self.assertTrue(
+                torch.equal(
+                    target["masks"],
+                    outputs["pred_masks"][b, top, : mask_size[0], : mask_size[1]].half(),
+                )
+            )
+            self.assertEqual(len(target["memory"]), 1)
+            self.assertEqual(tuple(target["memory"][0].shape), (4,) + memory_size)
+
+    def test_padding_invariance(self):
+        # an image alone and in a padded batch gets the same targets and the same losses
+        torch.manual_seed(0)
+        mask_size = (4, 6)
+        teacher = random_outputs(6, 3, mask_size)
+        student = random_outputs(6, 3, mask_size, feature_dim=8)
+        images = ImageList(torch.zeros(1, 3, 16, 24), [(16, 24)])
+        padded_images = ImageList(torch.zeros(1, 3, 32, 32), [(16, 24)])
+        padded_teacher = pad_outputs(teacher, (8, 8), (4, 4))
+        padded_student = pad_outputs(student, (8, 8), (4, 4))
+
+        targets = teacher_targets(teacher, images, num_queries=4, memory=True)
+        padded_targets = teacher_targets(padded_teacher, padded_images, num_queries=4, memory=True)
+        for target, padded_target in zip(targets, padded_targets):
+            for k in ["logits", "labels", "scores", "boxes", "masks"]:
+                self.assertTrue(torch.equal(target[k], padded_target[k]), k)
+            self.assertTrue(torch.equal(target["memory"][0], padded_target["memory"][0]))
+
+        matcher = HungarianMatcher(
+            cost_class=2.0, cost_mask=5.0, cost_dice=5.0, num_points=64, cost_box=5.0, cost_giou=2.0
+        )
+        distiller = KnowledgeDistiller(matcher, num_points=64, student_memory_dim=8, memory_dim=4)
+        torch.manual_seed(1)
+        losses = distiller(student, images, targets)
+        torch.manual_seed(1)
+        padded_losses = distiller(padded_student, padded_images, padded_targets)
+        self.assertEqual(set(losses), set(padded_losses))
+        self.assertIn("loss_kd_memory", losses)
+        for k in losses:
+            self.assertTrue(torch.allclose(losses[k], padded_losses[k], atol=1e-6), k)
+
+    def test_score_weighting(self):
+        torch.manual_seed(0)
+        boxes = torch.tensor([[0.5, 0.5, 0.2, 0.2], [0.3, 0.3, 0.1, 0.2]])
+        masks = torch.randn(2, 4, 4)
+        target = {
+            "logits": torch.randn(2, 3),
+            "labels": torch.tensor([0, 1]),
+            # the second teacher query only teaches the class
+            "scores": torch.tensor([1.0, 0.0]),
+            "boxes": boxes,
+            "masks": masks.half(),
+        }
+        images = ImageList(torch.zeros(1, 3, 16, 16), [(16, 16)])
+        distiller = KnowledgeDistiller(IdentityMatcher(), num_points=16)
+
+        def losses(student_boxes):
+            outputs = {
+                "pred_logits": torch.randn(1, 2, 3),
+                "pred_boxes": student_boxes[None],
+                "pred_masks": masks.half().float()[None],
+            }
+            return distiller(outputs, images, [target])
+
+        # wrong box on the query of zero score: no box loss
+        out = losses(torch.stack([boxes[0], boxes[1] + 0.1]))
+        self.assertAlmostEqual(out["loss_kd_bbox"].item(), 0.0, places=6)
+        # up to the epsilons of generalized_box_iou
+        self.assertAlmostEqual(out["loss_kd_giou"].item(), 0.0, places=4)
+        # wrong box on the query of score 1: its full L1 loss
+        out = losses(torch.stack([boxes[0] + 0.1, boxes[1]]))
+        self.assertAlmostEqual(out["loss_kd_bbox"].item(), 0.4, places=5)
+        self.assertGreater(out["loss_kd_giou"].item(), 0.0)
+        self.assertNotIn("loss_kd_memory", out)
+
+
+if __name__ == "__main__":
+    unittest.main()
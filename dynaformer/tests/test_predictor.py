@@ -0,0 +1,58 @@
+# ------------------------------------------------------------------------
+# DYNAFormer
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+import os
+import sys
+import unittest
+import torch
+
+from detectron2.structures import Instances
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "demo"))
+from predictor import AsyncPredictor, SharedMemoryRing  # noqa: E402
+
+
+def make_predictions():
+    instances = Instances((20, 30))
+    instances.pred_masks = torch.rand(3, 20, 30) > 0.5
+    return {
+        "instances": instances,
+        "sem_seg": torch.rand(2, 20, 30),
+        "panoptic_seg": (torch.randint(0, 5, (20, 30), dtype=torch.int32), [{"id": 1}]),
+    }
+
+
+class TestSharedMemoryRing(unittest.TestCase):
+    def test_round_trip(self):
+        ring = SharedMemoryRing(2, 20 * 30 * 3, 20 * 30 * 16)
+        predictions = make_predictions()
+        slot = ring.acquire()
+        res = ring.read_predictions(slot, ring.write_predictions(slot, predictions))
+        self.assertTrue(torch.equal(res["instances"].pred_masks, predictions["instances"].pred_masks))
+        self.assertTrue(torch.equal(res["sem_seg"], predictions["sem_seg"]))
+        self.assertTrue(torch.equal(res["panoptic_seg"][0], predictions["panoptic_seg"][0]))
+        ring.close()
+
+    def test_shutdown_copies_held_result(self):
+        # without the processes of the workers, the result of a worker is read from the ring by get()
+        predictor = AsyncPredictor.__new__(AsyncPredictor)
+        predictor.procs = []
+        predictor.ring = SharedMemoryRing(2, 20 * 30 * 3, 20 * 30 * 16)
+        predictor._held_slot = predictor._held_result = None
+        predictions = make_predictions()
+        slot = predictor.ring.acquire()
+        res = predictor.ring.read_predictions(slot, predictor.ring.write_predictions(slot, predictions))
+        res = predictor._finish(slot, res)
+        sem_seg = res["sem_seg"]
+
+        predictor.shutdown()
+        self.assertIsNone(predictor.ring)
+        # the result and the tensors taken from it are still valid after the ring is unmapped
+        self.assertTrue(torch.equal(sem_seg, predictions["sem_seg"]))
+        self.assertTrue(torch.equal(res["instances"].pred_masks, predictions["instances"].pred_masks))
+        self.assertTrue(torch.equal(res["panoptic_seg"][0], predictions["panoptic_seg"][0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Time to load the dataset dicts of the training and test datasets of a config without the annotation
+cache, with a cold cache (parsed and written) and with a warm cache (read):
+python tools/benchmark_annotation_cache.py --config-file CONFIG_FILE
+"""
+import logging
+import os
+import tempfile
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def load_time(dataset_name, cache_dir):
+    """
+    Returns:
+        (float, int): seconds to get the dataset dicts with the cache in `cache_dir` ("" to disable it)
+            and their number
+    """
+    os.environ["DETECTRON2_ANNOTATION_CACHE"] = cache_dir
+    start = time.perf_counter()
+    num_dicts = len(DatasetCatalog.get(dataset_name))
+    return time.perf_counter() - start, num_dicts
+
+
+def main():
+    args = default_argument_parser().parse_args()
+    cfg = setup(args)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for dataset_name in list(cfg.DATASETS.TRAIN) + list(cfg.DATASETS.TEST):
+            uncached, num_dicts = load_time(dataset_name, "")
+            cold, _ = load_time(dataset_name, cache_dir)
+            warm, _ = load_time(dataset_name, cache_dir)
+            rows.append([dataset_name, num_dicts, uncached, cold, warm, uncached / warm])
+            logger.info("{}: {} dicts, uncached {:.2f} s, cold {:.2f} s, warm {:.2f} s".format(*rows[-1]))
+    logger.info(
+        "Loading of the dataset dicts:\n"
+        + tabulate(
+            rows,
+            headers=["dataset", "dicts", "uncached (s)", "cold (s)", "warm (s)", "speedup"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of the queue and shared memory transports of AsyncPredictor:
+python tools/benchmark_async_predictor.py --config-file CONFIG_FILE \
+    --num-frames 300 --frame-size 1080 1920 --num-gpus 1 MODEL.WEIGHTS /path/to/model.pth
+"""
+import argparse
+import logging
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from detectron2.config import get_cfg
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'demo'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from predictor import AsyncPredictor
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    return cfg
+
+
+def run(cfg, args, shared_memory):
+    predictor = AsyncPredictor(cfg, num_gpus=args.num_gpus, shared_memory=shared_memory)
+    height, width = args.frame_size
+    frames = [
+        np.random.randint(0, 255, (height, width, 3), dtype=np.uint8) for _ in range(8)
+    ]
+    buffer_size = predictor.default_buffer_size
+
+    # warm up the workers (model building, cudnn autotuning)
+    for frame in frames:
+        predictor(frame)
+
+    start = time.perf_counter()
+    num_pending = 0
+    for i in range(args.num_frames):
+        predictor.put(frames[i % len(frames)])
+        num_pending += 1
+        if num_pending > buffer_size:
+            predictor.get()
+            num_pending -= 1
+    while num_pending:
+        predictor.get()
+        num_pending -= 1
+    elapsed = time.perf_counter() - start
+    predictor.shutdown()
+    return args.num_frames / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AsyncPredictor transport benchmark")
+    parser.add_argument("--config-file", metavar="FILE", required=True)
+    parser.add_argument("--num-frames", type=int, default=300)
+    parser.add_argument("--frame-size", type=int, nargs=2, default=[1080, 1920])
+    parser.add_argument("--num-gpus", type=int, default=1, help="0 runs one worker on CPU")
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+    setup_logger()
+    cfg = setup(args)
+
+    for name, shared_memory in [("queue", False), ("shared_memory", True)]:
+        fps = run(cfg, args, shared_memory)
+        logger.info("transport={}: {:.2f} frames/s".format(name, fps))
+
+
+if __name__ == "__main__":
+    mp.set_start_method("spawn", force=True)
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of the backbone of a config, and the latency of each of its stages:
+python tools/benchmark_backbone.py --config-file CONFIG_FILE --device cpu --input-size 1024 1024 \
+    --batch-size 1 --channels-last MODEL.WEIGHTS /path/to/model.pth
+With --fuse, the inference-only fused blocks of FocalNet are used, and --check-parity compares
+their outputs with the original blocks.
+"""
+import argparse
+import copy
+import logging
+import time
+from collections import defaultdict
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.modeling import build_backbone
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from dynaformer.modeling.backbone import focal  # noqa: F401, registers D2FocalNet
+from dynaformer.modeling.backbone.swin import WindowAttention
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    if args.channels_last:
+        cfg.MODEL.SWIN.CHANNELS_LAST = True
+    cfg.freeze()
+    return cfg
+
+
+def build(cfg, args):
+    backbone = build_backbone(cfg)
+    if cfg.MODEL.WEIGHTS:
+        # the checkpoint of a full model stores the backbone under "backbone."
+        DetectionCheckpointer(torch.nn.ModuleDict({"backbone": backbone})).load(cfg.MODEL.WEIGHTS)
+    for m in backbone.modules():
+        if isinstance(m, WindowAttention):
+            m.use_sdpa = m.use_sdpa and not args.no_sdpa
+    return backbone.to(args.device).eval()
+
+
+def check_parity(reference, backbone, x, atol):
+    """
+    Compare the outputs of the original backbone and of the fused backbone.
+    """
+    with torch.no_grad():
+        expected = reference(x)
+        outputs = backbone(x)
+    for k in expected:
+        diff = (expected[k] - outputs[k]).abs().max().item()
+        logger.info("parity {}: max abs diff {:.2e}".format(k, diff))
+        assert diff <= atol * max(expected[k].abs().max().item(), 1.0), "{} mismatch: {}".format(k, diff)
+
+
+def add_stage_timers(backbone, timings, device):
+    """
+    Record the latency of each stage (`backbone.layers[i]`) with forward hooks.
+    """
+    starts = {}
+
+    def _sync():
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    def _pre_hook(name):
+        def hook(module, inputs):
+            _sync()
+            starts[name] = time.perf_counter()
+
+        return hook
+
+    def _hook(name):
+        def hook(module, inputs, outputs):
+            _sync()
+            timings[name].append(time.perf_counter() - starts[name])
+
+        return hook
+
+    for i, layer in enumerate(getattr(backbone, "layers", [])):
+        name = "stage{}".format(i + 1)
+        layer.register_forward_pre_hook(_pre_hook(name))
+        layer.register_forward_hook(_hook(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="backbone throughput benchmark")
+    parser.add_argument("--config-file", metavar="FILE", required=True)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--input-size", type=int, nargs=2, default=[1024, 1024])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--num-iters", type=int, default=20)
+    parser.add_argument("--num-warmup", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--no-sdpa", action="store_true", help="use the explicit attention of WindowAttention")
+    parser.add_argument("--fuse", action="store_true", help="call fuse_for_inference() of the backbone (FocalNet)")
+    parser.add_argument("--check-parity", action="store_true", help="with --fuse, compare with the original backbone")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+    setup_logger()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    cfg = setup(args)
+    backbone = build(cfg, args)
+    x = torch.randn(args.batch_size, 3, *args.input_size, device=args.device)
+    if args.channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+
+    if args.fuse:
+        assert hasattr(backbone, "fuse_for_inference"), "{} has no fused inference mode".format(
+            cfg.MODEL.BACKBONE.NAME
+        )
+        reference = copy.deepcopy(backbone) if args.check_parity else None
+        backbone.fuse_for_inference()
+        if reference is not None:
+            check_parity(reference, backbone, x, args.atol)
+            del reference
+
+    timings = defaultdict(list)
+    add_stage_timers(backbone, timings, args.device)
+
+    with torch.no_grad():
+        for _ in range(args.num_warmup):
+            backbone(x)
+        timings.clear()
+        start = time.perf_counter()
+        for _ in range(args.num_iters):
+            backbone(x)
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+    rows = [[k, sum(v) / len(v) * 1000] for k, v in sorted(timings.items())]
+    rows.append(["total", elapsed / args.num_iters * 1000])
+    logger.info(
+        "{} on {} ({} threads), input {}x{}x{}:\n".format(
+            cfg.MODEL.BACKBONE.NAME, args.device, torch.get_num_threads(), args.batch_size, *args.input_size
+        )
+        + tabulate(rows, headers=["stage", "ms/iter"], floatfmt=".2f", tablefmt="pipe")
+    )
+    logger.info("throughput: {:.2f} images/s".format(args.batch_size * args.num_iters / elapsed))
+
+
+if __name__ == "__main__":
+    main()
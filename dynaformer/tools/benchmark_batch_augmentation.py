@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the training data loader of a config with the augmentations applied per sample in the
+data loader workers and with the batch augmentation stage (INPUT.BATCH_AUGMENTATION), for several
+numbers of workers:
+python tools/benchmark_batch_augmentation.py --config-file CONFIG_FILE --num-workers 2 4 8 --num-batches 200
+"""
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def loader_throughput(cfg, num_workers, batch_augmentation, num_batches):
+    """
+    Returns:
+        float: images per second of the training data loader, the startup of the workers (first
+            batch) excluded. The augmented batches are on MODEL.DEVICE with the batch stage.
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.DATALOADER.NUM_WORKERS = num_workers
+    cfg.INPUT.BATCH_AUGMENTATION = batch_augmentation
+    # the batch stage of the polyp semantic mapper builds the uint8 targets, the same in both modes
+    cfg.INPUT.SEM_SEG_UINT8_TARGETS = True
+    cfg.freeze()
+    data_loader = iter(Trainer.build_train_loader(cfg))
+    next(data_loader)
+    start = time.perf_counter()
+    num_images = sum(len(batch) for batch in itertools.islice(data_loader, num_batches))
+    if torch.device(cfg.MODEL.DEVICE).type == "cuda":
+        torch.cuda.synchronize()
+    return num_images / (time.perf_counter() - start)
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-workers", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--num-batches", type=int, default=200)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    rows = []
+    for num_workers in args.num_workers:
+        per_sample = loader_throughput(cfg, num_workers, False, args.num_batches)
+        batched = loader_throughput(cfg, num_workers, True, args.num_batches)
+        rows.append([num_workers, per_sample, batched, batched / per_sample])
+        logger.info("{} workers: {:.1f} images/s per sample, {:.1f} images/s batched".format(*rows[-1]))
+    logger.info(
+        "Training data loader of {}, batch augmentation on {}:\n".format(cfg.INPUT.DATASET_MAPPER_NAME, cfg.MODEL.DEVICE)
+        + tabulate(
+            rows,
+            headers=["workers", "per sample (images/s)", "batched (images/s)", "speedup"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
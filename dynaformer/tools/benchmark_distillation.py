@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Compare a student distilled with MODEL.DYNAFormer.DISTILL against its teacher: parameters, latency
+per image (batch of 1, e.g. on CPU) and box and mask AP on the first test dataset:
+python tools/benchmark_distillation.py --config-file STUDENT_CONFIG --latency-device cpu \
+    MODEL.WEIGHTS /path/to/student.pth MODEL.DYNAFormer.DISTILL.TEACHER_WEIGHTS /path/to/teacher.pth
+"""
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(config_file, opts=()):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(config_file)
+    cfg.merge_from_list(list(opts))
+    # the distiller is only used in training
+    cfg.MODEL.DYNAFormer.DISTILL.ENABLED = False
+    cfg.freeze()
+    return cfg
+
+
+def _sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def latency(model, data_loader, device, num_images, num_warmup):
+    """
+    Returns:
+        float: average latency in ms per image, inputs of batch size 1
+    """
+    model.to(device)
+    total = 0.0
+    for idx, inputs in enumerate(itertools.islice(data_loader, num_warmup + num_images)):
+        _sync(device)
+        start = time.perf_counter()
+        model(inputs)
+        _sync(device)
+        if idx >= num_warmup:
+            total += time.perf_counter() - start
+    return total / num_images * 1000
+
+
+def run(cfg, weights, args):
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(weights)
+    model.eval()
+    dataset_name = cfg.DATASETS.TEST[0]
+    data_loader = build_detection_test_loader(cfg, dataset_name)
+    results = inference_on_dataset(model, data_loader, COCOEvaluator(dataset_name))
+    ms = latency(model, data_loader, args.latency_device, args.num_latency_images, args.num_warmup)
+    return [
+        sum(p.numel() for p in model.parameters()) / 1e6,
+        ms,
+        results.get("bbox", {}).get("AP", float("nan")),
+        results.get("segm", {}).get("AP", float("nan")),
+    ]
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--latency-device", default="cpu")
+    parser.add_argument("--num-threads", type=int, default=0, help="torch threads for CPU latency, 0 keeps the default")
+    parser.add_argument("--num-latency-images", type=int, default=50)
+    parser.add_argument("--num-warmup", type=int, default=5)
+    args = parser.parse_args()
+    setup_logger()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    student_cfg = setup(args.config_file, args.opts)
+    distill_cfg = student_cfg.MODEL.DYNAFormer.DISTILL
+    teacher_cfg = setup(distill_cfg.TEACHER_CONFIG, ["DATASETS.TEST", student_cfg.DATASETS.TEST])
+
+    rows = []
+    for name, cfg, weights in [
+        ("teacher", teacher_cfg, distill_cfg.TEACHER_WEIGHTS),
+        ("student", student_cfg, student_cfg.MODEL.WEIGHTS),
+    ]:
+        rows.append([name] + run(cfg, weights, args))
+        logger.info("{}: {:.1f}M parameters, {:.2f} ms/image, box AP {:.2f}, mask AP {:.2f}".format(*rows[-1]))
+    rows[-1].append(rows[0][2] / rows[-1][2])
+    logger.info(
+        "Distillation, latency on {}:\n".format(args.latency_device)
+        + tabulate(
+            rows,
+            headers=["model", "params (M)", "ms/image", "box AP", "mask AP", "speedup"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
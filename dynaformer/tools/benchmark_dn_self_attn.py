@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the grouped self-attention of the denoising queries (MODEL.DYNAFormer.DN_GROUPED_SELF_ATTN) with
+the dense masked self-attention: output difference of a decoder layer, and training iteration time and
+peak memory on the training set:
+python tools/benchmark_dn_self_attn.py --config-file CONFIG_FILE --num-train-iters 20
+"""
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.engine import default_argument_parser
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.events import EventStorage
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from dynaformer.modeling.transformer_decoder.dino_decoder import DeformableTransformerDecoderLayer
+from dynaformer.modeling.transformer_decoder.dynaformer_decoder import DYNAFormerDecoder
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def self_attn_difference(cfg, num_groups, group_size, batch_size, device):
+    """
+    Returns:
+        float: max absolute difference between the grouped and the masked self-attention of a decoder layer
+    """
+    hidden_dim, num_queries = cfg.MODEL.DYNAFormer.HIDDEN_DIM, cfg.MODEL.DYNAFormer.NUM_OBJECT_QUERIES
+    layer = DeformableTransformerDecoderLayer(hidden_dim, n_heads=cfg.MODEL.DYNAFormer.NHEADS).to(device).eval()
+    pad_size = num_groups * group_size
+    q = torch.randn(pad_size + num_queries, batch_size, hidden_dim, device=device)
+    v = torch.randn(pad_size + num_queries, batch_size, hidden_dim, device=device)
+    attn_mask = DYNAFormerDecoder.dn_attn_mask(num_groups, group_size, num_queries, device)
+    dense = layer.self_attn(q, q, v, attn_mask=attn_mask)[0]
+    grouped = layer.grouped_self_attn(q, q, v, (num_groups, group_size))
+    return (dense - grouped).abs().max().item()
+
+
+def benchmark_training(cfg, num_iters, num_warmup):
+    """
+    Returns:
+        (float, float): average iteration time in ms and peak memory in MB
+    """
+    model = build_model(cfg)
+    if cfg.MODEL.WEIGHTS:
+        DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.train()
+    optimizer = Trainer.build_optimizer(cfg, model)
+    data_loader = Trainer.build_train_loader(cfg)
+    total = 0.0
+    with EventStorage():
+        for idx, data in enumerate(itertools.islice(data_loader, num_warmup + num_iters)):
+            if idx == num_warmup and torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            _sync()
+            start = time.perf_counter()
+            losses = sum(model(data).values())
+            optimizer.zero_grad()
+            losses.backward()
+            optimizer.step()
+            _sync()
+            if idx >= num_warmup:
+                total += time.perf_counter() - start
+    memory = torch.cuda.max_memory_allocated() / 1024 ** 2 if torch.cuda.is_available() else float("nan")
+    return total / num_iters * 1000, memory
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-train-iters", type=int, default=20)
+    parser.add_argument("--num-warmup", type=int, default=5)
+    parser.add_argument(
+        "--group-sizes", type=int, nargs="+", default=[1, 5, 20], help="instances per image for the parity check"
+    )
+    args = parser.parse_args()
+    cfg = setup(args)
+    device = cfg.MODEL.DEVICE
+
+    for group_size in args.group_sizes:
+        # prepare_for_dn splits DN_NUM denoising queries into groups of the max number of instances
+        num_groups = max(cfg.MODEL.DYNAFormer.DN_NUM // group_size, 1)
+        diff = self_attn_difference(cfg, num_groups, group_size, cfg.SOLVER.IMS_PER_BATCH, device)
+        logger.info("{} groups of {} queries: max abs difference {:.2e}".format(num_groups, group_size, diff))
+
+    rows = []
+    for grouped in [False, True]:
+        mode_cfg = cfg.clone()
+        mode_cfg.defrost()
+        mode_cfg.MODEL.DYNAFormer.DN_GROUPED_SELF_ATTN = grouped
+        mode_cfg.freeze()
+        ms, mb = benchmark_training(mode_cfg, args.num_train_iters, args.num_warmup)
+        rows.append(["grouped" if grouped else "dense masked", ms, mb])
+    logger.info(
+        "DN self-attention, training iterations:\n"
+        + tabulate(rows, headers=["self-attention", "ms/iter", "peak MB"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
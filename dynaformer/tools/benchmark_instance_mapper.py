@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Per-sample time of the LSJ instance mapper (COCOInstanceNewBaselineDatasetMapper) rasterizing the
+transformed polygons of every sample (INPUT.MASK_CACHE_MB 0) and transforming the cached masks
+rasterized at the original resolution, over a few epochs of the first training dataset:
+python tools/benchmark_instance_mapper.py --config-file CONFIG_FILE --num-samples 500 --num-epochs 2
+"""
+import logging
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import COCOInstanceNewBaselineDatasetMapper, add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-samples", type=int, default=500)
+    parser.add_argument("--num-epochs", type=int, default=2)
+    parser.add_argument("--cache-mb", type=int, default=64)
+    args = parser.parse_args()
+    cfg = setup(args)
+    dataset_dicts = DatasetCatalog.get(cfg.DATASETS.TRAIN[0])[: args.num_samples]
+
+    rows = []
+    for cache_mb in [0, args.cache_mb]:
+        mode_cfg = cfg.clone()
+        mode_cfg.defrost()
+        mode_cfg.INPUT.MASK_CACHE_MB = cache_mb
+        mode_cfg.freeze()
+        mapper = COCOInstanceNewBaselineDatasetMapper(mode_cfg, True)
+        for epoch in range(args.num_epochs):
+            if mapper.mask_cache is not None:
+                mapper.mask_cache.hits = mapper.mask_cache.misses = 0
+            start = time.perf_counter()
+            for dataset_dict in dataset_dicts:
+                mapper(dataset_dict)
+            ms = (time.perf_counter() - start) / len(dataset_dicts) * 1000
+            hit_rate = mapper.mask_cache.hit_rate() if mapper.mask_cache is not None else float("nan")
+            rows.append(["cached masks" if cache_mb else "polygons", epoch, ms, hit_rate])
+            logger.info("{}, epoch {}: {:.2f} ms/sample, cache hit rate {:.2f}".format(*rows[-1]))
+    logger.info(
+        "LSJ instance mapper on {} samples of {}:\n".format(len(dataset_dicts), cfg.DATASETS.TRAIN[0])
+        + tabulate(rows, headers=["masks", "epoch", "ms/sample", "cache hit rate"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage report of the training data loader of a config (DATALOADER.INSTRUMENT): mean time per sample
+of the stages of the mapping, queue depth, utilization of the workers and bytes per batch, and the
+throughput of the data loader without and with the instrumentation:
+python tools/benchmark_loader_stats.py --config-file CONFIG_FILE --num-batches 200
+"""
+import itertools
+import logging
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.events import EventStorage
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from dynaformer.data.loader_stats import STAGES
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def run(cfg, instrument, num_batches, storage):
+    """
+    Returns:
+        float: images per second of the training data loader, the startup of the workers (first
+            batch) excluded
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.DATALOADER.INSTRUMENT.ENABLED = instrument
+    cfg.freeze()
+    data_loader = iter(Trainer.build_train_loader(cfg))
+    next(data_loader)
+    num_images = 0
+    start = time.perf_counter()
+    for batch in itertools.islice(data_loader, num_batches):
+        num_images += len(batch)
+        storage.step()
+    return num_images / (time.perf_counter() - start)
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-batches", type=int, default=200)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    with EventStorage() as storage:
+        default = run(cfg, False, args.num_batches, storage)
+        instrumented = run(cfg, True, args.num_batches, storage)
+    logger.info(
+        "Throughput of the training data loader of {}:\n".format(cfg.INPUT.DATASET_MAPPER_NAME)
+        + tabulate(
+            [["default", default], ["instrumented", instrumented]],
+            headers=["loader", "images/s"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+    rows = [
+        ["{} (ms)".format(name), storage.history("loader/{}_time".format(name)).global_avg() * 1000]
+        for name in STAGES
+    ]
+    rows += [
+        [name[len("loader/"):], history.global_avg()]
+        for name, history in sorted(storage.histories().items())
+        if name.startswith("loader/") and not name.endswith("_time")
+    ]
+    logger.info(
+        "Data loader stages and counters, averaged over the reports:\n"
+        + tabulate(rows, headers=["metric", "mean"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
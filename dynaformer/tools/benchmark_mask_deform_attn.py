@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark a decoder layer with the fused mask-aware deformable attention against the unfused
+composition of MSDeformAttnMask, on random inputs of the size of a DYNAFormer decoder:
+python tools/benchmark_mask_deform_attn.py --image-size 1024 --batch-size 2 --num-queries 300
+"""
+import argparse
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer.modeling.transformer_decoder.dino_decoder import DeformableTransformerDecoderLayer
+from dynaformer.modeling.pixel_decoder.ops.functions.ms_deform_attn_func import MSDA_MASK_AVAILABLE
+from dynaformer.modeling.pixel_decoder.ops.modules import MSDeformAttnMask
+
+logger = logging.getLogger("detectron2")
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def make_inputs(args, device):
+    bs, nq, d_model = args.batch_size, args.num_queries, args.hidden_dim
+    strides = [8 * 2 ** i for i in range(args.num_levels)]
+    spatial_shapes = torch.as_tensor(
+        [(args.image_size // s, args.image_size // s) for s in strides], dtype=torch.long, device=device
+    )
+    level_start_index = torch.cat((spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1]))
+    num_tokens = int(spatial_shapes.prod(1).sum())
+    mask_size = args.image_size // 4
+    # smooth reference masks so that the mask boxes and the gating look like real anchors
+    masks = torch.randn(nq, bs, mask_size // 16, mask_size // 16, device=device)
+    masks = torch.nn.functional.interpolate(masks, size=(mask_size, mask_size), mode="bilinear", align_corners=False)
+    return dict(
+        tgt=torch.randn(nq, bs, d_model, device=device),
+        tgt_query_mask=torch.randn(nq, bs, d_model, device=device),
+        tgt_reference_bboxs=torch.randn(nq, bs, 4, device=device),
+        tgt_reference_masks=masks,
+        memory=torch.randn(num_tokens, bs, d_model, device=device),
+        memory_level_start_index=level_start_index,
+        memory_spatial_shapes=spatial_shapes,
+    )
+
+
+def benchmark(layer, inputs, fused, backward, num_iters, num_warmup):
+    """
+    Returns:
+        (float, float): average time in ms and peak memory in MB
+    """
+    for m in layer.modules():
+        if isinstance(m, MSDeformAttnMask):
+            m.fused_mask_attn = fused
+    total = 0.0
+    for idx in range(num_warmup + num_iters):
+        if idx == num_warmup and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        _sync()
+        start = time.perf_counter()
+        with torch.set_grad_enabled(backward):
+            out = layer(**inputs)
+            if backward:
+                out.sum().backward()
+        _sync()
+        if idx >= num_warmup:
+            total += time.perf_counter() - start
+    memory = torch.cuda.max_memory_allocated() / 1024 ** 2 if torch.cuda.is_available() else float("nan")
+    return total / num_iters * 1000, memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--num-queries", type=int, default=300)
+    parser.add_argument("--hidden-dim", type=int, default=256)
+    parser.add_argument("--num-levels", type=int, default=3)
+    parser.add_argument("--num-points", type=int, default=8)
+    parser.add_argument("--modes", nargs="+", default=["mask", "both"])
+    parser.add_argument("--num-iters", type=int, default=20)
+    parser.add_argument("--num-warmup", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    setup_logger()
+    assert MSDA_MASK_AVAILABLE, "rebuild the ops (dynaformer/modeling/pixel_decoder/ops/make.sh) for the fused kernel"
+
+    inputs = make_inputs(args, args.device)
+    rows = []
+    for mode in args.modes:
+        layer = DeformableTransformerDecoderLayer(
+            args.hidden_dim, 2048, 0.0, "relu", args.num_levels, 8, args.num_points, mode
+        ).to(args.device)
+        for backward in [False, True]:
+            results = {
+                fused: benchmark(layer, inputs, fused, backward, args.num_iters, args.num_warmup) for fused in [False, True]
+            }
+            (unfused_ms, unfused_mb), (fused_ms, fused_mb) = results[False], results[True]
+            rows.append(
+                [mode, "fwd+bwd" if backward else "fwd", unfused_ms, fused_ms, unfused_ms / fused_ms, unfused_mb, fused_mb]
+            )
+    logger.info(
+        "Decoder layer with {} queries, batch {}, image {} on {}:\n".format(
+            args.num_queries, args.batch_size, args.image_size, args.device
+        )
+        + tabulate(
+            rows,
+            headers=["sampling", "pass", "unfused ms", "fused ms", "speedup", "unfused MB", "fused MB"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
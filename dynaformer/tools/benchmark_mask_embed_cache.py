@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep the mask embedding cache of the decoder (MODEL.DYNAFormer.TEST.MASK_EMBED_CACHE_THRESHOLD) and
+report the cache hit rate of each decoder layer, decoder and model latency and mask AP on the first
+test dataset:
+python tools/benchmark_mask_embed_cache.py --config-file CONFIG_FILE --thresholds -1 0 0.05 0.1 \
+    MODEL.WEIGHTS /path/to/model.pth
+"""
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class _Timer:
+    """
+    Accumulates the time spent in the forward of a module through hooks.
+    """
+
+    def __init__(self, module):
+        self.total = 0.0
+        self.enabled = False
+        module.register_forward_pre_hook(self._start)
+        module.register_forward_hook(self._stop)
+
+    def _start(self, module, inputs):
+        _sync()
+        self.start = time.perf_counter()
+
+    def _stop(self, module, inputs, outputs):
+        _sync()
+        if self.enabled:
+            self.total += time.perf_counter() - self.start
+
+
+def run(cfg, args, threshold):
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.DYNAFormer.TEST.MASK_EMBED_CACHE_THRESHOLD = threshold
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    decoder = model.sem_seg_head.predictor.decoder
+    decoder_timer = _Timer(model.sem_seg_head.predictor)
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    data_loader = build_detection_test_loader(cfg, dataset_name)
+    total = 0.0
+    num_measured = 0
+    with torch.no_grad():
+        for idx, inputs in enumerate(itertools.islice(data_loader, args.num_warmup + args.num_latency_images)):
+            if idx == args.num_warmup:
+                decoder.reset_mask_embed_cache_stats()
+                decoder_timer.enabled = True
+            _sync()
+            start = time.perf_counter()
+            model(inputs)
+            _sync()
+            if idx >= args.num_warmup:
+                total += time.perf_counter() - start
+                num_measured += len(inputs)
+    num_measured = max(num_measured, 1)
+    hit_rates = decoder.mask_embed_cache_hit_rates()
+    decoder_timer.enabled = False
+    results = inference_on_dataset(model, data_loader, COCOEvaluator(dataset_name))
+    return (
+        hit_rates,
+        decoder_timer.total / num_measured * 1000,
+        total / num_measured * 1000,
+        results.get("segm", {}).get("AP", float("nan")),
+    )
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[-1.0, 0.0, 0.05, 0.1],
+        help="1 - IoU thresholds of the cache, negative disables it",
+    )
+    parser.add_argument("--num-latency-images", type=int, default=50)
+    parser.add_argument("--num-warmup", type=int, default=5)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    rows = []
+    baseline = None
+    for threshold in args.thresholds:
+        hit_rates, decoder_ms, model_ms, ap = run(cfg, args, threshold)
+        baseline = baseline or decoder_ms
+        rows.append(
+            [threshold, " ".join("{:.2f}".format(r) for r in hit_rates), decoder_ms, baseline / decoder_ms, model_ms, ap]
+        )
+        logger.info(
+            "threshold={}: hit rates {}, decoder {:.2f} ms/image, model {:.2f} ms/image, mask AP {:.2f}".format(
+                threshold, rows[-1][1], decoder_ms, model_ms, ap
+            )
+        )
+    logger.info(
+        "Mask embedding cache (speedup relative to the first threshold):\n"
+        + tabulate(
+            rows,
+            headers=["threshold", "hit rate per layer", "decoder ms/image", "speedup", "model ms/image", "mask AP"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the instance mask output formats (MODEL.DYNAFormer.TEST.MASK_FORMAT) on the
+first test dataset: mask bytes per image, evaluation time and mask AP.
+python tools/benchmark_mask_format.py --config-file CONFIG_FILE \
+    --formats float bool cropped rle MODEL.WEIGHTS /path/to/model.pth
+"""
+import logging
+import time
+
+import torch
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation import COCOEvaluator, DatasetEvaluator, DatasetEvaluators, inference_on_dataset
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def mask_nbytes(masks):
+    if isinstance(masks, torch.Tensor):
+        return masks.numel() * masks.element_size()
+    return masks.nbytes
+
+
+class MaskStatsEvaluator(DatasetEvaluator):
+    """
+    Measures the size of `pred_masks`, and the time spent in the wrapped evaluator.
+    """
+
+    def __init__(self, evaluator):
+        self._evaluator = evaluator
+
+    def reset(self):
+        self._evaluator.reset()
+        self._num_images = 0
+        self._nbytes = 0
+        self._eval_time = 0.0
+
+    def process(self, inputs, outputs):
+        for output in outputs:
+            if "instances" in output and output["instances"].has("pred_masks"):
+                self._nbytes += mask_nbytes(output["instances"].pred_masks)
+            self._num_images += 1
+        start = time.perf_counter()
+        self._evaluator.process(inputs, outputs)
+        self._eval_time += time.perf_counter() - start
+
+    def evaluate(self):
+        start = time.perf_counter()
+        results = self._evaluator.evaluate() or {}
+        self._eval_time += time.perf_counter() - start
+        results = dict(results)
+        results["mask_format"] = {
+            "mask_bytes_per_image": self._nbytes / max(self._num_images, 1),
+            "eval_time": self._eval_time,
+        }
+        return results
+
+
+def benchmark(cfg, mask_format, output_dir):
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.DYNAFormer.TEST.MASK_FORMAT = mask_format
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    data_loader = build_detection_test_loader(cfg, dataset_name)
+    evaluator = MaskStatsEvaluator(
+        COCOEvaluator(dataset_name, output_dir=os.path.join(output_dir, mask_format))
+    )
+    start = time.perf_counter()
+    results = inference_on_dataset(model, data_loader, DatasetEvaluators([evaluator]))
+    total_time = time.perf_counter() - start
+
+    stats = results["mask_format"]
+    logger.info(
+        "mask_format={}: {:.1f} KiB masks/image, eval {:.2f}s, total {:.2f}s, mask AP {}".format(
+            mask_format,
+            stats["mask_bytes_per_image"] / 1024,
+            stats["eval_time"],
+            total_time,
+            results.get("segm", {}).get("AP", "n/a"),
+        )
+    )
+    return results
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        default=["float", "bool", "cropped", "rle"],
+        choices=["float", "bool", "cropped", "rle"],
+    )
+    args = parser.parse_args()
+    cfg = setup(args)
+    output_dir = os.path.join(cfg.OUTPUT_DIR, "benchmark_mask_format")
+    for mask_format in args.formats:
+        benchmark(cfg, mask_format, output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the mask feature strides of the decoder (MODEL.DYNAFormer.MASK_FEATURE_STRIDE, optionally
+with MODEL.DYNAFormer.MASK_FEATURE_REFINE): training iteration time and peak memory, inference
+latency and peak memory, and mask AP on the first test dataset:
+python tools/benchmark_mask_stride.py --config-file CONFIG_FILE --modes 4 8 8r \
+    --weights /path/to/stride4.pth /path/to/stride8.pth /path/to/stride8r.pth
+A mode is a stride, with a trailing "r" for the final 1/COMMON_STRIDE refinement of the output layer.
+"""
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.events import EventStorage
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def _peak_memory_mb():
+    return torch.cuda.max_memory_allocated() / 1024 ** 2 if torch.cuda.is_available() else float("nan")
+
+
+def benchmark_training(cfg, weights, num_iters, num_warmup):
+    """
+    Returns:
+        (float, float): average iteration time in ms and peak memory in MB
+    """
+    model = build_model(cfg)
+    if weights:
+        DetectionCheckpointer(model).load(weights)
+    model.train()
+    optimizer = Trainer.build_optimizer(cfg, model)
+    data_loader = Trainer.build_train_loader(cfg)
+    total = 0.0
+    with EventStorage():
+        for idx, data in enumerate(itertools.islice(data_loader, num_warmup + num_iters)):
+            if idx == num_warmup:
+                _reset_peak_memory()
+            _sync()
+            start = time.perf_counter()
+            losses = sum(model(data).values())
+            optimizer.zero_grad()
+            losses.backward()
+            optimizer.step()
+            _sync()
+            if idx >= num_warmup:
+                total += time.perf_counter() - start
+    return total / num_iters * 1000, _peak_memory_mb()
+
+
+def benchmark_inference(cfg, weights, num_images, num_warmup):
+    """
+    Returns:
+        (float, float, float): average latency in ms per image, peak memory in MB and mask AP
+    """
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(weights)
+    model.eval()
+    dataset_name = cfg.DATASETS.TEST[0]
+    data_loader = build_detection_test_loader(cfg, dataset_name)
+    total = 0.0
+    num_measured = 0
+    with torch.no_grad():
+        for idx, inputs in enumerate(itertools.islice(data_loader, num_warmup + num_images)):
+            if idx == num_warmup:
+                _reset_peak_memory()
+            _sync()
+            start = time.perf_counter()
+            model(inputs)
+            _sync()
+            if idx >= num_warmup:
+                total += time.perf_counter() - start
+                num_measured += len(inputs)
+    latency, memory = total / max(num_measured, 1) * 1000, _peak_memory_mb()
+    results = inference_on_dataset(model, data_loader, COCOEvaluator(dataset_name))
+    return latency, memory, results.get("segm", {}).get("AP", float("nan"))
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--modes", nargs="+", default=["4", "8", "8r"])
+    parser.add_argument(
+        "--weights",
+        nargs="*",
+        default=[],
+        help="one checkpoint per mode (trained with that stride), defaults to MODEL.WEIGHTS",
+    )
+    parser.add_argument("--num-train-iters", type=int, default=20)
+    parser.add_argument("--num-test-images", type=int, default=50)
+    parser.add_argument("--num-warmup", type=int, default=5)
+    parser.add_argument("--skip-training", action="store_true")
+    args = parser.parse_args()
+    cfg = setup(args)
+    assert not args.weights or len(args.weights) == len(args.modes), "--weights needs one checkpoint per mode"
+
+    rows = []
+    for i, mode in enumerate(args.modes):
+        mode_cfg = cfg.clone()
+        mode_cfg.defrost()
+        mode_cfg.MODEL.DYNAFormer.MASK_FEATURE_REFINE = mode.endswith("r")
+        mode_cfg.MODEL.DYNAFormer.MASK_FEATURE_STRIDE = int(mode.rstrip("r"))
+        mode_cfg.freeze()
+        weights = args.weights[i] if args.weights else cfg.MODEL.WEIGHTS
+
+        train_ms, train_mb = float("nan"), float("nan")
+        if not args.skip_training:
+            train_ms, train_mb = benchmark_training(mode_cfg, weights, args.num_train_iters, args.num_warmup)
+        test_ms, test_mb, ap = benchmark_inference(mode_cfg, weights, args.num_test_images, args.num_warmup)
+        rows.append([mode, train_ms, train_mb, test_ms, test_mb, ap])
+        logger.info(
+            "mode {}: train {:.2f} ms/iter {:.0f} MB, test {:.2f} ms/image {:.0f} MB, mask AP {:.2f}".format(
+                mode, train_ms, train_mb, test_ms, test_mb, ap
+            )
+        )
+    logger.info(
+        "Mask feature stride:\n"
+        + tabulate(
+            rows,
+            headers=["mode", "train ms/iter", "train MB", "test ms/image", "test MB", "mask AP"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
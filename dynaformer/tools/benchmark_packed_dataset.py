@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the epoch time of the training data loader (reading, decoding and the dataset mapper of the
+config) on datasets and their packed versions, e.g.:
+python tools/benchmark_packed_dataset.py --config-file CONFIG_FILE \
+    --datasets polypdb_ins_train polypdb_ins_train_packed
+"""
+import itertools
+import logging
+import math
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def epoch_time(cfg, dataset_name, num_epochs):
+    """
+    Returns:
+        (int, float): number of images and average time of an epoch in seconds, the startup of the
+            workers (first batch) excluded
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.DATASETS.TRAIN = (dataset_name,)
+    cfg.freeze()
+    num_images = len(DatasetCatalog.get(dataset_name))
+    num_batches = num_epochs * math.ceil(num_images / cfg.SOLVER.IMS_PER_BATCH)
+    data_loader = iter(Trainer.build_train_loader(cfg))
+    next(data_loader)
+    start = time.perf_counter()
+    for _ in itertools.islice(data_loader, num_batches):
+        pass
+    return num_images, (time.perf_counter() - start) / num_epochs
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--datasets", nargs="+", required=True)
+    parser.add_argument("--num-epochs", type=int, default=1)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    rows = []
+    for dataset_name in args.datasets:
+        num_images, seconds = epoch_time(cfg, dataset_name, args.num_epochs)
+        rows.append([dataset_name, num_images, seconds, num_images / seconds, rows[0][2] / seconds if rows else 1.0])
+        logger.info("{}: {:.1f} s/epoch, {:.1f} images/s".format(dataset_name, seconds, num_images / seconds))
+    logger.info(
+        "Training data loader, {} workers (speedup relative to the first dataset):\n".format(cfg.DATALOADER.NUM_WORKERS)
+        + tabulate(rows, headers=["dataset", "images", "s/epoch", "images/s", "speedup"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Time spent waiting for the training batches (data_time) and in the prologue of the training forward
+(normalization, padding of the images and of the ground truth masks) of a config, without and with
+DATALOADER.PREFETCH:
+python tools/benchmark_prefetch.py --config-file CONFIG_FILE --num-iter 200
+"""
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.engine import default_argument_parser
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def prologue(model, batched_inputs):
+    images = model.preprocess_image(batched_inputs)
+    gt_instances = [x["instances"].to(model.device) for x in batched_inputs]
+    return model.prepare_targets(gt_instances, images, model.collated_masks(batched_inputs, images))
+
+
+def run(cfg, model, prefetch, num_iter, step_time):
+    """
+    Returns:
+        (float, float): average milliseconds per iteration waiting for the data loader and in the
+            forward prologue, the startup of the workers (first batch) excluded
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.DATALOADER.PREFETCH = prefetch
+    cfg.freeze()
+    data_loader = iter(Trainer.build_train_loader(cfg))
+    next(data_loader)
+    data_time = prologue_time = 0.0
+    for _ in range(num_iter):
+        start = time.perf_counter()
+        batched_inputs = next(data_loader)
+        data_time += time.perf_counter() - start
+        start = time.perf_counter()
+        prologue(model, batched_inputs)
+        synchronize(model.device)
+        prologue_time += time.perf_counter() - start
+        # stands for the rest of the training step, during which the next batches are prefetched
+        time.sleep(step_time)
+    return data_time * 1000 / num_iter, prologue_time * 1000 / num_iter
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-iter", type=int, default=200)
+    parser.add_argument("--step-time", type=float, default=0.2, help="seconds of the simulated training step")
+    args = parser.parse_args()
+    cfg = setup(args)
+    model = build_model(cfg)
+
+    rows = []
+    for prefetch in [False, True]:
+        data_time, prologue_time = run(cfg, model, prefetch, args.num_iter, args.step_time)
+        rows.append(["prefetch" if prefetch else "default", data_time, prologue_time, data_time + prologue_time])
+        logger.info("{}: data_time {:.2f} ms, prologue {:.2f} ms".format(*rows[-1]))
+    logger.info(
+        "Training input pipeline of {} on {}, {:.0f} ms step:\n".format(
+            cfg.INPUT.DATASET_MAPPER_NAME, cfg.MODEL.DEVICE, args.step_time * 1000
+        )
+        + tabulate(
+            rows, headers=["loader", "data_time (ms)", "prologue (ms)", "total (ms)"], floatfmt=".2f", tablefmt="pipe"
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
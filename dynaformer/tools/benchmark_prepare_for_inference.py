@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Check that `prepare_for_inference` preserves the outputs of a model, and report the CPU latency of
+each component (backbone, pixel decoder, transformer decoder) before and after:
+python tools/benchmark_prepare_for_inference.py --config-file CONFIG_FILE --input-size 512 512 \
+    MODEL.WEIGHTS /path/to/model.pth
+"""
+import argparse
+import copy
+import functools
+import logging
+import time
+from collections import defaultdict
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config, prepare_for_inference
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.freeze()
+    return cfg
+
+
+def add_component_timers(model, timings):
+    """
+    Record the latency of the components of the model by wrapping their entry points.
+    Returns the outputs of the last call of the segmentation head in a dict.
+    """
+    last_outputs = {}
+
+    def _timed(name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            ret = fn(*args, **kwargs)
+            timings[name].append(time.perf_counter() - start)
+            return ret
+
+        return wrapper
+
+    head = model.sem_seg_head
+    model.backbone.forward = _timed("backbone", model.backbone.forward)
+    # the pixel decoder is called through `forward_features` by the head
+    head.pixel_decoder.forward_features = _timed("pixel decoder", head.pixel_decoder.forward_features)
+    head.predictor.forward = _timed("transformer decoder", head.predictor.forward)
+    head.register_forward_hook(lambda module, inputs, outputs: last_outputs.update(outputs[0]))
+    return last_outputs
+
+
+def check_parity(reference_outputs, outputs, atol):
+    for k in ["pred_logits", "pred_masks", "pred_boxes"]:
+        if k not in reference_outputs:
+            continue
+        diff = (reference_outputs[k] - outputs[k]).abs().max().item()
+        logger.info("parity {}: max abs diff {:.2e}".format(k, diff))
+        assert diff <= atol * max(reference_outputs[k].abs().max().item(), 1.0), "{} mismatch: {}".format(k, diff)
+
+
+def benchmark(model, inputs, num_iters, num_warmup):
+    timings = defaultdict(list)
+    last_outputs = add_component_timers(model, timings)
+    with torch.no_grad():
+        for _ in range(num_warmup):
+            model(inputs)
+        timings.clear()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            model(inputs)
+        timings["total"] = [(time.perf_counter() - start) / num_iters]
+    return {k: sum(v) / len(v) * 1000 for k, v in timings.items()}, dict(last_outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="prepare_for_inference parity and CPU latency")
+    parser.add_argument("--config-file", metavar="FILE", required=True)
+    parser.add_argument("--input-size", type=int, nargs=2, default=[512, 512])
+    parser.add_argument("--num-iters", type=int, default=10)
+    parser.add_argument("--num-warmup", type=int, default=2)
+    parser.add_argument("--num-threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument("--atol", type=float, default=1e-3)
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+    setup_logger()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    cfg = setup(args)
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    prepared = prepare_for_inference(copy.deepcopy(model))
+
+    h, w = args.input_size
+    torch.manual_seed(0)
+    inputs = [{"image": torch.randint(0, 256, (3, h, w), dtype=torch.uint8), "height": h, "width": w}]
+
+    before, reference_outputs = benchmark(model, inputs, args.num_iters, args.num_warmup)
+    after, outputs = benchmark(prepared, inputs, args.num_iters, args.num_warmup)
+    check_parity(reference_outputs, outputs, args.atol)
+
+    rows = [[k, before[k], after[k], before[k] / after[k]] for k in before]
+    logger.info(
+        "{} on cpu ({} threads), input {}x{}:\n".format(cfg.MODEL.BACKBONE.NAME, torch.get_num_threads(), h, w)
+        + tabulate(rows, headers=["component", "ms before", "ms after", "speedup"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
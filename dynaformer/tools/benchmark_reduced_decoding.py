@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Decode time of the training images at full size and at the power-of-two reductions of JPEG decoding,
+and throughput of the training data loader of a config with and without INPUT.REDUCED_DECODING:
+python tools/benchmark_reduced_decoding.py --config-file CONFIG_FILE --num-images 200 --num-batches 200
+"""
+import itertools
+import logging
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from detectron2.data import detection_utils as utils
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from dynaformer.data.reduced_decoding import read_image_size
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def decode_time(file_names, image_format, factor):
+    """
+    Returns:
+        (float, float): average decode time in ms and megapixels of the decoded images
+    """
+    total_time, total_pixels = 0.0, 0
+    for file_name in file_names:
+        target_size = None
+        if factor > 1:
+            target_size = tuple(s // factor for s in read_image_size(file_name))
+        start = time.perf_counter()
+        image = utils.read_image(file_name, format=image_format, target_size=target_size)
+        total_time += time.perf_counter() - start
+        total_pixels += image.shape[0] * image.shape[1]
+    return total_time / len(file_names) * 1000, total_pixels / len(file_names) / 1e6
+
+
+def loader_throughput(cfg, reduced_decoding, num_batches):
+    """
+    Returns:
+        float: images per second of the training data loader, the startup of the workers (first
+            batch) excluded
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.INPUT.REDUCED_DECODING = reduced_decoding
+    # the polyp semantic mapper only decodes at a reduction with the uint8 targets, the same in both modes
+    cfg.INPUT.SEM_SEG_UINT8_TARGETS = True
+    cfg.freeze()
+    data_loader = iter(Trainer.build_train_loader(cfg))
+    next(data_loader)
+    start = time.perf_counter()
+    num_images = sum(len(batch) for batch in itertools.islice(data_loader, num_batches))
+    return num_images / (time.perf_counter() - start)
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-images", type=int, default=200, help="images of the decode benchmark")
+    parser.add_argument("--num-batches", type=int, default=200, help="batches of the data loader benchmark")
+    args = parser.parse_args()
+    cfg = setup(args)
+    dataset_dicts = DatasetCatalog.get(cfg.DATASETS.TRAIN[0])
+    file_names = [d["file_name"] for d in dataset_dicts[: args.num_images]]
+
+    rows = []
+    for factor in [1, 2, 4, 8]:
+        ms, megapixels = decode_time(file_names, cfg.INPUT.FORMAT, factor)
+        rows.append(["1/{}".format(factor), megapixels, ms, rows[0][2] / ms if rows else 1.0])
+    logger.info(
+        "Decoding {} images of {}:\n".format(len(file_names), cfg.DATASETS.TRAIN[0])
+        + tabulate(rows, headers=["reduction", "MP/image", "ms/image", "speedup"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+    rows = []
+    for reduced_decoding in [False, True]:
+        images_per_second = loader_throughput(cfg, reduced_decoding, args.num_batches)
+        rows.append(
+            [
+                "reduced" if reduced_decoding else "full size",
+                images_per_second,
+                images_per_second / rows[0][1] if rows else 1.0,
+            ]
+        )
+        logger.info("{} decoding: {:.1f} images/s".format(*rows[-1]))
+    logger.info(
+        "Training data loader, {} workers:\n".format(cfg.DATALOADER.NUM_WORKERS)
+        + tabulate(rows, headers=["decoding", "images/s", "speedup"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Per-sample time and size of the outputs (bytes of the tensors shipped from the data loader workers to
+the main process) of PolypInsSemanticDatasetMapper, with the legacy targets and with the uint8
+targets (INPUT.SEM_SEG_UINT8_TARGETS):
+python tools/benchmark_semantic_mapper.py --config-file CONFIG_FILE --num-samples 500
+"""
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import PolypInsSemanticDatasetMapper, add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def tensor_bytes(dataset_dict):
+    tensors = [v for v in dataset_dict.values() if isinstance(v, torch.Tensor)]
+    if "instances" in dataset_dict:
+        for v in dataset_dict["instances"].get_fields().values():
+            tensors.append(v if isinstance(v, torch.Tensor) else v.tensor)
+    return sum(t.element_size() * t.numel() for t in tensors)
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-samples", type=int, default=500)
+    args = parser.parse_args()
+    cfg = setup(args)
+    dataset_dicts = DatasetCatalog.get(cfg.DATASETS.TRAIN[0])[: args.num_samples]
+
+    rows = []
+    for uint8_targets in [False, True]:
+        mode_cfg = cfg.clone()
+        mode_cfg.defrost()
+        mode_cfg.INPUT.SEM_SEG_UINT8_TARGETS = uint8_targets
+        mode_cfg.freeze()
+        mapper = PolypInsSemanticDatasetMapper(mode_cfg, True)
+        total_time, total_bytes = 0.0, 0
+        for dataset_dict in dataset_dicts:
+            start = time.perf_counter()
+            output = mapper(dataset_dict)
+            total_time += time.perf_counter() - start
+            total_bytes += tensor_bytes(output)
+        rows.append(
+            [
+                "uint8" if uint8_targets else "legacy",
+                total_time / len(dataset_dicts) * 1000,
+                total_bytes / len(dataset_dicts) / 1024 ** 2,
+            ]
+        )
+        logger.info("{} targets: {:.2f} ms/sample, {:.2f} MB/sample".format(*rows[-1]))
+    logger.info(
+        "PolypInsSemanticDatasetMapper on {} samples of {}:\n".format(len(dataset_dicts), cfg.DATASETS.TRAIN[0])
+        + tabulate(rows, headers=["targets", "ms/sample", "MB/sample"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
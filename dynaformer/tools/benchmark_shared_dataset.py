@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Startup time and private RSS (excluding the shared pages) of each rank when building the training dataset
+of a config with the dataset dicts loaded and serialized by every rank, and shared by the ranks of the
+machine (DATALOADER.SHARED_DATASET):
+python tools/benchmark_shared_dataset.py --config-file CONFIG_FILE --num-gpus 8
+"""
+import logging
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import DatasetFromList, get_detection_dataset_dicts
+from detectron2.engine import default_argument_parser, launch
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils import comm
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from dynaformer.data.shared_dataset import build_shared_train_dataset
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger(distributed_rank=comm.get_rank())
+    return cfg
+
+
+def private_rss_mb():
+    # resident pages minus the resident file-backed (shared) pages, e.g. of the shared dataset file
+    with open("/proc/self/statm") as f:
+        resident, shared = (int(x) for x in f.read().split()[1:3])
+    return (resident - shared) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def build_dataset(cfg, shared):
+    if shared:
+        return build_shared_train_dataset(cfg)
+    return DatasetFromList(
+        get_detection_dataset_dicts(
+            cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS
+        ),
+        copy=False,
+    )
+
+
+def main(args, shared):
+    cfg = setup(args)
+    rss = private_rss_mb()
+    comm.synchronize()
+    start = time.perf_counter()
+    dataset = build_dataset(cfg, shared)
+    comm.synchronize()
+    elapsed = time.perf_counter() - start
+    # touch every item, as the data loader workers do over an epoch
+    for i in range(len(dataset)):
+        dataset[i]
+    results = comm.gather((comm.get_rank(), elapsed, private_rss_mb() - rss))
+    if comm.is_main_process():
+        rows = [list(r) for r in results]
+        logger.info(
+            "Training dataset of {}, {}:\n".format(
+                cfg.DATASETS.TRAIN, "shared by the ranks" if shared else "per rank"
+            )
+            + tabulate(rows, headers=["rank", "startup (s)", "private RSS (MiB)"], floatfmt=".2f", tablefmt="pipe")
+        )
+
+
+if __name__ == "__main__":
+    args = default_argument_parser().parse_args()
+    for shared in [False, True]:
+        launch(
+            main,
+            args.num_gpus,
+            num_machines=args.num_machines,
+            machine_rank=args.machine_rank,
+            dist_url=args.dist_url,
+            args=(args, shared),
+        )
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Padding ratio of the batches (the fraction of the padded batch tensor of `ImageList.from_tensors` that
+is padding) and throughput of the training data loader of a config, with the aspect ratio grouping and
+with DATALOADER.SIZE_BUCKETING:
+python tools/benchmark_size_bucketing.py --config-file CONFIG_FILE --num-batches 200
+"""
+import itertools
+import logging
+import math
+import time
+
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.engine import default_argument_parser
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def padding_ratio(batch, size_divisibility):
+    sizes = [tuple(d["image"].shape[-2:]) for d in batch]
+    h_pad, w_pad = (max(s) for s in zip(*sizes))
+    if size_divisibility > 1:
+        h_pad = math.ceil(h_pad / size_divisibility) * size_divisibility
+        w_pad = math.ceil(w_pad / size_divisibility) * size_divisibility
+    return 1 - sum(h * w for h, w in sizes) / (len(sizes) * h_pad * w_pad)
+
+
+def run(cfg, bucketing, num_batches):
+    """
+    Returns:
+        (float, float): average padding ratio of the batches and images per second, the startup of the
+            workers (first batch) excluded
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.DATALOADER.SIZE_BUCKETING.ENABLED = bucketing
+    cfg.freeze()
+    data_loader = iter(Trainer.build_train_loader(cfg))
+    next(data_loader)
+    ratios, num_images = [], 0
+    start = time.perf_counter()
+    for batch in itertools.islice(data_loader, num_batches):
+        ratios.append(padding_ratio(batch, cfg.MODEL.DYNAFormer.SIZE_DIVISIBILITY))
+        num_images += len(batch)
+    return sum(ratios) / len(ratios), num_images / (time.perf_counter() - start)
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-batches", type=int, default=200)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    rows = []
+    for bucketing in [False, True]:
+        ratio, images_per_second = run(cfg, bucketing, args.num_batches)
+        rows.append(["size buckets" if bucketing else "aspect ratio", ratio * 100, images_per_second])
+        logger.info("{}: {:.1f}% padding, {:.1f} images/s".format(*rows[-1]))
+    logger.info(
+        "Batching of the training data loader, buckets of {} pixels, buffer of {} images:\n".format(
+            cfg.DATALOADER.SIZE_BUCKETING.BUCKET_SIZE, cfg.DATALOADER.SIZE_BUCKETING.MAX_BUFFER
+        )
+        + tabulate(rows, headers=["batching", "padding (%)", "images/s"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
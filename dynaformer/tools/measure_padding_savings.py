@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the padding of real training (or test) batches and the fraction of the deformable encoder
+compute that is skipped with MODEL.DYNAFormer.USE_PADDING_MASK:
+python tools/measure_padding_savings.py --config-file CONFIG_FILE --num-batches 100 [--test]
+"""
+import itertools
+import logging
+import math
+
+import numpy as np
+import torch
+from tabulate import tabulate
+
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.structures import ImageList
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+from dynaformer.utils.utils import resize_padding_mask
+from train_net import Trainer
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def encoder_level_strides(pixel_decoder):
+    """
+    Strides of the levels of the deformable encoder, including the extra downsampled levels.
+    """
+    strides = sorted(pixel_decoder.transformer_feature_strides)
+    while len(strides) < pixel_decoder.total_num_feature_levels:
+        strides.append(strides[-1] * 2)
+    return strides
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--num-batches", type=int, default=100)
+    parser.add_argument("--test", action="store_true", help="use the test loader of DATASETS.TEST[0]")
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    # the model is only used for its padding mask and its encoder structure
+    model = build_model(cfg).eval()
+    pixel_decoder = model.sem_seg_head.pixel_decoder
+    encoder = pixel_decoder.transformer.encoder
+    strides = encoder_level_strides(pixel_decoder)
+    mask_stride = min(pixel_decoder.feature_strides)
+
+    if args.test:
+        data_loader = build_detection_test_loader(cfg, cfg.DATASETS.TEST[0])
+    else:
+        data_loader = Trainer.build_train_loader(cfg)
+
+    pixel_ratios, token_ratios, skipped_ratios, mask_ratios, flops_saved = [], [], [], [], []
+    for batched_inputs in itertools.islice(data_loader, args.num_batches):
+        images = ImageList.from_tensors([x["image"] for x in batched_inputs], model.size_divisibility)
+        padding_mask = model.padding_mask(batched_inputs, images)
+        h, w = images.tensor.shape[-2:]
+        if padding_mask is None:
+            padding_mask = torch.zeros((len(batched_inputs), h, w), dtype=torch.bool)
+        pixel_ratios.append(padding_mask.float().mean().item())
+
+        level_masks = [resize_padding_mask(padding_mask, (math.ceil(h / s), math.ceil(w / s))) for s in strides]
+        token_mask = torch.cat([m.flatten(1) for m in level_masks], 1)
+        num_tokens = token_mask.shape[1]
+        # the encoder refines the same number of tokens for all images of the batch
+        num_valid = int((~token_mask).sum(1).max())
+        token_ratios.append(token_mask.float().mean().item())
+        skipped_ratios.append(1.0 - num_valid / num_tokens)
+        flops_saved.append(1.0 - encoder.flops(num_tokens, num_valid) / encoder.flops(num_tokens))
+
+        reference_mask = resize_padding_mask(padding_mask, (math.ceil(h / mask_stride), math.ceil(w / mask_stride)))
+        mask_ratios.append(reference_mask.float().mean().item())
+
+    rows = [
+        ["padded pixels", np.mean(pixel_ratios)],
+        ["padded encoder tokens", np.mean(token_ratios)],
+        ["encoder queries skipped (batch max)", np.mean(skipped_ratios)],
+        ["encoder FLOPs saved", np.mean(flops_saved)],
+        ["padded reference mask area", np.mean(mask_ratios)],
+    ]
+    logger.info(
+        "Padding of {} {} batches ({}):\n".format(
+            len(pixel_ratios), "test" if args.test else "train", cfg.DATASETS.TEST[0] if args.test else cfg.DATASETS.TRAIN
+        )
+        + tabulate([[k, v * 100] for k, v in rows], headers=["", "%"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Pack a registered dataset into shards read through memory maps (see
+dynaformer/data/datasets/register_polypdb_packed.py): the encoded images, and the semantic masks
+binarized and bit-packed, are written to a few large shard files with an offset index:
+python tools/pack_dataset.py --dataset polypdb_ins_train --output datasets/packed/polypdb_ins_train
+"""
+import argparse
+import copy
+import logging
+
+import numpy as np
+import tqdm
+
+from detectron2.data import DatasetCatalog
+from detectron2.data import detection_utils as utils
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+import dynaformer  # noqa, register the datasets
+from dynaformer.data.datasets.register_polypdb_packed import PackWriter
+
+logger = logging.getLogger("detectron2")
+
+
+def binarize_mask(mask):
+    """
+    Same binarization as PolypInsSemanticDatasetMapper: mean of the channels above 128.
+    """
+    if mask.ndim == 3:
+        mask = mask.mean(axis=-1)
+    return mask > 128
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", required=True, help="name of a registered dataset")
+    parser.add_argument("--output", required=True, help="pack directory")
+    parser.add_argument("--shard-size-mb", type=int, default=256)
+    args = parser.parse_args()
+    setup_logger()
+
+    writer = PackWriter(args.output, shard_size=args.shard_size_mb * 1024 * 1024)
+    dataset_dicts = []
+    for record in tqdm.tqdm(DatasetCatalog.get(args.dataset)):
+        record = copy.deepcopy(record)
+        record["file_name"] = writer.add_file(record["file_name"])
+        if "sem_seg_file_name" in record:
+            record["sem_seg_file_name"] = writer.add_mask(binarize_mask(utils.read_image(record["sem_seg_file_name"])))
+        dataset_dicts.append(record)
+    writer.close(dataset_dicts)
+
+    index = np.load(os.path.join(args.output, "index.npy"))
+    logger.info(
+        "Packed {} images of {} into {} shards of {:.1f} MB in total: {}".format(
+            len(dataset_dicts), args.dataset, index["shard"].max() + 1, index["length"].sum() / 1024 ** 2, args.output
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
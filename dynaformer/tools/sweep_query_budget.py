@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep the inference query budget (MODEL.DYNAFormer.TEST.NUM_QUERIES) and report mask AP and
+latency on the first test dataset:
+python tools/sweep_query_budget.py --config-file CONFIG_FILE --budgets 100 50 20 10 \
+    --adaptive-thresholds 0.2 0.3 MODEL.WEIGHTS /path/to/model.pth
+"""
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def measure_latency(model, data_loader, num_images, num_warmup=5):
+    """
+    Returns:
+        float: average model latency in ms per image
+    """
+    total = 0.0
+    num_measured = 0
+    with torch.no_grad():
+        for idx, inputs in enumerate(itertools.islice(data_loader, num_warmup + num_images)):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            model(inputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if idx >= num_warmup:
+                total += time.perf_counter() - start
+                num_measured += len(inputs)
+    return total / max(num_measured, 1) * 1000
+
+
+def run(cfg, args, budget, threshold):
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.DYNAFormer.TEST.NUM_QUERIES = budget
+    if threshold is None:
+        cfg.MODEL.DYNAFormer.TEST.QUERY_SELECTION = "fixed"
+    else:
+        cfg.MODEL.DYNAFormer.TEST.QUERY_SELECTION = "adaptive"
+        cfg.MODEL.DYNAFormer.TEST.QUERY_SCORE_THRESHOLD = threshold
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    data_loader = build_detection_test_loader(cfg, dataset_name)
+    latency = measure_latency(model, data_loader, args.num_latency_images)
+    results = inference_on_dataset(model, data_loader, COCOEvaluator(dataset_name))
+    return latency, results.get("segm", {}).get("AP", float("nan"))
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--budgets", type=int, nargs="+", default=[100, 50, 20, 10])
+    parser.add_argument(
+        "--adaptive-thresholds",
+        type=float,
+        nargs="*",
+        default=[],
+        help="also run the adaptive selection with these score thresholds, using each budget as maximum",
+    )
+    parser.add_argument("--num-latency-images", type=int, default=50)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    rows = []
+    for budget in args.budgets:
+        for threshold in [None] + list(args.adaptive_thresholds):
+            latency, ap = run(cfg, args, budget, threshold)
+            mode = "fixed" if threshold is None else "adaptive@{}".format(threshold)
+            rows.append([budget, mode, latency, ap])
+            logger.info("budget={} mode={}: {:.2f} ms/image, mask AP {:.2f}".format(budget, mode, latency, ap))
+    logger.info(
+        "Query budget sweep:\n"
+        + tabulate(rows, headers=["budget", "selection", "ms/image", "mask AP"], floatfmt=".2f", tablefmt="pipe")
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep the token keep ratios of the sparse encoder (MODEL.SEM_SEG_HEAD.TOKEN_KEEP_RATIOS) and report
+the encoder FLOPs, the encoder and model latency and the mask AP on the first test dataset:
+python tools/sweep_token_keep_ratio.py --config-file CONFIG_FILE --ratios 1.0 0.5 0.3 0.1 \
+    MODEL.WEIGHTS /path/to/model.pth
+A ratio can also be a comma separated list with one value per encoder layer, e.g. 1.0,0.5,0.5,0.3,0.3,0.3.
+"""
+import functools
+import itertools
+import logging
+import time
+
+import torch
+from tabulate import tabulate
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+# fmt: off
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+from dynaformer import add_dynaformer_config
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_dynaformer_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger()
+    return cfg
+
+
+def run(cfg, args, ratios):
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.SEM_SEG_HEAD.TOKEN_KEEP_RATIOS = ratios
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    # time the deformable encoder and record its number of tokens
+    transformer = model.sem_seg_head.pixel_decoder.transformer
+    stats = {"time": 0.0, "calls": 0, "flops": 0}
+
+    @functools.wraps(transformer.forward)
+    def timed_forward(srcs, masks, pos_embeds):
+        start = time.perf_counter()
+        ret = forward(srcs, masks, pos_embeds)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        stats["time"] += time.perf_counter() - start
+        stats["calls"] += 1
+        stats["flops"] += transformer.encoder.flops(sum(src.shape[-2] * src.shape[-1] for src in srcs))
+        return ret
+
+    forward = transformer.forward
+    transformer.forward = timed_forward
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    data_loader = build_detection_test_loader(cfg, dataset_name)
+    total = 0.0
+    num_measured = 0
+    with torch.no_grad():
+        for idx, inputs in enumerate(itertools.islice(data_loader, args.num_warmup + args.num_latency_images)):
+            if idx == args.num_warmup:
+                stats.update(time=0.0, calls=0, flops=0)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            model(inputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if idx >= args.num_warmup:
+                total += time.perf_counter() - start
+                num_measured += len(inputs)
+    num_calls = max(stats["calls"], 1)
+    encoder_gflops = stats["flops"] / num_calls / 1e9
+    encoder_ms = stats["time"] / num_calls * 1000
+    model_ms = total / max(num_measured, 1) * 1000
+
+    results = inference_on_dataset(model, data_loader, COCOEvaluator(dataset_name))
+    return encoder_gflops, encoder_ms, model_ms, results.get("segm", {}).get("AP", float("nan"))
+
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument(
+        "--ratios",
+        nargs="+",
+        default=["1.0", "0.5", "0.3", "0.1"],
+        help="token keep ratios, a single value for all layers or a comma separated value per layer",
+    )
+    parser.add_argument("--num-latency-images", type=int, default=50)
+    parser.add_argument("--num-warmup", type=int, default=5)
+    args = parser.parse_args()
+    cfg = setup(args)
+
+    rows = []
+    for ratio in args.ratios:
+        ratios = [float(r) for r in ratio.split(",")]
+        gflops, encoder_ms, model_ms, ap = run(cfg, args, ratios)
+        rows.append([ratio, gflops, encoder_ms, model_ms, ap])
+        logger.info(
+            "ratios={}: encoder {:.2f} GFLOPs {:.2f} ms, model {:.2f} ms/image, mask AP {:.2f}".format(
+                ratio, gflops, encoder_ms, model_ms, ap
+            )
+        )
+    logger.info(
+        "Token keep ratio sweep:\n"
+        + tabulate(
+            rows,
+            headers=["keep ratios", "encoder GFLOPs", "encoder ms", "model ms/image", "mask AP"],
+            floatfmt=".2f",
+            tablefmt="pipe",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
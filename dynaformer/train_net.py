@@ -31,7 +31,8 @@ import torch
 import detectron2.utils.comm as comm
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
-from detectron2.data import MetadataCatalog, build_detection_train_loader
+from detectron2.data import DatasetMapper, MetadataCatalog, build_detection_train_loader
+from detectron2.modeling import build_model
 
 from detectron2.evaluation import (
     CityscapesInstanceEvaluator,
@@ -59,6 +60,12 @@ from dynaformer import (
     add_dynaformer_config,
     DetrDatasetMapper,
 )
+from dynaformer.data.batch_augmentation import BatchAugmentation
+from dynaformer.data.loader_stats import InstrumentedDataLoader, InstrumentedMapper, LoaderStats
+from dynaformer.data.prefetch import PrefetchDataLoader
+from dynaformer.data.shared_dataset import build_shared_train_dataset
+from dynaformer.data.size_bucketing import build_size_bucketed_train_loader
+from dynaformer.modeling.distiller import teacher_targets
 import random
 from detectron2.engine import (
     DefaultTrainer,
@@ -74,6 +81,25 @@ import weakref
 
 from detectron2.engine.hooks import EvalHook
 
+def build_batched_train_loader(cfg, mapper, loader_stats=None):
+    """
+    The training data loader of a mapper, batched by size with DATALOADER.SIZE_BUCKETING, by aspect
+    ratio otherwise. The dataset dicts are shared by the ranks of a machine with DATALOADER.SHARED_DATASET.
+    The mapped samples are recorded in `loader_stats` if given.
+    """
+    if loader_stats is not None:
+        mapper = InstrumentedMapper(mapper if mapper is not None else DatasetMapper(cfg, True), loader_stats)
+    dataset = build_shared_train_dataset(cfg) if cfg.DATALOADER.SHARED_DATASET.ENABLED else None
+    if cfg.DATALOADER.SIZE_BUCKETING.ENABLED:
+        # the buckets are the sizes of the mapped images, which the batch augmentation stage has not resized yet
+        assert not cfg.INPUT.BATCH_AUGMENTATION, (
+            "DATALOADER.SIZE_BUCKETING batches the images by their augmented size, "
+            "it cannot be used with INPUT.BATCH_AUGMENTATION"
+        )
+        return build_size_bucketed_train_loader(cfg, mapper, dataset=dataset)
+    return build_detection_train_loader(cfg, mapper=mapper, dataset=dataset)
+
+
 #Custom hooks with for evaluating afer certain iters - cfg.TEST.EVAL_START_ITER
 class EvalHook_Custom(EvalHook):
     def __init__(self, eval_period, eval_function, eval_after_train=True,eval_start_iter=None):
@@ -231,29 +257,48 @@ class Trainer(DefaultTrainer):
 
     @classmethod
     def build_train_loader(cls, cfg):
+        # created before the data loader workers start, so that they inherit the shared memory
+        loader_stats = LoaderStats(cfg.DATALOADER.NUM_WORKERS) if cfg.DATALOADER.INSTRUMENT.ENABLED else None
+        data_loader = cls.build_mapped_train_loader(cfg, loader_stats)
+        if cfg.DATALOADER.PREFETCH:
+            data_loader = PrefetchDataLoader(data_loader, cfg.MODEL.DEVICE)
+        if loader_stats is not None:
+            data_loader = InstrumentedDataLoader(data_loader, loader_stats, cfg.DATALOADER.INSTRUMENT.PERIOD)
+        return data_loader
+
+    @classmethod
+    def build_mapped_train_loader(cls, cfg, loader_stats=None):
         # coco instance segmentation lsj new baseline - Polyp instance segmentation
         if cfg.INPUT.DATASET_MAPPER_NAME == "coco_instance_lsj":
-            mapper = COCOInstanceNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
+            mapper = COCOInstanceNewBaselineDatasetMapper(cfg, True, loader_stats=loader_stats)
+            if cfg.INPUT.BATCH_AUGMENTATION:
+                return BatchAugmentationDataLoader(
+                    build_batched_train_loader(cfg, mapper, loader_stats), BatchAugmentation(mapper, cfg.MODEL.DEVICE)
+                )
+            return build_batched_train_loader(cfg, mapper, loader_stats)
         # coco instance segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_instance_detr":
             mapper = DetrDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
+            return build_batched_train_loader(cfg, mapper, loader_stats)
         # coco panoptic segmentation lsj new baseline
         elif cfg.INPUT.DATASET_MAPPER_NAME == "coco_panoptic_lsj":
             mapper = COCOPanopticNewBaselineDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
+            return build_batched_train_loader(cfg, mapper, loader_stats)
         # Semantic segmentation dataset mapper
         elif cfg.INPUT.DATASET_MAPPER_NAME == "mask_former_semantic":
             mapper = MaskFormerSemanticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
+            return build_batched_train_loader(cfg, mapper, loader_stats)
         # Polyp semantic segmentation dataset mapper
         elif cfg.INPUT.DATASET_MAPPER_NAME == "polyp_ins_semantic":
-            mapper = PolypInsSemanticDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
+            mapper = PolypInsSemanticDatasetMapper(cfg, True, loader_stats=loader_stats)
+            if cfg.INPUT.BATCH_AUGMENTATION:
+                return BatchAugmentationDataLoader(
+                    build_batched_train_loader(cfg, mapper, loader_stats), BatchAugmentation(mapper, cfg.MODEL.DEVICE)
+                )
+            return build_batched_train_loader(cfg, mapper, loader_stats)
         else:
             mapper = None
-            return build_detection_train_loader(cfg, mapper=mapper)
+            return build_batched_train_loader(cfg, mapper, loader_stats)
 
     @classmethod
     def build_lr_scheduler(cls, cfg, optimizer):
@@ -410,6 +455,90 @@ class Trainer(DefaultTrainer):
         return ret
 
 
+class BatchAugmentationDataLoader:
+    """
+    Applies the augmentations of a decode-only dataset mapper to the batches of a training data loader,
+    in the main process, see INPUT.BATCH_AUGMENTATION.
+    """
+
+    def __init__(self, data_loader, augmentation):
+        self.data_loader = data_loader
+        self.augmentation = augmentation
+
+    def __iter__(self):
+        for batched_inputs in self.data_loader:
+            yield self.augmentation(batched_inputs)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+
+class DistillationDataLoader:
+    """
+    Adds the distillation targets of a frozen teacher ("distill_targets") to the inputs of a training
+    data loader. The teacher runs in eval mode under no_grad.
+    """
+
+    def __init__(self, data_loader, teacher, num_queries, memory=False, amp=False):
+        self.data_loader = data_loader
+        self.teacher = teacher
+        self.num_queries = num_queries
+        self.memory = memory
+        self.amp = amp
+
+    def __iter__(self):
+        for batched_inputs in self.data_loader:
+            self.add_targets(batched_inputs)
+            yield batched_inputs
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    @torch.no_grad()
+    def add_targets(self, batched_inputs):
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            outputs, images = self.teacher.raw_outputs(batched_inputs, return_features=self.memory)
+        for x, t in zip(batched_inputs, teacher_targets(outputs, images, self.num_queries, self.memory)):
+            x["distill_targets"] = t
+
+
+class DistillTrainer(Trainer):
+    """
+    Trains a (lighter) student config against a frozen teacher checkpoint, see MODEL.DYNAFormer.DISTILL.
+    The student is trained with its usual losses and the distillation losses of :class:`KnowledgeDistiller`.
+    """
+
+    def __init__(self, cfg):
+        # the teacher is not a submodule of the student: it is neither optimized nor checkpointed
+        self.teacher = self.build_teacher(cfg)
+        super().__init__(cfg)
+
+    @classmethod
+    def build_teacher(cls, cfg):
+        teacher_cfg = get_cfg()
+        add_deeplab_config(teacher_cfg)
+        add_dynaformer_config(teacher_cfg)
+        teacher_cfg.merge_from_file(cfg.MODEL.DYNAFormer.DISTILL.TEACHER_CONFIG)
+        teacher_cfg.MODEL.DEVICE = cfg.MODEL.DEVICE
+        teacher_cfg.DATASETS.TRAIN = cfg.DATASETS.TRAIN
+        teacher_cfg.freeze()
+        teacher = build_model(teacher_cfg)
+        DetectionCheckpointer(teacher).load(cfg.MODEL.DYNAFormer.DISTILL.TEACHER_WEIGHTS)
+        teacher.eval()
+        teacher.requires_grad_(False)
+        return teacher
+
+    def build_train_loader(self, cfg):
+        distill_cfg = cfg.MODEL.DYNAFormer.DISTILL
+        return DistillationDataLoader(
+            super().build_train_loader(cfg),
+            self.teacher,
+            distill_cfg.NUM_QUERIES,
+            memory=distill_cfg.MEMORY_WEIGHT > 0,
+            amp=cfg.SOLVER.AMP.ENABLED,
+        )
+
+
 def setup(args):
     """
     Create configs and perform basic setups.
@@ -445,7 +574,7 @@ def main(args):
             verify_results(cfg, res)
         return res
 
-    trainer = Trainer(cfg)
+    trainer = (DistillTrainer if cfg.MODEL.DYNAFormer.DISTILL.ENABLED else Trainer)(cfg)
     trainer.resume_or_load(resume=args.resume)
     return trainer.train()
 